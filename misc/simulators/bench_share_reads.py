@@ -0,0 +1,76 @@
+"""
+Compare the cost of serving immutable share data through a storage server's
+BucketReader with and without memory-mapped reads. Run it like this:
+
+python bench_share_reads.py [SHARESIZE_MB [READSIZE_KB]]
+
+For each mode it reports the throughput (MB/s of share data served) and the
+CPU time spent per MB. The share file is read once before timing, so both
+modes are measured against a warm page cache, which is the case that matters
+for hot downloads.
+"""
+
+import os, sys, time, tempfile, shutil
+
+from allmydata.storage.server import StorageServer
+from allmydata.util import hashutil
+
+class FakeCanary:
+    def notifyOnDisconnect(self, *args, **kwargs):
+        return None
+    def dontNotifyOnDisconnect(self, marker):
+        pass
+
+MB = 1024*1024
+
+def make_share(ss, sharesize):
+    rs = hashutil.tagged_hash("renew", "bench")
+    cs = hashutil.tagged_hash("cancel", "bench")
+    si = "si" + "\x00"*14
+    already, writers = ss.remote_allocate_buckets(si, rs, cs, [0], sharesize,
+                                                  FakeCanary())
+    bw = writers[0]
+    chunk = os.urandom(MB)
+    for offset in range(0, sharesize, MB):
+        bw.remote_write(offset, chunk[:sharesize-offset])
+    bw.remote_close()
+    return si
+
+def bench(basedir, use_mmap, sharesize, readsize, passes):
+    ss = StorageServer(basedir, "\x00"*20, share_mmap_reads=use_mmap)
+    si = make_share(ss, sharesize)
+    reader = ss.remote_get_buckets(si)[0]
+    for offset in range(0, sharesize, readsize): # warm up
+        reader.remote_read(offset, readsize)
+
+    start_times = os.times()
+    start = time.time()
+    for i in range(passes):
+        for offset in range(0, sharesize, readsize):
+            reader.remote_read(offset, readsize)
+    elapsed = time.time() - start
+    stop_times = os.times()
+    cpu = (stop_times[0]-start_times[0]) + (stop_times[1]-start_times[1])
+    served = 1.0 * sharesize * passes / MB
+    ss.fdcache.clear()
+    return served / elapsed, cpu / served
+
+def main():
+    sharesize = int(sys.argv[1]) * MB if len(sys.argv) > 1 else 64*MB
+    readsize = int(sys.argv[2]) * 1024 if len(sys.argv) > 2 else 128*1024
+    passes = 20
+    print "share size %dMB, read size %dkB, %d passes" % (sharesize/MB,
+                                                          readsize/1024,
+                                                          passes)
+    for use_mmap in (False, True):
+        basedir = tempfile.mkdtemp()
+        try:
+            rate, cpu_per_mb = bench(basedir, use_mmap, sharesize, readsize,
+                                     passes)
+        finally:
+            shutil.rmtree(basedir)
+        print "%-10s %8.1f MB/s  %8.3f ms CPU/MB" % (
+            use_mmap and "mmap" or "read", rate, cpu_per_mb * 1000)
+
+if __name__ == '__main__':
+    main()
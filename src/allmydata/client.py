@@ -13,6 +13,7 @@ import allmydata
 from allmydata.storage.server import StorageServer
 from allmydata import storage_client
 from allmydata.immutable.upload import Uploader
+from allmydata.immutable.keycache import ConvergenceKeyCache
 from allmydata.immutable.offloaded import Helper
 from allmydata.control import ControlServer
 from allmydata.introducer.client import IntroducerClient
@@ -281,6 +282,35 @@ class Client(node.Node, pollmixin.PollMixin):
             sharetypes.append("mutable")
         expiration_sharetypes = tuple(sharetypes)
 
+        use_leasedb = self.get_config("storage", "leasedb.enabled", False,
+                                      boolean=True)
+        expire_indexed = self.get_config("storage", "expire.indexed", False,
+                                         boolean=True)
+        inventory_size = int(self.get_config("storage",
+                                             "share_inventory_size", 10000))
+        fd_cache_size = int(self.get_config("storage",
+                                            "share_fd_cache_size", 128))
+        mmap_reads = self.get_config("storage", "share_mmap_reads", False,
+                                     boolean=True)
+        fsync_policy = self.get_config("storage", "fsync", "none")
+        backend = self.get_config("storage", "backend", "disk")
+        data = self.get_config("storage", "pack.max_share_size", "64KiB")
+        pack_max_share_size = parse_abbreviated_size(data)
+        crawler_threads = int(self.get_config("storage", "crawler_threads", 0))
+        share_digests = self.get_config("storage", "share_digests", False,
+                                        boolean=True)
+        scrub_enabled = self.get_config("storage", "scrub.enabled", False,
+                                        boolean=True)
+        data = self.get_config("storage", "scrub.rate", "10MB")
+        scrub_rate = parse_abbreviated_size(data)
+        io_threads = int(self.get_config("storage", "io_threads", 0))
+        client_ops = int(self.get_config("storage",
+                                         "client_ops_per_second", 0))
+        data = self.get_config("storage", "client_bytes_per_second", "0")
+        client_bytes = parse_abbreviated_size(data)
+        max_concurrent = int(self.get_config("storage",
+                                             "max_concurrent_requests", 0))
+
         ss = StorageServer(storedir, self.nodeid,
                            reserved_space=reserved,
                            discard_storage=discard,
@@ -290,7 +320,23 @@ class Client(node.Node, pollmixin.PollMixin):
                            expiration_mode=mode,
                            expiration_override_lease_duration=o_l_d,
                            expiration_cutoff_date=cutoff_date,
-                           expiration_sharetypes=expiration_sharetypes)
+                           expiration_sharetypes=expiration_sharetypes,
+                           use_leasedb=use_leasedb,
+                           expiration_indexed=expire_indexed,
+                           share_inventory_size=inventory_size,
+                           share_fd_cache_size=fd_cache_size,
+                           share_mmap_reads=mmap_reads,
+                           fsync_policy=fsync_policy,
+                           backend=backend,
+                           pack_max_share_size=pack_max_share_size,
+                           crawler_threads=crawler_threads,
+                           share_digests=share_digests,
+                           scrub_enabled=scrub_enabled,
+                           scrub_rate=scrub_rate,
+                           io_threads=io_threads,
+                           client_ops_per_second=client_ops,
+                           client_bytes_per_second=client_bytes,
+                           max_concurrent_requests=max_concurrent)
         self.add_service(ss)
 
         furl_file = os.path.join(self.basedir, "private", "storage.furl").encode(get_filesystem_encoding())
@@ -317,8 +363,22 @@ class Client(node.Node, pollmixin.PollMixin):
         self.history = History(self.stats_provider)
         self.terminator = Terminator()
         self.terminator.setServiceParent(self)
+        pipeline_depth = self.get_config("client", "upload.pipeline_depth",
+                                         None)
+        if pipeline_depth is not None:
+            pipeline_depth = int(pipeline_depth)
+        encoding_threads = int(self.get_config("client",
+                                               "upload.encoding_threads", 0))
+        key_cache = None
+        if self.get_config("client", "upload.key_cache", False, boolean=True):
+            key_cache = ConvergenceKeyCache(
+                os.path.join(self.basedir, "private",
+                             "convergence_keys.sqlite"))
         self.add_service(Uploader(helper_furl, self.stats_provider,
-                                  self.history))
+                                  self.history,
+                                  pipeline_depth=pipeline_depth,
+                                  encoding_threads=encoding_threads,
+                                  key_cache=key_cache))
         self.init_blacklist()
         self.init_nodemaker()
 
@@ -349,9 +409,12 @@ class Client(node.Node, pollmixin.PollMixin):
         # (and everybody else who wants to use storage servers)
         ps = self.get_config("client", "peers.preferred", "").split(",")
         preferred_peers = tuple([p.strip() for p in ps if p != ""])
+        probe_interval = float(self.get_config("client",
+                                               "server.probe_interval", 0))
         sb = storage_client.StorageFarmBroker(permute_peers=True,
                                               preferred_peers=preferred_peers,
-                                              tub_options=self.tub_options)
+                                              tub_options=self.tub_options,
+                                              probe_interval=probe_interval)
         self.storage_broker = sb
         sb.setServiceParent(self)
 
@@ -34,6 +34,12 @@ class CRSEncoder(object):
         return self.share_size
 
     def encode(self, inshares, desired_share_ids=None):
+        return defer.succeed(self.encode_now(inshares, desired_share_ids))
+
+    def encode_now(self, inshares, desired_share_ids=None):
+        """Like encode(), but return (shares, desired_share_ids) directly
+        rather than through a Deferred, so that it can be called from a
+        worker thread."""
         precondition(desired_share_ids is None or len(desired_share_ids) <= self.max_shares, desired_share_ids, self.max_shares)
 
         if desired_share_ids is None:
@@ -43,7 +49,7 @@ class CRSEncoder(object):
             assert len(inshare) == self.share_size, (len(inshare), self.share_size, self.data_size, self.required_shares)
         shares = self.encoder.encode(inshares, desired_share_ids)
 
-        return defer.succeed((shares, desired_share_ids))
+        return (shares, desired_share_ids)
 
 class CRSDecoder(object):
     implements(ICodecDecoder)
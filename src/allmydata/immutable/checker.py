@@ -496,16 +496,28 @@ class Checker(log.PrefixingLogMixin):
         that we want to track and report whether or not each server
         responded.)"""
 
-        rref = s.get_rref()
-        lease_seed = s.get_lease_seed()
+        self._maybe_add_lease(s, storageindex)
+        d = s.get_rref().callRemote("get_buckets", storageindex)
+        return self._wrap_query_results(d, "get_buckets", {})
+
+    def _get_sharenums(self, s, storageindex):
+        """Like _get_buckets, but fires with (set(sharenum), success). The
+        server may answer this together with the queries of other checkers
+        that are running at the same time."""
+        self._maybe_add_lease(s, storageindex)
+        d = s.get_sharenums(storageindex)
+        return self._wrap_query_results(d, "get_sharenums", set())
+
+    def _maybe_add_lease(self, s, storageindex):
         if self._add_lease:
+            lease_seed = s.get_lease_seed()
             renew_secret = self._get_renewal_secret(lease_seed)
             cancel_secret = self._get_cancel_secret(lease_seed)
-            d2 = rref.callRemote("add_lease", storageindex,
-                                 renew_secret, cancel_secret)
+            d2 = s.get_rref().callRemote("add_lease", storageindex,
+                                         renew_secret, cancel_secret)
             d2.addErrback(self._add_lease_failed, s.get_name(), storageindex)
 
-        d = rref.callRemote("get_buckets", storageindex)
+    def _wrap_query_results(self, d, methname, empty):
         def _wrap_results(res):
             return (res, True)
 
@@ -513,10 +525,11 @@ class Checker(log.PrefixingLogMixin):
             level = log.WEIRD
             if f.check(DeadReferenceError):
                 level = log.UNUSUAL
-            self.log("failure from server on 'get_buckets' the REMOTE failure was:",
+            self.log("failure from server on '%s' the REMOTE failure was:"
+                     % methname,
                      facility="tahoe.immutable.checker",
                      failure=f, level=level, umid="AX7wZQ")
-            return ({}, False)
+            return (empty, False)
 
         d.addCallbacks(_wrap_results, _trap_errs)
         return d
@@ -731,9 +744,9 @@ class Checker(log.PrefixingLogMixin):
         our purposes, as a server that says it has none, except that we want
         to track and report whether or not each server responded.)"""
         def _curry_empty_corrupted(res):
-            buckets, responded = res
-            return (set(buckets), s, set(), set(), responded)
-        d = self._get_buckets(s, self._verifycap.get_storage_index())
+            sharenums, responded = res
+            return (sharenums, s, set(), set(), responded)
+        d = self._get_sharenums(s, self._verifycap.get_storage_index())
         d.addCallback(_curry_empty_corrupted)
         return d
 
@@ -67,7 +67,7 @@ class SegmentFetcher:
         # segment fetch is started and we already know about shares from the
         # previous segment
         self._shares.extend(shares)
-        self._shares.sort(key=lambda s: (s._dyhb_rtt, s._shnum) )
+        self._shares.sort(key=lambda s: (s._score, s._dyhb_rtt, s._shnum) )
         eventually(self.loop)
 
     def no_more_shares(self):
@@ -62,8 +62,7 @@ class ShareFinder:
         # test_dirnode, which creates us with storage_broker=None
         if not self._started:
             si = self.verifycap.storage_index
-            servers = self._storage_broker.get_servers_for_psi(si)
-            self._servers = iter(servers)
+            self._servers = self._storage_broker.iter_servers_for_psi(si)
             self._started = True
 
     def log(self, *args, **kwargs):
@@ -166,6 +165,7 @@ class ShareFinder:
         time_received = now()
         d_ev.finished(shnums, time_received)
         dyhb_rtt = time_received - time_sent
+        server.get_performance().record_rtt(dyhb_rtt)
         if not buckets:
             self.log(format="no shares from [%(name)s]", name=server.get_name(),
                      level=log.NOISY, parent=lp, umid="U7d4JA")
@@ -174,13 +174,19 @@ class ShareFinder:
         self.log(format="got shnums [%(shnums)s] from [%(name)s]",
                  shnums=shnums_s, name=server.get_name(),
                  level=log.NOISY, parent=lp, umid="0fcEZw")
+        # prefer servers that have been fast for blocks of about this size,
+        # not just the one that happened to answer this query first
+        blocksize = self.node.guessed_segment_size // self.verifycap.needed_shares
+        score = self._storage_broker.get_server_score(server, blocksize)
+        if score is None:
+            score = dyhb_rtt
         shares = []
         for shnum, bucket in buckets.iteritems():
-            s = self._create_share(shnum, bucket, server, dyhb_rtt)
+            s = self._create_share(shnum, bucket, server, dyhb_rtt, score)
             shares.append(s)
         self._deliver_shares(shares)
 
-    def _create_share(self, shnum, bucket, server, dyhb_rtt):
+    def _create_share(self, shnum, bucket, server, dyhb_rtt, score):
         if shnum in self._commonshares:
             cs = self._commonshares[shnum]
         else:
@@ -204,7 +210,7 @@ class ShareFinder:
             #     Yuck.
             self._commonshares[shnum] = cs
         s = Share(bucket, server, self.verifycap, cs, self.node,
-                  self._download_status, shnum, dyhb_rtt,
+                  self._download_status, shnum, dyhb_rtt, score,
                   self._node_logparent)
         return s
 
@@ -33,7 +33,7 @@ class Share:
     # servers. A different backend would use a different class.
 
     def __init__(self, rref, server, verifycap, commonshare, node,
-                 download_status, shnum, dyhb_rtt, logparent):
+                 download_status, shnum, dyhb_rtt, score, logparent):
         self._rref = rref
         self._server = server
         self._node = node # holds share_hash_tree and UEB
@@ -50,6 +50,8 @@ class Share:
         self._si_prefix = base32.b2a(verifycap.storage_index)[:8]
         self._shnum = shnum
         self._dyhb_rtt = dyhb_rtt
+        # how long we expect a block request to take (lower is better)
+        self._score = score
         # self._alive becomes False upon fatal corruption or server error
         self._alive = True
         self._loop_scheduled = False
@@ -84,6 +86,8 @@ class Share:
         v = server.get_version()
         ver = v["http://allmydata.org/tahoe/protocols/storage/v1"]
         self._overrun_ok = ver["tolerates-immutable-read-overrun"]
+        # newer servers let us fetch all the spans we want in one message
+        self._readv_ok = ver.get("accepts-immutable-readv", False)
         # If _overrun_ok and we guess the offsets correctly, we can get
         # everything in one RTT. If _overrun_ok and we guess wrong, we might
         # need two RTT (but we could get lucky and do it in one). If overrun
@@ -730,7 +734,9 @@ class Share:
         # and released in a single turn. I removed this for simplicity.
         # Reconsider the removal: maybe bring it back.
         ds = self._download_status
+        sent = now()
 
+        requests = []
         for (start, length) in ask:
             # TODO: quantize to reasonably-large blocks
             self._pending.add(start, length)
@@ -741,18 +747,54 @@ class Share:
                          level=log.NOISY, parent=self._lp, umid="sgVAyA")
             block_ev = ds.add_block_request(self._server, self._shnum,
                                             start, length, now())
+            requests.append((start, length, block_ev, lp))
+
+        if self._readv_ok and len(requests) > 1:
+            d = self._send_requestv([r[:2] for r in requests])
+            d.addCallback(self._record_transfer,
+                          sum([r[1] for r in requests]), sent)
+            d.addCallback(self._got_datav, requests)
+            d.addErrback(self._got_errorv, requests)
+            self._finish_request(d)
+            return
+
+        for (start, length, block_ev, lp) in requests:
             d = self._send_request(start, length)
+            d.addCallback(self._record_transfer, length, sent)
             d.addCallback(self._got_data, start, length, block_ev, lp)
             d.addErrback(self._got_error, start, length, block_ev, lp)
-            d.addCallback(self._trigger_loop)
-            d.addErrback(lambda f:
-                         log.err(format="unhandled error during send_request",
-                                 failure=f, parent=self._lp,
-                                 level=log.WEIRD, umid="qZu0wg"))
+            self._finish_request(d)
+
+    def _finish_request(self, d):
+        d.addCallback(self._trigger_loop)
+        d.addErrback(lambda f:
+                     log.err(format="unhandled error during send_request",
+                             failure=f, parent=self._lp,
+                             level=log.WEIRD, umid="qZu0wg"))
 
     def _send_request(self, start, length):
         return self._rref.callRemote("read", start, length)
 
+    def _record_transfer(self, res, length, sent):
+        self._server.get_performance().record_transfer(length, now() - sent)
+        return res
+
+    def _send_requestv(self, readv):
+        return self._rref.callRemote("readv", readv)
+
+    def _got_datav(self, datav, requests):
+        if len(datav) != len(requests):
+            raise ValueError("server answered %d of our %d read vectors"
+                             % (len(datav), len(requests)))
+        for (data, (start, length, block_ev, lp)) in zip(datav, requests):
+            self._got_data(data, start, length, block_ev, lp)
+
+    def _got_errorv(self, f, requests):
+        for (start, length, block_ev, lp) in requests[1:]:
+            block_ev.error(now())
+        (start, length, block_ev, lp) = requests[0]
+        self._got_error(f, start, length, block_ev, lp)
+
     def _got_data(self, data, start, length, block_ev, lp):
         block_ev.finished(len(data), now())
         if not self._alive:
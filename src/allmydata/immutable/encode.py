@@ -9,6 +9,8 @@ from allmydata.storage.server import si_b2a
 from allmydata.hashtree import HashTree
 from allmydata.util import mathutil, hashutil, base32, log, happinessutil
 from allmydata.util.assertutil import _assert, precondition
+from allmydata.util.workerpool import call_worker
+from allmydata.storage.diskio import when_done
 from allmydata.codec import CRSEncoder
 from allmydata.interfaces import IEncoder, IStorageBucketWriter, \
      IEncryptedUploadable, IUploadStatus, UploadUnhappinessError
@@ -74,7 +76,8 @@ PiB=1024*TiB
 class Encoder(object):
     implements(IEncoder)
 
-    def __init__(self, log_parent=None, upload_status=None, progress=None):
+    def __init__(self, log_parent=None, upload_status=None, progress=None,
+                 worker_pool=None):
         object.__init__(self)
         self.uri_extension_data = {}
         self._codec = None
@@ -87,6 +90,11 @@ class Encoder(object):
                                    facility="tahoe.encoder", parent=log_parent)
         self._aborted = False
         self._progress = progress
+        # if we have a WorkerPool, each segment is hashed and erasure-coded
+        # in one of its threads, and the next segment is read (and, by
+        # EncryptAnUploadable, encrypted) while that happens
+        self._worker_pool = worker_pool
+        self._prefetched = None # Deferred for the next segment's data
 
     def __repr__(self):
         if hasattr(self, "_storage_index"):
@@ -300,16 +308,12 @@ class Encoder(object):
         return self._gather_responses(dl)
 
     def _encode_segment(self, segnum):
-        codec = self._codec
-        start = time.time()
-
         # the ICodecEncoder API wants to receive a total of self.segment_size
         # bytes on each encode() call, broken up into a number of
         # identically-sized pieces. Due to the way the codec algorithm works,
         # these pieces need to be the same size as the share which the codec
         # will generate. Therefore we must feed it with input_piece_size that
         # equals the output share size.
-        input_piece_size = codec.get_block_size()
 
         # as a result, the number of input pieces per encode() call will be
         # equal to the number of required shares with which the codec was
@@ -322,62 +326,57 @@ class Encoder(object):
         # we read data from the source one segment at a time, and then chop
         # it into 'input_piece_size' pieces before handing it to the codec
 
-        crypttext_segment_hasher = hashutil.crypttext_segment_hasher()
-
         # memory footprint: we only hold a tiny piece of the plaintext at any
         # given time. We build up a segment's worth of cryptttext, then hand
         # it to the encoder. Assuming 3-of-10 encoding (3.3x expansion) and
         # 1MiB max_segment_size, we get a peak memory footprint of 4.3*1MiB =
         # 4.3MiB. Lowering max_segment_size to, say, 100KiB would drop the
-        # footprint to 430KiB at the expense of more hash-tree overhead.
-
-        d = self._gather_data(self.required_shares, input_piece_size,
-                              crypttext_segment_hasher)
-        def _done_gathering(chunks):
-            for c in chunks:
-                assert len(c) == input_piece_size
-            self._crypttext_hashes.append(crypttext_segment_hasher.digest())
-            # during this call, we hit 5*segsize memory
-            return codec.encode(chunks)
-        d.addCallback(_done_gathering)
-        def _done(res):
-            elapsed = time.time() - start
-            self._times["cumulative_encoding"] += elapsed
-            return res
-        d.addCallback(_done)
-        return d
+        # footprint to 430KiB at the expense of more hash-tree overhead. With
+        # a worker pool, the next segment's crypttext is read while this one
+        # is encoded, which adds another 1MiB.
+        return self._encode(segnum, self._codec, allow_short=False)
 
     def _encode_tail_segment(self, segnum):
+        # a short trailing chunk will be padded by _hash_and_encode
+        return self._encode(segnum, self._tail_codec, allow_short=True)
 
+    def _encode(self, segnum, codec, allow_short):
         start = time.time()
-        codec = self._tail_codec
-        input_piece_size = codec.get_block_size()
-
-        crypttext_segment_hasher = hashutil.crypttext_segment_hasher()
-
-        d = self._gather_data(self.required_shares, input_piece_size,
-                              crypttext_segment_hasher, allow_short=True)
-        def _done_gathering(chunks):
-            for c in chunks:
-                # a short trailing chunk will have been padded by
-                # _gather_data
-                assert len(c) == input_piece_size
-            self._crypttext_hashes.append(crypttext_segment_hasher.digest())
-            return codec.encode(chunks)
-        d.addCallback(_done_gathering)
-        def _done(res):
+        if self._prefetched is not None:
+            d, self._prefetched = self._prefetched, None
+        else:
+            d = self._gather_data(self.required_shares, codec.get_block_size())
+        def _got(data):
+            if (self._worker_pool is not None
+                and segnum + 1 < self.num_segments):
+                self._prefetch(segnum + 1)
+            return when_done(call_worker(self._worker_pool,
+                                         self._hash_and_encode,
+                                         data, codec, allow_short),
+                             _done)
+        def _done((shares, shareids, crypttext_segment_hash, block_hashes)):
+            self._crypttext_hashes.append(crypttext_segment_hash)
             elapsed = time.time() - start
             self._times["cumulative_encoding"] += elapsed
-            return res
-        d.addCallback(_done)
+            return (shares, shareids, block_hashes)
+        d.addCallback(_got)
         return d
 
-    def _gather_data(self, num_chunks, input_chunk_size,
-                     crypttext_segment_hasher,
-                     allow_short=False):
+    def _prefetch(self, segnum):
+        if segnum == self.num_segments - 1:
+            codec = self._tail_codec
+        else:
+            codec = self._codec
+        self._prefetched = defer.maybeDeferred(self._gather_data,
+                                               self.required_shares,
+                                               codec.get_block_size())
+
+    def _gather_data(self, num_chunks, input_chunk_size):
         """Return a Deferred that will fire when the required number of
-        chunks have been read (and hashed and encrypted). The Deferred fires
-        with a list of chunks, each of size input_chunk_size."""
+        chunks have been read (and encrypted). The Deferred fires with the
+        list of crypttext strings that read_encrypted() returned, which
+        hold num_chunks*input_chunk_size bytes in all (or fewer, if this
+        is the last segment)."""
 
         # I originally built this to allow read_encrypted() to behave badly:
         # to let it return more or less data than you asked for. It would
@@ -405,22 +404,41 @@ class Encoder(object):
             assert isinstance(data, (list,tuple))
             if self._aborted:
                 raise UploadAborted()
-            data = "".join(data)
-            precondition(len(data) <= read_size, len(data), read_size)
-            if not allow_short:
-                precondition(len(data) == read_size, len(data), read_size)
-            crypttext_segment_hasher.update(data)
-            self._crypttext_hasher.update(data)
-            if allow_short and len(data) < read_size:
-                # padding
-                data += "\x00" * (read_size - len(data))
-            encrypted_pieces = [data[i:i+input_chunk_size]
-                                for i in range(0, len(data), input_chunk_size)]
-            return encrypted_pieces
+            return data
         d.addCallback(_got)
         return d
 
-    def _send_segment(self, (shares, shareids), segnum):
+    def _hash_and_encode(self, data, codec, allow_short):
+        """Hash the crypttext strings in 'data' and erasure-code them with
+        'codec'. Return (shares, shareids, crypttext segment hash, block
+        hashes).
+
+        This may run in a worker thread, so it must not log, and the only
+        thing it may change is the whole-file crypttext hasher. That is safe
+        because the segments are encoded one at a time, in order."""
+        input_chunk_size = codec.get_block_size()
+        read_size = self.required_shares * input_chunk_size
+        data = "".join(data)
+        precondition(len(data) <= read_size, len(data), read_size)
+        if not allow_short:
+            precondition(len(data) == read_size, len(data), read_size)
+        crypttext_segment_hasher = hashutil.crypttext_segment_hasher()
+        crypttext_segment_hasher.update(data)
+        self._crypttext_hasher.update(data)
+        if allow_short and len(data) < read_size:
+            # padding
+            data += "\x00" * (read_size - len(data))
+        encrypted_pieces = [data[i:i+input_chunk_size]
+                            for i in range(0, len(data), input_chunk_size)]
+        del data
+        # during this call, we hit 5*segsize memory
+        (shares, shareids) = codec.encode_now(encrypted_pieces)
+        del encrypted_pieces
+        block_hashes = [hashutil.block_hash(block) for block in shares]
+        return (shares, shareids, crypttext_segment_hasher.digest(),
+                block_hashes)
+
+    def _send_segment(self, (shares, shareids, block_hashes), segnum):
         # To generate the URI, we must generate the roothash, so we must
         # generate all shares, even if we aren't actually giving them to
         # anybody. This means that the set of shares we create will be equal
@@ -440,7 +458,7 @@ class Encoder(object):
             d = self.send_block(shareid, segnum, block, lognum)
             dl.append(d)
 
-            block_hash = hashutil.block_hash(block)
+            block_hash = block_hashes[i]
             #from allmydata.util import base32
             #log.msg("creating block (shareid=%d, blocknum=%d) "
             #        "len=%d %r .. %r: %s" %
@@ -671,6 +689,10 @@ class Encoder(object):
     def err(self, f):
         self.log("upload failed", failure=f, level=log.UNUSUAL)
         self.set_status("Failed")
+        if self._prefetched is not None:
+            # nobody will look at the next segment now
+            self._prefetched.addErrback(lambda ignored: None)
+            self._prefetched = None
         # we need to abort any remaining shareholders, so they'll delete the
         # partial share, allowing someone else to upload it again.
         self.log("aborting shareholders", level=log.UNUSUAL)
@@ -0,0 +1,86 @@
+import os
+
+from allmydata.util import base32, hashutil
+from allmydata.util.dbutil import get_db
+
+# The convergence key cache (private/convergence_keys.sqlite) remembers the
+# encryption key and storage index of each local file that has been
+# uploaded (with a convergent key) from a FileName, along with the file's
+# size, mtime, ctime, and inode at the time. When the same file is uploaded
+# again and none of those have changed, its key comes from here, rather
+# than from reading the whole file, so the uploader can go straight to
+# asking the servers whether they already hold its shares.
+#
+# The key depends on the encoding parameters and the convergence secret as
+# well as the file's contents, so those are part of what each entry is
+# looked up by. The secret itself is not stored: just a hash of it.
+
+SCHEMA_v1 = """
+CREATE TABLE version
+(
+ version INTEGER  -- contains one row, set to 1
+);
+
+CREATE TABLE keys
+(
+ path BLOB NOT NULL,           -- absolute local filename
+ params VARCHAR(80) NOT NULL,  -- see _get_params_string
+ size INTEGER NOT NULL,        -- os.stat(path).st_size
+ mtime NUMBER NOT NULL,        -- os.stat(path).st_mtime
+ ctime NUMBER NOT NULL,        -- os.stat(path).st_ctime
+ inode INTEGER NOT NULL,       -- os.stat(path).st_ino
+ encryption_key BLOB NOT NULL,
+ storage_index BLOB NOT NULL,
+ PRIMARY KEY (path, params)
+);
+"""
+
+CONVERGENCE_TAG = "allmydata_convergence_key_cache_v1"
+
+def get_file_identity(f):
+    """Return what the cache uses to tell whether the open file 'f' has
+    changed: a tuple of its size, mtime, ctime, and inode."""
+    s = os.fstat(f.fileno())
+    return (s.st_size, s.st_mtime, s.st_ctime, s.st_ino)
+
+def _get_params_string(k, n, segsize, convergence):
+    convergence_hash = hashutil.tagged_hash(CONVERGENCE_TAG, convergence)
+    return "%d-%d-%d-%s" % (k, n, segsize, base32.b2a(convergence_hash))
+
+
+class ConvergenceKeyCache:
+    VERSION = 1
+
+    def __init__(self, dbfile):
+        # this raises DBError if the database cannot be opened
+        (self.sqlite_module, self.connection) = \
+            get_db(dbfile, create_version=(SCHEMA_v1, self.VERSION),
+                   dbname="convergence key cache")
+        self.cursor = self.connection.cursor()
+
+    def get_key(self, path, identity, k, n, segsize, convergence):
+        """Return (encryption key, storage index) for the file at 'path',
+        if its identity (see get_file_identity) is still the same as when
+        it was recorded with the same encoding parameters and convergence
+        secret. Otherwise return None."""
+        self.cursor.execute("SELECT size, mtime, ctime, inode,"
+                            " encryption_key, storage_index FROM keys"
+                            " WHERE path=? AND params=?",
+                            (self.sqlite_module.Binary(path),
+                             _get_params_string(k, n, segsize, convergence)))
+        row = self.cursor.fetchone()
+        if row is None or tuple(row[:4]) != tuple(identity):
+            return None
+        return (str(row[4]), str(row[5]))
+
+    def set_key(self, path, identity, k, n, segsize, convergence,
+                key, storage_index):
+        (size, mtime, ctime, inode) = identity
+        self.cursor.execute("INSERT OR REPLACE INTO keys"
+                            " VALUES (?,?,?,?,?,?,?,?)",
+                            (self.sqlite_module.Binary(path),
+                             _get_params_string(k, n, segsize, convergence),
+                             size, mtime, ctime, inode,
+                             self.sqlite_module.Binary(key),
+                             self.sqlite_module.Binary(storage_index)))
+        self.connection.commit()
@@ -1,11 +1,12 @@
-import struct
+import struct, time
 from zope.interface import implements
 from twisted.internet import defer
+from foolscap.api import eventually
 from allmydata.interfaces import IStorageBucketWriter, IStorageBucketReader, \
      FileTooLargeError, HASH_SIZE
 from allmydata.util import mathutil, observer, pipeline
 from allmydata.util.assertutil import precondition
-from allmydata.storage.server import si_b2a
+from allmydata.storage.common import si_b2a
 
 class LayoutInvalid(Exception):
     """ There is something wrong with these bytes so they can't be
@@ -233,8 +234,18 @@ class WriteBucketProxy:
         # reduce the number of round trips, so it might not be worth the
         # effort.
 
-        return self._pipeline.add(len(data),
-                                  self._rref.callRemote, "write", offset, data)
+        return self._pipeline.add(len(data), self._send_write, offset, data)
+
+    def _send_write(self, offset, data):
+        sent = time.time()
+        d = self._rref.callRemote("write", offset, data)
+        if self._server is not None:
+            def _record_transfer(res):
+                self._server.get_performance().record_transfer(
+                    len(data), time.time() - sent)
+                return res
+            d.addCallback(_record_transfer)
+        return d
 
     def close(self):
         d = self._pipeline.add(0, self._rref.callRemote, "close")
@@ -300,6 +311,14 @@ class ReadBucketProxy:
         self._storage_index = storage_index
         self._started = False # sent request to server
         self._ready = observer.OneShotObserverList() # got response from server
+        # reads issued during the same turn are sent as a single readv() to
+        # servers that support it
+        self._readv_ok = False
+        if server is not None and server.get_rref() is not None:
+            v = server.get_version()
+            ver = v["http://allmydata.org/tahoe/protocols/storage/v1"]
+            self._readv_ok = ver.get("accepts-immutable-readv", False)
+        self._queued_reads = [] # (offset, length, Deferred)
 
     def get_peerid(self):
         return self._server.get_serverid()
@@ -500,4 +519,31 @@ class ReadBucketProxy:
         return d
 
     def _read(self, offset, length):
-        return self._rref.callRemote("read", offset, length)
+        if not self._readv_ok:
+            return self._rref.callRemote("read", offset, length)
+        d = defer.Deferred()
+        if not self._queued_reads:
+            eventually(self._send_queued_reads)
+        self._queued_reads.append((offset, length, d))
+        return d
+
+    def _send_queued_reads(self):
+        reads, self._queued_reads = self._queued_reads, []
+        if len(reads) == 1:
+            (offset, length, d) = reads[0]
+            d2 = self._rref.callRemote("read", offset, length)
+            d2.addCallbacks(d.callback, d.errback)
+            return
+        d2 = self._rref.callRemote("readv", [r[:2] for r in reads])
+        def _got(datav):
+            if len(datav) != len(reads):
+                raise LayoutInvalid("server answered %d of our %d read vectors"
+                                    % (len(datav), len(reads)))
+            for (data, (offset, length, d)) in zip(datav, reads):
+                d.callback(data)
+        def _failed(f):
+            for (offset, length, d) in reads:
+                if not d.called:
+                    d.errback(f)
+        d2.addCallback(_got)
+        d2.addErrback(_failed)
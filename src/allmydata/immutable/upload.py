@@ -18,11 +18,14 @@ from allmydata.util.happinessutil import servers_of_happiness, \
                                          failure_message
 from allmydata.util.assertutil import precondition, _assert
 from allmydata.util.rrefutil import add_version_to_remote_reference
+from allmydata.util.workerpool import WorkerPool, call_worker
+from allmydata.storage.diskio import when_done
 from allmydata.interfaces import IUploadable, IUploader, IUploadResults, \
      IEncryptedUploadable, RIEncryptedUploadable, IUploadStatus, \
      NoServersError, InsufficientVersionError, UploadUnhappinessError, \
      DEFAULT_MAX_SEGMENT_SIZE, IProgress
 from allmydata.immutable import layout
+from allmydata.immutable.keycache import get_file_identity
 from pycryptopp.cipher.aes import AES
 
 from cStringIO import StringIO
@@ -121,10 +124,18 @@ class ServerTracker:
     def __init__(self, server,
                  sharesize, blocksize, num_segments, num_share_hashes,
                  storage_index,
-                 bucket_renewal_secret, bucket_cancel_secret):
+                 bucket_renewal_secret, bucket_cancel_secret,
+                 pipeline_depth=None):
         self._server = server
         self.buckets = {} # k: shareid, v: IRemoteBucketWriter
         self.sharesize = sharesize
+        # each bucket writer may have this many segments' worth of blocks in
+        # flight before the encoder waits for it. By default, it gets a
+        # little more than one 128KiB segment's worth (for k=3).
+        if pipeline_depth:
+            self.pipeline_size = pipeline_depth * blocksize
+        else:
+            self.pipeline_size = 50000
 
         wbp = layout.make_write_bucket_proxy(None, None, sharesize,
                                              blocksize, num_segments,
@@ -153,6 +164,7 @@ class ServerTracker:
 
     def query(self, sharenums):
         rref = self._server.get_rref()
+        sent = time.time()
         d = rref.callRemote("allocate_buckets",
                             self.storage_index,
                             self.renew_secret,
@@ -160,12 +172,15 @@ class ServerTracker:
                             sharenums,
                             self.allocated_size,
                             canary=Referenceable())
+        def _record_rtt(res):
+            self._server.get_performance().record_rtt(time.time() - sent)
+            return res
+        d.addCallback(_record_rtt)
         d.addCallback(self._got_reply)
         return d
 
     def ask_about_existing_shares(self):
-        rref = self._server.get_rref()
-        return rref.callRemote("get_buckets", self.storage_index)
+        return self._server.get_sharenums(self.storage_index)
 
     def _got_reply(self, (alreadygot, buckets)):
         #log.msg("%s._got_reply(%s)" % (self, (alreadygot, buckets)))
@@ -175,7 +190,8 @@ class ServerTracker:
                                 self.blocksize,
                                 self.num_segments,
                                 self.num_share_hashes,
-                                EXTENSION_SIZE)
+                                EXTENSION_SIZE,
+                                self.pipeline_size)
             b[sharenum] = bp
         self.buckets.update(b)
         return (alreadygot, set(b.keys()))
@@ -221,7 +237,7 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
     def get_shareholders(self, storage_broker, secret_holder,
                          storage_index, share_size, block_size,
                          num_segments, total_shares, needed_shares,
-                         servers_of_happiness):
+                         servers_of_happiness, pipeline_depth=None):
         """
         @return: (upload_trackers, already_serverids), where upload_trackers
                  is a set of ServerTracker instances that have agreed to hold
@@ -237,6 +253,8 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
         self.total_shares = total_shares
         self.servers_of_happiness = servers_of_happiness
         self.needed_shares = needed_shares
+        self._storage_broker = storage_broker
+        self._share_size = share_size
 
         self.homeless_shares = set(range(total_shares))
         self.use_trackers = set() # ServerTrackers that have shares assigned
@@ -294,7 +312,7 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
                                    share_size, block_size,
                                    num_segments, num_share_hashes,
                                    storage_index,
-                                   renew, cancel)
+                                   renew, cancel, pipeline_depth)
                 trackers.append(st)
             return trackers
 
@@ -478,6 +496,7 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
                 self.log("starting second pass",
                         level=log.NOISY)
                 self._started_second_pass = True
+                self._sort_trackers(self.second_pass_trackers)
             num_shares = mathutil.div_ceil(len(self.homeless_shares),
                                            len(self.second_pass_trackers))
             tracker = self.second_pass_trackers.pop(0)
@@ -498,6 +517,7 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
             # servers back into self.second_pass_trackers for the next pass.
             self.second_pass_trackers.extend(self.next_pass_trackers)
             self.next_pass_trackers[:] = []
+            self._sort_trackers(self.second_pass_trackers)
             return self._loop()
         else:
             # no more servers. If we haven't placed enough shares, we fail.
@@ -523,6 +543,16 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
                 self.log(msg, level=log.OPERATIONAL)
                 return (self.use_trackers, self.preexisting_shares)
 
+    def _sort_trackers(self, trackers):
+        # The first pass places shares in permuted order, so that
+        # downloaders find them on the first servers they ask. Which of
+        # those servers are asked to hold the leftover shares does not
+        # matter to them, so we ask the fastest ones first.
+        servers = self._storage_broker.sort_servers_by_score(
+            [tracker.get_server() for tracker in trackers], self._share_size)
+        order = dict([(server, i) for (i, server) in enumerate(servers)])
+        trackers.sort(key=lambda tracker: order[tracker.get_server()])
+
     def _got_response(self, res, tracker, shares_to_ask, put_tracker_here):
         if isinstance(res, failure.Failure):
             # This is unusual, and probably indicates a bug or a network
@@ -619,11 +649,15 @@ class Tahoe2ServerSelector(log.PrefixingLogMixin):
 
 class EncryptAnUploadable:
     """This is a wrapper that takes an IUploadable and provides
-    IEncryptedUploadable."""
+    IEncryptedUploadable.
+
+    If 'worker_pool' (a WorkerPool) is given, the plaintext is hashed and
+    encrypted in its threads rather than in the reactor thread."""
     implements(IEncryptedUploadable)
     CHUNKSIZE = 50*1024
 
-    def __init__(self, original, log_parent=None, progress=None):
+    def __init__(self, original, log_parent=None, progress=None,
+                 worker_pool=None):
         precondition(original.default_params_set,
                      "set_default_encoding_parameters not called on %r before wrapping with EncryptAnUploadable" % (original,))
         self.original = IUploadable(original)
@@ -637,6 +671,7 @@ class EncryptAnUploadable:
         self._ciphertext_bytes_read = 0
         self._status = None
         self._progress = progress
+        self._worker_pool = worker_pool
 
     def set_upload_status(self, upload_status):
         self._status = IUploadStatus(upload_status)
@@ -723,17 +758,11 @@ class EncryptAnUploadable:
             self._plaintext_segment_hashed_bytes += this_segment
 
             if self._plaintext_segment_hashed_bytes == self._segment_size:
-                # we've filled this segment
+                # we've filled this segment. It is logged (by
+                # _processed_plaintext) once we are back in the reactor
+                # thread.
                 self._plaintext_segment_hashes.append(p.digest())
                 self._plaintext_segment_hasher = None
-                self.log("closed hash [%d]: %dB" %
-                         (len(self._plaintext_segment_hashes)-1,
-                          self._plaintext_segment_hashed_bytes),
-                         level=log.NOISY)
-                self.log(format="plaintext leaf hash [%(segnum)d] is %(hash)s",
-                         segnum=len(self._plaintext_segment_hashes)-1,
-                         hash=base32.b2a(p.digest()),
-                         level=log.NOISY)
 
             offset += this_segment
 
@@ -776,7 +805,10 @@ class EncryptAnUploadable:
         def _good(plaintext):
             # and encrypt it..
             # o/' over the fields we go, hashing all the way, sHA! sHA! sHA! o/'
-            ct = self._hash_and_encrypt_plaintext(plaintext, hash_only)
+            return when_done(self._hash_and_encrypt_plaintext(plaintext,
+                                                              hash_only),
+                             _encrypted)
+        def _encrypted(ct):
             ciphertext.extend(ct)
             self._read_encrypted(remaining, ciphertext, hash_only,
                                  fire_when_done)
@@ -787,16 +819,30 @@ class EncryptAnUploadable:
         return None
 
     def _hash_and_encrypt_plaintext(self, data, hash_only):
+        """Hash and encrypt the list of plaintext strings 'data', in a
+        worker thread if I have a WorkerPool. Return the list of ciphertext
+        strings (an empty one if hash_only=True), or a Deferred that fires
+        with it."""
         assert isinstance(data, (tuple, list)), type(data)
         data = list(data)
+        for chunk in data:
+            self.log(" read_encrypted handling %dB-sized chunk" % len(chunk),
+                     level=log.NOISY)
+        if hash_only:
+            self.log("  skipping encryption", level=log.NOISY)
+        first_closed = len(self._plaintext_segment_hashes)
+        return when_done(call_worker(self._worker_pool,
+                                     self._process_plaintext, data, hash_only),
+                         self._processed_plaintext, first_closed)
+
+    def _process_plaintext(self, data, hash_only):
+        # this may run in a worker thread, so it must not log
         cryptdata = []
         # we use data.pop(0) instead of 'for chunk in data' to save
         # memory: each chunk is destroyed as soon as we're done with it.
         bytes_processed = 0
         while data:
             chunk = data.pop(0)
-            self.log(" read_encrypted handling %dB-sized chunk" % len(chunk),
-                     level=log.NOISY)
             bytes_processed += len(chunk)
             self._plaintext_hasher.update(chunk)
             self._update_segment_hash(chunk)
@@ -806,13 +852,21 @@ class EncryptAnUploadable:
             # this ability, change this to simply update the counter
             # before each call to (hash_only==False) _encryptor.process()
             ciphertext = self._encryptor.process(chunk)
-            if hash_only:
-                self.log("  skipping encryption", level=log.NOISY)
-            else:
+            if not hash_only:
                 cryptdata.append(ciphertext)
             del ciphertext
             del chunk
         self._ciphertext_bytes_read += bytes_processed
+        return cryptdata
+
+    def _processed_plaintext(self, cryptdata, first_closed):
+        for segnum in range(first_closed, len(self._plaintext_segment_hashes)):
+            self.log("closed hash [%d]: %dB" % (segnum, self._segment_size),
+                     level=log.NOISY)
+            self.log(format="plaintext leaf hash [%(segnum)d] is %(hash)s",
+                     segnum=segnum,
+                     hash=base32.b2a(self._plaintext_segment_hashes[segnum]),
+                     level=log.NOISY)
         if self._status:
             progress = float(self._ciphertext_bytes_read) / self._file_size
             self._status.set_progress(1, progress)
@@ -897,10 +951,13 @@ class UploadStatus:
 class CHKUploader:
     server_selector_class = Tahoe2ServerSelector
 
-    def __init__(self, storage_broker, secret_holder, progress=None):
+    def __init__(self, storage_broker, secret_holder, progress=None,
+                 pipeline_depth=None, worker_pool=None):
         # server_selector needs storage_broker and secret_holder
         self._storage_broker = storage_broker
         self._secret_holder = secret_holder
+        self._pipeline_depth = pipeline_depth
+        self._worker_pool = worker_pool
         self._log_number = self.log("CHKUploader starting", parent=None)
         self._encoder = None
         self._storage_index = None
@@ -955,6 +1012,7 @@ class CHKUploader:
             self._log_number,
             self._upload_status,
             progress=self._progress,
+            worker_pool=self._worker_pool,
         )
         d = e.set_encrypted_uploadable(eu)
         d.addCallback(self.locate_all_shareholders, started)
@@ -985,7 +1043,8 @@ class CHKUploader:
         d = server_selector.get_shareholders(storage_broker, secret_holder,
                                              storage_index,
                                              share_size, block_size,
-                                             num_segments, n, k, desired)
+                                             num_segments, n, k, desired,
+                                             self._pipeline_depth)
         def _done(res):
             self._server_selection_elapsed = time.time() - server_selection_started
             return res
@@ -1394,16 +1453,51 @@ class BaseUploadable:
 
         d = self.get_size()
         def _got_size(file_size):
-            # for small files, shrink the segment size to avoid wasting space
-            segsize = min(max_segsize, file_size)
-            # this must be a multiple of 'required_shares'==k
-            segsize = mathutil.next_multiple(segsize, k)
+            segsize = get_segment_size(max_segsize, k, file_size)
             encoding_parameters = (k, happy, n, segsize)
             self._all_encoding_parameters = encoding_parameters
             return encoding_parameters
         d.addCallback(_got_size)
         return d
 
+def get_segment_size(max_segsize, k, file_size):
+    # for small files, shrink the segment size to avoid wasting space
+    segsize = min(max_segsize, file_size)
+    # this must be a multiple of 'required_shares'==k
+    return mathutil.next_multiple(segsize, k)
+
+class ConvergentKeyHasher:
+    """I compute the convergent encryption key of a file as its contents
+    arrive (for example, as the body of an HTTP request is received), so
+    that a FileHandle for it need not read all of it once just to compute
+    the key before it reads it again to upload it. Feed me the contents
+    with update(), then hand me to FileHandle.set_key_hasher().
+
+    'default_params' are the client's default encoding parameters (as
+    returned by get_encoding_parameters()): if the upload ends up using
+    different ones, the FileHandle will compute the key itself."""
+
+    def __init__(self, size, default_params, convergence):
+        k = default_params["k"]
+        n = default_params["n"]
+        segsize = get_segment_size(default_params["max_segment_size"], k,
+                                   size)
+        self._params = (k, n, segsize, convergence)
+        self._hasher = convergence_hasher(k, n, segsize, convergence)
+        self._bytes_hashed = 0
+
+    def update(self, data):
+        self._hasher.update(data)
+        self._bytes_hashed += len(data)
+
+    def get_key(self, size, k, n, segsize, convergence):
+        """Return the encryption key for a file of 'size' bytes uploaded
+        with these parameters, or None if that is not what I hashed."""
+        if (size != self._bytes_hashed
+            or (k, n, segsize, convergence) != self._params):
+            return None
+        return self._hasher.digest()
+
 class FileHandle(BaseUploadable):
     implements(IUploadable)
 
@@ -1419,6 +1513,13 @@ class FileHandle(BaseUploadable):
         self._key = None
         self.convergence = convergence
         self._size = None
+        self._key_hasher = None
+
+    def set_key_hasher(self, key_hasher):
+        """Use the key computed by a ConvergentKeyHasher that has been fed
+        my contents, if it was computed with the encoding parameters I end
+        up using, rather than reading my contents to compute it."""
+        self._key_hasher = key_hasher
 
     def _get_encryption_key_convergent(self):
         if self._key is not None:
@@ -1429,6 +1530,13 @@ class FileHandle(BaseUploadable):
         d.addCallback(lambda size: self.get_all_encoding_parameters())
         def _got(params):
             k, happy, n, segsize = params
+            if self._key_hasher is not None:
+                self._key = self._key_hasher.get_key(self._size, k, n,
+                                                     segsize, self.convergence)
+                if self._key is not None:
+                    if self._status:
+                        self._status.set_progress(0, 1.0)
+                    return self._key
             f = self._filehandle
             enckey_hasher = convergence_hasher(k, n, segsize, self.convergence)
             f.seek(0)
@@ -1492,6 +1600,43 @@ class FileName(FileHandle):
         """
         assert convergence is None or isinstance(convergence, str), (convergence, type(convergence))
         FileHandle.__init__(self, open(filename, "rb"), convergence=convergence)
+        self._filename = os.path.abspath(filename)
+        self._key_cache = None
+
+    def set_key_cache(self, key_cache):
+        """Look my convergent encryption key up in a ConvergenceKeyCache
+        before reading my contents to compute it, and record it there
+        after."""
+        self._key_cache = key_cache
+
+    def _get_encryption_key_convergent(self):
+        if self._key is not None or self._key_cache is None:
+            return FileHandle._get_encryption_key_convergent(self)
+        identity = get_file_identity(self._filehandle)
+        d = self.get_all_encoding_parameters()
+        def _got(params):
+            k, happy, n, segsize = params
+            found = self._key_cache.get_key(self._filename, identity,
+                                            k, n, segsize, self.convergence)
+            if found is not None:
+                self._key = found[0]
+                if self._status:
+                    self._status.set_progress(0, 1.0)
+                return self._key
+            d2 = FileHandle._get_encryption_key_convergent(self)
+            d2.addCallback(_computed, k, n, segsize)
+            return d2
+        def _computed(key, k, n, segsize):
+            # if the file changed while we were reading it, the key might
+            # not match either version of it
+            if get_file_identity(self._filehandle) == identity:
+                self._key_cache.set_key(self._filename, identity,
+                                        k, n, segsize, self.convergence,
+                                        key, storage_index_hash(key))
+            return key
+        d.addCallback(_got)
+        return d
+
     def close(self):
         FileHandle.close(self)
         self._filehandle.close()
@@ -1515,10 +1660,20 @@ class Uploader(service.MultiService, log.PrefixingLogMixin):
     name = "uploader"
     URI_LIT_SIZE_THRESHOLD = 55
 
-    def __init__(self, helper_furl=None, stats_provider=None, history=None, progress=None):
+    def __init__(self, helper_furl=None, stats_provider=None, history=None,
+                 progress=None, pipeline_depth=None, encoding_threads=0,
+                 key_cache=None):
         self._helper_furl = helper_furl
+        self._key_cache = key_cache # a ConvergenceKeyCache, for FileNames
         self.stats_provider = stats_provider
         self._history = history
+        self._pipeline_depth = pipeline_depth
+        # with encoding_threads, uploads are encrypted, hashed, and
+        # erasure-coded in worker threads (see util/workerpool.py)
+        self._worker_pool = None
+        if encoding_threads:
+            self._worker_pool = WorkerPool(encoding_threads,
+                                           "upload-encoding")
         self._helper = None
         self._all_uploads = weakref.WeakKeyDictionary() # for debugging
         self._progress = progress
@@ -1531,6 +1686,11 @@ class Uploader(service.MultiService, log.PrefixingLogMixin):
             self.parent.tub.connectTo(self._helper_furl,
                                       self._got_helper)
 
+    def stopService(self):
+        if self._worker_pool is not None:
+            self._worker_pool.stop()
+        return service.MultiService.stopService(self)
+
     def _got_helper(self, helper):
         self.log("got helper connection, getting versions")
         default = { "http://allmydata.org/tahoe/protocols/helper/v1" :
@@ -1564,6 +1724,8 @@ class Uploader(service.MultiService, log.PrefixingLogMixin):
         assert progress is None or IProgress.providedBy(progress)
 
         uploadable = IUploadable(uploadable)
+        if self._key_cache is not None and isinstance(uploadable, FileName):
+            uploadable.set_key_cache(self._key_cache)
         d = uploadable.get_size()
         def _got_size(size):
             default_params = self.parent.get_encoding_parameters()
@@ -1581,7 +1743,8 @@ class Uploader(service.MultiService, log.PrefixingLogMixin):
                 uploader = LiteralUploader(progress=progress)
                 return uploader.start(uploadable)
             else:
-                eu = EncryptAnUploadable(uploadable, self._parentmsgid)
+                eu = EncryptAnUploadable(uploadable, self._parentmsgid,
+                                         worker_pool=self._worker_pool)
                 d2 = defer.succeed(None)
                 storage_broker = self.parent.get_storage_broker()
                 if self._helper:
@@ -1591,7 +1754,10 @@ class Uploader(service.MultiService, log.PrefixingLogMixin):
                 else:
                     storage_broker = self.parent.get_storage_broker()
                     secret_holder = self.parent._secret_holder
-                    uploader = CHKUploader(storage_broker, secret_holder, progress=progress)
+                    uploader = CHKUploader(storage_broker, secret_holder,
+                                           progress=progress,
+                                           pipeline_depth=self._pipeline_depth,
+                                           worker_pool=self._worker_pool)
                     d2.addCallback(lambda x: uploader.start(eu))
 
                 self._all_uploads[uploader] = None
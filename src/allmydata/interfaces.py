@@ -18,6 +18,7 @@ StorageIndex = StringConstraint(16)
 URI = StringConstraint(300) # kind of arbitrary
 
 MAX_BUCKETS = 256  # per peer -- zfec offers at most 256 shares per file
+MAX_SHARENUMS_QUERY = 1000 # storage indexes per get_sharenums() call
 
 DEFAULT_MAX_SEGMENT_SIZE = 128*1024
 
@@ -50,10 +51,22 @@ class RIBucketWriter(RemoteInterface):
         return None
 
 
+ReadVector = ListOf(TupleOf(Offset, ReadSize))
+ReadData = ListOf(ShareData)
+# returns data[offset:offset+length] for each element of ReadVector
+
 class RIBucketReader(RemoteInterface):
     def read(offset=Offset, length=ReadSize):
         return ShareData
 
+    def readv(readv=ReadVector):
+        """Read several ranges of the share at once, returning a list with
+        the data for each (offset, length) pair, in order. Each range is
+        truncated at the end of the share data, just like read(). Servers
+        which offer this advertise 'accepts-immutable-readv' in their
+        version dictionary."""
+        return ReadData
+
     def advise_corrupt_share(reason=str):
         """Clients who discover hash failures in shares that they have
         downloaded from me will use this method to inform me about the
@@ -79,9 +92,6 @@ TestAndWriteVectorsForShares = DictOf(int,
                                               DataVector,
                                               ChoiceOf(None, Offset), # new_length
                                               ))
-ReadVector = ListOf(TupleOf(Offset, ReadSize))
-ReadData = ListOf(ShareData)
-# returns data[offset:offset+length] for each element of TestVector
 
 
 class RIStorageServer(RemoteInterface):
@@ -93,6 +103,22 @@ class RIStorageServer(RemoteInterface):
         """
         return DictOf(str, Any())
 
+    def get_client_session(canary=Referenceable):
+        """
+        Return an object that offers all of my methods, through which the
+        caller (identified by the tubid of the canary's owner) should make
+        its requests from now on, so that I can share my attention fairly
+        between clients, and keep each one within its budget of requests and
+        bytes per second.
+
+        Servers which do this advertise 'accepts-client-sessions' in their
+        version dictionary. Requests made to me directly are all counted as
+        coming from a single anonymous client.
+
+        @return: an RIStorageServer
+        """
+        return Referenceable
+
     def allocate_buckets(storage_index=StorageIndex,
                          renew_secret=LeaseRenewSecret,
                          cancel_secret=LeaseCancelSecret,
@@ -149,6 +175,43 @@ class RIStorageServer(RemoteInterface):
     def get_buckets(storage_index=StorageIndex):
         return DictOf(int, RIBucketReader, maxKeys=MAX_BUCKETS)
 
+    def get_sharenums(storage_indexes=ListOf(StorageIndex,
+                                             maxLength=MAX_SHARENUMS_QUERY)):
+        """Ask which shares I hold for several storage indexes at once. This
+        is a cheaper way to ask the do-you-have-block question about many
+        files, when no BucketReaders are needed.
+
+        Servers which offer this method advertise the largest number of
+        storage indexes they will accept in a single call as
+        'maximum-get-sharenums-batch' in their version dictionary.
+
+        @return: a dictionary mapping storage index to the set of share
+                 numbers held for it. Storage indexes for which I hold no
+                 shares are omitted.
+        """
+        return DictOf(StorageIndex, SetOf(int, maxLength=MAX_BUCKETS),
+                      maxKeys=MAX_SHARENUMS_QUERY)
+
+    def get_share_digests(storage_index=StorageIndex,
+                          shnums=SetOf(int, maxLength=MAX_BUCKETS)):
+        """Return the digests of the data of the given shares (or of all the
+        shares I hold for this storage index, if shnums is empty). A share's
+        digest is the SHA256d hash of its data, tagged with
+        'allmydata_storage_share_data_v1'. A client that has verified a
+        share can remember its digest, and later compare it against mine to
+        find out whether the share has been replaced, without downloading
+        it.
+
+        Servers which keep share digests advertise
+        'provides-share-digests' in their version dictionary. Shares for
+        which I have no digest (including every share, if I do not keep
+        digests, and mutable shares that have been written recently) are
+        omitted.
+
+        @return: a dictionary mapping share number to digest
+        """
+        return DictOf(int, Hash, maxKeys=MAX_BUCKETS)
+
 
 
     def slot_readv(storage_index=StorageIndex,
@@ -291,6 +354,50 @@ class RIStorageServer(RemoteInterface):
         """
 
 
+class IStorageBackend(Interface):
+    """
+    I decide where a StorageServer keeps its immutable shares, and how they
+    are written and read. Shares are identified by (storage_index, shnum).
+    Mutable shares are always kept in the one-file-per-share layout under
+    BASEDIR/storage/shares/, whatever the backend.
+    """
+    def get_shares(storage_index):
+        """Return a dict mapping shnum to a (pathname, sharetype, size) tuple
+        for every share I hold for this storage index. 'pathname' is None
+        for shares which do not live in a file of their own."""
+
+    def have_shares():
+        """Return True if I hold any shares at all."""
+
+    def make_bucket_writer(storageserver, storage_index, shnum, max_size,
+                           lease_info, canary, fsync_policy,
+                           compute_digest=False):
+        """Return a BucketWriter that will store a new immutable share of at
+        most max_size bytes. If compute_digest=True, the writer will set its
+        .digest attribute to the share digest when it is closed."""
+
+    def make_bucket_reader(storageserver, storage_index, shnum, pathname):
+        """Return a BucketReader for an immutable share, given the pathname
+        that get_shares() reported for it."""
+
+    def stat_share(storage_index, shnum):
+        """Return an os.stat()-like result for a share, with at least an
+        st_size attribute, or raise EnvironmentError if I do not hold it."""
+
+    def delete_share(storage_index, shnum):
+        """Delete a share. The storage server's caches for the storage index
+        must be forgotten before this is called."""
+
+    def get_stats():
+        """Return a dict of numeric statistics about my storage, with str
+        keys. It may be empty."""
+
+    def stop():
+        """Release any files or databases I hold open, and stop any
+        background work. This may return a Deferred that fires when that
+        work has stopped."""
+
+
 class IStorageBucketWriter(Interface):
     """
     Objects of this kind live on the client side.
@@ -386,6 +493,24 @@ class IStorageBroker(Interface):
         """
         @return: list of IServer instances
         """
+    def iter_servers_for_psi(peer_selection_index):
+        """
+        @return: iterator of the same IServer instances as
+        get_servers_for_psi, in the same order, for callers that will
+        usually only need the first few
+        """
+    def get_server_score(server, nbytes=0):
+        """
+        @return: how long (in seconds) a request to the given IServer that
+        moves nbytes bytes is expected to take, judging by how it has done
+        so far, or None if it has not been measured. Lower is better.
+        """
+    def sort_servers_by_score(servers, nbytes=0):
+        """
+        @return: a list of the given IServer instances, the ones expected to
+        be fastest first. Servers that are about as fast as each other keep
+        their relative order.
+        """
     def get_connected_servers():
         """
         @return: frozenset of connected IServer instances
@@ -456,6 +581,10 @@ class IDisplayableServer(Interface):
     def get_longname():
         pass
 
+    def get_performance():
+        """Return the ServerPerformance that remembers how quickly this
+        server has been answering us."""
+
 
 class IServer(IDisplayableServer):
     """I live in the client, and represent a single server."""
@@ -470,6 +599,23 @@ class IServer(IDisplayableServer):
         once the connection is lost.
         """
 
+    def get_sharenums(storage_index):
+        """Return a Deferred that fires with the set of share numbers this
+        server holds for the given storage index. Queries made
+        at about the same time are sent to the server together, if it
+        supports that."""
+
+    def is_responsive():
+        """Return False if we are sending this server keepalive probes and
+        it has stopped answering them, else True. Servers that are not
+        responsive are the last to be picked for new operations."""
+
+    def get_share_digests(storage_index, shnums=()):
+        """Return a Deferred that fires with a dict mapping share number to
+        the digest that this server has recorded for that share (see
+        RIStorageServer.get_share_digests). It fires with an empty dict if
+        the server does not keep share digests."""
+
 
 class IMutableSlotWriter(Interface):
     """
@@ -2036,7 +2182,8 @@ class IUploadResults(Interface):
           cumulative_fetch : helper waiting for ciphertext requests
           total_fetch : helper start to last ciphertext response
           cumulative_encoding : just time spent in zfec
-          cumulative_sending : just time spent waiting for storage servers
+          cumulative_sending : just time spent waiting for room in the
+                               pipelines to the storage servers
           hashes_and_close : last segment push to shareholder close
           total_encode_and_push : first encode to shareholder close
         """
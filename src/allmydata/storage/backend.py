@@ -0,0 +1,59 @@
+
+import os
+
+from zope.interface import implements
+from allmydata.interfaces import IStorageBackend
+from allmydata.util import fileutil
+from allmydata.storage.common import storage_index_to_dir
+from allmydata.storage.immutable import BucketWriter, BucketReader
+
+class DiskBackend:
+    """I keep each share in a file of its own, at
+    BASEDIR/storage/shares/$START/$STORAGEINDEX/$SHARENUM, while it is being
+    uploaded at BASEDIR/storage/shares/incoming/$START/$STORAGEINDEX/$SHARENUM
+    . I use the storage server's share inventory to list buckets, and its
+    file handle cache to read shares."""
+    implements(IStorageBackend)
+
+    def __init__(self, sharedir, share_inventory, fdcache):
+        self.sharedir = sharedir
+        self.incomingdir = os.path.join(sharedir, "incoming")
+        self.share_inventory = share_inventory
+        self.fdcache = fdcache
+
+    def _sharefile(self, storage_index, shnum):
+        return os.path.join(self.sharedir, storage_index_to_dir(storage_index),
+                            "%d" % shnum)
+
+    def get_shares(self, storage_index):
+        return self.share_inventory.get_shares(storage_index)
+
+    def have_shares(self):
+        return bool(set(os.listdir(self.sharedir)) - set(["incoming"]))
+
+    def make_bucket_writer(self, storageserver, storage_index, shnum,
+                           max_size, lease_info, canary, fsync_policy,
+                           compute_digest=False):
+        si_dir = storage_index_to_dir(storage_index)
+        incominghome = os.path.join(self.incomingdir, si_dir, "%d" % shnum)
+        finalhome = os.path.join(self.sharedir, si_dir, "%d" % shnum)
+        fileutil.make_dirs(os.path.dirname(finalhome))
+        return BucketWriter(storageserver, incominghome, finalhome, max_size,
+                            lease_info, canary, fsync_policy=fsync_policy,
+                            compute_digest=compute_digest)
+
+    def make_bucket_reader(self, storageserver, storage_index, shnum,
+                           pathname):
+        return BucketReader(storageserver, pathname, storage_index, shnum)
+
+    def stat_share(self, storage_index, shnum):
+        return os.stat(self._sharefile(storage_index, shnum))
+
+    def delete_share(self, storage_index, shnum):
+        os.unlink(self._sharefile(storage_index, shnum))
+
+    def get_stats(self):
+        return {}
+
+    def stop(self):
+        pass
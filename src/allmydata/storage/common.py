@@ -1,6 +1,6 @@
 
 import os.path
-from allmydata.util import base32
+from allmydata.util import base32, hashutil
 
 class DataTooLargeError(Exception):
     pass
@@ -19,3 +19,32 @@ def si_a2b(ascii_storageindex):
 def storage_index_to_dir(storageindex):
     sia = si_b2a(storageindex)
     return os.path.join(sia[:2], sia)
+
+def get_share_identity(filename):
+    """Return the size, mtime and inode number of a share file, which change
+    when it is written or replaced, so that a digest computed earlier can be
+    known to still describe it."""
+    s = os.stat(filename)
+    return (s.st_size, s.st_mtime, s.st_ino)
+
+def compute_share_digest(share, chunksize=1024*1024):
+    """Return the digest of all of the data in a share, which can be
+    anything with a readv() method that truncates reads at the end of the
+    share data (ShareFile, MutableShareFile, or a packed share)."""
+    hasher = hashutil.share_digest_hasher()
+    for nbytes in hash_share_data(share, hasher, chunksize):
+        pass
+    return hasher.digest()
+
+def hash_share_data(share, hasher, chunksize=1024*1024):
+    """Feed all of the data in a share (as for compute_share_digest) to
+    'hasher', one chunk at a time. I am a generator which yields the number
+    of bytes in each chunk, so the caller can stop between chunks."""
+    offset = 0
+    while True:
+        [data] = share.readv([(offset, chunksize)])
+        hasher.update(data)
+        offset += len(data)
+        yield len(data)
+        if len(data) < chunksize:
+            return
@@ -1,10 +1,10 @@
 
 import os, time, struct
-import cPickle as pickle
-from twisted.internet import reactor
+from twisted.internet import reactor, defer, threads
 from twisted.application import service
+from twisted.python import log as twlog
 from allmydata.storage.common import si_b2a
-from allmydata.util import fileutil
+from allmydata.storage.crawlerstate import CrawlerStateStore
 
 class TimeSliceExceeded(Exception):
     pass
@@ -36,7 +36,11 @@ class ShareCrawler(service.MultiService):
     To use a crawler, create a subclass which implements the process_bucket()
     method. It will be called with a prefixdir and a base32 storage index
     string. process_bucket() must run synchronously. Any keys added to
-    self.state will be preserved. Override add_initial_state() to set up
+    self.state will be preserved, provided that touch_state() is called with
+    the path to each value that is changed in the middle of a cycle (the
+    whole state is written out when a cycle starts and when it finishes).
+    Lists in self.state may only be appended to, or replaced. Override
+    add_initial_state() to set up
     initial state keys. Override finished_cycle() to perform additional
     processing when the cycle is complete. Any status that the crawler
     produces should be put in the self.state dictionary. Status renderers
@@ -45,10 +49,13 @@ class ShareCrawler(service.MultiService):
     present the contents as they see fit.
 
     Then create an instance, with a reference to a StorageServer and a
-    filename where it can store persistent state. The statefile is used to
-    keep track of how far around the ring the process has travelled, as well
-    as timing history to allow the pace to be predicted and controlled. The
-    statefile will be updated and written to disk after each time slice (just
+    filename where it can store persistent state. The statefile (an SQLite
+    database, see storage/crawlerstate.py) is used to keep track of how far
+    around the ring the process has travelled, as well as timing history to
+    allow the pace to be predicted and controlled. Only the parts of
+    self.state that were touched, and have changed, are written out each
+    time. The statefile
+    will be updated and written to disk after each time slice (just
     before the crawler yields to the reactor), and also after each cycle is
     finished, and also when stopService() is called. Note that this means
     that a crawler which is interrupted with SIGKILL while it is in the
@@ -57,6 +64,17 @@ class ShareCrawler(service.MultiService):
 
     The crawler instance must be started with startService() before it will
     do any work. To make it stop doing work, call stopService().
+
+    If 'threads' is greater than zero, each time slice lists that many
+    prefixdirs at once in the reactor's thread pool (with deferToThread),
+    instead of listing them one at a time in the reactor thread. For each
+    bucket in those prefixdirs, the worker thread also calls scan_bucket(),
+    which subclasses can override to do the read-only part of their
+    per-bucket work (stat() and reading share files) away from the reactor.
+    The results are then merged back in prefix order in the reactor thread,
+    by the usual process_prefixdir()/process_bucket() methods, which can
+    find each bucket's scan_bucket() result in self.bucket_scans. The state
+    file, and so the ability to resume a cycle, are the same in both modes.
     """
 
     slow_start = 300 # don't start crawling for 5 minutes after startup
@@ -64,6 +82,7 @@ class ShareCrawler(service.MultiService):
     allowed_cpu_percentage = .10 # use up to 10% of the CPU, on average
     cpu_slice = 1.0 # use up to 1.0 seconds before yielding
     minimum_cycle_time = 300 # don't run a cycle faster than this
+    threads = 0 # prefixdirs to scan at once in worker threads, 0 for none
 
     def __init__(self, server, statefile, allowed_cpu_percentage=None):
         service.MultiService.__init__(self)
@@ -72,17 +91,21 @@ class ShareCrawler(service.MultiService):
         self.server = server
         self.sharedir = server.sharedir
         self.statefile = statefile
+        self.state_store = CrawlerStateStore(statefile)
         self.prefixes = [si_b2a(struct.pack(">H", i << (16-10)))[:2]
                          for i in range(2**10)]
         self.prefixes.sort()
         self.timer = None
         self.bucket_cache = (None, [])
+        self.bucket_scans = {}
+        self.slice_in_progress = None
         self.current_sleep_time = None
         self.next_wake_time = None
         self.last_prefix_finished_time = None
         self.last_prefix_elapsed_time = None
         self.last_cycle_started_time = None
         self.last_cycle_elapsed_time = None
+        self.touched_state = None # paths for touch_state(), None for all
         self.load_state()
 
     def minus_or_none(self, a, b):
@@ -190,11 +213,11 @@ class ShareCrawler(service.MultiService):
         #  ["last-complete-bucket"]: str, base32 storage index bucket name
         #                            of the last bucket to be processed, or
         #                            None if we are sleeping between cycles
-        try:
-            f = open(self.statefile, "rb")
-            state = pickle.load(f)
-            f.close()
-        except Exception:
+        state = self.state_store.get_state()
+        if state is None:
+            # this may be a pickle that was saved by an older version
+            state = self.state_store.legacy_pickle
+        if state is None:
             state = {"version": 1,
                      "last-cycle-finished": None,
                      "current-cycle": None,
@@ -209,6 +232,7 @@ class ShareCrawler(service.MultiService):
         else:
             self.last_complete_prefix_index = self.prefixes.index(lcp)
         self.add_initial_state()
+        self.touched_state = None
 
     def add_initial_state(self):
         """Hook method to add extra keys to self.state when first loaded.
@@ -229,11 +253,22 @@ class ShareCrawler(service.MultiService):
         else:
             last_complete_prefix = self.prefixes[lcpi]
         self.state["last-complete-prefix"] = last_complete_prefix
-        tmpfile = self.statefile + ".tmp"
-        f = open(tmpfile, "wb")
-        pickle.dump(self.state, f)
-        f.close()
-        fileutil.move_into_place(tmpfile, self.statefile)
+        touched = self.touched_state
+        if touched is not None:
+            touched.update([(k,) for k in self.CRAWLER_STATE_KEYS])
+        self.state_store.save_state(self.state, touched)
+        self.touched_state = set()
+
+    # the keys of self.state that save_state() always writes out
+    CRAWLER_STATE_KEYS = ["version", "last-cycle-finished", "current-cycle",
+                          "current-cycle-start-time", "last-complete-prefix",
+                          "last-complete-bucket"]
+
+    def touch_state(self, *path):
+        """Note that self.state[path[0]][path[1]]... has been changed, added
+        or removed, so that the next save_state() will write it out."""
+        if self.touched_state is not None:
+            self.touched_state.add(path)
 
     def startService(self):
         # arrange things to look like we were just sleeping, so
@@ -249,7 +284,14 @@ class ShareCrawler(service.MultiService):
             self.timer.cancel()
             self.timer = None
         self.save_state()
-        return service.MultiService.stopService(self)
+        d = defer.maybeDeferred(service.MultiService.stopService, self)
+        if self.slice_in_progress:
+            # wait for the worker threads, so that nothing is left touching
+            # the share directories after we have stopped
+            slice_d = defer.Deferred()
+            self.slice_in_progress.addBoth(lambda res: slice_d.callback(None))
+            d.addCallback(lambda ign: slice_d)
+        return d
 
     def start_slice(self):
         start_slice = time.time()
@@ -257,11 +299,23 @@ class ShareCrawler(service.MultiService):
         self.sleeping_between_cycles = False
         self.current_sleep_time = None
         self.next_wake_time = None
+        if self.threads > 0:
+            d = self.start_current_prefix_threaded(start_slice)
+            self.slice_in_progress = d
+            def _done(finished_cycle):
+                self.slice_in_progress = None
+                self.finish_slice(start_slice, finished_cycle)
+            d.addCallback(_done)
+            d.addErrback(twlog.err)
+            return
         try:
             self.start_current_prefix(start_slice)
             finished_cycle = True
         except TimeSliceExceeded:
             finished_cycle = False
+        self.finish_slice(start_slice, finished_cycle)
+
+    def finish_slice(self, start_slice, finished_cycle):
         self.save_state()
         if not self.running:
             # someone might have used stopService() to shut us down
@@ -273,6 +327,7 @@ class ShareCrawler(service.MultiService):
         # this_slice/percentage = this_slice+sleep_time
         # sleep_time = (this_slice/percentage) - this_slice
         sleep_time = (this_slice / self.allowed_cpu_percentage) - this_slice
+        sleep_time = max(sleep_time, self.minimum_sleep_time(this_slice))
         # if the math gets weird, or a timequake happens, don't sleep
         # forever. Note that this means that, while a cycle is running, we
         # will process at least one bucket every 5 minutes, no matter how
@@ -291,7 +346,9 @@ class ShareCrawler(service.MultiService):
         self.yielding(sleep_time)
         self.timer = reactor.callLater(sleep_time, self.start_slice)
 
-    def start_current_prefix(self, start_slice):
+    def start_cycle_if_needed(self):
+        """Start a new cycle if we are not already in the middle of one, and
+        return the number of the current cycle."""
         state = self.state
         if state["current-cycle"] is None:
             self.last_cycle_started_time = time.time()
@@ -301,36 +358,11 @@ class ShareCrawler(service.MultiService):
             else:
                 state["current-cycle"] = state["last-cycle-finished"] + 1
             self.started_cycle(state["current-cycle"])
-        cycle = state["current-cycle"]
+            self.touched_state = None # write it all out
+        return state["current-cycle"]
 
-        for i in range(self.last_complete_prefix_index+1, len(self.prefixes)):
-            # if we want to yield earlier, just raise TimeSliceExceeded()
-            prefix = self.prefixes[i]
-            prefixdir = os.path.join(self.sharedir, prefix)
-            if i == self.bucket_cache[0]:
-                buckets = self.bucket_cache[1]
-            else:
-                try:
-                    buckets = os.listdir(prefixdir)
-                    buckets.sort()
-                except EnvironmentError:
-                    buckets = []
-                self.bucket_cache = (i, buckets)
-            self.process_prefixdir(cycle, prefix, prefixdir,
-                                   buckets, start_slice)
-            self.last_complete_prefix_index = i
-
-            now = time.time()
-            if self.last_prefix_finished_time is not None:
-                elapsed = now - self.last_prefix_finished_time
-                self.last_prefix_elapsed_time = elapsed
-            self.last_prefix_finished_time = now
-
-            self.finished_prefix(cycle, prefix)
-            if time.time() >= start_slice + self.cpu_slice:
-                raise TimeSliceExceeded()
-
-        # yay! we finished the whole cycle
+    def finish_cycle(self, cycle):
+        state = self.state
         self.last_complete_prefix_index = -1
         self.last_prefix_finished_time = None # don't include the sleep
         now = time.time()
@@ -340,8 +372,126 @@ class ShareCrawler(service.MultiService):
         state["last-cycle-finished"] = cycle
         state["current-cycle"] = None
         self.finished_cycle(cycle)
+        self.touched_state = None # write it all out
         self.save_state()
 
+    def list_buckets(self, i, bucket_cache):
+        if i == bucket_cache[0]:
+            return bucket_cache[1]
+        prefixdir = os.path.join(self.sharedir, self.prefixes[i])
+        try:
+            buckets = os.listdir(prefixdir)
+            buckets.sort()
+        except EnvironmentError:
+            buckets = []
+        return buckets
+
+    def start_current_prefix(self, start_slice):
+        cycle = self.start_cycle_if_needed()
+
+        for i in range(self.last_complete_prefix_index+1, len(self.prefixes)):
+            # if we want to yield earlier, just raise TimeSliceExceeded()
+            buckets = self.list_buckets(i, self.bucket_cache)
+            self.bucket_cache = (i, buckets)
+            self.process_prefix(cycle, i, buckets, start_slice)
+            if self.slice_exceeded(start_slice):
+                raise TimeSliceExceeded()
+
+        # yay! we finished the whole cycle
+        self.finish_cycle(cycle)
+
+    def process_prefix(self, cycle, i, buckets, start_slice):
+        prefix = self.prefixes[i]
+        prefixdir = os.path.join(self.sharedir, prefix)
+        self.process_prefixdir(cycle, prefix, prefixdir,
+                               buckets, start_slice)
+        self.last_complete_prefix_index = i
+
+        now = time.time()
+        if self.last_prefix_finished_time is not None:
+            elapsed = now - self.last_prefix_finished_time
+            self.last_prefix_elapsed_time = elapsed
+        self.last_prefix_finished_time = now
+
+        self.finished_prefix(cycle, prefix)
+
+    def start_current_prefix_threaded(self, start_slice):
+        """Like start_current_prefix(), but scan the next self.threads
+        prefixdirs at a time in worker threads. I return a Deferred that
+        fires with True if the cycle was finished, or False if we ran out of
+        time (or were stopped) first."""
+        cycle = self.start_cycle_if_needed()
+        result = defer.Deferred()
+
+        def _scan_next():
+            first = self.last_complete_prefix_index+1
+            if first >= len(self.prefixes):
+                # yay! we finished the whole cycle
+                self.finish_cycle(cycle)
+                result.callback(True)
+                return
+            last = min(first+self.threads, len(self.prefixes))
+            # the worker threads get copies of everything they need from
+            # self.state, since we may modify it while they run
+            bucket_cache = self.bucket_cache
+            last_complete_bucket = self.state["last-complete-bucket"]
+            self.prepare_scan(self.prefixes[first:last])
+            dl = [threads.deferToThread(self.scan_prefix, i, bucket_cache,
+                                        last_complete_bucket)
+                  for i in range(first, last)]
+            d = defer.gatherResults(dl)
+            d.addCallback(_merge, first)
+            d.addErrback(result.errback)
+
+        def _merge(scans, first):
+            if not self.running:
+                # stopService() has already saved our state. The prefixes
+                # we scanned will be scanned again when we restart.
+                result.callback(False)
+                return
+            for (i, (buckets, bucket_scans)) in enumerate(scans):
+                self.bucket_cache = (first+i, buckets)
+                self.bucket_scans = bucket_scans
+                try:
+                    self.process_prefix(cycle, first+i, buckets, start_slice)
+                except TimeSliceExceeded:
+                    result.callback(False)
+                    return
+                finally:
+                    self.bucket_scans = {}
+                if not self.running:
+                    # e.g. a one-shot crawler that stopped itself
+                    result.callback(False)
+                    return
+                if self.slice_exceeded(start_slice):
+                    result.callback(False)
+                    return
+            _scan_next()
+
+        _scan_next()
+        return result
+
+    def scan_prefix(self, i, bucket_cache, last_complete_bucket):
+        """Run in a worker thread to list prefixdir number 'i', and call
+        scan_bucket() on each of its buckets that the current cycle has not
+        already processed. I return a tuple of (sorted list of bucket names,
+        dict mapping bucket name to scan_bucket() result)."""
+        buckets = self.list_buckets(i, bucket_cache)
+        prefixdir = os.path.join(self.sharedir, self.prefixes[i])
+        bucket_scans = {}
+        for bucket in buckets:
+            if bucket <= last_complete_bucket:
+                continue
+            try:
+                scan = self.scan_bucket(prefixdir, bucket)
+            except Exception:
+                # leave it for process_bucket() to deal with (and complain
+                # about) in the reactor thread
+                continue
+            if scan is not None:
+                bucket_scans[bucket] = scan
+        return (buckets, bucket_scans)
+
     def process_prefixdir(self, cycle, prefix, prefixdir, buckets, start_slice):
         """This gets a list of bucket names (i.e. storage index strings,
         base32-encoded) in sorted order.
@@ -359,11 +509,58 @@ class ShareCrawler(service.MultiService):
                 continue
             self.process_bucket(cycle, prefix, prefixdir, bucket)
             self.state["last-complete-bucket"] = bucket
-            if time.time() >= start_slice + self.cpu_slice:
+            if self.slice_exceeded(start_slice):
                 raise TimeSliceExceeded()
 
     # the remaining methods are explictly for subclasses to implement.
 
+    def slice_exceeded(self, start_slice):
+        """Return True if the time slice that began at 'start_slice' is over,
+        so I should save my state and yield. By default a slice lasts for
+        self.cpu_slice seconds. This is checked after each bucket (or
+        prefixdir, for crawlers which override process_prefixdir()).
+
+        This method is for subclasses to override. Subclasses which want
+        to end slices early should return True if the upcall does.
+        """
+        return time.time() >= start_slice + self.cpu_slice
+
+    def minimum_sleep_time(self, this_slice):
+        """Return the least number of seconds to sleep after a time slice
+        that took 'this_slice' seconds, for crawlers which need to pace
+        themselves by something other than CPU time. The sleep is still
+        limited to five minutes.
+
+        This method is for subclasses to override. No upcall is necessary.
+        """
+        return 0
+
+    def prepare_scan(self, prefixes):
+        """Called in the reactor thread just before the worker threads start
+        to scan the given prefixdirs (a list of prefixes), if self.threads
+        is greater than zero. A subclass can use this to give scan_bucket()
+        a snapshot of anything it needs from the reactor thread's side (such
+        as a database), by storing it in an attribute which nothing modifies
+        until the scans have finished.
+
+        This method is for subclasses to override. No upcall is necessary.
+        """
+        pass
+
+    def scan_bucket(self, prefixdir, storage_index_b32):
+        """Examine a single bucket in a worker thread, if self.threads is
+        greater than zero. This should only read from the disk, and must not
+        touch self.state, the server, or anything else that is used by the
+        reactor thread. Whatever it returns (other than None) will be
+        available as self.bucket_scans[storage_index_b32] when
+        process_bucket() is later called for the same bucket. The bucket
+        might have changed in between, so process_bucket() should treat the
+        result as a hint, and must still work if it is missing.
+
+        This method is for subclasses to override. No upcall is necessary.
+        """
+        return None
+
     def started_cycle(self, cycle):
         """Notify a subclass that the crawler is about to start a cycle.
 
@@ -432,6 +629,49 @@ class ShareCrawler(service.MultiService):
         pass
 
 
+class RateLimitedCrawler(ShareCrawler):
+    """I am a ShareCrawler which reads share data, no more than 'rate' bytes
+    per second on average, as well as using no more than its share of the
+    CPU. Subclasses call count_bytes() as they read, and may call
+    check_slice() between reads in the middle of a bucket, which raises
+    TimeSliceExceeded if the slice is over: process_bucket() will then be
+    called again for the same bucket in the next slice, and should carry on
+    from where it stopped.
+    """
+
+    def __init__(self, server, statefile, rate):
+        self.rate = rate # bytes per second
+        self._slice_bytes = 0
+        self._start_slice = None
+        ShareCrawler.__init__(self, server, statefile)
+
+    def count_bytes(self, nbytes):
+        self._slice_bytes += nbytes
+
+    def get_slice_budget(self):
+        # with the default 10% CPU and 1s slices, this is ten seconds' worth
+        # of reading, which keeps the sleeps between slices reasonable
+        return self.rate * self.cpu_slice / self.allowed_cpu_percentage
+
+    def slice_exceeded(self, start_slice):
+        return (self._slice_bytes >= self.get_slice_budget()
+                or ShareCrawler.slice_exceeded(self, start_slice))
+
+    def check_slice(self):
+        if self.slice_exceeded(self._start_slice):
+            raise TimeSliceExceeded()
+
+    def minimum_sleep_time(self, this_slice):
+        sleep_time = self._slice_bytes / float(self.rate) - this_slice
+        self._slice_bytes = 0
+        return sleep_time
+
+    def process_prefixdir(self, cycle, prefix, prefixdir, buckets, start_slice):
+        self._start_slice = start_slice
+        ShareCrawler.process_prefixdir(self, cycle, prefix, prefixdir,
+                                       buckets, start_slice)
+
+
 class BucketCountingCrawler(ShareCrawler):
     """I keep track of how many buckets are being managed by this server.
     This is equivalent to the number of distributed files and directories for
@@ -467,8 +707,10 @@ class BucketCountingCrawler(ShareCrawler):
         if cycle not in self.state["bucket-counts"]:
             self.state["bucket-counts"][cycle] = {}
         self.state["bucket-counts"][cycle][prefix] = len(buckets)
+        self.touch_state("bucket-counts", cycle, prefix)
         if prefix in self.prefixes[:self.num_sample_prefixes]:
             self.state["storage-index-samples"][prefix] = (cycle, buckets)
+            self.touch_state("storage-index-samples", prefix)
 
     def finished_cycle(self, cycle):
         last_counts = self.state["bucket-counts"].get(cycle, [])
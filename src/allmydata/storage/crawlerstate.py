@@ -0,0 +1,270 @@
+
+import os, sqlite3
+import cPickle as pickle
+from cStringIO import StringIO
+
+from allmydata.util.dbutil import get_db, DBError
+
+# Crawler state and history used to be pickled into a single file, which was
+# rewritten from scratch every time the crawler saved its state. Each of
+# those files is now an SQLite database instead. The state dictionary is
+# stored one value per row, keyed by the path of dictionary keys that leads
+# to it (nested dictionaries are flattened into their own rows). Lists, such
+# as the corrupt shares found so far, are only ever appended to, so their
+# items get a row each, and saving the state only adds the new ones. The
+# crawler tells save_state() which values it has touched since the last
+# save, and only those are written (if they changed). History is kept as
+# one row per cycle.
+
+SCHEMA_v1 = """
+CREATE TABLE version
+(
+ version INTEGER  -- contains one row, set to the schema version
+);
+
+CREATE TABLE state
+(
+ path BLOB PRIMARY KEY, -- pickled tuple of the keys that lead to this value
+ value BLOB NOT NULL    -- pickled value, an empty dict for a nested dict, or
+                        -- an empty list for a list kept in the items table
+);
+
+CREATE TABLE history
+(
+ cycle INTEGER PRIMARY KEY,
+ value BLOB NOT NULL    -- pickled
+);
+"""
+
+TABLE_ITEMS = """
+CREATE TABLE items -- added in v2
+(
+ path BLOB NOT NULL,    -- path of the list in the state table
+ seq INTEGER NOT NULL,  -- position in the list
+ value BLOB NOT NULL,   -- pickled
+ PRIMARY KEY (path, seq)
+);
+"""
+
+SCHEMA_v2 = SCHEMA_v1 + TABLE_ITEMS
+
+UPDATE_v1_to_v2 = TABLE_ITEMS + """
+UPDATE version SET version=2;
+"""
+
+UPDATERS = {
+    2: UPDATE_v1_to_v2,
+}
+
+def _dumps(obj):
+    # a Pickler in 'fast' mode does not memoize, so equal keys always pickle
+    # to the same string
+    f = StringIO()
+    p = pickle.Pickler(f, 2)
+    p.fast = 1
+    p.dump(obj)
+    return f.getvalue()
+
+NESTED_DICT = _dumps({})
+APPENDED_LIST = _dumps([])
+
+
+class _Changes:
+    def __init__(self):
+        self.written = [] # (path, value) rows of the state table
+        self.removed = [] # paths to remove from the state table
+        self.cleared = [] # paths of lists whose items are to be removed
+        self.appended = [] # (path, seq, value) rows of the items table
+
+
+class CrawlerStateStore:
+    """I hold the persistent state (and optionally the history) of a share
+    crawler in an SQLite database at 'dbfile'. If 'dbfile' holds a pickle
+    written by an older version instead, I replace it with an empty
+    database, and leave the unpickled contents in self.legacy_pickle for my
+    owner to import."""
+    VERSION = 2
+
+    def __init__(self, dbfile):
+        self.dbfile = dbfile
+        self.legacy_pickle = None
+        try:
+            self._open()
+        except (DBError, sqlite3.DatabaseError):
+            if not os.path.exists(dbfile):
+                raise
+            try:
+                f = open(dbfile, "rb")
+                try:
+                    self.legacy_pickle = pickle.load(f)
+                finally:
+                    f.close()
+            except Exception:
+                pass # unreadable, so start afresh, as we always have
+            os.unlink(dbfile)
+            self._open()
+        self._forget_saved()
+
+    def _open(self):
+        # this raises DBError (or sqlite3.DatabaseError, if it trips over a
+        # file that is not a database while setting the journal mode) if the
+        # database cannot be opened
+        (self.sqlite_module, self.connection) = \
+            get_db(self.dbfile, create_version=(SCHEMA_v2, self.VERSION),
+                   updaters=UPDATERS, dbname="crawler state",
+                   journal_mode="WAL", synchronous="NORMAL")
+        self.cursor = self.connection.cursor()
+
+    def _forget_saved(self):
+        # what was last written, so that unchanged values are not rewritten
+        self._saved = {(): NESTED_DICT} # path -> pickled value
+        self._children = {(): set()} # path of a nested dict -> its keys
+        self._lists = {} # path of a list -> (the list, items written)
+
+    def get_state(self):
+        """Return the state dictionary that was last saved, or None if
+        nothing has been saved yet."""
+        self._forget_saved()
+        self.cursor.execute("SELECT path, value FROM state")
+        rows = [(str(path), str(value))
+                for (path, value) in self.cursor.fetchall()]
+        if not rows:
+            return None
+        self.cursor.execute("SELECT path, value FROM items ORDER BY path, seq")
+        items = {}
+        for (path, value) in self.cursor.fetchall():
+            items.setdefault(str(path), []).append(pickle.loads(str(value)))
+        rows = [(pickle.loads(path), path, value) for (path, value) in rows]
+        # parents have shorter paths, so they are created before children
+        rows.sort(key=lambda row: len(row[0]))
+        state = {}
+        for (path, pickled_path, value) in rows:
+            parent = state
+            for k in path[:-1]:
+                parent = parent[k]
+            if value == NESTED_DICT:
+                v = {}
+                self._children[path] = set()
+            elif value == APPENDED_LIST:
+                v = items.get(pickled_path, [])
+                self._lists[path] = (v, len(v))
+            else:
+                v = pickle.loads(value)
+            parent[path[-1]] = v
+            self._saved[path] = value
+            self._children[path[:-1]].add(path[-1])
+        return state
+
+    def save_state(self, state, touched=None):
+        """Write out the state dictionary. 'touched' is a set of paths (tuples
+        of keys) to the values that may have been changed, added or removed
+        since the last save, or None if any of them may have been. Lists
+        must not be changed other than by appending to them, unless they are
+        replaced altogether."""
+        changes = _Changes()
+        if touched is None:
+            self._store((), state, changes)
+        else:
+            # parents first, so that children which are stored along with
+            # them are not stored again
+            for path in sorted(touched, key=len):
+                self._store_path(state, path, changes)
+        if not (changes.written or changes.removed or changes.appended):
+            return
+        Binary = self.sqlite_module.Binary
+        self.cursor.executemany("DELETE FROM items WHERE path=?",
+                                [(Binary(_dumps(path)),)
+                                 for path in changes.cleared])
+        self.cursor.executemany("DELETE FROM state WHERE path=?",
+                                [(Binary(_dumps(path)),)
+                                 for path in changes.removed])
+        self.cursor.executemany("INSERT OR REPLACE INTO state VALUES (?,?)",
+                                [(Binary(_dumps(path)), Binary(value))
+                                 for (path, value) in changes.written])
+        self.cursor.executemany("INSERT INTO items VALUES (?,?,?)",
+                                [(Binary(_dumps(path)), seq, Binary(value))
+                                 for (path, seq, value) in changes.appended])
+        self.connection.commit()
+
+    def _store_path(self, state, path, changes):
+        # find the value at 'path', and store it (or forget it, if it is
+        # gone). If one of its parents is new, store that parent instead.
+        value = state
+        for i in range(len(path)):
+            p = path[:i+1]
+            parent = p[:-1]
+            if not isinstance(value, dict):
+                self._store(parent, value, changes)
+                return
+            if p[-1] not in value:
+                self._forget(p, changes)
+                self._children[parent].discard(p[-1])
+                return
+            if i == len(path)-1 or self._saved.get(p) != NESTED_DICT:
+                self._store(p, value[p[-1]], changes)
+                self._children[parent].add(p[-1])
+                return
+            value = value[p[-1]]
+
+    def _store(self, path, value, changes):
+        saved = self._saved.get(path)
+        if isinstance(value, dict):
+            if saved != NESTED_DICT:
+                self._forget(path, changes)
+                self._saved[path] = NESTED_DICT
+                self._children[path] = set()
+                changes.written.append((path, NESTED_DICT))
+            for k in self._children[path] - set(value):
+                self._forget(path + (k,), changes)
+            for (k, v) in value.iteritems():
+                self._store(path + (k,), v, changes)
+            self._children[path] = set(value)
+        elif isinstance(value, list):
+            (old, written) = self._lists.get(path, (None, 0))
+            if (saved != APPENDED_LIST or old is not value
+                or len(value) < written):
+                self._forget(path, changes)
+                self._saved[path] = APPENDED_LIST
+                changes.written.append((path, APPENDED_LIST))
+                written = 0
+            for seq in range(written, len(value)):
+                changes.appended.append((path, seq, _dumps(value[seq])))
+            self._lists[path] = (value, len(value))
+        else:
+            pickled = _dumps(value)
+            if saved != pickled:
+                if saved in (NESTED_DICT, APPENDED_LIST):
+                    self._forget(path, changes)
+                self._saved[path] = pickled
+                changes.written.append((path, pickled))
+
+    def _forget(self, path, changes):
+        saved = self._saved.pop(path, None)
+        if saved is None:
+            return
+        if saved == NESTED_DICT:
+            for k in self._children.pop(path):
+                self._forget(path + (k,), changes)
+        elif saved == APPENDED_LIST:
+            del self._lists[path]
+            changes.cleared.append(path)
+        changes.removed.append(path)
+
+    def add_history(self, cycle, data, keep):
+        """Record 'data' as the history of 'cycle', and forget all but the
+        'keep' most recent cycles."""
+        Binary = self.sqlite_module.Binary
+        self.cursor.execute("INSERT OR REPLACE INTO history VALUES (?,?)",
+                            (cycle, Binary(_dumps(data))))
+        self.cursor.execute("DELETE FROM history WHERE cycle NOT IN"
+                            " (SELECT cycle FROM history"
+                            "  ORDER BY cycle DESC LIMIT ?)",
+                            (keep,))
+        self.connection.commit()
+
+    def get_history(self):
+        """Return a dictionary mapping cycle number to the data recorded by
+        add_history()."""
+        self.cursor.execute("SELECT cycle, value FROM history")
+        return dict([(cycle, pickle.loads(str(value)))
+                     for (cycle, value) in self.cursor.fetchall()])
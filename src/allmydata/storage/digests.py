@@ -0,0 +1,403 @@
+import os, struct
+
+from allmydata.util import log, hashutil
+from allmydata.util.dbutil import get_db
+from allmydata.storage.common import si_b2a, si_a2b, hash_share_data, \
+     get_share_identity, UnknownMutableContainerVersionError, \
+     UnknownImmutableContainerVersionError
+from allmydata.storage.shares import get_share_file
+from allmydata.storage.crawler import RateLimitedCrawler, TimeSliceExceeded
+
+# The share digest database (storage/share_digests.sqlite) is an optional
+# record of a digest of each share's data (see compute_share_digest() in
+# storage/common.py), which clients can fetch with get_share_digests() to
+# find out whether a share is still the one they verified earlier, without
+# downloading it.
+#
+# Immutable shares get their digest when their BucketWriter is closed. The
+# digest of a mutable share is forgotten each time the share is written,
+# and the ShareDigestCrawler fills in digests that are missing (including
+# those of shares that were stored before digests were enabled), and
+# forgets those of shares that have disappeared. Each digest is stored
+# along with the share file's size, mtime and inode number (see
+# get_share_identity), and the crawler hashes the share again if they
+# change, e.g. because the file was overwritten by something other than
+# the storage server.
+#
+# A digest only describes the share as it was written: noticing that a
+# share has rotted on the disk since then is the job of the scrubber, which
+# marks the digests of the corrupt shares it finds, so that they are no
+# longer given out (nor computed again until the share file changes).
+#
+# Hashing a share means reading all of it, so the crawler is limited to a
+# number of bytes per second (the scrubber's [storage]scrub.rate), and a
+# large share is hashed over as many time slices as it takes. With crawler
+# threads, the hashing is done in the worker threads instead (in
+# scan_bucket), within the same budget.
+
+SCHEMA_v1 = """
+CREATE TABLE version
+(
+ version INTEGER  -- contains one row, set to 1
+);
+
+CREATE TABLE digests
+(
+ storage_index VARCHAR(26) NOT NULL, -- base32
+ shnum INTEGER NOT NULL,
+ digest BLOB NOT NULL,               -- 32 bytes
+ PRIMARY KEY (storage_index, shnum)
+);
+"""
+
+SCHEMA_v2 = """
+CREATE TABLE version
+(
+ version INTEGER  -- contains one row, set to 2
+);
+
+CREATE TABLE digests
+(
+ storage_index VARCHAR(26) NOT NULL, -- base32
+ shnum INTEGER NOT NULL,
+ digest BLOB NOT NULL,               -- 32 bytes, or empty if corrupt
+ size INTEGER,                       -- the share file's identity when it
+ mtime REAL,                         -- was hashed, or NULL if not known
+ inode INTEGER,                      -- (e.g. for a packed share)
+ corrupt INTEGER NOT NULL DEFAULT 0, -- 1 if the scrubber found it corrupt
+ PRIMARY KEY (storage_index, shnum)
+);
+"""
+
+UPDATE_v1_to_v2 = """
+ALTER TABLE digests ADD COLUMN size INTEGER;
+ALTER TABLE digests ADD COLUMN mtime REAL;
+ALTER TABLE digests ADD COLUMN inode INTEGER;
+ALTER TABLE digests ADD COLUMN corrupt INTEGER NOT NULL DEFAULT 0;
+UPDATE version SET version=2;
+"""
+
+UPDATERS = {
+    2: UPDATE_v1_to_v2,
+}
+
+def _next_prefix(prefix):
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+def _identity(size, mtime, inode):
+    if size is None:
+        return None
+    return (size, mtime, inode)
+
+
+class ShareDigestDB:
+    VERSION = 2
+
+    def __init__(self, dbfile):
+        # this raises DBError if the database cannot be opened
+        (self.sqlite_module, self.connection) = \
+            get_db(dbfile, create_version=(SCHEMA_v2, self.VERSION),
+                   updaters=UPDATERS, dbname="share digests",
+                   journal_mode="WAL", synchronous="NORMAL")
+        self.cursor = self.connection.cursor()
+
+    def get_digests(self, storage_index):
+        """Return a dict mapping shnum to digest for the shares of the given
+        storage index that have one (and were not found to be corrupt)."""
+        self.cursor.execute("SELECT shnum, digest FROM digests"
+                            " WHERE storage_index=? AND corrupt=0",
+                            (si_b2a(storage_index),))
+        return dict([(shnum, str(digest))
+                     for (shnum, digest) in self.cursor.fetchall()])
+
+    def get_identities(self, storage_index):
+        """Return a dict mapping shnum to the identity (see
+        get_share_identity) that each share of the given storage index had
+        when its digest was computed, or None if that is not known. Shares
+        that were found to be corrupt are included."""
+        self.cursor.execute("SELECT shnum, size, mtime, inode FROM digests"
+                            " WHERE storage_index=?",
+                            (si_b2a(storage_index),))
+        return dict([(shnum, _identity(size, mtime, inode))
+                     for (shnum, size, mtime, inode)
+                     in self.cursor.fetchall()])
+
+    def get_storage_indexes_with_prefix(self, prefix):
+        """Return a set of the base32 storage indexes that start with the
+        given (base32) prefix and have at least one digest recorded."""
+        self.cursor.execute("SELECT DISTINCT storage_index FROM digests"
+                            " WHERE storage_index >= ? AND storage_index < ?",
+                            (prefix, _next_prefix(prefix)))
+        return set([str(row[0]) for row in self.cursor.fetchall()])
+
+    def get_identities_with_prefix(self, prefix):
+        """Return a dict mapping each base32 storage index that starts with
+        the given (base32) prefix to what get_identities() would return for
+        it."""
+        self.cursor.execute("SELECT storage_index, shnum, size, mtime, inode"
+                            " FROM digests"
+                            " WHERE storage_index >= ? AND storage_index < ?",
+                            (prefix, _next_prefix(prefix)))
+        identities = {}
+        for (si_s, shnum, size, mtime, inode) in self.cursor.fetchall():
+            identities.setdefault(str(si_s), {})[shnum] = \
+                _identity(size, mtime, inode)
+        return identities
+
+    def set_digest(self, storage_index, shnum, digest, identity=None):
+        (size, mtime, inode) = identity or (None, None, None)
+        self.cursor.execute("INSERT OR REPLACE INTO digests"
+                            " VALUES (?,?,?,?,?,?,0)",
+                            (si_b2a(storage_index), shnum,
+                             self.sqlite_module.Binary(digest),
+                             size, mtime, inode))
+        self.connection.commit()
+
+    def mark_corrupt(self, storage_index, shnum, identity):
+        """Record that the share, with the given identity, is corrupt: its
+        digest is no longer given out, and is not computed again until the
+        share file changes."""
+        (size, mtime, inode) = identity
+        self.cursor.execute("INSERT OR REPLACE INTO digests"
+                            " VALUES (?,?,?,?,?,?,1)",
+                            (si_b2a(storage_index), shnum,
+                             self.sqlite_module.Binary(""),
+                             size, mtime, inode))
+        self.connection.commit()
+
+    def forget(self, storage_index, shnums):
+        self.cursor.executemany("DELETE FROM digests"
+                                " WHERE storage_index=? AND shnum=?",
+                                [(si_b2a(storage_index), shnum)
+                                 for shnum in shnums])
+        self.connection.commit()
+
+
+def _list_shares(bucketdir):
+    try:
+        filenames = os.listdir(bucketdir)
+    except EnvironmentError:
+        return {}
+    shares = {}
+    for fn in filenames:
+        try:
+            shnum = int(fn)
+        except ValueError:
+            continue # non-numeric means not a sharefile
+        shares[shnum] = os.path.join(bucketdir, fn)
+    return shares
+
+
+class _ShareHasher:
+    """I compute the digest of the share file 'filename', a chunk at a time
+    (see hash_chunks). Afterwards, 'unreadable' is True if the share could
+    not be read, or else 'digest' is its digest, which only describes the
+    share if is_unchanged() is still True. 'bytes_read' is how much of it
+    was read."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.identity = None
+        self.digest = None
+        self.unreadable = False
+        self.bytes_read = 0
+
+    def hash_chunks(self):
+        """Hash the share, yielding the number of bytes read for each
+        chunk."""
+        hasher = hashutil.share_digest_hasher()
+        try:
+            self.identity = get_share_identity(self.filename)
+            sf = get_share_file(self.filename)
+            for nbytes in hash_share_data(sf, hasher):
+                self.bytes_read += nbytes
+                yield nbytes
+        except (UnknownMutableContainerVersionError,
+                UnknownImmutableContainerVersionError,
+                struct.error, EnvironmentError):
+            self.unreadable = True
+            return
+        self.digest = hasher.digest()
+
+    def is_unchanged(self):
+        # if a share changes while it is being hashed, we will try again
+        # next cycle
+        try:
+            return get_share_identity(self.filename) == self.identity
+        except EnvironmentError:
+            return False
+
+
+def _is_current(identity, filename):
+    # does the digest computed when the share had this identity (None if
+    # there is no digest, or we don't know) still describe it?
+    if identity is None:
+        return False
+    try:
+        return get_share_identity(filename) == identity
+    except EnvironmentError:
+        return False
+
+
+class _PrefixScan:
+    """What scan_bucket() needs for the buckets of one prefixdir: the
+    identities of the shares that have digests, and how many more bytes it
+    may read."""
+    def __init__(self, known, budget):
+        self.known = known # base32 storage index -> {shnum: identity}
+        self.budget = budget
+
+
+class ShareDigestCrawler(RateLimitedCrawler):
+    """I keep the share digest database up to date. Each cycle, I compute
+    the digest of every share on disk that does not have one (because it is
+    a mutable share that has been written since its digest was last
+    computed, or because it was stored before digests were enabled), or
+    whose share file has changed since its digest was computed, and I
+    forget the digests of shares that have disappeared. I read no more than
+    'rate' bytes per second on average.
+
+    My state records the number of digests computed and forgotten during
+    the current cycle ('cycle-to-date') and the most recently finished cycle
+    ('last-cycle').
+    """
+
+    slow_start = 60
+    minimum_cycle_time = 60*60
+
+    def __init__(self, server, statefile, digestdb, rate):
+        self.digestdb = digestdb
+        self._scans = {} # prefix -> _PrefixScan, see prepare_scan
+        # (storage_index_b32, shnum, _ShareHasher, its hash_chunks()) for a
+        # share we are in the middle of hashing in the reactor thread
+        self._in_progress = None
+        RateLimitedCrawler.__init__(self, server, statefile, rate)
+
+    def add_initial_state(self):
+        self.state.setdefault("cycle-to-date", self.create_empty_cycle_dict())
+        self.state.setdefault("last-cycle", None)
+
+    def create_empty_cycle_dict(self):
+        return {"computed-digests": 0,
+                "forgotten-digests": 0,
+                "corrupt-shares": [],
+                }
+
+    def started_cycle(self, cycle):
+        self.state["cycle-to-date"] = self.create_empty_cycle_dict()
+
+    def prepare_scan(self, prefixes):
+        # the worker threads share one slice's worth of reading between them
+        budget = self.get_slice_budget() / len(prefixes)
+        scans = {}
+        for prefix in prefixes:
+            scans[prefix] = _PrefixScan(
+                self.digestdb.get_identities_with_prefix(prefix), budget)
+        self._scans = scans
+
+    def scan_bucket(self, prefixdir, storage_index_b32):
+        # in a worker thread: hash the shares that have no current digest,
+        # until this prefixdir's budget runs out, and map the shnums of
+        # those that do to None. process_bucket() does the rest.
+        scan = self._scans.get(os.path.basename(prefixdir))
+        if scan is None:
+            return None
+        known = scan.known.get(storage_index_b32, {})
+        bucketdir = os.path.join(prefixdir, storage_index_b32)
+        hashed = {}
+        for (shnum, filename) in sorted(_list_shares(bucketdir).items()):
+            if _is_current(known.get(shnum), filename):
+                hashed[shnum] = None
+                continue
+            if scan.budget <= 0:
+                break
+            h = _ShareHasher(filename)
+            for nbytes in h.hash_chunks():
+                scan.budget -= nbytes
+            hashed[shnum] = h
+        return hashed
+
+    def process_prefixdir(self, cycle, prefix, prefixdir, buckets, start_slice):
+        RateLimitedCrawler.process_prefixdir(self, cycle, prefix, prefixdir,
+                                             buckets, start_slice)
+        on_disk = set(buckets)
+        for si_s in self.digestdb.get_storage_indexes_with_prefix(prefix):
+            if si_s not in on_disk:
+                self.update_bucket(si_s, {})
+
+    def process_bucket(self, cycle, prefix, prefixdir, storage_index_b32):
+        bucketdir = os.path.join(prefixdir, storage_index_b32)
+        self.update_bucket(storage_index_b32, _list_shares(bucketdir),
+                           self.bucket_scans.get(storage_index_b32))
+
+    def update_bucket(self, storage_index_b32, on_disk, hashed=None):
+        # 'hashed' is what scan_bucket() returned, if it was called
+        storage_index = si_a2b(storage_index_b32)
+        known = self.digestdb.get_identities(storage_index)
+
+        for shnum in sorted(on_disk):
+            if hashed is None:
+                if _is_current(known.get(shnum), on_disk[shnum]):
+                    continue
+                h = self._hash_share(storage_index_b32, shnum,
+                                     on_disk[shnum])
+            elif shnum in hashed:
+                h = hashed[shnum]
+                if h is None:
+                    continue # its digest is still current
+                self.count_bytes(h.bytes_read)
+            else:
+                # scan_bucket() ran out of budget: leave the rest of this
+                # bucket to be scanned again in the next slice, rather than
+                # reading it here in the reactor thread
+                raise TimeSliceExceeded()
+            if h.unreadable:
+                self._unreadable(storage_index_b32, shnum, h.filename)
+                if shnum in known:
+                    # its old digest no longer describes it
+                    self.digestdb.forget(storage_index, [shnum])
+                    self.state["cycle-to-date"]["forgotten-digests"] += 1
+                    self.touch_state("cycle-to-date", "forgotten-digests")
+            elif h.is_unchanged():
+                self.digestdb.set_digest(storage_index, shnum, h.digest,
+                                         h.identity)
+                self.state["cycle-to-date"]["computed-digests"] += 1
+                self.touch_state("cycle-to-date", "computed-digests")
+
+        missing = set(known) - set(on_disk)
+        if missing:
+            # packed shares are not in the share directories
+            self.server.forget_bucket(storage_index)
+            missing -= set(self.server.backend.get_shares(storage_index))
+        if missing:
+            self.digestdb.forget(storage_index, missing)
+            self.state["cycle-to-date"]["forgotten-digests"] += len(missing)
+            self.touch_state("cycle-to-date", "forgotten-digests")
+
+    def _hash_share(self, storage_index_b32, shnum, filename):
+        # in the reactor thread, a chunk at a time, stopping (and carrying
+        # on in the next slice) when the slice is over
+        if (self._in_progress is None
+            or self._in_progress[:2] != (storage_index_b32, shnum)):
+            self.check_slice() # don't start a share we cannot get far into
+            h = _ShareHasher(filename)
+            self._in_progress = (storage_index_b32, shnum, h, h.hash_chunks())
+        (ign, ign, h, chunks) = self._in_progress
+        for nbytes in chunks:
+            self.count_bytes(nbytes)
+            self.check_slice()
+        self._in_progress = None
+        return h
+
+    def _unreadable(self, storage_index_b32, shnum, filename):
+        log.msg(format="share-digest-crawler: unable to read %(fn)s",
+                fn=filename, facility="tahoe.storage",
+                level=log.UNUSUAL, umid="Hq3cZA")
+        self.state["cycle-to-date"]["corrupt-shares"].append(
+            (storage_index_b32, shnum))
+        self.touch_state("cycle-to-date", "corrupt-shares")
+
+    def finished_cycle(self, cycle):
+        last = self.state["cycle-to-date"].copy()
+        last["corrupt-shares"] = last["corrupt-shares"][:]
+        self.state["last-cycle"] = last
@@ -0,0 +1,203 @@
+import os, time
+
+from twisted.internet import defer, reactor, threads
+from twisted.python import failure
+from twisted.python.threadpool import ThreadPool
+
+# The storage server normally reads and writes share files in the reactor
+# thread, so a slow disk holds up every other request, even ones that never
+# touch it. If [storage]io_threads is set, the share reads and writes done
+# for remote_read, remote_write, remote_slot_readv,
+# remote_slot_testv_and_readv_and_writev (and a few related calls) are
+# handed to a DiskIO instead, which runs them in worker threads.
+#
+# Anything that is not safe to use from another thread (the lease and
+# digest databases, the share inventory, the file handle cache, and the
+# packed backend) is still used only in the reactor thread: the callers do
+# that part before or after the work they hand over.
+
+def call_io(diskio, path, f, *args):
+    """Call f(*args) through 'diskio' and return a Deferred that fires with
+    its result, or, if diskio is None, call it right here and return its
+    result."""
+    if diskio is None:
+        return f(*args)
+    return diskio.call(path, f, *args)
+
+def call_write_io(diskio, path, f, *args):
+    """Like call_io, for calls that may add or delete files under 'path'
+    (see DiskIO.writes_pending)."""
+    if diskio is None:
+        return f(*args)
+    return diskio.call_write(path, f, *args)
+
+def when_done(result, cb, *args):
+    """Pass 'result' (as returned by call_io) to cb(result, *args), after
+    it fires if it is a Deferred, and return what cb returns (wrapped in the
+    Deferred if there was one)."""
+    if isinstance(result, defer.Deferred):
+        return result.addCallback(cb, *args)
+    return cb(result, *args)
+
+def _run(f, args):
+    # runs in a worker thread
+    start = time.time()
+    try:
+        result = f(*args)
+    except:
+        result = failure.Failure()
+    return (time.time() - start, result)
+
+
+class _DiskQueue:
+    def __init__(self, name, threads):
+        self.name = name
+        self.threads = threads
+        self.pool = None
+        self.depth = 0 # calls queued or running
+
+    def get_pool(self):
+        if self.pool is None:
+            self.pool = ThreadPool(0, self.threads, self.name)
+            self.pool.start()
+        return self.pool
+
+    def stop(self):
+        if self.pool is not None:
+            self.pool.stop()
+            self.pool = None
+
+
+class DiskIO:
+    """I run file I/O for the storage server in worker threads, with a
+    separate queue of at most 'threads' threads for each disk (that is, for
+    each device holding one of the directories given to add_disk()), so
+    that a slow disk does not hold up I/O on the others.
+
+    Calls for the same path (a share file, or the bucket directory of a
+    mutable slot) are run one at a time, in the order they were made, so a
+    client's writes to a share land in order and a read never sees a
+    mutable share halfway through a write. Calls made with call_write() may
+    also add or delete files under their path, and writes_pending() tells
+    whether any are queued or running, so that the caller knows whether what
+    it has cached about those files will still hold when a new call runs.
+
+    For each call I pass three samples to record_latency(category, value):
+    'io-queue-depth' is the number of calls queued or running on the
+    call's disk when it was made (including itself), 'io-wait' is the time
+    it spent queued, and 'io-service' is the time it took to run.
+    """
+
+    def __init__(self, threads, record_latency):
+        assert threads > 0, threads
+        self.threads = threads
+        self._record_latency = record_latency
+        self._queues = {} # st_dev -> _DiskQueue
+        self._roots = [] # (directory with trailing separator, _DiskQueue)
+        self._waiting = {} # path -> calls waiting for an earlier one
+        self._writes = {} # path -> number of call_write() calls in progress
+        self._shutdown_trigger = None
+
+    def add_disk(self, root):
+        """Send I/O for files under the directory 'root' to the queue for the
+        device it lives on. Files outside every such directory use the
+        queue of the first one."""
+        dev = os.stat(root).st_dev
+        if dev not in self._queues:
+            name = "storage-io-%d" % len(self._queues)
+            self._queues[dev] = _DiskQueue(name, self.threads)
+        self._roots.append((os.path.join(root, ""), self._queues[dev]))
+
+    def _get_queue(self, path):
+        best = None
+        for (root, queue) in self._roots:
+            if path.startswith(root) and (best is None
+                                          or len(root) > len(best[0])):
+                best = (root, queue)
+        if best is None:
+            return self._roots[0][1]
+        return best[1]
+
+    def call(self, path, f, *args):
+        """Call f(*args) in one of the worker threads for the disk that
+        holds 'path', after any earlier calls for 'path' have finished.
+        Return a Deferred that fires (in the reactor thread) with its
+        result."""
+        return self._call(path, False, f, args)
+
+    def call_write(self, path, f, *args):
+        """Like call(), for a call that may add or delete files under
+        'path'."""
+        self._writes[path] = self._writes.get(path, 0) + 1
+        return self._call(path, True, f, args)
+
+    def writes_pending(self, path):
+        """Return True if a call_write() for 'path' is queued or running, in
+        which case a new call for 'path' will run after it."""
+        return path in self._writes
+
+    def _write_finished(self, path):
+        self._writes[path] -= 1
+        if not self._writes[path]:
+            del self._writes[path]
+
+    def _call(self, path, writes, f, args):
+        queue = self._get_queue(path)
+        queue.depth += 1
+        self._record_latency("io-queue-depth", float(queue.depth))
+        d = defer.Deferred()
+        c = (queue, writes, f, args, d, time.time())
+        if path in self._waiting:
+            self._waiting[path].append(c)
+        else:
+            self._waiting[path] = []
+            self._start(path, c)
+        return d
+
+    def _start(self, path, (queue, writes, f, args, d, queued)):
+        if self._shutdown_trigger is None:
+            # make sure the worker threads cannot keep the process alive
+            self._shutdown_trigger = reactor.addSystemEventTrigger(
+                "during", "shutdown", self.stop)
+        self._record_latency("io-wait", time.time() - queued)
+        d2 = threads.deferToThreadPool(reactor, queue.get_pool(), _run,
+                                       f, args)
+        def _done((elapsed, result)):
+            queue.depth -= 1
+            if writes:
+                self._write_finished(path)
+            self._record_latency("io-service", elapsed)
+            waiting = self._waiting.get(path)
+            if waiting:
+                self._start(path, waiting.pop(0))
+            elif waiting is not None:
+                del self._waiting[path]
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+        d2.addCallback(_done)
+
+    def get_stats(self):
+        return {"disks": len(self._queues),
+                "queued": sum([q.depth for q in self._queues.values()]),
+                }
+
+    def stop(self):
+        """Wait for the worker threads to finish what they are doing, and
+        stop them. Calls still waiting for an earlier call on the same path
+        are abandoned. I can be used again afterwards."""
+        if self._shutdown_trigger is not None:
+            try:
+                reactor.removeSystemEventTrigger(self._shutdown_trigger)
+            except (ValueError, KeyError):
+                pass # we are being called by it
+            self._shutdown_trigger = None
+        for (path, waiting) in self._waiting.items():
+            for c in waiting:
+                c[0].depth -= 1
+                if c[1]:
+                    self._write_finished(path)
+        self._waiting.clear()
+        for queue in self._queues.values():
+            queue.stop()
@@ -1,9 +1,11 @@
-import time, os, pickle, struct
-from allmydata.storage.crawler import ShareCrawler
+import time, os, struct
+from allmydata.storage.crawler import ShareCrawler, TimeSliceExceeded
+from allmydata.storage.crawlerstate import CrawlerStateStore
 from allmydata.storage.shares import get_share_file
 from allmydata.storage.common import UnknownMutableContainerVersionError, \
-     UnknownImmutableContainerVersionError
-from twisted.python import log as twlog
+     UnknownImmutableContainerVersionError, si_a2b, storage_index_to_dir
+from twisted.internet import defer
+from twisted.python import log as twlog, failure
 
 class LeaseCheckingCrawler(ShareCrawler):
     """I examine the leases on all shares, determining which are still valid
@@ -25,21 +27,21 @@ class LeaseCheckingCrawler(ShareCrawler):
     Prediction of space that will be recovered during the rest of this cycle
     Prediction of space that will be recovered by the entire current cycle.
 
-    Space recovered during the last 10 cycles  <-- saved in separate pickle
+    Space recovered during the last 10 cycles  <-- saved in history file
 
     Shares/buckets examined:
      this cycle-so-far
      prediction of rest of cycle
-     during last 10 cycles <-- separate pickle
-    start/finish time of last 10 cycles  <-- separate pickle
-    expiration time used for last 10 cycles <-- separate pickle
+     during last 10 cycles <-- history file
+    start/finish time of last 10 cycles  <-- history file
+    expiration time used for last 10 cycles <-- history file
 
     Histogram of leases-per-share:
      this-cycle-to-date
-     last 10 cycles <-- separate pickle
+     last 10 cycles <-- history file
     Histogram of lease ages, buckets = 1day
      cycle-to-date
-     last 10 cycles <-- separate pickle
+     last 10 cycles <-- history file
 
     All cycle-to-date values remain valid until the start of the next cycle.
 
@@ -47,6 +49,7 @@ class LeaseCheckingCrawler(ShareCrawler):
 
     slow_start = 360 # wait 6 minutes after startup
     minimum_cycle_time = 12*60*60 # not more than twice per day
+    history_cycles = 10 # how many cycles to keep in the history file
 
     def __init__(self, server, statefile, historyfile,
                  expiration_enabled, mode,
@@ -54,6 +57,13 @@ class LeaseCheckingCrawler(ShareCrawler):
                  cutoff_date, # used if expiration_mode=="cutoff-date"
                  sharetypes):
         self.historyfile = historyfile
+        self.history_store = CrawlerStateStore(historyfile)
+        legacy_history = self.history_store.legacy_pickle
+        if legacy_history:
+            # a pickled history, written by an older version
+            for cycle in sorted(legacy_history):
+                self.history_store.add_history(cycle, legacy_history[cycle],
+                                               self.history_cycles)
         self.expiration_enabled = expiration_enabled
         self.mode = mode
         self.override_lease_duration = None
@@ -81,13 +91,6 @@ class LeaseCheckingCrawler(ShareCrawler):
         for k in so_far:
             self.state["cycle-to-date"].setdefault(k, so_far[k])
 
-        # initialize history
-        if not os.path.exists(self.historyfile):
-            history = {} # cyclenum -> dict
-            f = open(self.historyfile, "wb")
-            pickle.dump(history, f)
-            f.close()
-
     def create_empty_cycle_dict(self):
         recovered = self.create_empty_recovered_dict()
         so_far = {"corrupt-shares": [],
@@ -112,20 +115,57 @@ class LeaseCheckingCrawler(ShareCrawler):
     def stat(self, fn):
         return os.stat(fn)
 
-    def process_bucket(self, cycle, prefix, prefixdir, storage_index_b32):
+    def scan_bucket(self, prefixdir, storage_index_b32):
+        # this may run in a worker thread, so it only reads: it returns the
+        # bucket's stat(), and a (shnum, sharefile, scan) tuple for each
+        # share, where the scan is what scan_share() returned
         bucketdir = os.path.join(prefixdir, storage_index_b32)
         s = self.stat(bucketdir)
-        would_keep_shares = []
-        wks = None
-
+        shares = []
         for fn in os.listdir(bucketdir):
             try:
                 shnum = int(fn)
             except ValueError:
                 continue # non-numeric means not a sharefile
             sharefile = os.path.join(bucketdir, fn)
+            shares.append((shnum, sharefile, self.scan_share(sharefile)))
+        return (s, shares)
+
+    def scan_share(self, sharefile):
+        # returns (sharefile object, leases or None), a Failure if the share
+        # is corrupt, or None if it could not be read
+        try:
+            sf = get_share_file(sharefile)
+            leases = None
+            if self.server.leasedb is None and not self.expiration_enabled:
+                # if we might cancel leases, process_share() must read them
+                # afresh, in case they have been renewed since
+                leases = list(sf.get_leases())
+        except (UnknownMutableContainerVersionError,
+                UnknownImmutableContainerVersionError,
+                struct.error):
+            return failure.Failure()
+        except EnvironmentError:
+            return None
+        return (sf, leases)
+
+    def process_bucket(self, cycle, prefix, prefixdir, storage_index_b32):
+        scan = self.bucket_scans.get(storage_index_b32)
+        if scan is None:
+            scan = self.scan_bucket(prefixdir, storage_index_b32)
+        (s, shares) = scan
+        would_keep_shares = []
+        wks = None
+        if self.expiration_enabled:
+            # we may delete some of these shares
+            self.server.forget_bucket(si_a2b(storage_index_b32))
+
+        for (shnum, sharefile, share_scan) in shares:
             try:
-                wks = self.process_share(sharefile)
+                if isinstance(share_scan, failure.Failure):
+                    share_scan.raiseException()
+                wks = self.process_share(sharefile, storage_index_b32, shnum,
+                                         share_scan)
             except (UnknownMutableContainerVersionError,
                     UnknownImmutableContainerVersionError,
                     struct.error):
@@ -133,17 +173,19 @@ class LeaseCheckingCrawler(ShareCrawler):
                 twlog.err()
                 which = (storage_index_b32, shnum)
                 self.state["cycle-to-date"]["corrupt-shares"].append(which)
+                self.touch_state("cycle-to-date", "corrupt-shares")
                 wks = (1, 1, 1, "unknown")
+            if wks is None:
+                continue # the share went away after it was scanned
             would_keep_shares.append(wks)
 
         sharetype = None
-        if wks:
+        if would_keep_shares:
             # use the last share's sharetype as the buckettype
-            sharetype = wks[3]
-        rec = self.state["cycle-to-date"]["space-recovered"]
-        self.increment(rec, "examined-buckets", 1)
+            sharetype = would_keep_shares[-1][3]
+        self.increment("space-recovered", "examined-buckets", 1)
         if sharetype:
-            self.increment(rec, "examined-buckets-"+sharetype, 1)
+            self.increment("space-recovered", "examined-buckets-"+sharetype, 1)
         del wks
 
         try:
@@ -157,19 +199,40 @@ class LeaseCheckingCrawler(ShareCrawler):
         if sum([wks[2] for wks in would_keep_shares]) == 0:
             self.increment_bucketspace("actual", bucket_diskbytes, sharetype)
 
-    def process_share(self, sharefilename):
+    def process_share(self, sharefilename, storage_index_b32, shnum,
+                      share_scan=None):
         # first, find out what kind of a share it is
-        sf = get_share_file(sharefilename)
+        if share_scan is None:
+            sf = get_share_file(sharefilename)
+            leases = None
+        else:
+            (sf, leases) = share_scan
         sharetype = sf.sharetype
         now = time.time()
-        s = self.stat(sharefilename)
+        try:
+            s = self.stat(sharefilename)
+        except EnvironmentError:
+            if share_scan is None:
+                raise
+            # it was deleted after a worker thread scanned it
+            return None
+
+        # if the server keeps a lease database, the leases live there rather
+        # than in the share container
+        leasedb = self.server.leasedb
+        if leasedb is not None:
+            storage_index = si_a2b(storage_index_b32)
+            leasedb.import_share(storage_index, shnum, sf) # if not yet known
+            leases = leasedb.get_leases(storage_index, shnum)
+        elif leases is None:
+            leases = sf.get_leases()
 
         num_leases = 0
         num_valid_leases_original = 0
         num_valid_leases_configured = 0
         expired_leases_configured = []
 
-        for li in sf.get_leases():
+        for li in leases:
             num_leases += 1
             original_expiration_time = li.get_expiration_time()
             grant_renew_time = li.get_grant_renew_time_time()
@@ -200,15 +263,21 @@ class LeaseCheckingCrawler(ShareCrawler):
             else:
                 num_valid_leases_configured += 1
 
-        so_far = self.state["cycle-to-date"]
-        self.increment(so_far["leases-per-share-histogram"], num_leases, 1)
+        self.increment("leases-per-share-histogram", num_leases, 1)
         self.increment_space("examined", s, sharetype)
 
         would_keep_share = [1, 1, 1, sharetype]
 
         if self.expiration_enabled:
             for li in expired_leases_configured:
-                sf.cancel_lease(li.cancel_secret)
+                if leasedb is not None:
+                    remaining = leasedb.cancel_lease(storage_index, shnum,
+                                                     li.cancel_secret)
+                    if not remaining:
+                        sf.unlink()
+                        leasedb.remove_deleted_share(storage_index, shnum)
+                else:
+                    sf.cancel_lease(li.cancel_secret)
 
         if num_valid_leases_original == 0:
             would_keep_share[0] = 0
@@ -234,27 +303,30 @@ class LeaseCheckingCrawler(ShareCrawler):
             # the docs say that st_blocks is only on linux. I also see it on
             # MacOS. But it isn't available on windows.
             diskbytes = sharebytes
-        so_far_sr = self.state["cycle-to-date"]["space-recovered"]
-        self.increment(so_far_sr, a+"-shares", 1)
-        self.increment(so_far_sr, a+"-sharebytes", sharebytes)
-        self.increment(so_far_sr, a+"-diskbytes", diskbytes)
+        sr = "space-recovered"
+        self.increment(sr, a+"-shares", 1)
+        self.increment(sr, a+"-sharebytes", sharebytes)
+        self.increment(sr, a+"-diskbytes", diskbytes)
         if sharetype:
-            self.increment(so_far_sr, a+"-shares-"+sharetype, 1)
-            self.increment(so_far_sr, a+"-sharebytes-"+sharetype, sharebytes)
-            self.increment(so_far_sr, a+"-diskbytes-"+sharetype, diskbytes)
+            self.increment(sr, a+"-shares-"+sharetype, 1)
+            self.increment(sr, a+"-sharebytes-"+sharetype, sharebytes)
+            self.increment(sr, a+"-diskbytes-"+sharetype, diskbytes)
 
     def increment_bucketspace(self, a, bucket_diskbytes, sharetype):
-        rec = self.state["cycle-to-date"]["space-recovered"]
-        self.increment(rec, a+"-diskbytes", bucket_diskbytes)
-        self.increment(rec, a+"-buckets", 1)
+        sr = "space-recovered"
+        self.increment(sr, a+"-diskbytes", bucket_diskbytes)
+        self.increment(sr, a+"-buckets", 1)
         if sharetype:
-            self.increment(rec, a+"-diskbytes-"+sharetype, bucket_diskbytes)
-            self.increment(rec, a+"-buckets-"+sharetype, 1)
+            self.increment(sr, a+"-diskbytes-"+sharetype, bucket_diskbytes)
+            self.increment(sr, a+"-buckets-"+sharetype, 1)
 
-    def increment(self, d, k, delta=1):
+    def increment(self, name, k, delta=1):
+        # add to one of the counters in self.state["cycle-to-date"][name]
+        d = self.state["cycle-to-date"][name]
         if k not in d:
             d[k] = 0
         d[k] += delta
+        self.touch_state("cycle-to-date", name, k)
 
     def add_lease_age_to_histogram(self, age):
         bucket_interval = 24*60*60
@@ -262,7 +334,7 @@ class LeaseCheckingCrawler(ShareCrawler):
         bucket_start = bucket_number * bucket_interval
         bucket_end = bucket_start + bucket_interval
         k = (bucket_start, bucket_end)
-        self.increment(self.state["cycle-to-date"]["lease-age-histogram"], k, 1)
+        self.increment("lease-age-histogram", k, 1)
 
     def convert_lease_age_histogram(self, lah):
         # convert { (minage,maxage) : count } into [ (minage,maxage,count) ]
@@ -303,14 +375,7 @@ class LeaseCheckingCrawler(ShareCrawler):
         # copy() needs to become a deepcopy
         h["space-recovered"] = s["space-recovered"].copy()
 
-        history = pickle.load(open(self.historyfile, "rb"))
-        history[cycle] = h
-        while len(history) > 10:
-            oldcycles = sorted(history.keys())
-            del history[oldcycles[0]]
-        f = open(self.historyfile, "wb")
-        pickle.dump(history, f)
-        f.close()
+        self.history_store.add_history(cycle, h, self.history_cycles)
 
     def get_state(self):
         """In addition to the crawler state described in
@@ -379,8 +444,7 @@ class LeaseCheckingCrawler(ShareCrawler):
         progress = self.get_progress()
 
         state = ShareCrawler.get_state(self) # does a shallow copy
-        history = pickle.load(open(self.historyfile, "rb"))
-        state["history"] = history
+        state["history"] = self.history_store.get_history()
 
         if not progress["cycle-in-progress"]:
             del state["cycle-to-date"]
@@ -423,3 +487,130 @@ class LeaseCheckingCrawler(ShareCrawler):
         state["estimated-remaining-cycle"] = remaining
         state["estimated-current-cycle"] = cycle
         return state
+
+
+class IndexedLeaseCheckingCrawler(LeaseCheckingCrawler):
+    """I am a LeaseCheckingCrawler for servers that keep a lease database.
+    Rather than walking every bucket and examining every share, each cycle
+    asks the database for the leases that have expired according to the
+    configured mode (using its index on expiration time), and examines only
+    the shares that hold them. The cost of a cycle is therefore proportional
+    to the number of expired leases, not to the number of shares on the
+    server, so I can afford to run much more often.
+
+    My state and history have the same shape as those of the
+    LeaseCheckingCrawler, but the 'examined' counts, the lease-age histogram
+    and the leases-per-share histogram only describe shares which held at
+    least one expired lease. Bucket counts are only kept for buckets that
+    were actually emptied.
+    """
+
+    minimum_cycle_time = 60*60 # cheap enough to run hourly
+    batch_size = 100
+
+    def add_initial_state(self):
+        LeaseCheckingCrawler.add_initial_state(self)
+        # ["expiration-cutoff"]: leases expiring before this time (seconds
+        #                        since epoch) are considered expired during
+        #                        the current cycle
+        # ["last-expired-lease"]: id of the last expired lease that was
+        #                         processed during the current cycle
+        self.state.setdefault("expiration-cutoff", None)
+        self.state.setdefault("last-expired-lease", 0)
+
+    def started_cycle(self, cycle):
+        LeaseCheckingCrawler.started_cycle(self, cycle)
+        self.state["expiration-cutoff"] = self.get_expiration_cutoff(time.time())
+        self.state["last-expired-lease"] = 0
+
+    def get_expiration_cutoff(self, now):
+        # leases have a fixed 31-day duration, so a lease's grant/renew time
+        # (from which its age is measured) is 31 days before its expiration
+        # time
+        if self.mode == "age":
+            if self.override_lease_duration is None:
+                return now
+            return now + 31*24*60*60 - self.override_lease_duration
+        assert self.mode == "cutoff-date"
+        return self.cutoff_date + 31*24*60*60
+
+    def start_current_prefix(self, start_slice):
+        cycle = self.start_cycle_if_needed()
+        leasedb = self.server.leasedb
+        while True:
+            batch = leasedb.get_expired_leases(self.state["expiration-cutoff"],
+                                               self.sharetypes_to_expire,
+                                               self.state["last-expired-lease"],
+                                               self.batch_size)
+            if not batch:
+                break
+            for (lease_id, storage_index, shnum, sharetype) in batch:
+                self.process_expired_lease(lease_id, storage_index, shnum,
+                                           sharetype)
+                self.state["last-expired-lease"] = lease_id
+                self.touch_state("last-expired-lease")
+                if self.slice_exceeded(start_slice):
+                    raise TimeSliceExceeded()
+        self.finish_cycle(cycle)
+
+    def start_current_prefix_threaded(self, start_slice):
+        # we don't walk the prefixdirs, so there is nothing to hand out to
+        # worker threads
+        try:
+            self.start_current_prefix(start_slice)
+        except TimeSliceExceeded:
+            return defer.succeed(False)
+        return defer.succeed(True)
+
+    def process_expired_lease(self, lease_id, storage_index, shnum, sharetype):
+        leasedb = self.server.leasedb
+        cutoff = self.state["expiration-cutoff"]
+        leases = leasedb.get_leases_with_ids(storage_index, shnum)
+        expired_ids = [lid for (lid, li) in leases
+                       if li.get_expiration_time() < cutoff]
+        # a share with several expired leases is examined (and all of them
+        # are removed) when we reach the first one
+        if not expired_ids or min(expired_ids) != lease_id:
+            return
+
+        bucketdir = os.path.join(self.sharedir,
+                                 storage_index_to_dir(storage_index))
+        try:
+            s = self.server.backend.stat_share(storage_index, shnum)
+        except EnvironmentError:
+            # the share has disappeared from disk, so forget about it
+            leasedb.remove_deleted_share(storage_index, shnum)
+            return
+
+        now = time.time()
+        num_valid_leases_original = 0
+        for (lid, li) in leases:
+            self.add_lease_age_to_histogram(li.get_age())
+            if li.get_expiration_time() > now:
+                num_valid_leases_original += 1
+
+        self.increment("leases-per-share-histogram", len(leases), 1)
+        self.increment_space("examined", s, sharetype)
+        if num_valid_leases_original == 0:
+            self.increment_space("original", s, sharetype)
+        if len(expired_ids) == len(leases):
+            self.increment_space("configured", s, sharetype)
+        if not self.expiration_enabled:
+            return
+
+        for lid in expired_ids:
+            leasedb.remove_lease(lid, storage_index, shnum)
+        if len(expired_ids) < len(leases):
+            return # the share is kept for the sake of its other leases
+        try:
+            bucket_diskbytes = self.stat(bucketdir).st_blocks * 512
+        except AttributeError:
+            bucket_diskbytes = 0 # no stat().st_blocks on windows
+        except EnvironmentError:
+            bucket_diskbytes = 0 # e.g. packed shares have no bucket directory
+        self.server.forget_bucket(storage_index)
+        self.server.backend.delete_share(storage_index, shnum)
+        leasedb.remove_deleted_share(storage_index, shnum)
+        self.increment_space("actual", s, sharetype)
+        if not leasedb.get_shares(storage_index):
+            self.increment_bucketspace("actual", bucket_diskbytes, sharetype)
@@ -0,0 +1,129 @@
+
+import os, mmap
+
+from allmydata.util.lrucache import LRUCache
+
+class FileHandleCache:
+    """I keep read-only file handles open for the share files that were
+    read most recently, so that streaming a share does not cost an
+    open()/close() pair for every read request. I hold at most 'size' open
+    handles, closing the least recently used one when I need room for
+    another; a size of 0 disables caching.
+
+    The handles are unbuffered, so data written through another handle to
+    the same file is visible immediately. Before I hand out a cached handle,
+    I check that its path still names the file it has open, and reopen it if
+    the file has been deleted or replaced (by an operator, say). The storage
+    server should still call forget() (or forget_directory()) before it
+    deletes or replaces a share file itself, because Windows will not remove
+    a file that is still open.
+
+    If use_mmap is True, map() will also hand out read-only memory maps of
+    the cached files, which live exactly as long as their file handles.
+    """
+
+    def __init__(self, size=128, use_mmap=False):
+        self.opens = 0
+        self.hits = 0
+        self.stale = 0
+        self.maps = 0
+        self.use_mmap = use_mmap and size > 0
+        self._handles = LRUCache(size, on_evict=self._evicted)
+        self._maps = {} # path -> mmap
+
+    def _evicted(self, path, f):
+        self._close(path, f)
+
+    def _close(self, path, f):
+        m = self._maps.pop(path, None)
+        if m is not None:
+            m.close()
+        f.close()
+
+    def _is_current(self, path, f):
+        # is 'path' still the file that 'f' has open?
+        try:
+            s = os.stat(path)
+        except OSError:
+            return False # deleted
+        fs = os.fstat(f.fileno())
+        return (s.st_ino, s.st_dev) == (fs.st_ino, fs.st_dev)
+
+    def open(self, path):
+        """Return a file object open for reading at 'path'. The caller must
+        pass it to done() when they are finished with it, and must not close
+        it themselves."""
+        f = self._handles.get(path)
+        if f is not None:
+            if self._is_current(path, f):
+                self.hits += 1
+                return f
+            self.stale += 1
+            self.forget(path)
+        self.opens += 1
+        f = open(path, 'rb', 0)
+        self._handles.set(path, f)
+        return f
+
+    def done(self, f):
+        if f.name not in self._handles:
+            f.close() # not cached
+        # otherwise we leave it open for next time
+
+    def map(self, path, length):
+        """Return a read-only mmap of at least the first 'length' bytes of
+        the file at 'path', or None if use_mmap is off or the file cannot be
+        mapped. The map remains valid until the file is forgotten or
+        evicted, so the caller should slice what it needs right away rather
+        than holding on to the map."""
+        if not self.use_mmap or length <= 0:
+            return None
+        m = self._maps.get(path)
+        if m is not None and len(m) >= length:
+            f = self._handles.get(path) # this marks it as recently used
+            # a file that shrank in place would make reads from the end of
+            # the map fail with SIGBUS, so we check that too
+            if (self._is_current(path, f)
+                and os.fstat(f.fileno()).st_size >= len(m)):
+                return m
+        f = self.open(path)
+        try:
+            new_m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (EnvironmentError, ValueError):
+            # e.g. an empty file, or a platform or filesystem that cannot
+            # map it
+            self.done(f)
+            return None
+        if len(new_m) < length or path not in self._handles:
+            new_m.close()
+            self.done(f)
+            return None
+        self.maps += 1
+        old_m = self._maps.get(path)
+        if old_m is not None:
+            old_m.close() # the file changed size since we mapped it
+        self._maps[path] = new_m
+        return new_m
+
+    def forget(self, path):
+        f = self._handles.pop(path)
+        if f is not None:
+            self._close(path, f)
+
+    def forget_directory(self, dirpath):
+        for path in self._handles.keys():
+            if os.path.dirname(path) == dirpath:
+                self.forget(path)
+
+    def clear(self):
+        for path in self._handles.keys():
+            self.forget(path)
+
+    def get_stats(self):
+        return {"opens": self.opens,
+                "hits": self.hits,
+                "stale": self.stale,
+                "evictions": self._handles.evictions,
+                "open": len(self._handles),
+                "maps": self.maps,
+                }
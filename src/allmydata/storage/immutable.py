@@ -1,15 +1,18 @@
 import os, stat, struct, time
 
 from foolscap.api import Referenceable
+from twisted.internet import defer
+from twisted.python import failure
 
 from zope.interface import implements
 from allmydata.interfaces import RIBucketWriter, RIBucketReader
 from allmydata.util import base32, fileutil, log
 from allmydata.util.assertutil import precondition
-from allmydata.util.hashutil import timing_safe_compare
+from allmydata.util.hashutil import timing_safe_compare, share_digest_hasher
 from allmydata.storage.lease import LeaseInfo
 from allmydata.storage.common import UnknownImmutableContainerVersionError, \
-     DataTooLargeError
+     DataTooLargeError, compute_share_digest, get_share_identity
+from allmydata.storage.diskio import call_io, when_done
 
 # each share file (in storage/shares/$SI/$SHNUM) contains lease information
 # and share data. The share data is accessed by RIBucketWriter.write and
@@ -40,11 +43,13 @@ class ShareFile:
     LEASE_SIZE = struct.calcsize(">L32s32sL")
     sharetype = "immutable"
 
-    def __init__(self, filename, max_size=None, create=False):
-        """ If max_size is not None then I won't allow more than max_size to be written to me. If create=True and max_size must not be None. """
+    def __init__(self, filename, max_size=None, create=False, fdcache=None):
+        """ If max_size is not None then I won't allow more than max_size to be written to me. If create=True and max_size must not be None. If fdcache is provided (a FileHandleCache), reads will use its file handles instead of opening the file each time. """
         precondition((max_size is not None) or (not create), max_size, create)
         self.home = filename
         self._max_size = max_size
+        self._fdcache = fdcache
+        self._write_f = None
         if create:
             # touch the file, so later callers will see that we're working on
             # it. Also construct the metadata.
@@ -65,10 +70,13 @@ class ShareFile:
             self._lease_offset = max_size + 0x0c
             self._num_leases = 0
         else:
-            f = open(self.home, 'rb')
-            filesize = os.path.getsize(self.home)
-            (version, unused, num_leases) = struct.unpack(">LLL", f.read(0xc))
-            f.close()
+            f = self._open_for_read()
+            try:
+                filesize = os.fstat(f.fileno())[stat.ST_SIZE]
+                f.seek(0)
+                (version, unused, num_leases) = struct.unpack(">LLL", f.read(0xc))
+            finally:
+                self._done_reading(f)
             if version != 1:
                 msg = "sharefile %s had version %d but we wanted 1" % \
                       (filename, version)
@@ -77,9 +85,32 @@ class ShareFile:
             self._lease_offset = filesize - (num_leases * self.LEASE_SIZE)
         self._data_offset = 0xc
 
+    def _open_for_read(self):
+        if self._fdcache:
+            return self._fdcache.open(self.home)
+        return open(self.home, 'rb')
+
+    def _done_reading(self, f):
+        if self._fdcache:
+            self._fdcache.done(f)
+        else:
+            f.close()
+
+    def _map(self, end):
+        # a memory map covering at least the first 'end' bytes, if the
+        # cache hands them out
+        if self._fdcache:
+            return self._fdcache.map(self.home, end)
+        return None
+
     def unlink(self):
+        if self._fdcache:
+            self._fdcache.forget(self.home)
         os.unlink(self.home)
 
+    def get_data_length(self):
+        return self._lease_offset - self._data_offset
+
     def read_share_data(self, offset, length):
         precondition(offset >= 0)
         # reads beyond the end of the data are truncated. Reads that start
@@ -88,15 +119,70 @@ class ShareFile:
         actuallength = max(0, min(length, self._lease_offset-seekpos))
         if actuallength == 0:
             return ""
-        f = open(self.home, 'rb')
-        f.seek(seekpos)
-        return f.read(actuallength)
+        m = self._map(seekpos+actuallength)
+        if m is not None:
+            # This is not zero-copy: slicing the map still makes a new str
+            # (foolscap can only send a str, not a buffer()), but it saves
+            # the seek() and read() system calls and their extra buffering.
+            return m[seekpos:seekpos+actuallength]
+        f = self._open_for_read()
+        try:
+            f.seek(seekpos)
+            return f.read(actuallength)
+        finally:
+            self._done_reading(f)
+
+    # ranges that are closer together than this are fetched with one read
+    READV_MERGE_GAP = 4096
+
+    def readv(self, readv):
+        """Return a list with the share data for each (offset, length) in
+        readv, truncated like read_share_data(). All of the ranges are
+        served from a single open file, and ranges that overlap or nearly
+        touch are fetched with a single read."""
+        results = [""] * len(readv)
+        wanted = []
+        for i, (offset, length) in enumerate(readv):
+            precondition(offset >= 0)
+            seekpos = self._data_offset+offset
+            actuallength = max(0, min(length, self._lease_offset-seekpos))
+            if actuallength > 0:
+                wanted.append((seekpos, seekpos+actuallength, i))
+        if not wanted:
+            return results
+        m = self._map(max([w[1] for w in wanted]))
+        if m is not None:
+            for (start, end, i) in wanted:
+                results[i] = m[start:end]
+            return results
+        wanted.sort()
+        runs = [] # (start, end, [(start, end, i)..])
+        for (start, end, i) in wanted:
+            if runs and start <= runs[-1][1] + self.READV_MERGE_GAP:
+                run = runs[-1]
+                run[1] = max(run[1], end)
+                run[2].append((start, end, i))
+            else:
+                runs.append([start, end, [(start, end, i)]])
+        f = self._open_for_read()
+        try:
+            for (runstart, runend, members) in runs:
+                f.seek(runstart)
+                data = f.read(runend - runstart)
+                for (start, end, i) in members:
+                    results[i] = data[start-runstart:end-runstart]
+        finally:
+            self._done_reading(f)
+        return results
 
     def write_share_data(self, offset, data):
         length = len(data)
         precondition(offset >= 0, offset)
         if self._max_size is not None and offset+length > self._max_size:
             raise DataTooLargeError(self._max_size, offset, length)
+        if self._write_f is not None:
+            self._buffer_write(offset, data)
+            return
         f = open(self.home, 'rb+')
         real_offset = self._data_offset+offset
         f.seek(real_offset)
@@ -104,6 +190,73 @@ class ShareFile:
         f.write(data)
         f.close()
 
+    # sequential writes are buffered until they add up to this much
+    WRITE_BUFFER_SIZE = 1024*1024
+
+    def keep_open_for_writing(self):
+        """Hold the share file open until close_for_writing() is called.
+        Until then, write_share_data() writes through that one handle, and
+        buffers writes which continue where the previous one ended so that
+        they reach the disk as a few large writes. The buffered data is not
+        visible to readers until flush_writes() or close_for_writing() is
+        called."""
+        self._write_f = open(self.home, 'rb+')
+        self._pending = []
+        self._pending_offset = 0
+        self._pending_size = 0
+
+    def _buffer_write(self, offset, data):
+        if offset != self._pending_offset + self._pending_size:
+            self.flush_writes()
+            self._pending_offset = offset
+        self._pending.append(data)
+        self._pending_size += len(data)
+        if self._pending_size >= self.WRITE_BUFFER_SIZE:
+            self.flush_writes()
+
+    def flush_writes(self):
+        if self._write_f is None:
+            return
+        if self._pending:
+            real_offset = self._data_offset+self._pending_offset
+            self._write_f.seek(real_offset)
+            self._write_f.write("".join(self._pending))
+            self._write_f.flush()
+        self._pending = []
+        self._pending_offset += self._pending_size
+        self._pending_size = 0
+
+    def close_for_writing(self, fsync=False):
+        """Write out any buffered data and close the handle opened by
+        keep_open_for_writing(), if it was called. If fsync=True, wait until
+        the data is on disk before returning."""
+        if self._write_f is None:
+            if fsync:
+                f = open(self.home, 'rb+')
+                try:
+                    os.fsync(f.fileno())
+                finally:
+                    f.close()
+            return
+        self.flush_writes()
+        if fsync:
+            self._write_f.flush()
+            os.fsync(self._write_f.fileno())
+        self._write_f.close()
+        self._write_f = None
+
+    def discard_writes(self):
+        """Throw away any buffered data, and close the handle opened by
+        keep_open_for_writing(), without raising any errors."""
+        if self._write_f is None:
+            return
+        self._pending = []
+        try:
+            self._write_f.close()
+        except EnvironmentError:
+            pass
+        self._write_f = None
+
     def _write_lease_record(self, f, lease_number, lease_info):
         offset = self._lease_offset + lease_number * self.LEASE_SIZE
         f.seek(offset)
@@ -194,11 +347,20 @@ class ShareFile:
         return space_freed
 
 
+# How hard BucketWriter tries to make a finished share survive a crash:
+#  "none": leave it to the OS to write the share out whenever it likes
+#  "close": fsync the share file before reporting the close as finished
+#  "close-and-dir": also fsync the directory the share was moved into
+FSYNC_POLICIES = ("none", "close", "close-and-dir")
+
 class BucketWriter(Referenceable):
     implements(RIBucketWriter)
 
-    def __init__(self, ss, incominghome, finalhome, max_size, lease_info, canary):
+    def __init__(self, ss, incominghome, finalhome, max_size, lease_info,
+                 canary, fsync_policy="none", compute_digest=False):
+        precondition(fsync_policy in FSYNC_POLICIES, fsync_policy)
         self.ss = ss
+        self._fsync_policy = fsync_policy
         self.incominghome = incominghome
         self.finalhome = finalhome
         self._max_size = max_size # don't allow the client to write more than this
@@ -206,29 +368,132 @@ class BucketWriter(Referenceable):
         self._disconnect_marker = canary.notifyOnDisconnect(self._disconnected)
         self.closed = False
         self.throw_out_all_data = False
+        # writes, and the work of closing or aborting, are done in the
+        # server's I/O threads if it has them (see storage/diskio.py)
+        self._diskio = ss.diskio
         self._sharefile = ShareFile(incominghome, create=True, max_size=max_size)
         # also, add our lease to the file now, so that other ones can be
         # added by simultaneous uploaders
         self._sharefile.add_lease(lease_info)
+        # each writer kept open holds a file descriptor and a write buffer,
+        # so the server only lets so many of them do that at once
+        self._moved = False
+        if ss.reserve_write_handle(self):
+            self._sharefile.keep_open_for_writing()
+        # If compute_digest=True, self.digest is set to the share digest
+        # (see storage/digests.py) when we are closed. Uploaders write their
+        # shares from start to finish, so we hash the data as it arrives,
+        # and only read the share back if the writes skip around. Once the
+        # share is in place, self.identity is what get_share_identity()
+        # says about it.
+        self.digest = None
+        self.identity = None
+        self._digest_hasher = None
+        self._compute_digest = compute_digest
+        if compute_digest:
+            self._digest_hasher = share_digest_hasher()
+            self._digest_offset = 0
 
     def allocated_size(self):
         return self._max_size
 
+    def _call_io(self, f, *args):
+        return call_io(self._diskio, self.incominghome, f, *args)
+
     def remote_write(self, offset, data):
         start = time.time()
         precondition(not self.closed)
         if self.throw_out_all_data:
             return
+        def _written(ign):
+            self.ss.add_latency("write", time.time() - start)
+            self.ss.count("write")
+        return when_done(self._call_io(self._write, offset, data), _written)
+
+    def _write(self, offset, data):
         self._sharefile.write_share_data(offset, data)
-        self.ss.add_latency("write", time.time() - start)
-        self.ss.count("write")
+        if self._digest_hasher is not None:
+            if offset == self._digest_offset:
+                self._digest_hasher.update(data)
+                self._digest_offset += len(data)
+            else:
+                self._digest_hasher = None
 
     def remote_close(self):
         precondition(not self.closed)
         start = time.time()
+        # no more writes, and a disconnect no longer aborts us
+        self.closed = True
+        self._canary.dontNotifyOnDisconnect(self._disconnect_marker)
 
+        def _closed(filelen):
+            self._sharefile = None
+            self.ss.bucket_writer_closed(self, filelen)
+            self.ss.add_latency("close", time.time() - start)
+            self.ss.count("close")
+        try:
+            d = self._call_io(self._close)
+        except Exception:
+            f = failure.Failure()
+            self._close_failed(f)
+            f.raiseException()
+        if isinstance(d, defer.Deferred):
+            d.addErrback(self._close_failed)
+        return when_done(d, _closed)
+
+    def _close_failed(self, f):
+        # the share could not be finished (the disk may be full), so throw it
+        # away and give back its space, as if we had been aborted
+        log.msg(format="storage: unable to close sharefile %(fn)s",
+                fn=self.incominghome, failure=f, facility="tahoe.storage",
+                level=log.WEIRD, umid="Q2Zk6w")
+        def _discarded(ign):
+            self._sharefile = None
+            self.ss.bucket_writer_closed(self, 0)
+            return f
+        return when_done(self._call_io(self._discard_share), _discarded)
+
+    def _discard_share(self):
+        self._sharefile.discard_writes()
+        fileutil.remove_if_possible(self.incominghome)
+        if self._moved:
+            fileutil.remove_if_possible(self.finalhome)
+        self._remove_incoming_dirs()
+
+    def _close(self):
+        if self._compute_digest:
+            self.digest = self._finish_digest()
+        return self._finish_share()
+
+    def _finish_digest(self):
+        hasher = self._digest_hasher
+        if hasher is None:
+            self._sharefile.flush_writes()
+            return compute_share_digest(ShareFile(self.incominghome))
+        # reads of the finished share will return zeros for any part of the
+        # allocated space that was never written
+        unwritten = self._max_size - self._digest_offset
+        while unwritten > 0:
+            zeros = min(unwritten, 1024*1024)
+            hasher.update("\x00" * zeros)
+            unwritten -= zeros
+        return hasher.digest()
+
+    def _finish_share(self):
+        """Move the completed share from incominghome to its permanent home,
+        and return the number of bytes it occupies there."""
+        self._sharefile.close_for_writing(fsync=(self._fsync_policy != "none"))
         fileutil.make_dirs(os.path.dirname(self.finalhome))
         fileutil.rename(self.incominghome, self.finalhome)
+        self._moved = True
+        if self._fsync_policy == "close-and-dir":
+            fileutil.fsync_directory(os.path.dirname(self.finalhome))
+        self._remove_incoming_dirs()
+        self.identity = get_share_identity(self.finalhome)
+        (size, mtime, ino) = self.identity
+        return size
+
+    def _remove_incoming_dirs(self):
         try:
             # self.incominghome is like storage/shares/incoming/ab/abcde/4 .
             # We try to delete the parent (.../ab/abcde) to avoid leaving
@@ -253,14 +518,6 @@ class BucketWriter(Referenceable):
             # exceptions, those are normal consequences of the
             # above-mentioned conditions.
             pass
-        self._sharefile = None
-        self.closed = True
-        self._canary.dontNotifyOnDisconnect(self._disconnect_marker)
-
-        filelen = os.stat(self.finalhome)[stat.ST_SIZE]
-        self.ss.bucket_writer_closed(self, filelen)
-        self.ss.add_latency("close", time.time() - start)
-        self.ss.count("close")
 
     def _disconnected(self):
         if not self.closed:
@@ -271,26 +528,31 @@ class BucketWriter(Referenceable):
                 facility="tahoe.storage", level=log.UNUSUAL)
         if not self.closed:
             self._canary.dontNotifyOnDisconnect(self._disconnect_marker)
-        self._abort()
+        d = self._abort()
         self.ss.count("abort")
+        return d
 
     def _abort(self):
         if self.closed:
             return
 
+        # We are now considered closed for further writing. Once the share
+        # is gone, we must tell the storage server about this so that it
+        # stops expecting us to use the space it allocated for us earlier.
+        self.closed = True
+        def _aborted(ign):
+            self._sharefile = None
+            self.ss.bucket_writer_closed(self, 0)
+        return when_done(self._call_io(self._remove_share), _aborted)
+
+    def _remove_share(self):
+        self._sharefile.close_for_writing()
         os.remove(self.incominghome)
         # if we were the last share to be moved, remove the incoming/
         # directory that was our parent
         parentdir = os.path.split(self.incominghome)[0]
         if not os.listdir(parentdir):
             os.rmdir(parentdir)
-        self._sharefile = None
-
-        # We are now considered closed for further writing. We must tell
-        # the storage server about this so that it stops expecting us to
-        # use the space it allocated for us earlier.
-        self.closed = True
-        self.ss.bucket_writer_closed(self, 0)
 
 
 class BucketReader(Referenceable):
@@ -298,7 +560,13 @@ class BucketReader(Referenceable):
 
     def __init__(self, ss, sharefname, storage_index=None, shnum=None):
         self.ss = ss
-        self._share_file = ShareFile(sharefname)
+        self._diskio = ss.diskio
+        fdcache = ss.fdcache
+        if self._diskio is not None:
+            # the cache may only be used from the reactor thread
+            fdcache = None
+        self._share_file = ShareFile(sharefname, fdcache=fdcache)
+        self._io_path = sharefname
         self.storage_index = storage_index
         self.shnum = shnum
 
@@ -307,12 +575,25 @@ class BucketReader(Referenceable):
                                base32.b2a_l(self.storage_index[:8], 60),
                                self.shnum)
 
+    def _call_io(self, f, *args):
+        return call_io(self._diskio, self._io_path, f, *args)
+
     def remote_read(self, offset, length):
         start = time.time()
-        data = self._share_file.read_share_data(offset, length)
-        self.ss.add_latency("read", time.time() - start)
-        self.ss.count("read")
-        return data
+        def _read(data):
+            self.ss.add_latency("read", time.time() - start)
+            self.ss.count("read")
+            return data
+        return when_done(self._call_io(self._share_file.read_share_data,
+                                       offset, length), _read)
+
+    def remote_readv(self, readv):
+        start = time.time()
+        def _read(datav):
+            self.ss.add_latency("readv-immutable", time.time() - start)
+            self.ss.count("readv-immutable")
+            return datav
+        return when_done(self._call_io(self._share_file.readv, readv), _read)
 
     def remote_advise_corrupt_share(self, reason):
         return self.ss.remote_advise_corrupt_share("immutable",
@@ -0,0 +1,149 @@
+
+import os, re, struct, time
+
+from allmydata.storage.common import storage_index_to_dir
+from allmydata.storage.mutable import MutableShareFile
+from allmydata.util.lrucache import LRUCache
+
+# $SHARENUM matches this regex:
+NUM_RE=re.compile("^[0-9]+$")
+
+def scan_bucket(bucketdir):
+    """Return a dict mapping shnum to (pathname, sharetype, size) for the
+    share files in bucketdir. 'sharetype' is 'mutable' or 'immutable', or
+    None for files that do not look like share containers. A missing
+    bucketdir simply has no shares."""
+    shares = {}
+    try:
+        filenames = os.listdir(bucketdir)
+    except OSError:
+        # Commonly caused by there being no buckets at all.
+        return shares
+    for f in filenames:
+        if not NUM_RE.match(f):
+            continue
+        filename = os.path.join(bucketdir, f)
+        try:
+            fh = open(filename, 'rb')
+            try:
+                header = fh.read(32)
+            finally:
+                fh.close()
+            size = os.path.getsize(filename)
+        except EnvironmentError:
+            continue # vanished while we were looking at it
+        if header[:32] == MutableShareFile.MAGIC:
+            sharetype = "mutable"
+        elif header[:4] == struct.pack(">L", 1):
+            sharetype = "immutable"
+        else:
+            sharetype = None # non-sharefile
+        shares[int(f)] = (filename, sharetype, size)
+    return shares
+
+
+class ShareInventory:
+    """I remember which share files live in each bucket directory, so that
+    the storage server does not need to listdir() and open every share to
+    answer a request. I hold at most 'size' buckets, evicting the least
+    recently used one when I am full; a size of 0 disables caching.
+
+    I am populated lazily, and the storage server must call forget() for a
+    storage index whenever it creates, modifies, or deletes one of its
+    shares. Shares that are added, removed, or rewritten behind the server's
+    back (by an operator moving shares between servers, say) are noticed
+    too: along with each listing I remember the mtime and inode of its
+    bucket directory and of each share file in it, and I list the directory
+    again if any of them has changed. That costs a stat() of the directory
+    and of each share per lookup, which is still much cheaper than listing
+    the directory and reading the header of every share.
+    """
+
+    # On filesystems that only record whole seconds, a file changed in the
+    # same second as we looked at it might change again without its mtime
+    # moving, so such a listing is checked against the disk every time
+    # until it is old enough to be trusted. On any filesystem, a listing of
+    # files that changed while we were reading them is not trusted.
+    RACY_WINDOW = 2
+
+    def __init__(self, sharedir, size=10000):
+        self.sharedir = sharedir
+        self.hits = 0
+        self.misses = 0
+        self._buckets = LRUCache(size) # storage_index -> (identity, shares)
+
+    def _bucketdir(self, storage_index):
+        return os.path.join(self.sharedir, storage_index_to_dir(storage_index))
+
+    def _get_identity(self, bucketdir, shares):
+        """Return what tells us whether bucketdir, or any of the share files
+        in 'shares' (as returned by scan_bucket), have changed: a tuple of
+        the (mtime, inode) of the directory and the (mtime, size, inode) of
+        each share, or () if the directory does not exist."""
+        try:
+            s = os.stat(bucketdir)
+        except OSError:
+            return ()
+        identity = [(s.st_mtime, s.st_ino)]
+        for shnum in sorted(shares):
+            try:
+                s = os.stat(shares[shnum][0])
+            except OSError:
+                identity.append(None) # removed
+                continue
+            identity.append((s.st_mtime, s.st_size, s.st_ino))
+        return tuple(identity)
+
+    def _is_racy(self, identity, start):
+        for entry in identity:
+            if entry is None:
+                return True
+            mtime = entry[0]
+            if mtime >= start:
+                return True # changed while we were reading it
+            if mtime == int(mtime) and time.time() - mtime < self.RACY_WINDOW:
+                return True
+        return False
+
+    def get_shares(self, storage_index):
+        """Return a dict mapping shnum to (pathname, sharetype, size) for the
+        shares I have for this storage index. The caller must not modify
+        it."""
+        shares = self.get_cached_shares(storage_index)
+        if shares is not None:
+            return shares
+        self.misses += 1
+        bucketdir = self._bucketdir(storage_index)
+        start = time.time()
+        shares = scan_bucket(bucketdir)
+        identity = self._get_identity(bucketdir, shares)
+        if self._is_racy(identity, start):
+            identity = None # see RACY_WINDOW
+        self._buckets.set(storage_index, (identity, shares))
+        return shares
+
+    def get_cached_shares(self, storage_index):
+        """Return what get_shares() would, if I have an up-to-date listing
+        for this storage index, or None if the directory would have to be
+        listed."""
+        entry = self._buckets.get(storage_index)
+        if entry is None or entry[0] is None:
+            return None
+        if entry[0] != self._get_identity(self._bucketdir(storage_index),
+                                          entry[1]):
+            return None
+        self.hits += 1
+        return entry[1]
+
+    def forget(self, storage_index):
+        self._buckets.pop(storage_index)
+
+    def clear(self):
+        self._buckets.clear()
+
+    def get_stats(self):
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "evictions": self._buckets.evictions,
+                "buckets": len(self._buckets),
+                }
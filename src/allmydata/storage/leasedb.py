@@ -0,0 +1,359 @@
+import os, struct
+
+from allmydata.util import base32, log
+from allmydata.util.dbutil import get_db
+from allmydata.util.hashutil import timing_safe_compare
+from allmydata.storage.common import si_b2a, si_a2b, \
+     UnknownMutableContainerVersionError, UnknownImmutableContainerVersionError
+from allmydata.storage.lease import LeaseInfo
+from allmydata.storage.shares import get_share_file
+from allmydata.storage.crawler import ShareCrawler
+
+# The lease database (storage/leasedb.sqlite) is an optional index of every
+# share held by this server, and of every lease on those shares. When it is
+# enabled, it is authoritative for leases: add-lease, renew-lease and the
+# lease-checker consult and update the database instead of opening each
+# share container, and the lease records embedded in the share files are
+# only read once, when a share that predates the database is imported.
+#
+# Shares are identified by (base32 storage index, share number). Secrets are
+# stored in base32, and are compared with timing_safe_compare() after the
+# rows for a given share have been fetched by storage index.
+
+SCHEMA_v1 = """
+CREATE TABLE version
+(
+ version INTEGER  -- contains one row, set to 1
+);
+
+CREATE TABLE shares
+(
+ storage_index VARCHAR(26) NOT NULL, -- base32
+ shnum INTEGER NOT NULL,
+ sharetype VARCHAR(9) NOT NULL,      -- 'immutable' or 'mutable'
+ PRIMARY KEY (storage_index, shnum)
+);
+
+CREATE TABLE leases
+(
+ storage_index VARCHAR(26) NOT NULL,
+ shnum INTEGER NOT NULL,
+ owner_num INTEGER NOT NULL,
+ renew_secret VARCHAR(52) NOT NULL,  -- base32
+ cancel_secret VARCHAR(52) NOT NULL, -- base32
+ expiration_time INTEGER NOT NULL,   -- seconds since epoch
+ nodeid VARCHAR(32),                 -- base32, only recorded for mutable shares
+ FOREIGN KEY (storage_index, shnum) REFERENCES shares (storage_index, shnum)
+   ON DELETE CASCADE
+);
+
+CREATE INDEX leases_by_share ON leases (storage_index, shnum);
+"""
+
+INDEX_EXPIRATION = """
+CREATE INDEX leases_by_expiration ON leases (expiration_time); -- added in v2
+"""
+
+SCHEMA_v2 = SCHEMA_v1 + INDEX_EXPIRATION
+
+UPDATE_v1_to_v2 = INDEX_EXPIRATION + """
+UPDATE version SET version=2;
+"""
+
+UPDATERS = {
+    2: UPDATE_v1_to_v2,
+}
+
+def _next_prefix(prefix):
+    # the smallest string that sorts after every string that starts with
+    # 'prefix'
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class LeaseDB:
+    VERSION = 2
+
+    def __init__(self, dbfile):
+        # this raises DBError if the database cannot be opened or upgraded
+        (self.sqlite_module, self.connection) = \
+            get_db(dbfile, create_version=(SCHEMA_v2, self.VERSION),
+                   updaters=UPDATERS, dbname="leasedb",
+                   journal_mode="WAL", synchronous="NORMAL")
+        self.cursor = self.connection.cursor()
+
+    def _row_to_lease(self, row):
+        (owner_num, renew_secret, cancel_secret, expiration_time, nodeid) = row
+        if nodeid is not None:
+            nodeid = base32.a2b(str(nodeid))
+        return LeaseInfo(owner_num,
+                         base32.a2b(str(renew_secret)),
+                         base32.a2b(str(cancel_secret)),
+                         expiration_time, nodeid)
+
+    def _insert_lease(self, si_s, shnum, lease_info):
+        nodeid = None
+        if lease_info.nodeid is not None:
+            nodeid = base32.b2a(lease_info.nodeid)
+        self.cursor.execute("INSERT INTO leases VALUES (?,?,?,?,?,?,?)",
+                            (si_s, shnum, lease_info.owner_num,
+                             base32.b2a(lease_info.renew_secret),
+                             base32.b2a(lease_info.cancel_secret),
+                             int(lease_info.expiration_time), nodeid))
+
+    def _get_lease_rows(self, si_s, shnum):
+        self.cursor.execute("SELECT rowid, owner_num, renew_secret,"
+                            " cancel_secret, expiration_time, nodeid"
+                            " FROM leases"
+                            " WHERE storage_index=? AND shnum=?",
+                            (si_s, shnum))
+        return [(row[0], self._row_to_lease(row[1:]))
+                for row in self.cursor.fetchall()]
+
+    def get_shares(self, storage_index):
+        """Return a dict mapping shnum to sharetype for all shares of the
+        given storage index that are recorded in the database."""
+        self.cursor.execute("SELECT shnum, sharetype FROM shares"
+                            " WHERE storage_index=?",
+                            (si_b2a(storage_index),))
+        return dict([(shnum, str(sharetype))
+                     for (shnum, sharetype) in self.cursor.fetchall()])
+
+    def get_storage_indexes_with_prefix(self, prefix):
+        """Return a set of the base32 storage indexes that start with the
+        given (base32) prefix and have at least one share recorded."""
+        self.cursor.execute("SELECT DISTINCT storage_index FROM shares"
+                            " WHERE storage_index >= ? AND storage_index < ?",
+                            (prefix, _next_prefix(prefix)))
+        return set([str(row[0]) for row in self.cursor.fetchall()])
+
+    def add_new_share(self, storage_index, shnum, sharetype):
+        self.cursor.execute("INSERT OR IGNORE INTO shares VALUES (?,?,?)",
+                            (si_b2a(storage_index), shnum, sharetype))
+        self.connection.commit()
+
+    def remove_deleted_share(self, storage_index, shnum):
+        # the leases go away with the share, by ON DELETE CASCADE
+        self.cursor.execute("DELETE FROM shares"
+                            " WHERE storage_index=? AND shnum=?",
+                            (si_b2a(storage_index), shnum))
+        self.connection.commit()
+
+    def import_share(self, storage_index, shnum, sf):
+        """Record a share (and the leases held in its container) that was
+        not created through this database. Do nothing if the share is
+        already known. Returns True if the share was imported."""
+        si_s = si_b2a(storage_index)
+        self.cursor.execute("INSERT OR IGNORE INTO shares VALUES (?,?,?)",
+                            (si_s, shnum, sf.sharetype))
+        if self.cursor.rowcount != 1:
+            return False
+        for lease_info in sf.get_leases():
+            self._insert_lease(si_s, shnum, lease_info)
+        self.connection.commit()
+        return True
+
+    def get_leases(self, storage_index, shnum):
+        """Return a list of LeaseInfo instances for the given share."""
+        return [lease for (rowid, lease)
+                in self._get_lease_rows(si_b2a(storage_index), shnum)]
+
+    def get_leases_with_ids(self, storage_index, shnum):
+        """Return a list of (lease_id, LeaseInfo) tuples for the given
+        share. lease_id identifies the lease for remove_lease()."""
+        return self._get_lease_rows(si_b2a(storage_index), shnum)
+
+    def add_or_renew_leases(self, storage_index, shnums, lease_info):
+        """For each of the given shares, renew the lease that has the same
+        renew secret as lease_info, or add lease_info as a new lease if
+        there is no such lease. Leases are never shortened."""
+        si_s = si_b2a(storage_index)
+        for shnum in shnums:
+            for (rowid, lease) in self._get_lease_rows(si_s, shnum):
+                if timing_safe_compare(lease.renew_secret,
+                                       lease_info.renew_secret):
+                    if lease_info.expiration_time > lease.expiration_time:
+                        self.cursor.execute("UPDATE leases"
+                                            " SET expiration_time=?"
+                                            " WHERE rowid=?",
+                                            (int(lease_info.expiration_time),
+                                             rowid))
+                    break
+            else:
+                self._insert_lease(si_s, shnum, lease_info)
+        self.connection.commit()
+
+    def renew_leases(self, storage_index, shnums, renew_secret,
+                     new_expire_time):
+        """Renew the lease with the given renew secret on each of the given
+        shares. Raise IndexError if any of them lacks such a lease; shares
+        that were processed before that one keep their renewed lease."""
+        si_s = si_b2a(storage_index)
+        try:
+            for shnum in shnums:
+                for (rowid, lease) in self._get_lease_rows(si_s, shnum):
+                    if timing_safe_compare(lease.renew_secret, renew_secret):
+                        if new_expire_time > lease.expiration_time:
+                            self.cursor.execute("UPDATE leases"
+                                                " SET expiration_time=?"
+                                                " WHERE rowid=?",
+                                                (int(new_expire_time), rowid))
+                        break
+                else:
+                    raise IndexError("unable to renew non-existent lease")
+        finally:
+            self.connection.commit()
+
+    def cancel_lease(self, storage_index, shnum, cancel_secret):
+        """Remove any leases on the given share that have the given cancel
+        secret. Return the number of leases that remain. Raise IndexError if
+        there was no lease with that cancel secret. The share itself is
+        left in place: the caller is responsible for deleting it (and
+        calling remove_deleted_share) when no leases remain."""
+        si_s = si_b2a(storage_index)
+        remaining = 0
+        cancelled = []
+        for (rowid, lease) in self._get_lease_rows(si_s, shnum):
+            if timing_safe_compare(lease.cancel_secret, cancel_secret):
+                cancelled.append(rowid)
+            else:
+                remaining += 1
+        if not cancelled:
+            raise IndexError("unable to find matching lease to cancel")
+        for rowid in cancelled:
+            self.cursor.execute("DELETE FROM leases WHERE rowid=?", (rowid,))
+        self.connection.commit()
+        return remaining
+
+    def get_expired_leases(self, expiration_cutoff, sharetypes,
+                           after_rowid=0, limit=100):
+        """Return up to 'limit' leases that expire before
+        expiration_cutoff, on shares of one of the given sharetypes, as a
+        list of (lease_id, storage_index, shnum, sharetype) tuples ordered by
+        lease_id. Use after_rowid to continue from the last lease_id of a
+        previous batch. This uses the expiration-time index, so it costs
+        time proportional to the number of expired leases rather than to the
+        number of shares."""
+        sharetypes = list(sharetypes)
+        if not sharetypes:
+            return []
+        self.cursor.execute("SELECT leases.rowid, leases.storage_index,"
+                            " leases.shnum, shares.sharetype"
+                            " FROM leases, shares"
+                            " WHERE leases.expiration_time < ?"
+                            " AND leases.rowid > ?"
+                            " AND shares.storage_index=leases.storage_index"
+                            " AND shares.shnum=leases.shnum"
+                            " AND shares.sharetype IN (%s)"
+                            " ORDER BY leases.rowid LIMIT ?"
+                            % ",".join(["?"] * len(sharetypes)),
+                            [int(expiration_cutoff), after_rowid]
+                            + sharetypes + [limit])
+        return [(rowid, si_a2b(str(si_s)), shnum, str(sharetype))
+                for (rowid, si_s, shnum, sharetype) in self.cursor.fetchall()]
+
+    def remove_lease(self, lease_id, storage_index, shnum):
+        """Remove a single lease, as identified by get_expired_leases().
+        Return the number of leases that remain on its share."""
+        si_s = si_b2a(storage_index)
+        self.cursor.execute("DELETE FROM leases WHERE rowid=?", (lease_id,))
+        self.cursor.execute("SELECT COUNT(*) FROM leases"
+                            " WHERE storage_index=? AND shnum=?",
+                            (si_s, shnum))
+        (remaining,) = self.cursor.fetchone()
+        self.connection.commit()
+        return remaining
+
+
+class LeaseDBCrawler(ShareCrawler):
+    """I keep the lease database consistent with the share files on disk.
+    Each cycle, I import shares that are present on disk but unknown to the
+    database (for example shares that were stored before the database was
+    enabled, or which were copied into place by hand), and I remove database
+    records for shares that have disappeared from disk.
+
+    My state records the number of shares imported and removed during the
+    current cycle ('cycle-to-date') and the most recently finished cycle
+    ('last-cycle').
+    """
+
+    slow_start = 60 # import early, since until then lookups are slower
+    minimum_cycle_time = 24*60*60 # reconcile at most once a day
+
+    def __init__(self, server, statefile, leasedb):
+        self.leasedb = leasedb
+        ShareCrawler.__init__(self, server, statefile)
+
+    def add_initial_state(self):
+        self.state.setdefault("cycle-to-date", self.create_empty_cycle_dict())
+        self.state.setdefault("last-cycle", None)
+
+    def create_empty_cycle_dict(self):
+        return {"imported-shares": 0,
+                "removed-shares": 0,
+                "corrupt-shares": [],
+                }
+
+    def started_cycle(self, cycle):
+        self.state["cycle-to-date"] = self.create_empty_cycle_dict()
+
+    def process_prefixdir(self, cycle, prefix, prefixdir, buckets, start_slice):
+        ShareCrawler.process_prefixdir(self, cycle, prefix, prefixdir,
+                                       buckets, start_slice)
+        # now look for whole buckets that the database knows about, but
+        # which are no longer on disk
+        on_disk = set(buckets)
+        for si_s in self.leasedb.get_storage_indexes_with_prefix(prefix):
+            if si_s not in on_disk:
+                self.reconcile_bucket(si_s, [])
+
+    def process_bucket(self, cycle, prefix, prefixdir, storage_index_b32):
+        bucketdir = os.path.join(prefixdir, storage_index_b32)
+        try:
+            filenames = os.listdir(bucketdir)
+        except EnvironmentError:
+            filenames = []
+        self.reconcile_bucket(storage_index_b32, filenames, bucketdir)
+
+    def reconcile_bucket(self, storage_index_b32, filenames, bucketdir=None):
+        storage_index = si_a2b(storage_index_b32)
+        on_disk = {}
+        for fn in filenames:
+            try:
+                shnum = int(fn)
+            except ValueError:
+                continue # non-numeric means not a sharefile
+            on_disk[shnum] = os.path.join(bucketdir, fn)
+        known = self.leasedb.get_shares(storage_index)
+        so_far = self.state["cycle-to-date"]
+
+        for shnum in sorted(set(on_disk) - set(known)):
+            try:
+                sf = get_share_file(on_disk[shnum])
+                self.leasedb.import_share(storage_index, shnum, sf)
+            except (UnknownMutableContainerVersionError,
+                    UnknownImmutableContainerVersionError,
+                    struct.error):
+                log.msg(format="leasedb-crawler: unable to import %(fn)s",
+                        fn=on_disk[shnum], facility="tahoe.storage",
+                        level=log.UNUSUAL, umid="bV0bxw")
+                so_far["corrupt-shares"].append((storage_index_b32, shnum))
+                self.touch_state("cycle-to-date", "corrupt-shares")
+                continue
+            so_far["imported-shares"] += 1
+            self.touch_state("cycle-to-date", "imported-shares")
+
+        missing = set(known) - set(on_disk)
+        if missing:
+            # the backend may keep some shares outside the share directories.
+            # Our listing is fresher than the server's cached one.
+            self.server.forget_bucket(storage_index)
+            missing -= set(self.server.backend.get_shares(storage_index))
+        for shnum in sorted(missing):
+            self.leasedb.remove_deleted_share(storage_index, shnum)
+            so_far["removed-shares"] += 1
+            self.touch_state("cycle-to-date", "removed-shares")
+
+    def finished_cycle(self, cycle):
+        last = self.state["cycle-to-date"].copy()
+        last["corrupt-shares"] = last["corrupt-shares"][:]
+        self.state["last-cycle"] = last
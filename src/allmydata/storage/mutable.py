@@ -4,6 +4,7 @@ from allmydata.interfaces import BadWriteEnablerError
 from allmydata.util import idlib, log
 from allmydata.util.assertutil import precondition
 from allmydata.util.hashutil import timing_safe_compare
+from allmydata.util.spans import Spans, DataSpans
 from allmydata.storage.lease import LeaseInfo
 from allmydata.storage.common import UnknownMutableContainerVersionError, \
      DataTooLargeError
@@ -26,6 +27,7 @@ from allmydata.mutable.layout import MAX_MUTABLE_SHARE_SIZE
 #                        40  32   cancel token
 #                        72  20   nodeid which accepted the tokens
 # 7   468       (a)     data
+#     ??        ??      unused space, for the data to grow into
 # 8   ??        4       count of extra leases
 # 9   ??        n*92    extra leases
 
@@ -52,13 +54,22 @@ class MutableShareFile:
     assert len(MAGIC) == 32
     MAX_SIZE = MAX_MUTABLE_SHARE_SIZE
     # TODO: decide upon a policy for max share size
+    # when the data outgrows the container, we make room for it to grow by
+    # another eighth (and at least this much) before the extra leases have
+    # to be moved again
+    MIN_GROWTH_RESERVE = 4096
 
-    def __init__(self, filename, parent=None):
+    def __init__(self, filename, parent=None, fdcache=None):
         self.home = filename
+        self._fdcache = fdcache
         if os.path.exists(self.home):
             # we don't cache anything, just check the magic
-            f = open(self.home, 'rb')
-            data = f.read(self.HEADER_SIZE)
+            f = self._open_for_read()
+            try:
+                f.seek(0)
+                data = f.read(self.HEADER_SIZE)
+            finally:
+                self._done_reading(f)
             (magic,
              write_enabler_nodeid, write_enabler,
              data_length, extra_least_offset) = \
@@ -92,7 +103,20 @@ class MutableShareFile:
         # extra leases go here, none at creation
         f.close()
 
+    def _open_for_read(self):
+        if self._fdcache:
+            return self._fdcache.open(self.home)
+        return open(self.home, 'rb')
+
+    def _done_reading(self, f):
+        if self._fdcache:
+            self._fdcache.done(f)
+        else:
+            f.close()
+
     def unlink(self):
+        if self._fdcache:
+            self._fdcache.forget(self.home)
         os.unlink(self.home)
 
     def _read_data_length(self, f):
@@ -139,13 +163,16 @@ class MutableShareFile:
         f.write(struct.pack(">L", num_leases))
 
     def _change_container_size(self, f, new_container_size):
+        """Move the extra leases so that the container can hold
+        new_container_size bytes of data. Return the number of bytes
+        written."""
         if new_container_size > self.MAX_SIZE:
             raise DataTooLargeError()
         old_extra_lease_offset = self._read_extra_lease_offset(f)
         new_extra_lease_offset = self.DATA_OFFSET + new_container_size
         if new_extra_lease_offset < old_extra_lease_offset:
             # TODO: allow containers to shrink. For now they remain large.
-            return
+            return 0
         num_extra_leases = self._read_num_extra_leases(f)
         f.seek(old_extra_lease_offset)
         leases_size = 4 + num_extra_leases * self.LEASE_SIZE
@@ -162,6 +189,20 @@ class MutableShareFile:
         f.seek(new_extra_lease_offset)
         f.write(extra_lease_data)
         self._write_extra_lease_offset(f, new_extra_lease_offset)
+        return 2*leases_size + 8
+
+    def _grow_container(self, f, data_size):
+        """Make sure the container can hold data_size bytes of data, leaving
+        some room to spare if it has to be enlarged. Return the number of
+        bytes written."""
+        extra_lease_offset = self._read_extra_lease_offset(f)
+        if self.DATA_OFFSET + data_size <= extra_lease_offset:
+            return 0
+        if data_size > self.MAX_SIZE:
+            raise DataTooLargeError()
+        reserve = max(self.MIN_GROWTH_RESERVE, data_size // 8)
+        return self._change_container_size(f, min(data_size + reserve,
+                                                  self.MAX_SIZE))
 
     def _write_share_data(self, f, offset, data):
         length = len(data)
@@ -372,10 +413,12 @@ class MutableShareFile:
 
     def readv(self, readv):
         datav = []
-        f = open(self.home, 'rb')
-        for (offset, length) in readv:
-            datav.append(self._read_share_data(f, offset, length))
-        f.close()
+        f = self._open_for_read()
+        try:
+            for (offset, length) in readv:
+                datav.append(self._read_share_data(f, offset, length))
+        finally:
+            self._done_reading(f)
         return datav
 
 #    def remote_get_length(self):
@@ -385,10 +428,12 @@ class MutableShareFile:
 #        return data_length
 
     def check_write_enabler(self, write_enabler, si_s):
-        f = open(self.home, 'rb+')
-        (real_write_enabler, write_enabler_nodeid) = \
-                             self._read_write_enabler_and_nodeid(f)
-        f.close()
+        f = self._open_for_read()
+        try:
+            (real_write_enabler, write_enabler_nodeid) = \
+                                 self._read_write_enabler_and_nodeid(f)
+        finally:
+            self._done_reading(f)
         # avoid a timing attack
         #if write_enabler != real_write_enabler:
         if not timing_safe_compare(write_enabler, real_write_enabler):
@@ -405,27 +450,62 @@ class MutableShareFile:
 
     def check_testv(self, testv):
         test_good = True
-        f = open(self.home, 'rb+')
-        for (offset, length, operator, specimen) in testv:
-            data = self._read_share_data(f, offset, length)
-            if not testv_compare(data, operator, specimen):
-                test_good = False
-                break
-        f.close()
+        f = self._open_for_read()
+        try:
+            for (offset, length, operator, specimen) in testv:
+                data = self._read_share_data(f, offset, length)
+                if not testv_compare(data, operator, specimen):
+                    test_good = False
+                    break
+        finally:
+            self._done_reading(f)
         return test_good
 
     def writev(self, datav, new_length):
+        """Apply a list of (offset, data) write vectors, in order, and then
+        truncate the data to new_length if that is shorter. Return the
+        number of bytes written to the share file."""
+        # Where the vectors overlap, the later ones win, so we combine them
+        # first and write each byte just once. The header is read and
+        # written (at most) once, rather than once per vector, and the
+        # container is enlarged (moving the extra leases) at most once.
+        spans = DataSpans()
         f = open(self.home, 'rb+')
-        for (offset, data) in datav:
-            self._write_share_data(f, offset, data)
-        if new_length is not None:
-            cur_length = self._read_data_length(f)
-            if new_length < cur_length:
-                self._write_data_length(f, new_length)
+        try:
+            data_length = self._read_data_length(f)
+            new_data_length = data_length
+            for (offset, data) in datav:
+                precondition(offset >= 0)
+                spans.add(offset, data)
+                new_data_length = max(new_data_length, offset+len(data))
+            written = self._grow_container(f, new_data_length)
+
+            # Fill any newly exposed empty space with 0's, rather than
+            # revealing whatever was there before (palimpsest).
+            exposed = Spans(data_length, new_data_length - data_length)
+            for (start, length) in exposed - spans.get_spans():
+                f.seek(self.DATA_OFFSET+start)
+                f.write('\x00'*length)
+                written += length
+
+            for (start, data) in spans.get_chunks():
+                f.seek(self.DATA_OFFSET+start)
+                f.write(data)
+                written += len(data)
+
+            if new_length is not None and new_length < new_data_length:
                 # TODO: if we're going to shrink the share file when the
                 # share data has shrunk, then call
                 # self._change_container_size() here.
-        f.close()
+                new_data_length = new_length
+            if new_data_length != data_length:
+                # an interrupt before this leaves the old data length in
+                # place
+                self._write_data_length(f, new_data_length)
+                written += 8
+        finally:
+            f.close()
+        return written
 
 def testv_compare(a, op, b):
     assert op in ("lt", "le", "eq", "ne", "ge", "gt")
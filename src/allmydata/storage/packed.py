@@ -0,0 +1,471 @@
+
+import os, re
+
+from twisted.internet import defer, threads
+from allmydata.util import fileutil, log
+from allmydata.util.assertutil import precondition
+from allmydata.util.dbutil import get_db
+from allmydata.storage.common import si_b2a, storage_index_to_dir
+from allmydata.storage.immutable import ShareFile, BucketWriter, BucketReader
+from allmydata.storage.backend import DiskBackend
+
+# The packed backend keeps small immutable shares in a few large pack files
+# instead of in a file (and a directory) each, which saves the inode and
+# block overhead that dominates the disk usage of servers holding millions
+# of small shares:
+#
+# storage/packs/index.sqlite : where each packed share lives
+# storage/packs/pack-$PACKID : share data, appended back to back
+#
+# Only the share data is packed: the container header is redundant, and the
+# leases live in the lease database, which this backend requires. Larger
+# immutable shares, and all mutable shares, are kept in the usual
+# one-file-per-share layout under storage/shares/ .
+#
+# Pack files are append-only. Deleting a packed share only marks its bytes
+# as dead; once at least COMPACT_RATIO of a (no longer growing) pack is
+# dead, the live shares are copied into a new pack and the old one is
+# removed. The copying (up to half a pack) is done in a worker thread, into
+# storage/packs/compacting-$PACKID, and only the switch of the index to the
+# new pack is done in the reactor thread. One pack is compacted at a time.
+
+SCHEMA_v1 = """
+CREATE TABLE version
+(
+ version INTEGER  -- contains one row, set to 1
+);
+
+CREATE TABLE packs
+(
+ pack_id INTEGER PRIMARY KEY,
+ size INTEGER NOT NULL,      -- bytes appended so far
+ dead_bytes INTEGER NOT NULL -- bytes belonging to deleted shares
+);
+
+CREATE TABLE shares
+(
+ storage_index VARCHAR(26) NOT NULL, -- base32
+ shnum INTEGER NOT NULL,
+ pack_id INTEGER NOT NULL,
+ offset INTEGER NOT NULL,
+ length INTEGER NOT NULL,
+ PRIMARY KEY (storage_index, shnum),
+ FOREIGN KEY (pack_id) REFERENCES packs (pack_id)
+);
+
+CREATE INDEX shares_by_pack ON shares (pack_id, offset);
+"""
+
+PACK_RE = re.compile("^pack-([0-9]+)$")
+COMPACTING_RE = re.compile("^compacting-([0-9]+)$")
+
+
+def copy_extents(oldfile, newfile, extents):
+    """Copy each (offset, length) extent of 'oldfile', in order, into a new
+    'newfile', and fsync it. Return the list of offsets at which they were
+    written. This is run in a worker thread."""
+    new_offsets = []
+    inf = open(oldfile, "rb")
+    outf = open(newfile, "wb")
+    try:
+        for (offset, length) in extents:
+            inf.seek(offset)
+            new_offsets.append(outf.tell())
+            outf.write(inf.read(length))
+        outf.flush()
+        os.fsync(outf.fileno())
+    finally:
+        inf.close()
+        outf.close()
+    return new_offsets
+
+
+class PackedShareStat:
+    """The subset of an os.stat() result that the lease checker uses."""
+    def __init__(self, size):
+        self.st_size = size
+
+
+class PackedShare:
+    """I provide the read side of ShareFile for a share stored in a pack.
+    Compaction may move the share while a client is reading it, so I look
+    up its location again after every compaction."""
+    sharetype = "immutable"
+
+    def __init__(self, backend, storage_index, shnum):
+        self._backend = backend
+        self._storage_index = storage_index
+        self._shnum = shnum
+        self._located_at = None
+        self._locate()
+
+    def _locate(self):
+        if self._located_at != self._backend.compactions:
+            location = self._backend._get_location(self._storage_index,
+                                                   self._shnum)
+            if location is None:
+                raise IOError("packed share %s:%d has been deleted"
+                              % (si_b2a(self._storage_index), self._shnum))
+            (pack_id, self._offset, self._length) = location
+            self._packfile = self._backend._packfile(pack_id)
+            self._located_at = self._backend.compactions
+
+    def get_data_length(self):
+        return self._length
+
+    def read_share_data(self, offset, length):
+        return self.readv([(offset, length)])[0]
+
+    def readv(self, readv):
+        self._locate()
+        results = []
+        fdcache = self._backend.fdcache
+        f = fdcache.open(self._packfile)
+        try:
+            for (offset, length) in readv:
+                precondition(offset >= 0)
+                # truncated just like ShareFile reads
+                actuallength = max(0, min(length, self._length-offset))
+                if actuallength == 0:
+                    results.append("")
+                    continue
+                f.seek(self._offset+offset)
+                results.append(f.read(actuallength))
+        finally:
+            fdcache.done(f)
+        return results
+
+    def get_leases(self):
+        return iter([]) # they are kept in the lease database
+
+
+class PackedBucketWriter(BucketWriter):
+    """I receive a share in the usual incoming file, then append it to a pack
+    when it is closed, unless it is too large to be packed."""
+
+    def __init__(self, ss, backend, storage_index, shnum, incominghome,
+                 finalhome, max_size, lease_info, canary, fsync_policy="none",
+                 compute_digest=False):
+        BucketWriter.__init__(self, ss, incominghome, finalhome, max_size,
+                              lease_info, canary, fsync_policy=fsync_policy,
+                              compute_digest=compute_digest)
+        self._backend = backend
+        self._storage_index = storage_index
+        self._shnum = shnum
+        # packs are indexed in SQLite, which must stay in the reactor thread
+        self._diskio = None
+
+    def _finish_share(self):
+        if self._max_size > self._backend.max_share_size:
+            return BucketWriter._finish_share(self)
+        self._sharefile.close_for_writing()
+        sf = ShareFile(self.incominghome)
+        data = sf.read_share_data(0, sf.get_data_length())
+        self._backend.add_share(self._storage_index, self._shnum, data,
+                                fsync=(self._fsync_policy != "none"))
+        os.remove(self.incominghome)
+        self._remove_incoming_dirs()
+        return len(data)
+
+
+class PackedBucketReader(BucketReader):
+    def __init__(self, ss, share, storage_index, shnum):
+        self.ss = ss
+        self._diskio = None # see PackedBucketWriter
+        self._share_file = share
+        self._io_path = None
+        self.storage_index = storage_index
+        self.shnum = shnum
+
+
+class PackedBackend(DiskBackend):
+    """I store immutable shares of up to max_share_size bytes in pack files
+    under BASEDIR/storage/packs/, and everything else the way DiskBackend
+    does."""
+
+    VERSION = 1
+    PACK_SIZE = 64*1024*1024 # start a new pack once one reaches this size
+    COMPACT_RATIO = 0.5
+
+    def __init__(self, sharedir, share_inventory, fdcache, packdir,
+                 max_share_size=64*1024):
+        DiskBackend.__init__(self, sharedir, share_inventory, fdcache)
+        self.packdir = packdir
+        self.max_share_size = max_share_size
+        self.compactions = 0
+        self._compact_queue = [] # pack_ids waiting to be compacted
+        self._compacting = None # (pack_id, Deferred) being compacted
+        self._stopped = False
+        fileutil.make_dirs(packdir)
+        # this raises DBError if the index cannot be opened
+        (self.sqlite_module, self.connection) = \
+            get_db(os.path.join(packdir, "index.sqlite"),
+                   create_version=(SCHEMA_v1, self.VERSION),
+                   dbname="pack index",
+                   journal_mode="WAL", synchronous="NORMAL")
+        self.cursor = self.connection.cursor()
+        self._remove_orphaned_packs()
+        self._current = None # (pack_id, file, size) being appended to
+        # running totals for get_stats(), so that polling them does not scan
+        # the index. Every change to the index must keep these up to date.
+        self.cursor.execute("SELECT COUNT(*), COALESCE(SUM(size), 0),"
+                            " COALESCE(SUM(dead_bytes), 0) FROM packs")
+        (self._packs, self._pack_bytes, self._dead_bytes) = \
+            self.cursor.fetchone()
+        self.cursor.execute("SELECT COUNT(*) FROM shares")
+        (self._packed_shares,) = self.cursor.fetchone()
+
+    def _packfile(self, pack_id):
+        return os.path.join(self.packdir, "pack-%d" % pack_id)
+
+    def _remove_orphaned_packs(self):
+        # a crash during compaction can leave behind a pack that never made
+        # it into the index, or a partial copy
+        self.cursor.execute("SELECT pack_id FROM packs")
+        known = set([row[0] for row in self.cursor.fetchall()])
+        for fn in os.listdir(self.packdir):
+            mo = PACK_RE.match(fn)
+            if (COMPACTING_RE.match(fn)
+                or (mo and int(mo.group(1)) not in known)):
+                log.msg("removing orphaned pack %s" % fn,
+                        facility="tahoe.storage", level=log.UNUSUAL)
+                os.remove(os.path.join(self.packdir, fn))
+
+    def _new_pack(self, commit=True):
+        self.cursor.execute("INSERT INTO packs (size, dead_bytes)"
+                            " VALUES (0, 0)")
+        pack_id = self.cursor.lastrowid
+        if commit:
+            self.connection.commit()
+        return pack_id
+
+    def _get_current_pack(self):
+        if self._current is None:
+            self.cursor.execute("SELECT pack_id, size FROM packs"
+                                " ORDER BY pack_id DESC LIMIT 1")
+            row = self.cursor.fetchone()
+            if row is None or row[1] >= self.PACK_SIZE:
+                pack_id = self._new_pack()
+                self._packs += 1
+                size = 0
+            else:
+                (pack_id, size) = row
+            self._current = (pack_id, open(self._packfile(pack_id), "ab"),
+                             size)
+        return self._current
+
+    def _get_location(self, storage_index, shnum):
+        self.cursor.execute("SELECT pack_id, offset, length FROM shares"
+                            " WHERE storage_index=? AND shnum=?",
+                            (si_b2a(storage_index), shnum))
+        return self.cursor.fetchone()
+
+    def add_share(self, storage_index, shnum, data, fsync=False):
+        (pack_id, f, size) = self._get_current_pack()
+        f.seek(0, os.SEEK_END)
+        offset = f.tell()
+        f.write(data)
+        f.flush()
+        if fsync:
+            os.fsync(f.fileno())
+        self.cursor.execute("INSERT INTO shares VALUES (?,?,?,?,?)",
+                            (si_b2a(storage_index), shnum, pack_id, offset,
+                             len(data)))
+        self.cursor.execute("UPDATE packs SET size=? WHERE pack_id=?",
+                            (offset+len(data), pack_id))
+        self.connection.commit()
+        self._packed_shares += 1
+        self._pack_bytes += offset+len(data) - size
+        if offset+len(data) >= self.PACK_SIZE:
+            f.close()
+            self._current = None
+        else:
+            self._current = (pack_id, f, offset+len(data))
+
+    def get_shares(self, storage_index):
+        shares = DiskBackend.get_shares(self, storage_index)
+        self.cursor.execute("SELECT shnum, length FROM shares"
+                            " WHERE storage_index=?",
+                            (si_b2a(storage_index),))
+        packed = self.cursor.fetchall()
+        if packed:
+            shares = shares.copy() # the inventory's dict is not ours
+            for (shnum, length) in packed:
+                shares[shnum] = (None, "immutable", length)
+        return shares
+
+    def have_shares(self):
+        self.cursor.execute("SELECT 1 FROM shares LIMIT 1")
+        return (self.cursor.fetchone() is not None
+                or DiskBackend.have_shares(self))
+
+    def make_bucket_writer(self, storageserver, storage_index, shnum,
+                           max_size, lease_info, canary, fsync_policy,
+                           compute_digest=False):
+        si_dir = storage_index_to_dir(storage_index)
+        incominghome = os.path.join(self.incomingdir, si_dir, "%d" % shnum)
+        finalhome = os.path.join(self.sharedir, si_dir, "%d" % shnum)
+        return PackedBucketWriter(storageserver, self, storage_index, shnum,
+                                  incominghome, finalhome, max_size,
+                                  lease_info, canary, fsync_policy,
+                                  compute_digest)
+
+    def make_bucket_reader(self, storageserver, storage_index, shnum,
+                           pathname):
+        if pathname is not None:
+            return DiskBackend.make_bucket_reader(self, storageserver,
+                                                  storage_index, shnum,
+                                                  pathname)
+        share = PackedShare(self, storage_index, shnum)
+        return PackedBucketReader(storageserver, share, storage_index, shnum)
+
+    def stat_share(self, storage_index, shnum):
+        location = self._get_location(storage_index, shnum)
+        if location is None:
+            return DiskBackend.stat_share(self, storage_index, shnum)
+        return PackedShareStat(location[2])
+
+    def delete_share(self, storage_index, shnum):
+        location = self._get_location(storage_index, shnum)
+        if location is None:
+            return DiskBackend.delete_share(self, storage_index, shnum)
+        (pack_id, offset, length) = location
+        self.cursor.execute("DELETE FROM shares"
+                            " WHERE storage_index=? AND shnum=?",
+                            (si_b2a(storage_index), shnum))
+        self.cursor.execute("UPDATE packs SET dead_bytes=dead_bytes+?"
+                            " WHERE pack_id=?", (length, pack_id))
+        self.connection.commit()
+        self._packed_shares -= 1
+        self._dead_bytes += length
+        self._maybe_compact(pack_id)
+
+    def _maybe_compact(self, pack_id):
+        if self._current is not None and self._current[0] == pack_id:
+            return # still growing
+        if (pack_id in self._compact_queue
+            or (self._compacting and self._compacting[0] == pack_id)):
+            return
+        self.cursor.execute("SELECT size, dead_bytes FROM packs"
+                            " WHERE pack_id=?", (pack_id,))
+        (size, dead_bytes) = self.cursor.fetchone()
+        if dead_bytes < size * self.COMPACT_RATIO:
+            return
+        self._compact_queue.append(pack_id)
+        self._compact_next()
+
+    def _compact_next(self):
+        if self._compacting is not None or self._stopped:
+            return
+        if not self._compact_queue:
+            return
+        pack_id = self._compact_queue.pop(0)
+        d = self.compact(pack_id)
+        self._compacting = (pack_id, d)
+        def _done(res):
+            self._compacting = None
+            self._compact_next()
+            return res
+        d.addBoth(_done)
+        d.addErrback(log.err, format="error compacting pack %(pack_id)d",
+                     pack_id=pack_id, facility="tahoe.storage",
+                     level=log.WEIRD, umid="p3xTbQ")
+
+    def compact(self, pack_id):
+        """Copy the live shares of a pack into a new one, then remove it.
+        Return a Deferred that fires when this is done. The shares are
+        copied in a worker thread, so they may be deleted in the meantime
+        (but nothing may be added to the pack)."""
+        self.cursor.execute("SELECT storage_index, shnum, offset, length"
+                            " FROM shares WHERE pack_id=? ORDER BY offset",
+                            (pack_id,))
+        live = self.cursor.fetchall()
+        tmpfile = os.path.join(self.packdir, "compacting-%d" % pack_id)
+        if live:
+            d = threads.deferToThread(copy_extents, self._packfile(pack_id),
+                                      tmpfile, [(offset, length)
+                                                for (si_s, shnum, offset,
+                                                     length) in live])
+        else:
+            d = defer.succeed([])
+        d.addCallback(self._switch_pack, pack_id, live, tmpfile)
+        return d
+
+    def _switch_pack(self, new_offsets, pack_id, live, tmpfile):
+        if self._stopped:
+            fileutil.remove_if_possible(tmpfile)
+            return
+        self.cursor.execute("SELECT storage_index, shnum FROM shares"
+                            " WHERE pack_id=?", (pack_id,))
+        still_live = set([tuple(row) for row in self.cursor.fetchall()])
+        moved = []
+        for ((si_s, shnum, offset, length), new_offset) in zip(live,
+                                                               new_offsets):
+            if (si_s, shnum) in still_live:
+                still_live.remove((si_s, shnum))
+                moved.append((new_offset, length, si_s, shnum))
+        if still_live:
+            # something was appended to the pack after all: leave it be
+            fileutil.remove_if_possible(tmpfile)
+            return
+        self.cursor.execute("SELECT size, dead_bytes FROM packs"
+                            " WHERE pack_id=?", (pack_id,))
+        (old_size, old_dead_bytes) = self.cursor.fetchone()
+        new_pack_id = None
+        new_size = new_dead_bytes = 0
+        if moved:
+            # the index only starts to point at the new pack once its data
+            # is safely on disk. Shares deleted during the copy are dead.
+            new_pack_id = self._new_pack(commit=False)
+            os.rename(tmpfile, self._packfile(new_pack_id))
+            self.cursor.executemany("UPDATE shares SET pack_id=?, offset=?"
+                                    " WHERE storage_index=? AND shnum=?",
+                                    [(new_pack_id, new_offset, si_s, shnum)
+                                     for (new_offset, length, si_s, shnum)
+                                     in moved])
+            new_size = os.stat(self._packfile(new_pack_id)).st_size
+            live_bytes = sum([length for (new_offset, length, si_s, shnum)
+                              in moved])
+            new_dead_bytes = new_size - live_bytes
+            self.cursor.execute("UPDATE packs SET size=?, dead_bytes=?"
+                                " WHERE pack_id=?",
+                                (new_size, new_dead_bytes, new_pack_id))
+        else:
+            fileutil.remove_if_possible(tmpfile)
+        oldfile = self._packfile(pack_id)
+        self.cursor.execute("DELETE FROM packs WHERE pack_id=?", (pack_id,))
+        self.connection.commit()
+        if moved:
+            self._packs += 1
+        self._packs -= 1
+        self._pack_bytes += new_size - old_size
+        self._dead_bytes += new_dead_bytes - old_dead_bytes
+        self.fdcache.forget(oldfile)
+        os.remove(oldfile)
+        self.compactions += 1
+        log.msg(format="compacted pack %(old)d into %(new)s"
+                " (%(shares)d live shares)",
+                old=pack_id, new=new_pack_id, shares=len(moved),
+                facility="tahoe.storage", level=log.OPERATIONAL)
+
+    def get_stats(self):
+        return {"packs": self._packs,
+                "packed_shares": self._packed_shares,
+                "pack_bytes": self._pack_bytes,
+                "dead_bytes": self._dead_bytes,
+                "compactions": self.compactions,
+                }
+
+    def stop(self):
+        """Stop compacting. Return a Deferred that fires once a copy that is
+        in progress has finished (and been thrown away), or None."""
+        self._stopped = True
+        self._compact_queue = []
+        if self._current is not None:
+            self._current[1].close()
+            self._current = None
+        if self._compacting is None:
+            return None
+        d = defer.Deferred()
+        self._compacting[1].addBoth(lambda ign: d.callback(None))
+        return d
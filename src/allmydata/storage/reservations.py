@@ -0,0 +1,52 @@
+
+import weakref
+
+class SpaceReservations:
+    """I keep a running total of the space promised to the BucketWriters
+    that are still being written, so that the storage server does not have
+    to add up every active writer each time it decides whether it can accept
+    another share. I also keep the total per client (by the tubid of the
+    uploader, or 'unknown' for local callers).
+
+    A writer's reservation is released when release() is called (when it is
+    closed or aborted), or when the writer is garbage-collected without
+    either of those happening, e.g. because the allocate_buckets() caller
+    dropped it.
+    """
+
+    def __init__(self):
+        self.total = 0
+        self._by_client = {} # client_id -> bytes
+        self._writers = {} # id(bw) -> (weakref, client_id, size)
+
+    def reserve(self, bw, client_id, size):
+        key = id(bw)
+        def _gone(ref):
+            self._release(key)
+        self._writers[key] = (weakref.ref(bw, _gone), client_id, size)
+        self.total += size
+        self._by_client[client_id] = self._by_client.get(client_id, 0) + size
+
+    def release(self, bw):
+        self._release(id(bw))
+
+    def _release(self, key):
+        # dropping the weakref here means _gone() will not be called later
+        entry = self._writers.pop(key, None)
+        if entry is None:
+            return
+        (ref, client_id, size) = entry
+        self.total -= size
+        left = self._by_client[client_id] - size
+        if left:
+            self._by_client[client_id] = left
+        else:
+            del self._by_client[client_id]
+
+    def __len__(self):
+        return len(self._writers)
+
+    def get_by_client(self):
+        """Return a dict mapping client_id to the number of bytes reserved
+        by that client's active uploads."""
+        return self._by_client.copy()
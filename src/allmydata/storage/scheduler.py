@@ -0,0 +1,254 @@
+from twisted.internet import defer, reactor
+from twisted.python import failure
+
+# The FairScheduler sits between each client's ClientSession (see
+# storage/session.py) and the StorageServer, so that one busy client cannot
+# take all of the server's attention. Each client (identified by the tubid
+# of its ClientSession) can have a budget of requests per second and bytes
+# per second, and the server can have a limit on the number of requests that
+# are in progress at once (which only matters when requests take a while,
+# e.g. when [storage]io_threads is set). A request that would go over
+# either is queued, and queued requests are started in round-robin order
+# across clients (favouring those with the fewest requests in progress), so
+# a client with a deep queue waits its turn behind clients that have only
+# one or two requests waiting. Clients can be marked as low priority (the
+# server uses this for all of the older clients that do not ask for a
+# session): their requests wait whenever anyone else's are waiting, and
+# only get a turn when no one else can have it.
+#
+# The server calls connect() for each session it hands out and disconnect()
+# when its client goes away, and a client is forgotten once it has no
+# sessions left and nothing in progress or queued.
+
+class _Client:
+    def __init__(self, client_id, ops_per_second, bytes_per_second, now,
+                 low_priority):
+        self.client_id = client_id
+        self.low_priority = low_priority
+        self.sessions = 0
+        self.departed = False
+        # each budget is a token bucket that can hold one second's worth
+        self.ops = ops_per_second
+        self.bytes = bytes_per_second
+        self.last_refill = now
+        self.queue = [] # (nbytes, f, args, Deferred, time queued)
+        self.active = 0
+        self.requests = 0
+        self.bytes_used = 0
+        self.throttled = 0
+        self.wait = 0.0
+
+
+class FairScheduler:
+    """I decide when each client's storage requests run.
+
+    call(client_id, nbytes, f, *args) either calls f(*args) right away and
+    returns its result, or, if the client is over budget or the server is
+    busy, queues it and returns a Deferred that fires with its result once
+    it has been run. A budget of 0 means no limit.
+
+    A request may take the client's token buckets below zero (so a single
+    large write is never refused), in which case the client's next request
+    waits until they have refilled.
+    """
+
+    def __init__(self, ops_per_second=0, bytes_per_second=0,
+                 max_concurrent=0, record_latency=None,
+                 low_priority_clients=()):
+        self.ops_per_second = ops_per_second
+        self.bytes_per_second = bytes_per_second
+        self.max_concurrent = max_concurrent
+        self._record_latency = record_latency
+        self._low_priority = frozenset(low_priority_clients)
+        self.clock = reactor # tests may replace this with a task.Clock
+        self.active = 0
+        self.throttled = 0 # including for clients that have been forgotten
+        self._clients = {} # client_id -> _Client
+        self._waiting = [] # client_ids with queued requests, in turn order
+        self._timer = None
+        self._dispatching = False
+
+    def _get_client(self, client_id):
+        now = self.clock.seconds()
+        if client_id not in self._clients:
+            self._clients[client_id] = _Client(
+                client_id, self.ops_per_second, self.bytes_per_second, now,
+                client_id in self._low_priority)
+        c = self._clients[client_id]
+        elapsed = now - c.last_refill
+        c.last_refill = now
+        if self.ops_per_second:
+            c.ops = min(self.ops_per_second,
+                        c.ops + elapsed * self.ops_per_second)
+        if self.bytes_per_second:
+            c.bytes = min(self.bytes_per_second,
+                          c.bytes + elapsed * self.bytes_per_second)
+        return c
+
+    def _may_start(self, c):
+        if self.max_concurrent and self.active >= self.max_concurrent:
+            return False
+        if self.ops_per_second and c.ops < 1:
+            return False
+        if self.bytes_per_second and c.bytes <= 0:
+            return False
+        return True
+
+    def connect(self, client_id):
+        """Note that a session has been handed out to this client."""
+        c = self._get_client(client_id)
+        c.sessions += 1
+        c.departed = False
+
+    def disconnect(self, client_id):
+        """Note that one of this client's sessions has gone away. Once it
+        has none left, the client is forgotten as soon as it is idle."""
+        c = self._clients.get(client_id)
+        if c is None:
+            return
+        c.sessions -= 1
+        if c.sessions <= 0:
+            c.departed = True
+            self._forget_if_idle(c)
+
+    def _forget_if_idle(self, c):
+        if (c.departed and not c.active and not c.queue
+            and self._clients.get(c.client_id) is c):
+            del self._clients[c.client_id]
+
+    def call(self, client_id, nbytes, f, *args):
+        c = self._get_client(client_id)
+        if (not c.queue and self._may_start(c)
+            and not (c.low_priority and self._waiting)):
+            return self._run(c, nbytes, f, args)
+        d = defer.Deferred()
+        c.queue.append((nbytes, f, args, d, self.clock.seconds()))
+        c.throttled += 1
+        self.throttled += 1
+        if client_id not in self._waiting:
+            self._waiting.append(client_id)
+        self._schedule()
+        return d
+
+    def _run(self, c, nbytes, f, args):
+        c.ops -= 1
+        c.bytes -= nbytes
+        c.requests += 1
+        c.bytes_used += nbytes
+        c.active += 1
+        self.active += 1
+        try:
+            result = f(*args)
+        except:
+            self._finished(None, c)
+            raise
+        if isinstance(result, defer.Deferred):
+            result.addBoth(self._finished, c)
+        else:
+            self._finished(None, c)
+        return result
+
+    def _finished(self, res, c):
+        c.active -= 1
+        self.active -= 1
+        self._forget_if_idle(c)
+        if not self._dispatching:
+            self._schedule()
+        return res
+
+    def _dispatch(self):
+        self._timer = None
+        self._dispatching = True
+        while True:
+            # the next turn goes to the waiting client with the fewest
+            # requests in progress, or the one that has waited longest for
+            # a turn, low-priority clients last. It then goes to the back
+            # of the line.
+            best = None
+            for client_id in self._waiting:
+                c = self._get_client(client_id)
+                if (self._may_start(c)
+                    and (best is None
+                         or ((c.low_priority, c.active)
+                             < (best.low_priority, best.active)))):
+                    best = c
+            if best is None:
+                break
+            c = best
+            (nbytes, f, args, d, queued) = c.queue.pop(0)
+            waited = self.clock.seconds() - queued
+            c.wait += waited
+            if self._record_latency:
+                self._record_latency("scheduler-wait", waited)
+            self._waiting.remove(c.client_id)
+            if c.queue:
+                self._waiting.append(c.client_id)
+            try:
+                result = self._run(c, nbytes, f, args)
+            except:
+                d.errback(failure.Failure())
+                continue
+            if isinstance(result, defer.Deferred):
+                result.chainDeferred(d)
+            else:
+                d.callback(result)
+        self._dispatching = False
+        self._schedule()
+
+    def _schedule(self):
+        # arrange for _dispatch to run when the first waiting client will
+        # have refilled its budget, unless it is already arranged, or we are
+        # waiting for requests in progress to finish
+        if not self._waiting or self._timer:
+            return
+        if self.max_concurrent and self.active >= self.max_concurrent:
+            return
+        delay = None
+        for client_id in self._waiting:
+            c = self._get_client(client_id)
+            wait = 0
+            if self.ops_per_second and c.ops < 1:
+                wait = (1 - c.ops) / float(self.ops_per_second)
+            if self.bytes_per_second and c.bytes <= 0:
+                # a little extra, so that the bucket is above zero by then
+                wait = max(wait,
+                           (1 - c.bytes) / float(self.bytes_per_second))
+            if delay is None or wait < delay:
+                delay = wait
+        self._timer = self.clock.callLater(delay, self._dispatch)
+
+    def stop(self):
+        """Stop the timer, and abandon the queued requests: their Deferreds
+        errback with CancelledError."""
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        self._waiting = []
+        for c in self._clients.values():
+            queue, c.queue = c.queue, []
+            for (nbytes, f, args, d, queued) in queue:
+                d.errback(defer.CancelledError("the storage server is "
+                                               "stopping"))
+
+    def get_stats(self):
+        return {"clients": len(self._clients),
+                "active": self.active,
+                "queued": sum([len(c.queue)
+                               for c in self._clients.values()]),
+                "throttled": self.throttled,
+                }
+
+    def get_client_stats(self):
+        """Return a dict mapping each client_id to a dict of how many
+        requests and bytes it has used, how many of its requests had to
+        wait ('throttled'), how many are waiting now ('queued'), and how
+        long (in seconds) they have waited in total ('wait')."""
+        stats = {}
+        for (client_id, c) in self._clients.items():
+            stats[client_id] = {"requests": c.requests,
+                                "bytes": c.bytes_used,
+                                "throttled": c.throttled,
+                                "queued": len(c.queue),
+                                "wait": c.wait,
+                                }
+        return stats
@@ -0,0 +1,311 @@
+import os, struct
+
+from twisted.internet import defer
+from twisted.python import failure
+
+from allmydata import hashtree, uri
+from allmydata.util import log, mathutil
+from allmydata.util.hashutil import block_hash
+from allmydata.immutable import layout as immutable_layout
+from allmydata.mutable import layout as mutable_layout
+from allmydata.mutable.common import BadShareError
+from allmydata.storage.common import si_a2b, get_share_identity, \
+     UnknownMutableContainerVersionError, UnknownImmutableContainerVersionError
+from allmydata.storage.shares import get_share_file
+from allmydata.storage.crawler import RateLimitedCrawler
+from pycryptopp.publickey import rsa
+
+# The scrubber reads every share on the server, and checks it the way the
+# Verifier would (see immutable/checker.py and mutable/checker.py), but
+# without the verify-cap: block data is checked against the block hash tree,
+# the block hash tree against the share hash chain, and the share hash chain
+# against the root hash recorded in the share itself (in the UEB for
+# immutable shares, and in the signed header for mutable shares, whose
+# signature is also checked). This catches shares that have been damaged on
+# disk, without sending them over the network. It cannot tell whether a
+# share which is consistent with itself is the share the uploader meant to
+# store: only a client holding the cap can do that.
+
+class ShareCorruption(Exception):
+    pass
+
+# errors which mean that a share could not be parsed
+PARSE_ERRORS = (immutable_layout.LayoutInvalid, BadShareError,
+                hashtree.BadHashError, hashtree.NotEnoughHashesError,
+                struct.error, ValueError, IndexError, KeyError,
+                AssertionError, rsa.Error,
+                UnknownMutableContainerVersionError,
+                UnknownImmutableContainerVersionError)
+
+
+class _LocalBucket:
+    """I let a ReadBucketProxy read an immutable share file directly."""
+    def __init__(self, sf):
+        self._sf = sf
+        self.bytes_read = 0
+
+    def callRemote(self, methname, offset, length):
+        assert methname == "read", methname
+        data = self._sf.read_share_data(offset, length)
+        self.bytes_read += len(data)
+        return defer.succeed(data)
+
+class _LocalSlot:
+    """I let an MDMFSlotReadProxy read a mutable share file directly."""
+    def __init__(self, msf, shnum):
+        self._msf = msf
+        self._shnum = shnum
+        self.bytes_read = 0
+
+    def callRemote(self, methname, storage_index, shnums, readv):
+        assert methname == "slot_readv", methname
+        datav = self._msf.readv(readv)
+        self.bytes_read += sum([len(data) for data in datav])
+        return defer.succeed({self._shnum: datav})
+
+def _result(d):
+    # the proxies only wait for their rref, and ours answer immediately
+    results = []
+    d.addBoth(results.append)
+    assert results, "read did not finish synchronously"
+    if isinstance(results[0], failure.Failure):
+        results[0].raiseException()
+    return results[0]
+
+def _check_block_hashes(leaves, stored):
+    computed = list(hashtree.HashTree(leaves))
+    if len(stored) != len(computed):
+        raise ShareCorruption("block hash tree has %d hashes, not %d"
+                              % (len(stored), len(computed)))
+    for (i, (a, b)) in enumerate(zip(computed, stored)):
+        if a != b:
+            if i >= len(computed) - len(leaves):
+                raise ShareCorruption("block %d does not match its hash"
+                                      % (i - (len(computed) - len(leaves))))
+            raise ShareCorruption("block hash tree node %d is wrong" % i)
+    return computed[0]
+
+def _check_share_hashes(num_shares, root_hash, share_hashes, shnum, leaf):
+    share_hash_tree = hashtree.IncompleteHashTree(num_shares)
+    share_hash_tree.set_hashes({0: root_hash})
+    try:
+        share_hash_tree.set_hashes(share_hashes, leaves={shnum: leaf})
+    except (hashtree.BadHashError, hashtree.NotEnoughHashesError), e:
+        raise ShareCorruption("share hash chain is bad: %s" % (e,))
+
+def verify_immutable_share(sf, storage_index, shnum):
+    """Check an immutable share (a ShareFile), one block at a time. I am a
+    generator which yields the number of bytes read so far each time I
+    finish a block, and raise ShareCorruption (or one of PARSE_ERRORS) if
+    the share is bad."""
+    bucket = _LocalBucket(sf)
+    rbp = immutable_layout.ReadBucketProxy(bucket, None, storage_index)
+    ueb = uri.unpack_extension(_result(rbp.get_uri_extension()))
+    k = ueb["needed_shares"]
+    n = ueb["total_shares"]
+    size = ueb["size"]
+    segment_size = ueb["segment_size"]
+    if not (0 < k <= n and shnum < n and size > 0 and segment_size > 0):
+        raise ShareCorruption("UEB has bad encoding parameters")
+    block_size = mathutil.div_ceil(segment_size, k)
+    share_size = mathutil.div_ceil(size, k)
+    num_segments = mathutil.div_ceil(size, segment_size)
+
+    crypttext_hash_tree = hashtree.IncompleteHashTree(num_segments)
+    crypttext_hash_tree.set_hashes({0: ueb["crypttext_root_hash"]})
+    crypttext_hashes = _result(rbp.get_crypttext_hashes())
+    try:
+        crypttext_hash_tree.set_hashes(dict(enumerate(crypttext_hashes)))
+    except (hashtree.BadHashError, hashtree.NotEnoughHashesError), e:
+        raise ShareCorruption("crypttext hash tree is bad: %s" % (e,))
+
+    leaves = []
+    for blocknum in range(num_segments):
+        if blocknum < num_segments-1:
+            thisblocksize = block_size
+        else:
+            thisblocksize = share_size % block_size or block_size
+        block = _result(rbp.get_block_data(blocknum, block_size,
+                                           thisblocksize))
+        if len(block) != thisblocksize:
+            raise ShareCorruption("block %d is truncated" % blocknum)
+        leaves.append(block_hash(block))
+        yield bucket.bytes_read
+
+    stored = _result(rbp.get_block_hashes(at_least_these=(0,)))
+    root = _check_block_hashes(leaves, stored)
+    share_hashes = dict(_result(rbp.get_share_hashes()))
+    _check_share_hashes(n, ueb["share_root_hash"], share_hashes, shnum, root)
+    yield bucket.bytes_read
+
+def verify_mutable_share(msf, storage_index, shnum):
+    """Like verify_immutable_share(), but for a MutableShareFile holding an
+    SDMF or MDMF share."""
+    slot = _LocalSlot(msf, shnum)
+    reader = mutable_layout.MDMFSlotReadProxy(slot, storage_index, shnum)
+    (seqnum, root_hash, IV, segsize, datalen, k, n, prefix,
+     offsets) = _result(reader.get_verinfo())
+    is_sdmf = _result(reader.is_sdmf())
+    if not (0 < k <= n and shnum < n):
+        raise ShareCorruption("header has bad encoding parameters")
+
+    pubkey = rsa.create_verifying_key_from_string(
+        _result(reader.get_verification_key()))
+    if not pubkey.verify(prefix, _result(reader.get_signature())):
+        raise ShareCorruption("signature is invalid")
+
+    if datalen == 0:
+        num_segments = 0
+    elif is_sdmf:
+        num_segments = 1
+    else:
+        num_segments = mathutil.div_ceil(datalen, segsize)
+    leaves = []
+    for segnum in range(num_segments):
+        (block, salt) = _result(reader.get_block_and_salt(segnum))
+        if is_sdmf:
+            leaves.append(block_hash(block))
+        else:
+            leaves.append(block_hash(salt + block))
+        yield slot.bytes_read
+
+    if num_segments:
+        stored = _result(reader.get_blockhashes())
+        root = _check_block_hashes(leaves, stored)
+        share_hashes = _result(reader.get_sharehashes())
+        _check_share_hashes(n, root_hash, share_hashes, shnum, root)
+    yield slot.bytes_read
+
+
+class ShareScrubber(RateLimitedCrawler):
+    """I read every share on the server and check its hashes (see
+    verify_immutable_share and verify_mutable_share), reading no more than
+    'rate' bytes per second on average. Large shares are checked over as
+    many time slices as it takes. Shares which fail are reported in the
+    server's corruption-advisories directory, once per cycle in which they
+    newly fail.
+
+    My state records the shares and bytes examined and the corrupt shares
+    found in the current cycle ('cycle-to-date') and in the most recently
+    finished one ('last-cycle'). Each corrupt share is recorded as a
+    (base32 storage index, shnum, sharetype, reason) tuple.
+
+    Shares kept by the packed backend are not checked.
+    """
+
+    minimum_cycle_time = 7*24*60*60 # scrub at most once a week
+
+    def __init__(self, server, statefile, rate):
+        self._in_progress = None # (storage_index_b32, generator)
+        RateLimitedCrawler.__init__(self, server, statefile, rate)
+
+    def add_initial_state(self):
+        self.state.setdefault("cycle-to-date", self.create_empty_cycle_dict())
+        self.state.setdefault("last-cycle", None)
+
+    def create_empty_cycle_dict(self):
+        return {"examined-shares": 0,
+                "examined-bytes": 0,
+                "corrupt-shares": [],
+                }
+
+    def started_cycle(self, cycle):
+        self.state["cycle-to-date"] = self.create_empty_cycle_dict()
+
+    def process_bucket(self, cycle, prefix, prefixdir, storage_index_b32):
+        # if the last slice ended in the middle of this bucket, carry on
+        # from where it stopped
+        if (self._in_progress is None
+            or self._in_progress[0] != storage_index_b32):
+            bucketdir = os.path.join(prefixdir, storage_index_b32)
+            self._in_progress = (storage_index_b32,
+                                 self.scrub_bucket(bucketdir,
+                                                   storage_index_b32))
+        for nbytes in self._in_progress[1]:
+            self.count_bytes(nbytes)
+            self.check_slice()
+        self._in_progress = None
+
+    def scrub_bucket(self, bucketdir, storage_index_b32):
+        """Check each share in the bucket, yielding the number of bytes read
+        since the last yield."""
+        try:
+            filenames = os.listdir(bucketdir)
+        except EnvironmentError:
+            return
+        for fn in sorted(filenames):
+            try:
+                shnum = int(fn)
+            except ValueError:
+                continue # non-numeric means not a sharefile
+            for nbytes in self.scrub_share(os.path.join(bucketdir, fn),
+                                           storage_index_b32, shnum):
+                yield nbytes
+
+    def scrub_share(self, filename, storage_index_b32, shnum):
+        storage_index = si_a2b(storage_index_b32)
+        so_far = self.state["cycle-to-date"]
+        sharetype = "unknown"
+        read = 0
+        try:
+            before = get_share_identity(filename)
+            sf = get_share_file(filename)
+            sharetype = sf.sharetype
+            if sharetype == "mutable":
+                verifier = verify_mutable_share(sf, storage_index, shnum)
+            else:
+                verifier = verify_immutable_share(sf, storage_index, shnum)
+            for total in verifier:
+                yield total - read
+                read = total
+            reason = None
+        except ShareCorruption, e:
+            reason = str(e)
+        except PARSE_ERRORS, e:
+            reason = "unable to parse share: %r" % (e,)
+        except EnvironmentError:
+            return # deleted before we got to it
+        so_far["examined-shares"] += 1
+        so_far["examined-bytes"] += read
+        self.touch_state("cycle-to-date", "examined-shares")
+        self.touch_state("cycle-to-date", "examined-bytes")
+        if reason is None:
+            return
+        try:
+            after = get_share_identity(filename)
+        except EnvironmentError:
+            return # deleted while we were reading it
+        if after != before:
+            # modified while we were reading it, so we may have read a
+            # mixture of old and new data. Check it again next cycle.
+            return
+        if self.server.share_digests is not None:
+            # stop vouching for the share, until it is written again
+            self.server.share_digests.mark_corrupt(storage_index, shnum,
+                                                   after)
+        self.found_corrupt_share(storage_index_b32, shnum, sharetype, reason)
+
+    def found_corrupt_share(self, storage_index_b32, shnum, sharetype, reason):
+        so_far = self.state["cycle-to-date"]
+        so_far["corrupt-shares"].append((storage_index_b32, shnum, sharetype,
+                                         reason))
+        self.touch_state("cycle-to-date", "corrupt-shares")
+        last = self.state["last-cycle"]
+        if last is not None:
+            for (si_s, old_shnum, ign, ign) in last["corrupt-shares"]:
+                if (si_s, old_shnum) == (storage_index_b32, shnum):
+                    return # already reported
+        log.msg(format="scrubber found corruption in (%(sharetype)s) "
+                "%(si)s-%(shnum)d: %(reason)s",
+                sharetype=sharetype, si=storage_index_b32, shnum=shnum,
+                reason=reason, facility="tahoe.storage", level=log.SCARY,
+                umid="4vLXvg")
+        self.server.add_corruption_advisory(sharetype,
+                                            si_a2b(storage_index_b32),
+                                            shnum, reason,
+                                            reporter="scrubber")
+
+    def finished_cycle(self, cycle):
+        last = self.state["cycle-to-date"].copy()
+        last["corrupt-shares"] = last["corrupt-shares"][:]
+        self.state["last-cycle"] = last
@@ -1,11 +1,14 @@
-import os, re, weakref, struct, time
+import os, weakref, time, heapq
 
 from foolscap.api import Referenceable
 from twisted.application import service
+from twisted.internet import defer
 
 from zope.interface import implements
-from allmydata.interfaces import RIStorageServer, IStatsProducer
+from allmydata.interfaces import RIStorageServer, IStatsProducer, \
+     MAX_SHARENUMS_QUERY
 from allmydata.util import fileutil, idlib, log, time_format
+from allmydata.util.histogram import WindowedHistogram
 import allmydata # for __full_version__
 
 from allmydata.storage.common import si_b2a, si_a2b, storage_index_to_dir
@@ -14,9 +17,23 @@ from allmydata.storage.lease import LeaseInfo
 from allmydata.storage.mutable import MutableShareFile, EmptyShare, \
      create_mutable_sharefile
 from allmydata.mutable.layout import MAX_MUTABLE_SHARE_SIZE
-from allmydata.storage.immutable import ShareFile, BucketWriter, BucketReader
+from allmydata.storage.immutable import ShareFile, FSYNC_POLICIES
 from allmydata.storage.crawler import BucketCountingCrawler
-from allmydata.storage.expirer import LeaseCheckingCrawler
+from allmydata.storage.expirer import LeaseCheckingCrawler, \
+     IndexedLeaseCheckingCrawler
+from allmydata.storage.leasedb import LeaseDB, LeaseDBCrawler
+from allmydata.storage.digests import ShareDigestDB, ShareDigestCrawler
+from allmydata.storage.scrubber import ShareScrubber
+from allmydata.storage.inventory import ShareInventory, NUM_RE, scan_bucket
+from allmydata.storage.fdcache import FileHandleCache
+from allmydata.storage.diskio import DiskIO, call_io, call_write_io, \
+     when_done
+from allmydata.storage.scheduler import FairScheduler
+from allmydata.storage.session import ClientSession, SESSIONLESS
+from allmydata.storage.backend import DiskBackend
+from allmydata.storage.packed import PackedBackend
+from allmydata.storage.reservations import SpaceReservations
+_pyflakes_hush.append(NUM_RE) # re-exported
 
 # storage/
 # storage/shares/incoming
@@ -24,19 +41,49 @@ from allmydata.storage.expirer import LeaseCheckingCrawler
 #   be moved to storage/shares/$START/$STORAGEINDEX/$SHARENUM upon success
 # storage/shares/$START/$STORAGEINDEX
 # storage/shares/$START/$STORAGEINDEX/$SHARENUM
+# storage/leasedb.sqlite (only if use_leasedb=True)
+# storage/share_digests.sqlite (only if share_digests=True)
+# storage/packs/ (only if backend="packed", see storage/packed.py)
 
 # Where "$START" denotes the first 10 bits worth of $STORAGEINDEX (that's 2
 # base-32 chars).
 
-# $SHARENUM matches this regex:
-NUM_RE=re.compile("^[0-9]+$")
+# $SHARENUM matches NUM_RE (see storage/inventory.py)
 
 
+class _MessageCollector:
+    """I stand in for the StorageServer as the parent of share files that
+    are used in an I/O thread, where log messages cannot be sent, and keep
+    their messages until replay() sends them from the reactor thread."""
+
+    def __init__(self):
+        self.messages = []
+
+    def log(self, *args, **kwargs):
+        self.messages.append((args, kwargs))
+
+    def replay(self, res, server):
+        for (args, kwargs) in self.messages:
+            server.log(*args, **kwargs)
+        self.messages = []
+        return res
+
 
 class StorageServer(service.MultiService, Referenceable):
     implements(RIStorageServer, IStatsProducer)
     name = 'storage'
     LeaseCheckerClass = LeaseCheckingCrawler
+    IndexedLeaseCheckerClass = IndexedLeaseCheckingCrawler
+    # how long get_available_space() may use an old statvfs() result
+    available_space_cache_time = 10
+    # get_latencies() describes the samples from this many seconds
+    LATENCY_WINDOW = 5*60
+    # get_stats() names this many of the clients with the most space
+    # reserved, and adds up the rest as allocated_by_client.others
+    ALLOCATED_BY_CLIENT_STATS = 10
+    # how many BucketWriters may keep their share file (and a write buffer
+    # of up to WRITE_BUFFER_SIZE) open at once. The rest write through.
+    MAX_OPEN_WRITERS = 100
 
     def __init__(self, storedir, nodeid, reserved_space=0,
                  discard_storage=False, readonly_storage=False,
@@ -45,7 +92,23 @@ class StorageServer(service.MultiService, Referenceable):
                  expiration_mode="age",
                  expiration_override_lease_duration=None,
                  expiration_cutoff_date=None,
-                 expiration_sharetypes=("mutable", "immutable")):
+                 expiration_sharetypes=("mutable", "immutable"),
+                 use_leasedb=False,
+                 expiration_indexed=False,
+                 share_inventory_size=10000,
+                 share_fd_cache_size=128,
+                 share_mmap_reads=False,
+                 fsync_policy="none",
+                 backend="disk",
+                 pack_max_share_size=64*1024,
+                 crawler_threads=0,
+                 share_digests=False,
+                 scrub_enabled=False,
+                 scrub_rate=10*1000*1000,
+                 io_threads=0,
+                 client_ops_per_second=0,
+                 client_bytes_per_second=0,
+                 max_concurrent_requests=0):
         service.MultiService.__init__(self)
         assert isinstance(nodeid, str)
         assert len(nodeid) == 20
@@ -67,43 +130,152 @@ class StorageServer(service.MultiService, Referenceable):
         self._clean_incomplete()
         fileutil.make_dirs(self.incomingdir)
         self._active_writers = weakref.WeakKeyDictionary()
+        self._open_writers = weakref.WeakKeyDictionary()
+        self._reservations = SpaceReservations()
+        self._available_space = None
+        self._available_space_time = None # when it was measured
+        self.share_inventory = ShareInventory(sharedir, share_inventory_size)
+        self.fdcache = FileHandleCache(share_fd_cache_size,
+                                       use_mmap=share_mmap_reads)
         log.msg("StorageServer created", facility="tahoe.storage")
 
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError("fsync policy '%s' must be one of %s"
+                             % (fsync_policy, ", ".join(FSYNC_POLICIES)))
+        self.fsync_policy = fsync_policy
+
+        if expiration_indexed and not use_leasedb:
+            raise ValueError("indexed lease expiration requires the lease"
+                             " database")
+        if backend == "disk":
+            self.backend = DiskBackend(sharedir, self.share_inventory,
+                                       self.fdcache)
+        elif backend == "packed":
+            # packed shares have no lease records of their own, and are
+            # invisible to the crawlers that walk the share directories
+            if not use_leasedb:
+                raise ValueError("the packed backend requires the lease"
+                                 " database")
+            if expiration_enabled and not expiration_indexed:
+                raise ValueError("the packed backend requires indexed"
+                                 " lease expiration")
+            self.backend = PackedBackend(sharedir, self.share_inventory,
+                                         self.fdcache,
+                                         os.path.join(storedir, "packs"),
+                                         pack_max_share_size)
+        else:
+            raise ValueError("storage backend '%s' must be 'disk' or"
+                             " 'packed'" % (backend,))
+        self.leasedb = None
+        if use_leasedb:
+            self.leasedb = LeaseDB(os.path.join(storedir, "leasedb.sqlite"))
+        self.share_digests = None
+        if share_digests:
+            self.share_digests = ShareDigestDB(os.path.join(storedir,
+                                                "share_digests.sqlite"))
+
         if reserved_space:
-            if self.get_available_space() is None:
+            if fileutil.get_available_space(sharedir, reserved_space) is None:
                 log.msg("warning: [storage]reserved_space= is set, but this platform does not support an API to get disk statistics (statvfs(2) or GetDiskFreeSpaceEx), so this reservation cannot be honored",
                         umin="0wZ27w", level=log.UNUSUAL)
 
-        self.latencies = {"allocate": [], # immutable
-                          "write": [],
-                          "close": [],
-                          "read": [],
-                          "get": [],
-                          "writev": [], # mutable
-                          "readv": [],
-                          "add-lease": [], # both
-                          "renew": [],
-                          "cancel": [],
-                          }
+        # each category keeps a histogram of every sample since we started,
+        # and of those from the last LATENCY_WINDOW seconds
+        self.latencies = {}
+        for category in ["allocate", # immutable
+                         "write",
+                         "close",
+                         "read",
+                         "get",
+                         "get-sharenums",
+                         "get-share-digests",
+                         "writev", # mutable
+                         "readv",
+                         "readv-immutable",
+                         "add-lease", # both
+                         "renew",
+                         "cancel",
+                         "io-queue-depth", # only with io_threads
+                         "io-wait",
+                         "io-service",
+                         "scheduler-wait", # only with client budgets
+                         ]:
+            self.latencies[category] = WindowedHistogram(self.LATENCY_WINDOW)
+        # if io_threads is 0, share files are read and written right here in
+        # the reactor thread
+        self.diskio = None
+        if io_threads:
+            self.diskio = DiskIO(io_threads, self.add_latency)
+            self.diskio.add_disk(sharedir)
+            self.diskio.add_disk(self.incomingdir)
+        # without client budgets or a concurrency limit, requests are
+        # handled as soon as they arrive, and clients are not offered
+        # sessions
+        self.scheduler = None
+        if (client_ops_per_second or client_bytes_per_second
+            or max_concurrent_requests):
+            self.scheduler = FairScheduler(client_ops_per_second,
+                                           client_bytes_per_second,
+                                           max_concurrent_requests,
+                                           self.add_latency,
+                                           low_priority_clients=[SESSIONLESS])
+        self._sessionless = ClientSession(self, SESSIONLESS)
         self.add_bucket_counter()
+        self.bucket_counter.threads = crawler_threads
 
         statefile = os.path.join(self.storedir, "lease_checker.state")
         historyfile = os.path.join(self.storedir, "lease_checker.history")
         klass = self.LeaseCheckerClass
+        if expiration_indexed:
+            klass = self.IndexedLeaseCheckerClass
         self.lease_checker = klass(self, statefile, historyfile,
                                    expiration_enabled, expiration_mode,
                                    expiration_override_lease_duration,
                                    expiration_cutoff_date,
                                    expiration_sharetypes)
+        self.lease_checker.threads = crawler_threads
         self.lease_checker.setServiceParent(self)
 
+        if self.leasedb is not None:
+            statefile = os.path.join(self.storedir, "leasedb_crawler.state")
+            self.leasedb_crawler = LeaseDBCrawler(self, statefile,
+                                                  self.leasedb)
+            self.leasedb_crawler.threads = crawler_threads
+            self.leasedb_crawler.setServiceParent(self)
+
+        if self.share_digests is not None:
+            statefile = os.path.join(self.storedir,
+                                     "share_digest_crawler.state")
+            self.share_digest_crawler = ShareDigestCrawler(self, statefile,
+                                                           self.share_digests,
+                                                           scrub_rate)
+            self.share_digest_crawler.threads = crawler_threads
+            self.share_digest_crawler.setServiceParent(self)
+
+        self.scrubber = None
+        if scrub_enabled:
+            statefile = os.path.join(self.storedir, "scrubber.state")
+            self.scrubber = ShareScrubber(self, statefile, scrub_rate)
+            self.scrubber.setServiceParent(self)
+
     def __repr__(self):
         return "<StorageServer %s>" % (idlib.shortnodeid_b2a(self.my_nodeid),)
 
+    def stopService(self):
+        d = service.MultiService.stopService(self)
+        if self.diskio is not None:
+            self.diskio.stop()
+        if self.scheduler is not None:
+            self.scheduler.stop()
+        stopped = defer.maybeDeferred(self.backend.stop)
+        self.fdcache.clear()
+        d.addCallback(lambda ign: stopped)
+        return d
+
     def have_shares(self):
         # quick test to decide if we need to commit to an implicit
         # permutation-seed or if we should use a new one
-        return bool(set(os.listdir(self.sharedir)) - set(["incoming"]))
+        return self.backend.have_shares()
 
     def add_bucket_counter(self):
         statefile = os.path.join(self.storedir, "bucket_counter.state")
@@ -115,49 +287,42 @@ class StorageServer(service.MultiService, Referenceable):
             self.stats_provider.count("storage_server." + name, delta)
 
     def add_latency(self, category, latency):
-        a = self.latencies[category]
-        a.append(latency)
-        if len(a) > 1000:
-            self.latencies[category] = a[-1000:]
+        self.latencies[category].add(latency)
 
-    def get_latencies(self):
-        """Return a dict, indexed by category, that contains a dict of
-        latency numbers for each category. If there are sufficient samples
-        for unambiguous interpretation, each dict will contain the
-        following keys: mean, 01_0_percentile, 10_0_percentile,
-        50_0_percentile (median), 90_0_percentile, 95_0_percentile,
-        99_0_percentile, 99_9_percentile.  If there are insufficient
-        samples for a given percentile to be interpreted unambiguously
-        that percentile will be reported as None. If no samples have been
-        collected for the given category, then that category name will
-        not be present in the return value. """
-        # note that Amazon's Dynamo paper says they use 99.9% percentile.
+    def get_latency_histograms(self, cumulative=False):
+        """Return a dict, indexed by category, of Histograms of the latency
+        samples collected in the last LATENCY_WINDOW seconds, or (if
+        cumulative=True) since the server was started. Categories with no
+        such samples are left out."""
         output = {}
-        for category in self.latencies:
-            if not self.latencies[category]:
-                continue
-            stats = {}
-            samples = self.latencies[category][:]
-            count = len(samples)
-            stats["samplesize"] = count
-            samples.sort()
-            if count > 1:
-                stats["mean"] = sum(samples) / count
+        for (category, wh) in self.latencies.items():
+            if cumulative:
+                h = wh.cumulative
             else:
-                stats["mean"] = None
-
-            orderstatlist = [(0.01, "01_0_percentile", 100), (0.1, "10_0_percentile", 10),\
-                             (0.50, "50_0_percentile", 10), (0.90, "90_0_percentile", 10),\
-                             (0.95, "95_0_percentile", 20), (0.99, "99_0_percentile", 100),\
-                             (0.999, "99_9_percentile", 1000)]
-
-            for percentile, percentilestring, minnumtoobserve in orderstatlist:
-                if count >= minnumtoobserve:
-                    stats[percentilestring] = samples[int(percentile*count)]
-                else:
-                    stats[percentilestring] = None
+                h = wh.get_window()
+            if h.count:
+                output[category] = h
+        return output
 
-            output[category] = stats
+    def get_latencies(self, cumulative=False):
+        """Return a dict, indexed by category, that contains a dict of
+        latency numbers for each category, computed from the samples
+        collected in the last LATENCY_WINDOW seconds (or, if
+        cumulative=True, since the server was started). If there are
+        sufficient samples for unambiguous interpretation, each dict will
+        contain the following keys: mean, 01_0_percentile,
+        10_0_percentile, 50_0_percentile (median), 90_0_percentile,
+        95_0_percentile, 99_0_percentile, 99_9_percentile.  If there are
+        insufficient samples for a given percentile to be interpreted
+        unambiguously that percentile will be reported as None. If no
+        samples have been collected for the given category, then that
+        category name will not be present in the return value.
+        Percentiles are read from a histogram, so they are only accurate
+        to within about half a percent. """
+        # note that Amazon's Dynamo paper says they use 99.9% percentile.
+        output = {}
+        for (category, h) in self.get_latency_histograms(cumulative).items():
+            output[category] = h.summarize()
         return output
 
     def log(self, *args, **kwargs):
@@ -173,9 +338,23 @@ class StorageServer(service.MultiService, Referenceable):
         # contains numeric values.
         stats = { 'storage_server.allocated': self.allocated_size(), }
         stats['storage_server.reserved_space'] = self.reserved_space
+        by_client = self.get_allocated_size_by_client()
+        stats['storage_server.allocated_clients'] = len(by_client)
+        top = heapq.nlargest(self.ALLOCATED_BY_CLIENT_STATS,
+                             by_client.items(), key=lambda item: item[1])
+        for client_id,size in top:
+            stats['storage_server.allocated_by_client.%s' % client_id] = size
+        others = self.allocated_size() - sum([size for (client_id, size)
+                                              in top])
+        if others:
+            stats['storage_server.allocated_by_client.others'] = others
         for category,ld in self.get_latencies().items():
             for name,v in ld.items():
                 stats['storage_server.latencies.%s.%s' % (category, name)] = v
+        for category,ld in self.get_latencies(cumulative=True).items():
+            for name,v in ld.items():
+                stats['storage_server.latencies_cumulative.%s.%s'
+                      % (category, name)] = v
 
         try:
             disk = fileutil.get_disk_stats(self.sharedir, self.reserved_space)
@@ -187,11 +366,14 @@ class StorageServer(service.MultiService, Referenceable):
             stats['storage_server.disk_free_for_root'] = disk['free_for_root']
             stats['storage_server.disk_free_for_nonroot'] = disk['free_for_nonroot']
             stats['storage_server.disk_avail'] = disk['avail']
+            self._set_available_space(disk['avail'])
         except AttributeError:
             writeable = True
+            self._set_available_space(None)
         except EnvironmentError:
             log.msg("OS call to get disk statistics failed", level=log.UNUSUAL)
             writeable = False
+            self._set_available_space(0)
 
         if self.readonly_storage:
             stats['storage_server.disk_avail'] = 0
@@ -202,21 +384,79 @@ class StorageServer(service.MultiService, Referenceable):
         bucket_count = s.get("last-complete-bucket-count")
         if bucket_count:
             stats['storage_server.total_bucket_count'] = bucket_count
+        for name,v in self.share_inventory.get_stats().items():
+            stats['storage_server.share_inventory.%s' % name] = v
+        for name,v in self.fdcache.get_stats().items():
+            stats['storage_server.fd_cache.%s' % name] = v
+        for name,v in self.backend.get_stats().items():
+            stats['storage_server.backend.%s' % name] = v
+        if self.diskio is not None:
+            for name,v in self.diskio.get_stats().items():
+                stats['storage_server.io.%s' % name] = v
+        if self.scheduler is not None:
+            for name,v in self.scheduler.get_stats().items():
+                stats['storage_server.scheduler.%s' % name] = v
+        if self.scrubber is not None:
+            s = self.scrubber.get_state()
+            for (prefix, counts) in [("", s["cycle-to-date"]),
+                                     ("last_cycle.", s["last-cycle"])]:
+                if counts is None:
+                    continue
+                stats['storage_server.scrubber.%sexamined_shares' % prefix] \
+                    = counts["examined-shares"]
+                stats['storage_server.scrubber.%sexamined_bytes' % prefix] \
+                    = counts["examined-bytes"]
+                stats['storage_server.scrubber.%scorrupt_shares' % prefix] \
+                    = len(counts["corrupt-shares"])
         return stats
 
     def get_available_space(self):
         """Returns available space for share storage in bytes, or None if no
-        API to get this information is available."""
+        API to get this information is available. To keep statvfs() out of
+        every allocate_buckets() call, the answer is measured at most once
+        every 'available_space_cache_time' seconds, and in between it is
+        reduced by the size of each share that is written."""
 
         if self.readonly_storage:
             return 0
-        return fileutil.get_available_space(self.sharedir, self.reserved_space)
+        now = time.time()
+        measured = self._available_space_time
+        if (measured is None or now < measured
+            or now - measured >= self.available_space_cache_time):
+            self.refresh_available_space()
+        return self._available_space
+
+    def refresh_available_space(self):
+        avail = fileutil.get_available_space(self.sharedir,
+                                             self.reserved_space)
+        self._set_available_space(avail)
+
+    def _set_available_space(self, avail):
+        self._available_space = avail
+        self._available_space_time = time.time()
 
     def allocated_size(self):
-        space = 0
-        for bw in self._active_writers:
-            space += bw.allocated_size()
-        return space
+        return self._reservations.total
+
+    def get_allocated_size_by_client(self):
+        """Return a dict mapping the tubid of each client with uploads in
+        progress (or 'unknown') to the space reserved for them."""
+        return self._reservations.get_by_client()
+
+    def _get_client_id(self, canary):
+        try:
+            return canary.getRemoteTubID() or "unknown"
+        except (AttributeError, AssertionError):
+            # local callers, and the fake canaries used by unit tests
+            return "unknown"
+
+    def doRemoteCall(self, methodname, args, kwargs):
+        # clients that do not use a ClientSession of their own share one,
+        # which the scheduler only gives a turn when no one else wants it
+        if (self.scheduler is not None
+            and methodname not in ("get_version", "get_client_session")):
+            return self._sessionless.doRemoteCall(methodname, args, kwargs)
+        return Referenceable.doRemoteCall(self, methodname, args, kwargs)
 
     def remote_get_version(self):
         remaining_space = self.get_available_space()
@@ -232,11 +472,23 @@ class StorageServer(service.MultiService, Referenceable):
                       "delete-mutable-shares-with-zero-length-writev": True,
                       "fills-holes-with-zero-bytes": True,
                       "prevents-read-past-end-of-share-data": True,
+                      "maximum-get-sharenums-batch": MAX_SHARENUMS_QUERY,
+                      "accepts-immutable-readv": True,
+                      "provides-share-digests":
+                          self.share_digests is not None,
+                      "accepts-client-sessions": self.scheduler is not None,
                       },
                     "application-version": str(allmydata.__full_version__),
                     }
         return version
 
+    def remote_get_client_session(self, canary):
+        client_id = self._get_client_id(canary)
+        if self.scheduler is not None:
+            self.scheduler.connect(client_id)
+            canary.notifyOnDisconnect(self.scheduler.disconnect, client_id)
+        return ClientSession(self, client_id)
+
     def remote_allocate_buckets(self, storage_index,
                                 renew_secret, cancel_secret,
                                 sharenums, allocated_size,
@@ -253,16 +505,17 @@ class StorageServer(service.MultiService, Referenceable):
 
         log.msg("storage: allocate_buckets %s" % si_s)
 
-        # in this implementation, the lease information (including secrets)
-        # goes into the share files themselves. It could also be put into a
-        # separate database. Note that the lease should not be added until
-        # the BucketWriter has been closed.
+        # the lease information (including secrets) goes into the share
+        # files themselves, or into the lease database if we have one. Note
+        # that the lease should not be added until the BucketWriter has been
+        # closed.
         expire_time = time.time() + 31*24*60*60
         lease_info = LeaseInfo(owner_num,
                                renew_secret, cancel_secret,
                                expire_time, self.my_nodeid)
 
         max_space_per_bucket = allocated_size
+        client_id = None
 
         remaining_space = self.get_available_space()
         limited = remaining_space is not None
@@ -277,15 +530,23 @@ class StorageServer(service.MultiService, Referenceable):
         # they asked about: this will save them a lot of work. Add or update
         # leases for all of them: if they want us to hold shares for this
         # file, they'll want us to hold leases for this file.
-        for (shnum, fn) in self._get_bucket_shares(storage_index):
-            alreadygot.add(shnum)
-            sf = ShareFile(fn)
-            sf.add_or_renew_lease(lease_info)
+        # What we report comes from the shares themselves rather than from
+        # the lease database, which may not know about shares that were
+        # copied in or lost behind our back.
+        existing = self.backend.get_shares(storage_index)
+        alreadygot.update(existing)
+        if self.leasedb is not None:
+            indexed = self._reconcile_indexed_shares(storage_index, existing)
+            self.leasedb.add_or_renew_leases(storage_index, indexed,
+                                             lease_info)
+        else:
+            for shnum in sorted(existing):
+                sf = ShareFile(existing[shnum][0])
+                sf.add_or_renew_lease(lease_info)
 
         for shnum in sharenums:
             incominghome = os.path.join(self.incomingdir, si_dir, "%d" % shnum)
-            finalhome = os.path.join(self.sharedir, si_dir, "%d" % shnum)
-            if os.path.exists(finalhome):
+            if shnum in existing:
                 # great! we already have it. easy.
                 pass
             elif os.path.exists(incominghome):
@@ -296,39 +557,125 @@ class StorageServer(service.MultiService, Referenceable):
                 pass
             elif (not limited) or (remaining_space >= max_space_per_bucket):
                 # ok! we need to create the new share file.
-                bw = BucketWriter(self, incominghome, finalhome,
-                                  max_space_per_bucket, lease_info, canary)
+                bw = self.backend.make_bucket_writer(self, storage_index,
+                                                     shnum,
+                                                     max_space_per_bucket,
+                                                     lease_info, canary,
+                                                     self.fsync_policy,
+                                                     self.share_digests
+                                                     is not None)
                 if self.no_storage:
                     bw.throw_out_all_data = True
                 bucketwriters[shnum] = bw
-                self._active_writers[bw] = 1
+                self._active_writers[bw] = (storage_index, shnum, lease_info)
+                if client_id is None:
+                    client_id = self._get_client_id(canary)
+                self._reservations.reserve(bw, client_id, bw.allocated_size())
                 if limited:
                     remaining_space -= max_space_per_bucket
             else:
                 # bummer! not enough space to accept this bucket
                 pass
 
-        if bucketwriters:
-            fileutil.make_dirs(os.path.join(self.sharedir, si_dir))
-
         self.add_latency("allocate", time.time() - start)
         return alreadygot, bucketwriters
 
     def _iter_share_files(self, storage_index):
-        for shnum, filename in self._get_bucket_shares(storage_index):
-            f = open(filename, 'rb')
-            header = f.read(32)
-            f.close()
-            if header[:32] == MutableShareFile.MAGIC:
-                sf = MutableShareFile(filename, self)
+        for shnum, sf in self._iter_shnums_and_share_files(storage_index):
+            yield sf
+
+    def _iter_shnums_and_share_files(self, storage_index):
+        shares = self.share_inventory.get_shares(storage_index)
+        return self._open_share_files(shares)
+
+    def _get_io_shares(self, storage_index):
+        """Return the shares of this storage index for a call to
+        _bucket_io(), or None if the call must look for itself (with
+        _scan_io_shares). With I/O threads, that is when it will be queued
+        behind a call that may add or delete shares, or when the share
+        inventory would have to list the directory, which is better done in
+        the I/O thread."""
+        if self.diskio is None:
+            return self.share_inventory.get_shares(storage_index)
+        if self.diskio.writes_pending(self._get_bucketdir(storage_index)):
+            return None
+        return self.share_inventory.get_cached_shares(storage_index)
+
+    def _scan_io_shares(self, storage_index, shares):
+        if shares is None:
+            shares = scan_bucket(os.path.join(self.sharedir,
+                                  storage_index_to_dir(storage_index)))
+        return shares
+
+    def _open_share_files(self, shares):
+        """Yield (shnum, share file) pairs for the shares in 'shares' (as
+        returned by the share inventory). This may run in an I/O thread."""
+        fdcache = self._get_io_fdcache()
+        for shnum in sorted(shares):
+            (filename, sharetype, size) = shares[shnum]
+            if sharetype == "mutable":
+                sf = MutableShareFile(filename, self, fdcache=fdcache)
                 # note: if the share has been migrated, the renew_lease()
                 # call will throw an exception, with information to help the
                 # client update the lease.
-            elif header[:4] == struct.pack(">L", 1):
-                sf = ShareFile(filename)
+            elif sharetype == "immutable":
+                sf = ShareFile(filename, fdcache=fdcache)
             else:
                 continue # non-sharefile
-            yield sf
+            yield shnum, sf
+
+    def _get_io_fdcache(self):
+        # the file handle cache may only be used from the reactor thread
+        if self.diskio is not None:
+            return None
+        return self.fdcache
+
+    def _get_bucketdir(self, storage_index):
+        return os.path.join(self.sharedir, storage_index_to_dir(storage_index))
+
+    def _bucket_io(self, storage_index, f, *args):
+        """Call f(*args) to read or write the share files of this storage
+        index, in an I/O thread if we have them (see storage/diskio.py),
+        after any earlier calls for the same storage index. Return its
+        result, or a Deferred that fires with it."""
+        return call_io(self.diskio, self._get_bucketdir(storage_index),
+                       f, *args)
+
+    def _bucket_write_io(self, storage_index, f, *args):
+        """Like _bucket_io(), for calls that may add or delete shares."""
+        return call_write_io(self.diskio, self._get_bucketdir(storage_index),
+                             f, *args)
+
+    def _get_indexed_shares(self, storage_index):
+        """Return a dict mapping shnum to sharetype for the shares of this
+        storage_index, as recorded in the lease database. Shares which
+        predate the database are imported from their share files the first
+        time their storage index is asked about."""
+        shares = self.leasedb.get_shares(storage_index)
+        if not shares:
+            for shnum, sf in self._iter_shnums_and_share_files(storage_index):
+                self.leasedb.import_share(storage_index, shnum, sf)
+                shares[shnum] = sf.sharetype
+        return shares
+
+    def _reconcile_indexed_shares(self, storage_index, existing):
+        """Make the lease database agree with 'existing' (as returned by the
+        backend) about the shares of this storage_index: shares that are no
+        longer there are forgotten, and share files it does not know about
+        are imported. Return the shares it now knows about, as for
+        _get_indexed_shares()."""
+        shares = self.leasedb.get_shares(storage_index)
+        for shnum in sorted(set(shares) - set(existing)):
+            self.leasedb.remove_deleted_share(storage_index, shnum)
+            del shares[shnum]
+        # packed shares (with no filename) are always in the database
+        unknown = dict([(shnum, existing[shnum]) for shnum in existing
+                        if shnum not in shares
+                        and existing[shnum][0] is not None])
+        for shnum, sf in self._open_share_files(unknown):
+            self.leasedb.import_share(storage_index, shnum, sf)
+            shares[shnum] = sf.sharetype
+        return shares
 
     def remote_add_lease(self, storage_index, renew_secret, cancel_secret,
                          owner_num=1):
@@ -338,41 +685,100 @@ class StorageServer(service.MultiService, Referenceable):
         lease_info = LeaseInfo(owner_num,
                                renew_secret, cancel_secret,
                                new_expire_time, self.my_nodeid)
-        for sf in self._iter_share_files(storage_index):
+        d = None
+        if self.leasedb is not None:
+            shnums = self._get_indexed_shares(storage_index)
+            self.leasedb.add_or_renew_leases(storage_index, shnums,
+                                             lease_info)
+        else:
+            d = self._bucket_io(storage_index, self._add_or_renew_file_leases,
+                                storage_index,
+                                self._get_io_shares(storage_index),
+                                lease_info)
+        def _added(ign):
+            self.add_latency("add-lease", time.time() - start)
+            return None
+        return when_done(d, _added)
+
+    def _add_or_renew_file_leases(self, storage_index, shares, lease_info):
+        shares = self._scan_io_shares(storage_index, shares)
+        for shnum, sf in self._open_share_files(shares):
             sf.add_or_renew_lease(lease_info)
-        self.add_latency("add-lease", time.time() - start)
-        return None
 
     def remote_renew_lease(self, storage_index, renew_secret):
         start = time.time()
         self.count("renew")
         new_expire_time = time.time() + 31*24*60*60
+        if self.leasedb is not None:
+            shnums = self._get_indexed_shares(storage_index)
+            found_buckets = bool(shnums)
+            self.leasedb.renew_leases(storage_index, shnums, renew_secret,
+                                      new_expire_time)
+        else:
+            found_buckets = self._bucket_io(storage_index,
+                                            self._renew_file_leases,
+                                            storage_index,
+                                            self._get_io_shares(storage_index),
+                                            renew_secret, new_expire_time)
+        def _renewed(found_buckets):
+            self.add_latency("renew", time.time() - start)
+            if not found_buckets:
+                raise IndexError("no such lease to renew")
+        return when_done(found_buckets, _renewed)
+
+    def _renew_file_leases(self, storage_index, shares, renew_secret,
+                           new_expire_time):
+        shares = self._scan_io_shares(storage_index, shares)
         found_buckets = False
-        for sf in self._iter_share_files(storage_index):
+        for shnum, sf in self._open_share_files(shares):
             found_buckets = True
             sf.renew_lease(renew_secret, new_expire_time)
-        self.add_latency("renew", time.time() - start)
-        if not found_buckets:
-            raise IndexError("no such lease to renew")
+        return found_buckets
+
+    def reserve_write_handle(self, bw):
+        """Return True if the given BucketWriter may keep its share file open
+        until it is closed, False if it must write through instead."""
+        if len(self._open_writers) >= self.MAX_OPEN_WRITERS:
+            return False
+        self._open_writers[bw] = True
+        return True
 
     def bucket_writer_closed(self, bw, consumed_size):
         if self.stats_provider:
             self.stats_provider.count('storage_server.bytes_added', consumed_size)
-        del self._active_writers[bw]
+        (storage_index, shnum, lease_info) = self._active_writers.pop(bw)
+        self._open_writers.pop(bw, None)
+        self._reservations.release(bw)
+        if self._available_space is not None:
+            # the share is now on disk, where the next statvfs() will see it
+            self._available_space = max(0, self._available_space
+                                        - consumed_size)
+        self.forget_bucket(storage_index)
+        # aborted writers report a consumed_size of zero, and leave no share
+        if self.leasedb is not None and consumed_size:
+            self.leasedb.add_new_share(storage_index, shnum, "immutable")
+            self.leasedb.add_or_renew_leases(storage_index, [shnum],
+                                             lease_info)
+        if self.share_digests is not None and bw.digest is not None:
+            self.share_digests.set_digest(storage_index, shnum, bw.digest,
+                                          bw.identity)
+
+    def forget_bucket(self, storage_index):
+        """Drop everything we have cached about the shares of this storage
+        index. This must be called before any of its share files are
+        deleted, and after shares are added or changed."""
+        self.share_inventory.forget(storage_index)
+        bucketdir = os.path.join(self.sharedir,
+                                 storage_index_to_dir(storage_index))
+        self.fdcache.forget_directory(bucketdir)
 
     def _get_bucket_shares(self, storage_index):
         """Return a list of (shnum, pathname) tuples for files that hold
         shares for this storage_index. In each tuple, 'shnum' will always be
         the integer form of the last component of 'pathname'."""
-        storagedir = os.path.join(self.sharedir, storage_index_to_dir(storage_index))
-        try:
-            for f in os.listdir(storagedir):
-                if NUM_RE.match(f):
-                    filename = os.path.join(storagedir, f)
-                    yield (int(f), filename)
-        except OSError:
-            # Commonly caused by there being no buckets at all.
-            pass
+        shares = self.share_inventory.get_shares(storage_index)
+        for shnum in sorted(shares):
+            yield (shnum, shares[shnum][0])
 
     def remote_get_buckets(self, storage_index):
         start = time.time()
@@ -380,12 +786,41 @@ class StorageServer(service.MultiService, Referenceable):
         si_s = si_b2a(storage_index)
         log.msg("storage: get_buckets %s" % si_s)
         bucketreaders = {} # k: sharenum, v: BucketReader
-        for shnum, filename in self._get_bucket_shares(storage_index):
-            bucketreaders[shnum] = BucketReader(self, filename,
-                                                storage_index, shnum)
+        shares = self.backend.get_shares(storage_index)
+        for shnum in sorted(shares):
+            bucketreaders[shnum] = self.backend.make_bucket_reader(
+                self, storage_index, shnum, shares[shnum][0])
         self.add_latency("get", time.time() - start)
         return bucketreaders
 
+    def remote_get_sharenums(self, storage_indexes):
+        start = time.time()
+        self.count("get-sharenums")
+        log.msg("storage: get_sharenums (%d storage indexes)"
+                % len(storage_indexes))
+        result = {}
+        for storage_index in storage_indexes:
+            shares = self.backend.get_shares(storage_index)
+            if shares:
+                result[storage_index] = set(shares)
+        self.add_latency("get-sharenums", time.time() - start)
+        return result
+
+    def remote_get_share_digests(self, storage_index, shnums):
+        start = time.time()
+        self.count("get-share-digests")
+        result = {}
+        if self.share_digests is not None:
+            shares = self.backend.get_shares(storage_index)
+            digests = self.share_digests.get_digests(storage_index)
+            for shnum, digest in digests.items():
+                # digests can outlive their shares until the crawler
+                # notices that they have gone
+                if shnum in shares and (shnum in shnums or not shnums):
+                    result[shnum] = digest
+        self.add_latency("get-share-digests", time.time() - start)
+        return result
+
     def get_leases(self, storage_index):
         """Provide an iterator that yields all of the leases attached to this
         bucket. Each lease is returned as a LeaseInfo instance.
@@ -395,6 +830,11 @@ class StorageServer(service.MultiService, Referenceable):
 
         # since all shares get the same lease data, we just grab the leases
         # from the first share
+        if self.leasedb is not None:
+            shnums = sorted(self._get_indexed_shares(storage_index))
+            if not shnums:
+                return iter([])
+            return iter(self.leasedb.get_leases(storage_index, shnums[0]))
         try:
             shnum, filename = self._get_bucket_shares(storage_index).next()
             sf = ShareFile(filename)
@@ -410,21 +850,82 @@ class StorageServer(service.MultiService, Referenceable):
         self.count("writev")
         si_s = si_b2a(storage_index)
         log.msg("storage: slot_writev %s" % si_s)
+        (write_enabler, renew_secret, cancel_secret) = secrets
+        if self.leasedb is not None:
+            # make sure pre-existing shares are indexed before we touch
+            # their leases
+            self._get_indexed_shares(storage_index)
+
+        ownerid = 1 # TODO
+        expire_time = time.time() + 31*24*60*60   # one month
+        lease_info = LeaseInfo(ownerid,
+                               renew_secret, cancel_secret,
+                               expire_time, self.my_nodeid)
+
+        # the share files are about to change (or be deleted), so we stop
+        # caching anything about them
+        self.forget_bucket(storage_index)
+        # the share files must not log from an I/O thread, so they leave
+        # their messages with 'logger' instead
+        logger = self
+        if self.diskio is not None:
+            logger = _MessageCollector()
+        d = self._bucket_write_io(storage_index,
+                                  self._testv_and_readv_and_writev,
+                                  storage_index,
+                                  self._get_io_shares(storage_index), secrets,
+                                  test_and_write_vectors, read_vector,
+                                  lease_info, logger)
+        if logger is not self:
+            d.addBoth(logger.replay, self)
+        def _written((testv_is_good, read_data, created, deleted, nbytes)):
+            if nbytes:
+                self.count("writev-bytes", nbytes)
+            if testv_is_good:
+                self.forget_bucket(storage_index)
+                if self.share_digests is not None:
+                    # the crawler will compute new ones
+                    self.share_digests.forget(storage_index,
+                                              test_and_write_vectors.keys())
+                if self.leasedb is not None:
+                    for sharenum in deleted:
+                        self.leasedb.remove_deleted_share(storage_index,
+                                                          sharenum)
+                    for sharenum in created:
+                        self.leasedb.add_new_share(storage_index, sharenum,
+                                                   "mutable")
+                    written = [sharenum for sharenum
+                               in sorted(test_and_write_vectors)
+                               if test_and_write_vectors[sharenum][2] != 0]
+                    self.leasedb.add_or_renew_leases(storage_index, written,
+                                                     lease_info)
+            # all done
+            self.add_latency("writev", time.time() - start)
+            return (testv_is_good, read_data)
+        return when_done(d, _written)
+
+    def _testv_and_readv_and_writev(self, storage_index, shares, secrets,
+                                    test_and_write_vectors, read_vector,
+                                    lease_info, logger):
+        """Do the file I/O for remote_slot_testv_and_readv_and_writev(). I
+        may run in an I/O thread, so I leave the lease database alone when
+        there is one, log through 'logger' rather than the server, and
+        return the sharenums of the shares I created and deleted, along with
+        whether the test vectors passed, the data that was read, and the
+        number of bytes written to share files."""
+        si_s = si_b2a(storage_index)
         si_dir = storage_index_to_dir(storage_index)
         (write_enabler, renew_secret, cancel_secret) = secrets
-        # shares exist if there is a file for them
         bucketdir = os.path.join(self.sharedir, si_dir)
+        fdcache = self._get_io_fdcache()
+        # shares exist if there is a file for them
+        found = self._scan_io_shares(storage_index, shares)
         shares = {}
-        if os.path.isdir(bucketdir):
-            for sharenum_s in os.listdir(bucketdir):
-                try:
-                    sharenum = int(sharenum_s)
-                except ValueError:
-                    continue
-                filename = os.path.join(bucketdir, sharenum_s)
-                msf = MutableShareFile(filename, self)
-                msf.check_write_enabler(write_enabler, si_s)
-                shares[sharenum] = msf
+        for sharenum in sorted(found):
+            msf = MutableShareFile(found[sharenum][0], logger,
+                                   fdcache=fdcache)
+            msf.check_write_enabler(write_enabler, si_s)
+            shares[sharenum] = msf
         # write_enabler is good for all existing shares.
 
         # Now evaluate test vectors.
@@ -433,15 +934,15 @@ class StorageServer(service.MultiService, Referenceable):
             (testv, datav, new_length) = test_and_write_vectors[sharenum]
             if sharenum in shares:
                 if not shares[sharenum].check_testv(testv):
-                    self.log("testv failed: [%d]: %r" % (sharenum, testv))
+                    logger.log("testv failed: [%d]: %r" % (sharenum, testv))
                     testv_is_good = False
                     break
             else:
                 # compare the vectors against an empty share, in which all
                 # reads return empty strings.
                 if not EmptyShare().check_testv(testv):
-                    self.log("testv failed (empty): [%d] %r" % (sharenum,
-                                                                testv))
+                    logger.log("testv failed (empty): [%d] %r" % (sharenum,
+                                                                  testv))
                     testv_is_good = False
                     break
 
@@ -450,12 +951,9 @@ class StorageServer(service.MultiService, Referenceable):
         for sharenum, share in shares.items():
             read_data[sharenum] = share.readv(read_vector)
 
-        ownerid = 1 # TODO
-        expire_time = time.time() + 31*24*60*60   # one month
-        lease_info = LeaseInfo(ownerid,
-                               renew_secret, cancel_secret,
-                               expire_time, self.my_nodeid)
-
+        created = []
+        deleted = []
+        nbytes = 0
         if testv_is_good:
             # now apply the write vectors
             for sharenum in test_and_write_vectors:
@@ -463,6 +961,7 @@ class StorageServer(service.MultiService, Referenceable):
                 if new_length == 0:
                     if sharenum in shares:
                         shares[sharenum].unlink()
+                        deleted.append(sharenum)
                 else:
                     if sharenum not in shares:
                         # allocate a new share
@@ -470,30 +969,31 @@ class StorageServer(service.MultiService, Referenceable):
                         share = self._allocate_slot_share(bucketdir, secrets,
                                                           sharenum,
                                                           allocated_size,
-                                                          owner_num=0)
+                                                          owner_num=0,
+                                                          logger=logger)
                         shares[sharenum] = share
-                    shares[sharenum].writev(datav, new_length)
-                    # and update the lease
-                    shares[sharenum].add_or_renew_lease(lease_info)
+                        created.append(sharenum)
+                    nbytes += shares[sharenum].writev(datav, new_length)
+                    # and update the lease, unless it lives in the lease
+                    # database, which our caller takes care of
+                    if self.leasedb is None:
+                        shares[sharenum].add_or_renew_lease(lease_info)
 
             if new_length == 0:
                 # delete empty bucket directories
                 if not os.listdir(bucketdir):
                     os.rmdir(bucketdir)
 
-
-        # all done
-        self.add_latency("writev", time.time() - start)
-        return (testv_is_good, read_data)
+        return (testv_is_good, read_data, created, deleted, nbytes)
 
     def _allocate_slot_share(self, bucketdir, secrets, sharenum,
-                             allocated_size, owner_num=0):
+                             allocated_size, owner_num=0, logger=None):
         (write_enabler, renew_secret, cancel_secret) = secrets
         my_nodeid = self.my_nodeid
         fileutil.make_dirs(bucketdir)
         filename = os.path.join(bucketdir, "%d" % sharenum)
         share = create_mutable_sharefile(filename, my_nodeid, write_enabler,
-                                         self)
+                                         logger or self)
         return share
 
     def remote_slot_readv(self, storage_index, shares, readv):
@@ -502,29 +1002,42 @@ class StorageServer(service.MultiService, Referenceable):
         si_s = si_b2a(storage_index)
         lp = log.msg("storage: slot_readv %s %s" % (si_s, shares),
                      facility="tahoe.storage", level=log.OPERATIONAL)
-        si_dir = storage_index_to_dir(storage_index)
-        # shares exist if there is a file for them
-        bucketdir = os.path.join(self.sharedir, si_dir)
-        if not os.path.isdir(bucketdir):
+        def _read(datavs):
+            log.msg("returning shares %s" % (datavs.keys(),),
+                    facility="tahoe.storage", level=log.NOISY, parent=lp)
             self.add_latency("readv", time.time() - start)
-            return {}
+            return datavs
+        return when_done(self._bucket_io(storage_index, self._slot_readv,
+                                         storage_index,
+                                         self._get_io_shares(storage_index),
+                                         shares, readv), _read)
+
+    def _slot_readv(self, storage_index, found, shares, readv):
+        found = self._scan_io_shares(storage_index, found)
+        fdcache = self._get_io_fdcache()
+        # shares exist if there is a file for them
         datavs = {}
-        for sharenum_s in os.listdir(bucketdir):
-            try:
-                sharenum = int(sharenum_s)
-            except ValueError:
-                continue
+        for sharenum in sorted(found):
             if sharenum in shares or not shares:
-                filename = os.path.join(bucketdir, sharenum_s)
-                msf = MutableShareFile(filename, self)
+                msf = MutableShareFile(found[sharenum][0], self,
+                                       fdcache=fdcache)
                 datavs[sharenum] = msf.readv(readv)
-        log.msg("returning shares %s" % (datavs.keys(),),
-                facility="tahoe.storage", level=log.NOISY, parent=lp)
-        self.add_latency("readv", time.time() - start)
         return datavs
 
     def remote_advise_corrupt_share(self, share_type, storage_index, shnum,
                                     reason):
+        self.add_corruption_advisory(share_type, storage_index, shnum, reason)
+        si_s = si_b2a(storage_index)
+        log.msg(format=("client claims corruption in (%(share_type)s) " +
+                        "%(si)s-%(shnum)d: %(reason)s"),
+                share_type=share_type, si=si_s, shnum=shnum, reason=reason,
+                level=log.SCARY, umid="SGx2fA")
+        return None
+
+    def add_corruption_advisory(self, share_type, storage_index, shnum,
+                                reason, reporter="client"):
+        """Write a report of a corrupt share into the corruption-advisories
+        directory, for the server's operator to look at."""
         fileutil.make_dirs(self.corruption_advisory_dir)
         now = time_format.iso_utc(sep="T")
         si_s = si_b2a(storage_index)
@@ -536,12 +1049,8 @@ class StorageServer(service.MultiService, Referenceable):
         f.write("type: %s\n" % share_type)
         f.write("storage_index: %s\n" % si_s)
         f.write("share_number: %d\n" % shnum)
+        f.write("reported_by: %s\n" % reporter)
         f.write("\n")
         f.write(reason)
         f.write("\n")
         f.close()
-        log.msg(format=("client claims corruption in (%(share_type)s) " +
-                        "%(si)s-%(shnum)d: %(reason)s"),
-                share_type=share_type, si=si_s, shnum=shnum, reason=reason,
-                level=log.SCARY, umid="SGx2fA")
-        return None
@@ -0,0 +1,151 @@
+from foolscap.api import Referenceable
+from zope.interface import implements
+from allmydata.interfaces import RIStorageServer, RIBucketWriter, \
+     RIBucketReader
+from allmydata.storage.diskio import when_done
+
+# A ClientSession is the StorageServer as seen by one client. Clients that
+# find 'accepts-client-sessions' in the server's version dictionary ask for
+# one with get_client_session(canary) and use it instead of the server
+# itself. Every request that arrives through it, and through the bucket
+# writers and readers it hands out, is attributed to the tubid of the
+# canary's owner, and passed through the server's FairScheduler.
+#
+# Foolscap does not tell a remote_* method who called it, which is why this
+# takes an extra round trip: the canary is how we learn the caller's tubid,
+# and when its owner goes away, so that the scheduler can forget them.
+# Older clients that call the server directly all share one session, under
+# the SESSIONLESS client_id, which the scheduler treats as low priority.
+
+SESSIONLESS = "sessionless"
+
+def _readv_size(readv):
+    return sum([length for (offset, length) in readv])
+
+
+class ClientSession(Referenceable):
+    implements(RIStorageServer)
+
+    def __init__(self, server, client_id):
+        self.server = server
+        self.client_id = client_id
+
+    def _call(self, nbytes, f, *args):
+        if self.server.scheduler is None:
+            return f(*args)
+        return self.server.scheduler.call(self.client_id, nbytes, f, *args)
+
+    def remote_get_version(self):
+        return self.server.remote_get_version()
+
+    def remote_get_client_session(self, canary):
+        return self.server.remote_get_client_session(canary)
+
+    def remote_allocate_buckets(self, storage_index,
+                                renew_secret, cancel_secret,
+                                sharenums, allocated_size,
+                                canary):
+        def _wrap((alreadygot, bucketwriters)):
+            for shnum in bucketwriters:
+                bucketwriters[shnum] = ScheduledBucketWriter(
+                    self, bucketwriters[shnum])
+            return (alreadygot, bucketwriters)
+        return when_done(self._call(0, self.server.remote_allocate_buckets,
+                                    storage_index, renew_secret,
+                                    cancel_secret, sharenums, allocated_size,
+                                    canary),
+                         _wrap)
+
+    def remote_add_lease(self, storage_index, renew_secret, cancel_secret):
+        return self._call(0, self.server.remote_add_lease,
+                          storage_index, renew_secret, cancel_secret)
+
+    def remote_renew_lease(self, storage_index, renew_secret):
+        return self._call(0, self.server.remote_renew_lease,
+                          storage_index, renew_secret)
+
+    def remote_get_buckets(self, storage_index):
+        def _wrap(bucketreaders):
+            for shnum in bucketreaders:
+                bucketreaders[shnum] = ScheduledBucketReader(
+                    self, bucketreaders[shnum])
+            return bucketreaders
+        return when_done(self._call(0, self.server.remote_get_buckets,
+                                    storage_index),
+                         _wrap)
+
+    def remote_get_sharenums(self, storage_indexes):
+        return self._call(0, self.server.remote_get_sharenums,
+                          storage_indexes)
+
+    def remote_get_share_digests(self, storage_index, shnums):
+        return self._call(0, self.server.remote_get_share_digests,
+                          storage_index, shnums)
+
+    def remote_slot_readv(self, storage_index, shares, readv):
+        # with no shares listed, we will read from all of them, and a
+        # mutable file rarely has more than ten
+        nbytes = _readv_size(readv) * (len(shares) or 10)
+        return self._call(nbytes, self.server.remote_slot_readv,
+                          storage_index, shares, readv)
+
+    def remote_slot_testv_and_readv_and_writev(self, storage_index,
+                                               secrets,
+                                               test_and_write_vectors,
+                                               read_vector):
+        nbytes = _readv_size(read_vector) * len(test_and_write_vectors)
+        for (testv, datav, new_length) in test_and_write_vectors.values():
+            nbytes += sum([len(data) for (offset, data) in datav])
+        return self._call(nbytes,
+                          self.server.remote_slot_testv_and_readv_and_writev,
+                          storage_index, secrets, test_and_write_vectors,
+                          read_vector)
+
+    def remote_advise_corrupt_share(self, share_type, storage_index, shnum,
+                                    reason):
+        return self._call(0, self.server.remote_advise_corrupt_share,
+                          share_type, storage_index, shnum, reason)
+
+
+class ScheduledBucketWriter(Referenceable):
+    """I pass a client's calls to a BucketWriter through its session's
+    scheduler. Since each client's requests are run in the order they were
+    made, its writes still land before its close()."""
+    implements(RIBucketWriter)
+
+    def __init__(self, session, bucketwriter):
+        self.session = session
+        self.bucketwriter = bucketwriter
+
+    def remote_write(self, offset, data):
+        return self.session._call(len(data), self.bucketwriter.remote_write,
+                                  offset, data)
+
+    def remote_close(self):
+        return self.session._call(0, self.bucketwriter.remote_close)
+
+    def remote_abort(self):
+        return self.session._call(0, self.bucketwriter.remote_abort)
+
+
+class ScheduledBucketReader(Referenceable):
+    """I pass a client's calls to a BucketReader through its session's
+    scheduler."""
+    implements(RIBucketReader)
+
+    def __init__(self, session, bucketreader):
+        self.session = session
+        self.bucketreader = bucketreader
+
+    def remote_read(self, offset, length):
+        return self.session._call(length, self.bucketreader.remote_read,
+                                  offset, length)
+
+    def remote_readv(self, readv):
+        return self.session._call(_readv_size(readv),
+                                  self.bucketreader.remote_readv, readv)
+
+    def remote_advise_corrupt_share(self, reason):
+        return self.session._call(0,
+                                  self.bucketreader.remote_advise_corrupt_share,
+                                  reason)
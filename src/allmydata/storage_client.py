@@ -29,12 +29,12 @@ the foolscap-based server implemented in src/allmydata/storage/*.py .
 # 6: implement other sorts of IStorageClient classes: S3, etc
 
 
-import re, time
+import re, time, heapq, math
 from zope.interface import implements
-from twisted.internet import defer
+from twisted.internet import defer, reactor
 from twisted.application import service
 
-from foolscap.api import Tub, eventually
+from foolscap.api import Tub, eventually, Referenceable
 from allmydata.interfaces import IStorageBroker, IDisplayableServer, IServer
 from allmydata.util import log, base32
 from allmydata.util.assertutil import precondition
@@ -102,18 +102,25 @@ class StorageFarmBroker(service.MultiService):
     I'm also responsible for subscribing to the IntroducerClient to find out
     about new servers as they are announced by the Introducer.
     """
-    def __init__(self, permute_peers, preferred_peers=(), tub_options={}):
+    def __init__(self, permute_peers, preferred_peers=(), tub_options={},
+                 probe_interval=0):
         service.MultiService.__init__(self)
         assert permute_peers # False not implemented yet
         self.permute_peers = permute_peers
         self.preferred_peers = preferred_peers
         self._tub_options = tub_options
+        self._probe_interval = probe_interval
 
         # self.servers maps serverid -> IServer, and keeps track of all the
         # storage servers that we've heard about. Each descriptor manages its
         # own Reconnector, and will give us a RemoteReference when we ask
         # them for it.
         self.servers = {}
+        # self._ring is a list of (is_unpreferred, permutation seed, server)
+        # for every server in self.servers, or None if it needs rebuilding.
+        # get_servers_for_psi() uses it so that it need not ask every server
+        # for its seed and name each time.
+        self._ring = None
         self.introducer_client = None
         self._server_listeners = ObserverList()
 
@@ -126,10 +133,12 @@ class StorageFarmBroker(service.MultiService):
         s.rref = rref
         s._is_connected = True
         self.servers[serverid] = s
+        self._ring = None
 
     def test_add_server(self, serverid, s):
         s.on_status_changed(lambda _: self._got_connection())
         self.servers[serverid] = s
+        self._ring = None
 
     def use_introducer(self, introducer_client):
         self.introducer_client = ic = introducer_client
@@ -144,7 +153,8 @@ class StorageFarmBroker(service.MultiService):
             precondition(isinstance(key_s, str), key_s)
             precondition(key_s.startswith("v0-"), key_s)
         assert ann["service-name"] == "storage"
-        s = NativeStorageServer(key_s, ann, self._tub_options)
+        s = NativeStorageServer(key_s, ann, self._tub_options,
+                                self._probe_interval)
         s.on_status_changed(lambda _: self._got_connection())
         serverid = s.get_serverid()
         old = self.servers.get(serverid)
@@ -153,6 +163,7 @@ class StorageFarmBroker(service.MultiService):
                 return # duplicate
             # replacement
             del self.servers[serverid]
+            self._ring = None
             old.stop_connecting()
             old.disownServiceParent()
             # NOTE: this disownServiceParent() returns a Deferred that
@@ -169,6 +180,7 @@ class StorageFarmBroker(service.MultiService):
             # almost always be the case for normal runtime).
         # now we forget about them and start using the new one
         self.servers[serverid] = s
+        self._ring = None
         s.setServiceParent(self)
         s.start_connecting(self._trigger_connections)
         # the descriptor will manage their own Reconnector, and each time we
@@ -185,16 +197,49 @@ class StorageFarmBroker(service.MultiService):
         for dsc in self.servers.values():
             dsc.try_to_connect()
 
+    def _get_ring(self):
+        # (some unit tests change self.servers directly)
+        if self._ring is None or len(self._ring) != len(self.servers):
+            self._ring = [(s.get_longname() not in self.preferred_peers,
+                           s.get_permutation_seed(), s)
+                          for s in self.servers.values()]
+        return self._ring
+
+    def _get_permuted(self, peer_selection_index):
+        # return a list of (sort key, server) for the connected servers.
+        # Servers that have stopped answering our probes go to the back. The
+        # position in the ring breaks ties between servers with the same
+        # seed, and keeps the servers themselves from being compared.
+        assert self.permute_peers == True
+        return [((not s.is_responsive(), is_unpreferred,
+                  sha1(peer_selection_index + seed).digest(), i), s)
+                for (i, (is_unpreferred, seed, s))
+                in enumerate(self._get_ring())
+                if s.is_connected()]
+
     def get_servers_for_psi(self, peer_selection_index):
         # return a list of server objects (IServers)
-        assert self.permute_peers == True
-        connected_servers = self.get_connected_servers()
-        preferred_servers = frozenset(s for s in connected_servers if s.get_longname() in self.preferred_peers)
-        def _permuted(server):
-            seed = server.get_permutation_seed()
-            is_unpreferred = server not in preferred_servers
-            return (is_unpreferred, sha1(peer_selection_index + seed).digest())
-        return sorted(connected_servers, key=_permuted)
+        permuted = self._get_permuted(peer_selection_index)
+        permuted.sort()
+        return [s for (key, s) in permuted]
+
+    def iter_servers_for_psi(self, peer_selection_index):
+        # yield the same servers as get_servers_for_psi, in the same order,
+        # but only sort as far as the caller reads
+        permuted = self._get_permuted(peer_selection_index)
+        heapq.heapify(permuted)
+        while permuted:
+            (key, s) = heapq.heappop(permuted)
+            yield s
+
+    def get_server_score(self, server, nbytes=0):
+        """Return how long (in seconds) we expect a request to 'server' that
+        moves 'nbytes' bytes to take, judging by how it has done so far, or
+        None if we have not measured it yet. Lower is better."""
+        return server.get_performance().estimate(nbytes)
+
+    def sort_servers_by_score(self, servers, nbytes=0):
+        return sort_servers_by_score(servers, nbytes)
 
     def get_all_serverids(self):
         return frozenset(self.servers.keys())
@@ -215,6 +260,27 @@ class StorageFarmBroker(service.MultiService):
             return self.servers[serverid]
         return StubServer(serverid)
 
+# scores below this (in seconds) are all equally good, and above it only
+# a difference of more than a factor of two counts, so that the order of
+# servers that are about as fast as each other is not decided by jitter
+SCORE_FLOOR = 0.05
+
+def _score_band(score):
+    if score < SCORE_FLOOR:
+        return 0
+    return 1 + int(math.log(score / SCORE_FLOOR, 2))
+
+def sort_servers_by_score(servers, nbytes=0):
+    """Return a list of 'servers', fastest first for a request that moves
+    'nbytes' bytes. Servers that are about as fast as each other, and those
+    we have not measured yet (which go last), keep their relative order."""
+    def _key((i, server)):
+        score = server.get_performance().estimate(nbytes)
+        if score is None:
+            return (True, 0, i)
+        return (False, _score_band(score), i)
+    return [server for (i, server) in sorted(enumerate(servers), key=_key)]
+
 class StubServer:
     implements(IDisplayableServer)
     def __init__(self, serverid):
@@ -227,6 +293,124 @@ class StubServer:
         return base32.b2a(self.serverid)
     def get_nickname(self):
         return "?"
+    def get_performance(self):
+        return ServerPerformance()
+    def is_responsive(self):
+        return True
+
+class ServerPerformance:
+    """I remember how quickly one server has been answering us, as
+    exponentially weighted moving averages of the round-trip time of small
+    requests, and of the rate at which larger requests move data. Uploads,
+    downloads, and share lookups all tell me what they see."""
+
+    # each new sample counts for this much of the average
+    ALPHA = 0.2
+    # requests that move less data than this are timed as round trips
+    MIN_TRANSFER_SIZE = 16*1024
+
+    def __init__(self):
+        self.rtt = None
+        self.throughput = None # bytes per second
+        self.rtt_samples = 0
+        self.transfer_samples = 0
+
+    def _average(self, old, sample):
+        if old is None:
+            return sample
+        return (1 - self.ALPHA) * old + self.ALPHA * sample
+
+    def record_rtt(self, elapsed):
+        self.rtt = self._average(self.rtt, elapsed)
+        self.rtt_samples += 1
+
+    def record_transfer(self, nbytes, elapsed):
+        if nbytes < self.MIN_TRANSFER_SIZE or elapsed <= 0:
+            self.record_rtt(elapsed)
+            return
+        self.throughput = self._average(self.throughput, nbytes / elapsed)
+        self.transfer_samples += 1
+
+    def estimate(self, nbytes=0):
+        """Return how long (in seconds) I expect a request that moves
+        'nbytes' bytes to take, or None if I have measured nothing yet."""
+        if self.rtt is None and self.throughput is None:
+            return None
+        estimate = self.rtt or 0.0
+        if nbytes and self.throughput:
+            estimate += nbytes / self.throughput
+        return estimate
+
+    def get_stats(self):
+        return {"rtt": self.rtt,
+                "throughput": self.throughput,
+                "rtt_samples": self.rtt_samples,
+                "transfer_samples": self.transfer_samples,
+                }
+
+class SharenumBatcher:
+    """I coalesce do-you-have-block queries for one server. Each call to
+    get_sharenums() is held for up to 'window' seconds, then all of the
+    storage indexes asked about in the meantime are sent to the server in
+    as few get_sharenums() calls as it allows. Servers which do not offer
+    get_sharenums() are asked with one get_buckets() call per storage
+    index instead.
+
+    'server' is the IServer whose get_rref() and get_version() I use.
+    """
+
+    def __init__(self, server, window=0.01, clock=None):
+        self._server = server
+        self.window = window
+        self._clock = clock or reactor
+        self._pending = {} # storage_index -> list of Deferreds
+        self._timer = None
+
+    def get_sharenums(self, storage_index):
+        d = defer.Deferred()
+        self._pending.setdefault(storage_index, []).append(d)
+        if self._timer is None:
+            self._timer = self._clock.callLater(self.window, self._flush)
+        return d
+
+    def _call(self, methname, *args):
+        rref = self._server.get_rref()
+        return defer.maybeDeferred(lambda: rref.callRemote(methname, *args))
+
+    def _flush(self):
+        self._timer = None
+        pending, self._pending = self._pending, {}
+        batch_size = None
+        version = self._server.get_version()
+        if version is not None:
+            v1 = version.get("http://allmydata.org/tahoe/protocols/storage/v1",
+                             {})
+            batch_size = v1.get("maximum-get-sharenums-batch")
+        storage_indexes = sorted(pending.keys())
+        if not batch_size:
+            for si in storage_indexes:
+                d = self._call("get_buckets", si)
+                d.addCallback(lambda buckets, si=si: {si: set(buckets)})
+                self._deliver(d, {si: pending[si]})
+            return
+        while storage_indexes:
+            batch = storage_indexes[:batch_size]
+            storage_indexes = storage_indexes[batch_size:]
+            d = self._call("get_sharenums", batch)
+            self._deliver(d, dict([(si, pending[si]) for si in batch]))
+
+    def _deliver(self, d, waiters):
+        def _got(res):
+            for si, ds in waiters.items():
+                for waiter in ds:
+                    waiter.callback(set(res.get(si, ())))
+        def _failed(f):
+            for ds in waiters.values():
+                for waiter in ds:
+                    waiter.errback(f)
+        d.addCallbacks(_got, _failed)
+        d.addErrback(log.err, facility="tahoe.storage_broker",
+                     umid="k3NFBQ")
 
 class NativeStorageServer(service.MultiService):
     """I hold information about a storage server that we want to connect to.
@@ -256,11 +440,20 @@ class NativeStorageServer(service.MultiService):
         "application-version": "unknown: no get_version()",
         }
 
-    def __init__(self, key_s, ann, tub_options={}):
+    # when probing, a server that has not answered a probe by the time the
+    # next one is due has missed it
+    PROBE_MISSES_ALLOWED = 0
+
+    def __init__(self, key_s, ann, tub_options={}, probe_interval=0):
         service.MultiService.__init__(self)
         self.key_s = key_s
         self.announcement = ann
         self._tub_options = tub_options
+        self._probe_interval = probe_interval
+        self.clock = reactor # tests may replace this with a task.Clock
+        # servers that share their attention between clients learn who we
+        # are from this when we ask for a session
+        self._session_canary = Referenceable()
 
         assert "anonymous-storage-FURL" in ann, ann
         furl = str(ann["anonymous-storage-FURL"])
@@ -291,6 +484,18 @@ class NativeStorageServer(service.MultiService):
         self._reconnector = None
         self._trigger_cb = None
         self._on_status_changed = ObserverList()
+        self._sharenum_batcher = SharenumBatcher(self)
+        self._performance = ServerPerformance()
+
+        # keepalive probes, if probe_interval is set
+        self._probe_timer = None
+        self._probe_outstanding = False
+        self._probes_missed_in_a_row = 0
+        self.probes_sent = 0
+        self.probes_missed = 0
+        self.last_probe_rtt = None
+        self.last_probe_time = None
+        self.connections = 0
 
     def on_status_changed(self, status_changed):
         """
@@ -347,6 +552,33 @@ class NativeStorageServer(service.MultiService):
         else:
             return self.rref.getDataLastReceivedAt()
 
+    def get_liveness(self):
+        """Return 'unknown' if we are not connected or not probing, 'alive'
+        if the server answered our last probe in time, or 'unresponsive' if
+        it did not."""
+        if not self._is_connected or not self._probe_interval:
+            return "unknown"
+        if self._probes_missed_in_a_row > self.PROBE_MISSES_ALLOWED:
+            return "unresponsive"
+        if self.last_probe_rtt is None:
+            return "unknown"
+        return "alive"
+
+    def is_responsive(self):
+        return self.get_liveness() != "unresponsive"
+
+    def get_last_probe_rtt(self):
+        return self.last_probe_rtt
+
+    def get_connection_stats(self):
+        return {"liveness": self.get_liveness(),
+                "connections": self.connections,
+                "probes_sent": self.probes_sent,
+                "probes_missed": self.probes_missed,
+                "last_probe_rtt": self.last_probe_rtt,
+                "last_probe_time": self.last_probe_time,
+                }
+
     def get_available_space(self):
         version = self.get_version()
         if version is None:
@@ -375,11 +607,30 @@ class NativeStorageServer(service.MultiService):
             eventually(self._trigger_cb)
         default = self.VERSION_DEFAULTS
         d = add_version_to_remote_reference(rref, default)
+        d.addCallback(self._get_session, lp)
         d.addCallback(self._got_versioned_service, lp)
         d.addCallback(lambda ign: self._on_status_changed.notify(self))
         d.addErrback(log.err, format="storageclient._got_connection",
                      name=self.get_name(), umid="Sdq3pg")
 
+    def _get_session(self, rref, lp):
+        v1 = rref.version.get("http://allmydata.org/tahoe/protocols/storage/v1",
+                              {})
+        if not v1.get("accepts-client-sessions"):
+            return rref
+        d = rref.callRemote("get_client_session", self._session_canary)
+        def _got_session(session):
+            session.version = rref.version
+            return session
+        def _failed(f):
+            log.msg(format="unable to get a session from %(name)s",
+                    name=self.get_name(), failure=f,
+                    facility="tahoe.storage_broker", level=log.UNUSUAL,
+                    parent=lp, umid="k3XHbw")
+            return rref
+        d.addCallbacks(_got_session, _failed)
+        return d
+
     def _got_versioned_service(self, rref, lp):
         log.msg(format="%(name)s provided version info %(version)s",
                 name=self.get_name(), version=rref.version,
@@ -390,11 +641,76 @@ class NativeStorageServer(service.MultiService):
         self.remote_host = rref.getPeer()
         self.rref = rref
         self._is_connected = True
+        self.connections += 1
         rref.notifyOnDisconnect(self._lost)
+        self._start_probing()
+
+    def _start_probing(self):
+        self._stop_probing()
+        self._probe_outstanding = False
+        self._probes_missed_in_a_row = 0
+        self.last_probe_rtt = None
+        if self._probe_interval:
+            self._probe_timer = self.clock.callLater(self._probe_interval,
+                                                     self._probe)
+
+    def _stop_probing(self):
+        if self._probe_timer and self._probe_timer.active():
+            self._probe_timer.cancel()
+        self._probe_timer = None
+
+    def _probe(self):
+        # A probe is a get_version() call, which servers answer without
+        # touching their disks or waiting their turn behind other requests.
+        self._probe_timer = self.clock.callLater(self._probe_interval,
+                                                 self._probe)
+        if self._probe_outstanding:
+            # the last probe is still unanswered. Don't pile on another.
+            self.probes_missed += 1
+            self._probes_missed_in_a_row += 1
+            if self._probes_missed_in_a_row == self.PROBE_MISSES_ALLOWED + 1:
+                log.msg(format="%(name)s is not answering probes",
+                        name=self.get_name(),
+                        facility="tahoe.storage_broker", level=log.UNUSUAL,
+                        umid="f0xP4A")
+            return
+        rref = self.rref
+        sent = self.clock.seconds()
+        self._probe_outstanding = True
+        self.probes_sent += 1
+        d = rref.callRemote("get_version")
+        def _answered(res):
+            if rref is not self.rref:
+                return # from an old connection
+            rtt = self.clock.seconds() - sent
+            self._probe_outstanding = False
+            self._probes_missed_in_a_row = 0
+            self.last_probe_rtt = rtt
+            self.last_probe_time = time.time()
+            self._performance.record_rtt(rtt)
+        def _failed(f):
+            # a lost connection is noticed by _lost()
+            if rref is self.rref:
+                self._probe_outstanding = False
+        d.addCallbacks(_answered, _failed)
 
     def get_rref(self):
         return self.rref
 
+    def get_performance(self):
+        return self._performance
+
+    def get_sharenums(self, storage_index):
+        return self._sharenum_batcher.get_sharenums(storage_index)
+
+    def get_share_digests(self, storage_index, shnums=()):
+        version = self.get_version() or {}
+        v1 = version.get("http://allmydata.org/tahoe/protocols/storage/v1", {})
+        if not v1.get("provides-share-digests"):
+            return defer.succeed({})
+        return self.rref.callRemote("get_share_digests", storage_index,
+                                    set(shnums))
+
     def _lost(self):
         log.msg(format="lost connection to %(name)s", name=self.get_name(),
                 facility="tahoe.storage_broker", umid="zbRllw")
@@ -406,6 +722,11 @@ class NativeStorageServer(service.MultiService):
         # use s.get_rref().callRemote() and not worry about it being None.
         self._is_connected = False
         self.remote_host = None
+        self._stop_probing()
+
+    def stopService(self):
+        self._stop_probing()
+        return service.MultiService.stopService(self)
 
     def stop_connecting(self):
         # used when this descriptor has been superceded by another
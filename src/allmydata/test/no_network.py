@@ -23,6 +23,8 @@ from base64 import b32encode
 from allmydata import uri as tahoe_uri
 from allmydata.client import Client
 from allmydata.storage.server import StorageServer, storage_index_to_dir
+from allmydata.storage_client import SharenumBatcher, ServerPerformance, \
+     sort_servers_by_score
 from allmydata.util import fileutil, idlib, hashutil
 from allmydata.util.hashutil import sha1
 from allmydata.test.common_web import HTTPClientGETFactory
@@ -44,6 +46,7 @@ class LocalWrapper:
         self.post_call_notifier = None
         self.disconnectors = {}
         self.counter_by_methname = {}
+        self.remote_tubid = None
 
     def _clear_counters(self):
         self.counter_by_methname = {}
@@ -111,6 +114,9 @@ class LocalWrapper:
             d.addCallback(self.post_call_notifier, self, methname)
         return d
 
+    def getRemoteTubID(self):
+        return self.remote_tubid
+
     def notifyOnDisconnect(self, f, *args, **kwargs):
         m = Marker()
         self.disconnectors[m] = (f, args, kwargs)
@@ -132,6 +138,8 @@ class NoNetworkServer:
     def __init__(self, serverid, rref):
         self.serverid = serverid
         self.rref = rref
+        self._sharenum_batcher = SharenumBatcher(self)
+        self._performance = ServerPerformance()
     def __repr__(self):
         return "<NoNetworkServer for %s>" % self.get_name()
     # Special method used by copy.copy() and copy.deepcopy(). When those are
@@ -160,6 +168,12 @@ class NoNetworkServer:
         return self.rref
     def get_version(self):
         return self.rref.version
+    def get_sharenums(self, storage_index):
+        return self._sharenum_batcher.get_sharenums(storage_index)
+    def get_performance(self):
+        return self._performance
+    def is_responsive(self):
+        return True
 
 class NoNetworkStorageBroker:
     implements(IStorageBroker)
@@ -168,6 +182,12 @@ class NoNetworkStorageBroker:
             seed = server.get_permutation_seed()
             return sha1(peer_selection_index + seed).digest()
         return sorted(self.get_connected_servers(), key=_permuted)
+    def iter_servers_for_psi(self, peer_selection_index):
+        return iter(self.get_servers_for_psi(peer_selection_index))
+    def get_server_score(self, server, nbytes=0):
+        return server.get_performance().estimate(nbytes)
+    def sort_servers_by_score(self, servers, nbytes=0):
+        return sort_servers_by_score(servers, nbytes)
     def get_connected_servers(self):
         return self.client._servers
     def get_nickname_for_serverid(self, serverid):
@@ -285,6 +305,22 @@ class NoNetworkGrid(service.MultiService):
         self.proxies_by_id[serverid] = NoNetworkServer(serverid, wrapper)
         self.rebuild_serverlist()
 
+    def use_client_sessions(self):
+        # give each client a ClientSession of its own on each server, as the
+        # clients of a real grid get from servers that offer them, so that
+        # the servers can tell the clients apart. This lasts until the next
+        # change to the list of servers.
+        for c in self.clients:
+            canary = LocalWrapper(Referenceable())
+            canary.remote_tubid = idlib.nodeid_b2a(c.nodeid)
+            servers = []
+            for (serverid, server) in self.proxies_by_id.items():
+                ss = server.get_rref().original
+                session = LocalWrapper(ss.remote_get_client_session(canary))
+                session.version = ss.remote_get_version()
+                servers.append(NoNetworkServer(serverid, session))
+            c._servers = frozenset(servers)
+
     def get_all_serverids(self):
         return self.proxies_by_id.keys()
 
@@ -247,6 +247,30 @@ class Basic(testutil.ReallyEqualMixin, unittest.TestCase):
         sb.servers.clear()
         self.failUnlessReallyEqual(self._permute(sb, "one"), [])
 
+    def test_iter_permuted(self):
+        sb = StorageFarmBroker(True, ['1'])
+        for k in ["%d" % i for i in range(4)]:
+            ann = {"anonymous-storage-FURL": "pb://abcde@nowhere/fake",
+                   "permutation-seed-base32": base32.b2a(k) }
+            sb.test_add_rref(k, "rref", ann)
+        servers = sb.iter_servers_for_psi("one")
+        self.failUnlessReallyEqual(servers.next().get_longname(), '1')
+        self.failUnlessReallyEqual([s.get_longname() for s in servers],
+                                   ['3','0','2'])
+
+        # a server that arrives later is included, and one that is not
+        # connected is left out
+        ann = {"anonymous-storage-FURL": "pb://abcde@nowhere/fake",
+               "permutation-seed-base32": base32.b2a("4") }
+        sb.test_add_rref("4", "rref", ann)
+        sb.servers["2"]._is_connected = False
+        self.failUnlessReallyEqual(self._permute(sb, "one"), ['1','3','0','4'])
+        self.failUnlessReallyEqual([s.get_longname()
+                                    for s in sb.iter_servers_for_psi("one")],
+                                   ['1','3','0','4'])
+        sb.servers.clear()
+        self.failUnlessReallyEqual(self._permute(sb, "one"), [])
+
     def test_permute_with_preferred(self):
         sb = StorageFarmBroker(True, ['1','4'])
         for k in ["%d" % i for i in range(5)]:
@@ -1,14 +1,18 @@
 
 import time
 import os.path
+import cPickle as pickle
 from twisted.trial import unittest
 from twisted.application import service
 from twisted.internet import defer
+from twisted.python import threadable
 from foolscap.api import eventually, fireEventually
 
-from allmydata.util import fileutil, hashutil, pollmixin
+from allmydata.util import fileutil, hashutil, pollmixin, dbutil
 from allmydata.storage.server import StorageServer, si_b2a
 from allmydata.storage.crawler import ShareCrawler, TimeSliceExceeded
+from allmydata.storage import crawlerstate
+from allmydata.storage.crawlerstate import CrawlerStateStore
 
 from allmydata.test.test_storage import FakeCanary
 from allmydata.test.common_util import StallMixin
@@ -82,6 +86,18 @@ class OneShotCrawler(ShareCrawler):
         self.finished_d.callback(None)
         self.disownServiceParent()
 
+class ScanningCrawler(BucketEnumeratingCrawler):
+    threads = 3
+    def __init__(self, *args, **kwargs):
+        BucketEnumeratingCrawler.__init__(self, *args, **kwargs)
+        self.scans = []
+    def scan_bucket(self, prefixdir, storage_index_b32):
+        return (storage_index_b32, threadable.isInIOThread())
+    def process_bucket(self, cycle, prefix, prefixdir, storage_index_b32):
+        BucketEnumeratingCrawler.process_bucket(self, cycle, prefix, prefixdir,
+                                                storage_index_b32)
+        self.scans.append(self.bucket_scans.get(storage_index_b32))
+
 class Basic(unittest.TestCase, StallMixin, pollmixin.PollMixin):
     def setUp(self):
         self.s = service.MultiService()
@@ -328,6 +344,199 @@ class Basic(unittest.TestCase, StallMixin, pollmixin.PollMixin):
         d.addCallback(_check)
         return d
 
+    def test_threaded(self):
+        self.basedir = "crawler/Basic/threaded"
+        fileutil.make_dirs(self.basedir)
+        serverid = "\x00" * 20
+        ss = StorageServer(self.basedir, serverid)
+        ss.setServiceParent(self.s)
+
+        sis = []
+        for i in range(10):
+            for tail in range(4):
+                sis.append(self.write(i, ss, serverid, tail))
+
+        statefile = os.path.join(self.basedir, "statefile")
+        c = ScanningCrawler(ss, statefile)
+        c.setServiceParent(self.s)
+
+        d = c.finished_d
+        def _check(ignored):
+            self.failUnlessEqual(sorted(sis), sorted(c.all_buckets))
+            # every bucket was scanned in a worker thread, and the scan was
+            # handed to process_bucket() in the reactor thread
+            self.failUnlessEqual(sorted(c.scans),
+                                 [(si, False) for si in sorted(sis)])
+            self.failUnlessEqual(c.bucket_scans, {})
+            # the state file looks just like that of an unthreaded crawler
+            c.save_state()
+            state = CrawlerStateStore(statefile).get_state()
+            self.failUnlessEqual(sorted(state.keys()),
+                                 ["current-cycle", "current-cycle-start-time",
+                                  "last-complete-bucket",
+                                  "last-complete-prefix",
+                                  "last-cycle-finished", "version"])
+            self.failUnlessEqual(state["last-cycle-finished"], 0)
+            self.failUnlessEqual(state["current-cycle"], None)
+            self.failUnlessEqual(state["last-complete-prefix"], None)
+        d.addCallback(_check)
+        return d
+
+    def test_threaded_paced(self):
+        self.basedir = "crawler/Basic/threaded_paced"
+        fileutil.make_dirs(self.basedir)
+        serverid = "\x00" * 20
+        ss = StorageServer(self.basedir, serverid)
+        ss.setServiceParent(self.s)
+
+        # put four buckets in each prefixdir
+        sis = []
+        for i in range(10):
+            for tail in range(4):
+                sis.append(self.write(i, ss, serverid, tail))
+
+        statefile = os.path.join(self.basedir, "statefile")
+        c = PacedCrawler(ss, statefile)
+        c.threads = 2
+        yielded = []
+        def _yielded():
+            yielded.append(len(c.all_buckets))
+            c.yield_cb = None
+        c.yield_cb = _yielded
+        c.setServiceParent(self.s)
+
+        # the crawler gives up its slice in the middle of a prefixdir after
+        # six buckets, and should resume from the next bucket without
+        # repeating or skipping any
+        d = c.finished_d
+        def _check(ignored):
+            self.failUnlessEqual(yielded, [6])
+            self.failUnlessEqual(len(sis), len(c.all_buckets))
+            self.failUnlessEqual(sorted(sis), sorted(c.all_buckets))
+        d.addCallback(_check)
+        return d
+
+    def test_state_store(self):
+        self.basedir = "crawler/Basic/state_store"
+        fileutil.make_dirs(self.basedir)
+        statefile = os.path.join(self.basedir, "statefile")
+        store = CrawlerStateStore(statefile)
+        self.failUnlessEqual(store.get_state(), None)
+        self.failUnlessEqual(store.legacy_pickle, None)
+        counts = dict([(prefix, 1) for prefix in ["aa", "ab", "ac", "ad"]])
+        state = {"version": 1,
+                 "last-complete-bucket": None,
+                 "bucket-counts": {0: counts, 1: {}},
+                 "histogram": {(0, 86400): 3},
+                 "corrupt-shares": [("aaaa", 0)],
+                 }
+        store.save_state(state)
+        self.failUnlessEqual(CrawlerStateStore(statefile).get_state(), state)
+
+        # saving again only writes the values that have changed
+        before = store.connection.total_changes
+        state["bucket-counts"][1]["aa"] = 2
+        state["histogram"][(0, 86400)] += 1
+        store.save_state(state)
+        self.failUnlessEqual(store.connection.total_changes - before, 2)
+        before = store.connection.total_changes
+        store.save_state(state)
+        self.failUnlessEqual(store.connection.total_changes, before)
+
+        # and forgets the ones that have gone
+        del state["bucket-counts"][0]
+        store.save_state(state)
+        self.failUnlessEqual(store.connection.total_changes - before,
+                             1 + len(counts))
+        store2 = CrawlerStateStore(statefile)
+        self.failUnlessEqual(store2.get_state(), state)
+
+        # given the paths it touched, only those values are written out, and
+        # lists only gain a row for each new item
+        state = store2.get_state()
+        state["corrupt-shares"].append(("bbbb", 1))
+        state["histogram"][(0, 86400)] += 1
+        state["bucket-counts"][1]["ab"] = 1
+        state["bucket-counts"][2] = {"aa": 1}
+        before = store2.connection.total_changes
+        store2.save_state(state, set([("corrupt-shares",),
+                                      ("bucket-counts", 1, "ab"),
+                                      ("bucket-counts", 2, "aa")]))
+        self.failUnlessEqual(store2.connection.total_changes - before, 4)
+        saved = CrawlerStateStore(statefile).get_state()
+        self.failUnlessEqual(saved["corrupt-shares"],
+                             [("aaaa", 0), ("bbbb", 1)])
+        self.failUnlessEqual(saved["bucket-counts"], state["bucket-counts"])
+        self.failUnlessEqual(saved["histogram"], {(0, 86400): 4})
+        before = store2.connection.total_changes
+        del state["bucket-counts"][2]
+        state["corrupt-shares"] = []
+        store2.save_state(state, set([("bucket-counts", 2),
+                                      ("corrupt-shares",)]))
+        saved = CrawlerStateStore(statefile).get_state()
+        self.failIf(2 in saved["bucket-counts"])
+        self.failUnlessEqual(saved["corrupt-shares"], [])
+
+        for cycle in range(5):
+            store2.add_history(cycle, {"cycle": cycle}, 3)
+        self.failUnlessEqual(store2.get_history(),
+                             {2: {"cycle": 2}, 3: {"cycle": 3},
+                              4: {"cycle": 4}})
+
+    def test_state_store_upgrade(self):
+        self.basedir = "crawler/Basic/state_store_upgrade"
+        fileutil.make_dirs(self.basedir)
+        statefile = os.path.join(self.basedir, "statefile")
+        (sqlite3, db) = dbutil.get_db(statefile,
+                                      create_version=(crawlerstate.SCHEMA_v1,
+                                                      1))
+        # version 1 kept lists in the state table, like any other value
+        db.execute("INSERT INTO state VALUES (?,?)",
+                   (sqlite3.Binary(crawlerstate._dumps(("corrupt-shares",))),
+                    sqlite3.Binary(crawlerstate._dumps([("aaaa", 0)]))))
+        db.commit()
+        db.close()
+        store = CrawlerStateStore(statefile)
+        state = store.get_state()
+        self.failUnlessEqual(state, {"corrupt-shares": [("aaaa", 0)]})
+        state["corrupt-shares"].append(("bbbb", 1))
+        store.save_state(state, set([("corrupt-shares",)]))
+        self.failUnlessEqual(CrawlerStateStore(statefile).get_state(), state)
+
+    def test_legacy_statefile(self):
+        self.basedir = "crawler/Basic/legacy_statefile"
+        fileutil.make_dirs(self.basedir)
+        serverid = "\x00" * 20
+        ss = StorageServer(self.basedir, serverid)
+        statefile = os.path.join(self.basedir, "statefile")
+        # older versions pickled the whole state
+        state = {"version": 1,
+                 "last-cycle-finished": 3,
+                 "current-cycle": 4,
+                 "current-cycle-start-time": 1234567890,
+                 "last-complete-prefix": "ab",
+                 "last-complete-bucket": "abcd",
+                 }
+        f = open(statefile, "wb")
+        pickle.dump(state, f)
+        f.close()
+
+        c = BucketEnumeratingCrawler(ss, statefile)
+        self.failUnlessEqual(c.get_state(), state)
+        self.failUnlessEqual(c.last_complete_prefix_index,
+                             c.prefixes.index("ab"))
+        c.save_state()
+        c2 = BucketEnumeratingCrawler(ss, statefile)
+        self.failUnlessEqual(c2.get_state(), state)
+
+        # an unreadable statefile is ignored, as it always has been
+        statefile3 = os.path.join(self.basedir, "statefile3")
+        f = open(statefile3, "wb")
+        f.write("garbage")
+        f.close()
+        c3 = BucketEnumeratingCrawler(ss, statefile3)
+        self.failUnlessEqual(c3.get_state()["last-cycle-finished"], None)
+
     def OFF_test_cpu_usage(self):
         # this test can't actually assert anything, because too many
         # buildslave machines are slow. But on a fast developer machine, it
@@ -408,7 +617,15 @@ class Basic(unittest.TestCase, StallMixin, pollmixin.PollMixin):
 
 
     def test_oneshot(self):
-        self.basedir = "crawler/Basic/oneshot"
+        return self.do_oneshot("crawler/Basic/oneshot", 0)
+
+    def test_oneshot_threaded(self):
+        # here the crawler stops itself while it is merging the results of
+        # its worker threads
+        return self.do_oneshot("crawler/Basic/oneshot_threaded", 4)
+
+    def do_oneshot(self, basedir, threads):
+        self.basedir = basedir
         fileutil.make_dirs(self.basedir)
         serverid = "\x00" * 20
         ss = StorageServer(self.basedir, serverid)
@@ -419,6 +636,7 @@ class Basic(unittest.TestCase, StallMixin, pollmixin.PollMixin):
 
         statefile = os.path.join(self.basedir, "statefile")
         c = OneShotCrawler(ss, statefile)
+        c.threads = threads
         c.setServiceParent(self.s)
 
         d = c.finished_d
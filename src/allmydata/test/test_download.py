@@ -609,6 +609,41 @@ class DownloadTest(_Base, unittest.TestCase):
         d.addCallback(_got_data)
         return d
 
+    def _download_counting_readv(self, readv_ok):
+        # servers that can't overrun need several requests to fetch the
+        # hash trees and blocks, so those are the ones where readv matters
+        self.basedir = self.mktemp()
+        self.set_up_grid()
+        self.c0 = self.g.clients[0]
+
+        self.load_shares()
+        for s in self.c0.storage_broker.get_connected_servers():
+            rref = s.get_rref()
+            v1 = rref.version["http://allmydata.org/tahoe/protocols/storage/v1"]
+            v1["tolerates-immutable-read-overrun"] = False
+            v1["accepts-immutable-readv"] = readv_ok
+
+        n = self.c0.create_node_from_uri(immutable_uri)
+        d = download_to_data(n)
+        def _got_data(data):
+            self.failUnlessEqual(data, plaintext)
+            return sum([ss.latencies["readv-immutable"].cumulative.count
+                        for (i,ss,ssdir) in self.iterate_servers()])
+        d.addCallback(_got_data)
+        return d
+
+    def test_download_readv(self):
+        # several spans of a share are fetched with a single message
+        d = self._download_counting_readv(True)
+        d.addCallback(lambda readvs: self.failUnless(readvs > 0))
+        return d
+
+    def test_download_no_readv(self):
+        # old servers only offer read()
+        d = self._download_counting_readv(False)
+        d.addCallback(self.failUnlessEqual, 0)
+        return d
+
     def test_download_segment(self):
         self.basedir = self.mktemp()
         self.set_up_grid()
@@ -1288,6 +1323,7 @@ class MyShare:
         self._shnum = shnum
         self._server = server
         self._dyhb_rtt = rtt
+        self._score = rtt
     def __repr__(self):
         return "sh%d-on-%s" % (self._shnum, self._server.get_name())
 
@@ -15,6 +15,7 @@ from allmydata.util.consumer import download_to_data
 from allmydata.interfaces import NotEnoughSharesError
 from allmydata.immutable.upload import Data
 from allmydata.immutable.downloader import finder
+from allmydata.storage_client import ServerPerformance
 
 
 class MockShareHashTree(object):
@@ -118,12 +119,18 @@ class TestShareFinder(unittest.TestCase):
                 return "name-%s" % self.serverid
             def get_version(self):
                 return self.rref.version
+            def get_performance(self):
+                return ServerPerformance()
 
         class MockStorageBroker(object):
             def __init__(self, servers):
                 self.servers = servers
             def get_servers_for_psi(self, si):
                 return self.servers
+            def iter_servers_for_psi(self, si):
+                return iter(self.servers)
+            def get_server_score(self, server, nbytes=0):
+                return None
 
         class MockDownloadStatus(object):
             def add_dyhb_request(self, server, when):
@@ -3770,6 +3770,41 @@ class Update(GridTestMixin, unittest.TestCase, testutil.ShouldFailMixin):
         d0.addCallback(_run)
         return d0
 
+    def _get_writev_bytes(self):
+        return sum([ss.stats_provider.counters.get("storage_server.writev-bytes", 0)
+                    for ss in self.g.servers_by_number.values()])
+
+    def test_bytes_written_per_update(self):
+        # A benchmark as much as a test: a 4KiB update to the middle of an
+        # MDMF file should cause the servers to write roughly one segment's
+        # worth of each share (plus hashes and signatures), not the whole
+        # share.
+        self.nm.default_encoding_parameters['n'] = 10
+        self.nm.default_encoding_parameters['k'] = 3
+        offset = 3 * DEFAULT_MAX_SEGMENT_SIZE + 1000
+        new_data = "x" * 4096
+        expected = self.data[:offset]+new_data+self.data[offset+len(new_data):]
+        d = self.nm.create_mutable_file(MutableData(self.data),
+                                        version=MDMF_VERSION)
+        def _uploaded(n):
+            self.n = n
+            self.uploaded_bytes = self._get_writev_bytes()
+            return n.get_best_mutable_version()
+        d.addCallback(_uploaded)
+        d.addCallback(lambda mv: mv.update(MutableData(new_data), offset))
+        def _updated(ign):
+            written = self._get_writev_bytes() - self.uploaded_bytes
+            share_size = self.uploaded_bytes / 10
+            per_share = written / 10
+            log.msg("MDMF 4KiB update wrote %d bytes per share (of %d)"
+                    % (per_share, share_size))
+            self.failUnless(0 < per_share < share_size / 4,
+                            (per_share, share_size))
+            return self.n.download_best_version()
+        d.addCallback(_updated)
+        d.addCallback(lambda results: self.failUnlessEqual(results, expected))
+        return d
+
     def test_multiple_segment_replace(self):
         replace_offset = 2 * DEFAULT_MAX_SEGMENT_SIZE
         new_data = self.data[:replace_offset]
@@ -1,22 +1,39 @@
 
-import time, os.path, platform, stat, re, simplejson, struct, shutil
+import time, os.path, errno, platform, stat, re, simplejson, struct, shutil
+import threading
+import cPickle as pickle
 
 from twisted.trial import unittest
 
 from twisted.internet import defer
+from twisted.internet.task import Clock
 from twisted.application import service
-from foolscap.api import fireEventually
+from foolscap.api import fireEventually, Tub
 import itertools
 from allmydata import interfaces
 from allmydata.util import fileutil, hashutil, base32, pollmixin, time_format
 from allmydata.storage.server import StorageServer
 from allmydata.storage.mutable import MutableShareFile
-from allmydata.storage.immutable import BucketWriter, BucketReader
+from allmydata.storage.immutable import BucketWriter, BucketReader, ShareFile
 from allmydata.storage.common import DataTooLargeError, storage_index_to_dir, \
-     UnknownMutableContainerVersionError, UnknownImmutableContainerVersionError
+     UnknownMutableContainerVersionError, UnknownImmutableContainerVersionError, \
+     get_share_identity, si_a2b, si_b2a
 from allmydata.storage.lease import LeaseInfo
 from allmydata.storage.crawler import BucketCountingCrawler
-from allmydata.storage.expirer import LeaseCheckingCrawler
+from allmydata.storage.crawlerstate import CrawlerStateStore
+from allmydata.storage.expirer import LeaseCheckingCrawler, \
+     IndexedLeaseCheckingCrawler
+from allmydata.storage import leasedb
+from allmydata.storage.fdcache import FileHandleCache
+from allmydata.storage.inventory import ShareInventory
+from allmydata.storage.scrubber import ShareScrubber
+from allmydata.storage import digests
+from allmydata.storage.digests import ShareDigestCrawler
+from allmydata.storage.diskio import DiskIO, call_io, when_done
+from allmydata.storage.scheduler import FairScheduler
+from allmydata.storage.session import ClientSession, SESSIONLESS
+from allmydata.util import dbutil, deferredutil, idlib, iputil
+from allmydata.util.consumer import download_to_data
 from allmydata.immutable.layout import WriteBucketProxy, WriteBucketProxy_v2, \
      ReadBucketProxy
 from allmydata.mutable.layout import MDMFSlotWriteProxy, MDMFSlotReadProxy, \
@@ -27,10 +44,13 @@ from allmydata.mutable.layout import MDMFSlotWriteProxy, MDMFSlotReadProxy, \
                                      SIGNATURE_SIZE, \
                                      VERIFICATION_KEY_SIZE, \
                                      SHARE_HASH_CHAIN_SIZE
-from allmydata.interfaces import BadWriteEnablerError
+from allmydata.interfaces import BadWriteEnablerError, MDMF_VERSION
 from allmydata.test.common import LoggingServiceParent, ShouldFailMixin
 from allmydata.test.common_web import WebRenderingMixin
-from allmydata.test.no_network import NoNetworkServer
+from allmydata.test.no_network import NoNetworkServer, GridTestMixin
+from allmydata.test import common
+from allmydata.immutable import upload
+from allmydata.mutable.publish import MutableData
 from allmydata.web.storage import StorageStatus, remove_prefix
 
 class Marker:
@@ -65,6 +85,10 @@ class Bucket(unittest.TestCase):
         fileutil.make_dirs(os.path.join(basedir, "tmp"))
         return incoming, final
 
+    fdcache = None
+    diskio = None
+    def reserve_write_handle(self, bw):
+        return True
     def bucket_writer_closed(self, bw, consumed):
         pass
     def add_latency(self, category, latency):
@@ -105,6 +129,93 @@ class Bucket(unittest.TestCase):
         self.failUnlessEqual(br.remote_read(25, 25), "b"*25)
         self.failUnlessEqual(br.remote_read(50, 7), "c"*7)
 
+    def test_readv(self):
+        incoming, final = self.make_workdir("test_readv")
+        bw = BucketWriter(self, incoming, final, 60, self.make_lease(),
+                          FakeCanary())
+        bw.remote_write(0, "a"*25)
+        bw.remote_write(25, "b"*25)
+        bw.remote_write(50, "c"*10)
+        bw.remote_close()
+
+        br = BucketReader(self, bw.finalhome)
+        readv = [(50, 7), (0, 25), (20, 10), (55, 100), (60, 5), (100, 5)]
+        expected = ["c"*7, "a"*25, "a"*5+"b"*5, "c"*5, "", ""]
+        self.failUnlessEqual(br.remote_readv(readv), expected)
+        self.failUnlessEqual(br.remote_readv([]), [])
+        # and without merging any of the ranges
+        br._share_file.READV_MERGE_GAP = -1
+        self.failUnlessEqual(br.remote_readv(readv), expected)
+
+    def test_write_coalescing(self):
+        incoming, final = self.make_workdir("test_write_coalescing")
+        bw = BucketWriter(self, incoming, final, 70, self.make_lease(),
+                          FakeCanary())
+        sf = bw._sharefile
+        sf.WRITE_BUFFER_SIZE = 40
+        writes = []
+        class RecordingFile:
+            def __init__(self, f):
+                self._f = f
+            def write(self, data):
+                writes.append(data)
+                return self._f.write(data)
+            def __getattr__(self, name):
+                return getattr(self._f, name)
+        sf._write_f = RecordingFile(sf._write_f)
+        bw.remote_write(0, "a"*10)
+        bw.remote_write(10, "b"*10)
+        self.failUnlessEqual(writes, [])
+        bw.remote_write(20, "c"*20) # fills the buffer
+        self.failUnlessEqual(writes, ["a"*10+"b"*10+"c"*20])
+        bw.remote_write(60, "e"*10) # out of order
+        bw.remote_write(40, "d"*20)
+        bw.remote_write(35, "C"*5) # overwrites earlier data
+        self.failUnlessEqual(writes[1:], ["e"*10, "d"*20])
+        bw.remote_close()
+        self.failUnlessEqual(writes[3:], ["C"*5])
+
+        br = BucketReader(self, bw.finalhome)
+        self.failUnlessEqual(br.remote_read(0, 100),
+                             "a"*10+"b"*10+"c"*15+"C"*5+"d"*20+"e"*10)
+
+    def test_abort_closes_file(self):
+        incoming, final = self.make_workdir("test_abort_closes_file")
+        bw = BucketWriter(self, incoming, final, 100, self.make_lease(),
+                          FakeCanary())
+        bw.remote_write(0, "a"*10)
+        f = bw._sharefile._write_f
+        bw.remote_abort()
+        self.failUnless(f.closed)
+        self.failIf(os.path.exists(incoming))
+
+    def _count_fsyncs(self):
+        fsyncs = []
+        orig_fsync = os.fsync
+        def _fsync(fd):
+            fsyncs.append(fd)
+            return orig_fsync(fd)
+        self.patch(os, "fsync", _fsync)
+        return fsyncs
+
+    def test_fsync_policy(self):
+        for (policy, expected) in [("none", 0),
+                                   ("close", 1),
+                                   ("close-and-dir", 2)]:
+            incoming, final = self.make_workdir("test_fsync_policy_"+policy)
+            fsyncs = self._count_fsyncs()
+            bw = BucketWriter(self, incoming, final, 100, self.make_lease(),
+                              FakeCanary(), fsync_policy=policy)
+            bw.remote_write(0, "a"*100)
+            self.failUnlessEqual(len(fsyncs), 0)
+            bw.remote_close()
+            if platform.system() == "Windows":
+                expected = min(expected, 1) # directories cannot be synced
+            self.failUnlessEqual(len(fsyncs), expected, policy)
+        self.failUnlessRaises(AssertionError, BucketWriter, self, incoming,
+                              final, 100, self.make_lease(), FakeCanary(),
+                              fsync_policy="sometimes")
+
     def test_read_past_end_of_share_data(self):
         # test vector for immutable files (hard-coded contents of an immutable share
         # file):
@@ -138,6 +249,8 @@ class Bucket(unittest.TestCase):
         fileutil.write(final, share_file_data)
 
         class MockStorageServer(object):
+            fdcache = None
+            diskio = None
             def add_latency(self, category, latency):
                 pass
             def count(self, name, delta=1):
@@ -164,12 +277,15 @@ class RemoteBucket:
     def __init__(self):
         self.read_count = 0
         self.write_count = 0
+        self.methnames = []
 
     def callRemote(self, methname, *args, **kwargs):
         def _call():
             meth = getattr(self.target, "remote_" + methname)
             return meth(*args, **kwargs)
 
+        self.methnames.append(methname)
+
         if methname == "slot_readv":
             self.read_count += 1
         if "writev" in methname:
@@ -199,6 +315,10 @@ class BucketProxy(unittest.TestCase):
         return LeaseInfo(owner_num, renew_secret, cancel_secret,
                          expiration_time, "\x00" * 20)
 
+    fdcache = None
+    diskio = None
+    def reserve_write_handle(self, bw):
+        return True
     def bucket_writer_closed(self, bw, consumed):
         pass
     def add_latency(self, category, latency):
@@ -216,7 +336,8 @@ class BucketProxy(unittest.TestCase):
                               uri_extension_size_max=500)
         self.failUnless(interfaces.IStorageBucketWriter.providedBy(bp), bp)
 
-    def _do_test_readwrite(self, name, header_size, wbp_class, rbp_class):
+    def _do_test_readwrite(self, name, header_size, wbp_class, rbp_class,
+                           version=None):
         # Let's pretend each share has 100 bytes of data, and that there are
         # 4 segments (25 bytes each), and 8 shares total. So the two
         # per-segment merkle trees (crypttext_hash_tree,
@@ -263,6 +384,9 @@ class BucketProxy(unittest.TestCase):
             rb = RemoteBucket()
             rb.target = br
             server = NoNetworkServer("abc", None)
+            if version is not None:
+                rb.version = version
+                server = NoNetworkServer("abc", rb)
             rbp = rbp_class(rb, server, storage_index="")
             self.failUnlessIn("to peer", repr(rbp))
             self.failUnless(interfaces.IStorageBucketReader.providedBy(rbp), rbp)
@@ -287,6 +411,18 @@ class BucketProxy(unittest.TestCase):
             d1.addCallback(lambda res:
                            self.failUnlessEqual(res, uri_extension))
 
+            # reads issued at the same time
+            def _read_concurrently(res):
+                del rb.methnames[:]
+                return deferredutil.gatherResults([
+                    rbp.get_block_data(3, 25, 20),
+                    rbp.get_block_data(0, 25, 25),
+                    rbp.get_crypttext_hashes()])
+            d1.addCallback(_read_concurrently)
+            def _check_concurrent(res):
+                self.failUnlessEqual(res, ["d"*20, "a"*25, crypttext_hashes])
+                return rb.methnames
+            d1.addCallback(_check_concurrent)
             return d1
 
         d.addCallback(_start_reading)
@@ -298,8 +434,19 @@ class BucketProxy(unittest.TestCase):
                                        0x24, WriteBucketProxy, ReadBucketProxy)
 
     def test_readwrite_v2(self):
-        return self._do_test_readwrite("test_readwrite_v2",
-                                       0x44, WriteBucketProxy_v2, ReadBucketProxy)
+        d = self._do_test_readwrite("test_readwrite_v2",
+                                    0x44, WriteBucketProxy_v2, ReadBucketProxy)
+        d.addCallback(self.failUnlessEqual, ["read"]*3)
+        return d
+
+    def test_readwrite_v2_readv(self):
+        version = {"http://allmydata.org/tahoe/protocols/storage/v1":
+                   {"accepts-immutable-readv": True}}
+        d = self._do_test_readwrite("test_readwrite_v2_readv",
+                                    0x44, WriteBucketProxy_v2, ReadBucketProxy,
+                                    version)
+        d.addCallback(self.failUnlessEqual, ["readv"])
+        return d
 
 class Server(unittest.TestCase):
 
@@ -324,6 +471,18 @@ class Server(unittest.TestCase):
     def test_create(self):
         self.create("test_create")
 
+    def test_fsync_policy(self):
+        ss = StorageServer(self.workdir("test_fsync_policy"), "\x00" * 20,
+                           fsync_policy="close-and-dir")
+        self.failUnlessEqual(ss.fsync_policy, "close-and-dir")
+        already, writers = self.allocate(ss, "si1", [0], 75)
+        self.failUnlessEqual(writers[0]._fsync_policy, "close-and-dir")
+        for w in writers.values():
+            w.remote_abort()
+        self.failUnlessRaises(ValueError, StorageServer,
+                              self.workdir("test_fsync_policy_bad"),
+                              "\x00" * 20, fsync_policy="always")
+
     def test_declares_fixed_1528(self):
         ss = self.create("test_declares_fixed_1528")
         ver = ss.remote_get_version()
@@ -402,6 +561,19 @@ class Server(unittest.TestCase):
         new_children_of_storedir = set(os.listdir(storedir))
         self.failUnlessEqual(children_of_storedir, new_children_of_storedir)
 
+    def test_get_sharenums(self):
+        ss = self.create("test_get_sharenums")
+        ver = ss.remote_get_version()
+        sv1 = ver['http://allmydata.org/tahoe/protocols/storage/v1']
+        self.failUnless(sv1.get('maximum-get-sharenums-batch'), sv1)
+        for si, sharenums in [("si1", [0, 1, 2]), ("si3", [5])]:
+            already, writers = self.allocate(ss, si, sharenums, 75)
+            for wb in writers.values():
+                wb.remote_close()
+        self.failUnlessEqual(ss.remote_get_sharenums(["si1", "si2", "si3"]),
+                             {"si1": set([0, 1, 2]), "si3": set([5])})
+        self.failUnlessEqual(ss.remote_get_sharenums([]), {})
+
     def test_remove_incoming(self):
         ss = self.create("test_remove_incoming")
         already, writers = self.allocate(ss, "vid", range(3), 10)
@@ -429,6 +601,45 @@ class Server(unittest.TestCase):
             writer.remote_abort()
         self.failUnlessEqual(ss.allocated_size(), 0)
 
+    def test_close_failure(self):
+        # a writer whose share cannot be finished (e.g. because the disk is
+        # full) should be cleaned up as if it had been aborted
+        ss = self.create("test_close_failure")
+        already, writers = self.allocate(ss, "closefail", [0], 150)
+        bw = writers[0]
+        bw.remote_write(0, "a"*150)
+        f = bw._sharefile._write_f
+        def _fail():
+            raise IOError(errno.ENOSPC, "No space left on device")
+        bw._finish_share = _fail
+        self.failUnlessRaises(IOError, bw.remote_close)
+        self.failUnless(f.closed)
+        self.failIf(os.path.exists(bw.incominghome))
+        self.failUnlessEqual(ss.allocated_size(), 0)
+        self.failUnlessEqual(ss.remote_get_buckets("closefail"), {})
+        self.flushLoggedErrors(IOError)
+
+    def test_open_writer_limit(self):
+        ss = self.create("test_open_writer_limit")
+        ss.MAX_OPEN_WRITERS = 2
+        already, writers = self.allocate(ss, "openlimit", [0, 1, 2], 75)
+        open_writers = [bw for bw in writers.values()
+                        if bw._sharefile._write_f is not None]
+        self.failUnlessEqual(len(open_writers), 2)
+        for i, bw in writers.items():
+            bw.remote_write(0, "%75d" % i)
+        # a writer that closes gives its handle to the next one
+        open_writers[0].remote_close()
+        already, writers2 = self.allocate(ss, "openlimit2", [0], 75)
+        self.failIfEqual(writers2[0]._sharefile._write_f, None)
+        for bw in writers.values():
+            if not bw.closed:
+                bw.remote_close()
+        b = ss.remote_get_buckets("openlimit")
+        self.failUnlessEqual(set(b.keys()), set([0, 1, 2]))
+        for i in range(3):
+            self.failUnlessEqual(b[i].remote_read(0, 75), "%75d" % i)
+
 
     def test_allocate(self):
         ss = self.create("test_allocate")
@@ -569,6 +780,8 @@ class Server(unittest.TestCase):
 
         # this also changes the amount reported as available by call_get_disk_stats
         allocated = 1001 + OVERHEAD + LEASE_SIZE
+        # which the server only asks for occasionally
+        ss.refresh_available_space()
 
         # now there should be ALLOCATED=1001+12+72=1085 bytes allocated, and
         # 5000-1085=3915 free, therefore we can fit 39 100byte shares
@@ -582,6 +795,85 @@ class Server(unittest.TestCase):
         ss.disownServiceParent()
         del ss
 
+    def test_available_space_cache(self):
+        calls = []
+        avail = [50000]
+        def call_get_disk_stats(whichdir, reserved_space=0):
+            calls.append(whichdir)
+            return {'total': 100000, 'used': 50000, 'free_for_root': 50000,
+                    'free_for_nonroot': 50000, 'avail': avail[0]}
+        self.patch(fileutil, 'get_disk_stats', call_get_disk_stats)
+        ss = self.create("test_available_space_cache")
+        clock = [1000.0]
+        self.patch(time, 'time', lambda: clock[0])
+
+        a,w = self.allocate(ss, "si1", [0,1,2], 1000)
+        self.failUnlessEqual(len(calls), 1)
+        a,w2 = self.allocate(ss, "si2", [0], 1000)
+        self.failUnlessEqual(ss.get_available_space(), 50000)
+        self.failUnlessEqual(len(calls), 1)
+
+        # closing a share takes its size out of the cached figure
+        w2[0].remote_write(0, "a"*100)
+        w2[0].remote_close()
+        avail1 = ss.get_available_space()
+        self.failUnless(50000 - 2000 < avail1 < 50000 - 100, avail1)
+        self.failUnlessEqual(len(calls), 1)
+
+        # until it is measured again
+        avail[0] = 40000
+        clock[0] += ss.available_space_cache_time
+        self.failUnlessEqual(ss.get_available_space(), 40000)
+        self.failUnlessEqual(len(calls), 2)
+        ss.get_stats()
+        self.failUnlessEqual(len(calls), 3)
+        avail[0] = 30000
+        self.failUnlessEqual(ss.get_available_space(), 40000)
+
+    def test_allocated_size_by_client(self):
+        class TubCanary(FakeCanary):
+            def __init__(self, tubid):
+                FakeCanary.__init__(self, True)
+                self.tubid = tubid
+            def getRemoteTubID(self):
+                return self.tubid
+        ss = self.create("test_allocated_size_by_client")
+        a,w1 = self.allocate(ss, "si1", [0,1], 100, TubCanary("tub1"))
+        a,w2 = self.allocate(ss, "si2", [0], 300, TubCanary("tub2"))
+        a,w3 = self.allocate(ss, "si3", [0], 50, FakeCanary(True))
+        self.failUnlessEqual(ss.allocated_size(), 550)
+        self.failUnlessEqual(ss.get_allocated_size_by_client(),
+                             {"tub1": 200, "tub2": 300, "unknown": 50})
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.allocated"], 550)
+        self.failUnlessEqual(stats["storage_server.allocated_clients"], 3)
+        self.failUnlessEqual(stats["storage_server.allocated_by_client.tub1"],
+                             200)
+        self.failIfIn("storage_server.allocated_by_client.others", stats)
+        # only the clients with the most space reserved get a stat each
+        ss.ALLOCATED_BY_CLIENT_STATS = 1
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.allocated_clients"], 3)
+        self.failUnlessEqual(stats["storage_server.allocated_by_client.tub2"],
+                             300)
+        self.failIfIn("storage_server.allocated_by_client.tub1", stats)
+        self.failUnlessEqual(
+            stats["storage_server.allocated_by_client.others"], 250)
+        del ss.ALLOCATED_BY_CLIENT_STATS
+
+        w1[0].remote_write(0, "a")
+        w1[0].remote_close()
+        w2[0].remote_abort()
+        self.failUnlessEqual(ss.get_allocated_size_by_client(),
+                             {"tub1": 100, "unknown": 50})
+        # writers that are dropped without being closed give their space
+        # back too
+        del w1, w3
+        self.failUnlessEqual(ss.allocated_size(), 0)
+        self.failUnlessEqual(ss.get_allocated_size_by_client(), {})
+        self.failIfIn("storage_server.allocated_by_client.tub1",
+                      ss.get_stats())
+
     def test_seek(self):
         basedir = self.workdir("test_seek_behavior")
         fileutil.make_dirs(basedir)
@@ -1368,6 +1660,1186 @@ class MutableServer(unittest.TestCase):
         self.failIf(os.path.exists(bucketdir), bucketdir)
 
 
+class ServerWithLeaseDB(Server):
+    # run all of the Server tests again, with leases kept in the database
+
+    def workdir(self, name):
+        basedir = os.path.join("storage", "ServerWithLeaseDB", name)
+        return basedir
+
+    def create(self, name, reserved_space=0, klass=StorageServer):
+        workdir = self.workdir(name)
+        ss = klass(workdir, "\x00" * 20, reserved_space=reserved_space,
+                   stats_provider=FakeStatsProvider(), use_leasedb=True)
+        ss.setServiceParent(self.sparent)
+        return ss
+
+
+class ServerWithPackedBackend(Server):
+    # and again, with small immutable shares kept in pack files
+
+    def workdir(self, name):
+        basedir = os.path.join("storage", "ServerWithPackedBackend", name)
+        return basedir
+
+    def create(self, name, reserved_space=0, klass=StorageServer):
+        workdir = self.workdir(name)
+        ss = klass(workdir, "\x00" * 20, reserved_space=reserved_space,
+                   stats_provider=FakeStatsProvider(), use_leasedb=True,
+                   backend="packed")
+        ss.setServiceParent(self.sparent)
+        return ss
+
+    def test_bad_container_version(self):
+        raise unittest.SkipTest("packed shares have no container header")
+
+
+class MutableServerWithLeaseDB(MutableServer):
+
+    def workdir(self, name):
+        basedir = os.path.join("storage", "MutableServerWithLeaseDB", name)
+        return basedir
+
+    def create(self, name):
+        workdir = self.workdir(name)
+        ss = StorageServer(workdir, "\x00" * 20, use_leasedb=True)
+        ss.setServiceParent(self.sparent)
+        return ss
+
+    def test_leases(self):
+        pass
+    test_leases.skip = ("this exercises the lease slots of the mutable"
+                        " container, which are not used with a lease database")
+
+
+class DiskIOThreads(unittest.TestCase, pollmixin.PollMixin):
+
+    def setUp(self):
+        self.sparent = LoggingServiceParent()
+        self.sparent.startService()
+    def tearDown(self):
+        return self.sparent.stopService()
+
+    def create(self, name, **kwargs):
+        workdir = os.path.join("storage", "DiskIOThreads", name)
+        ss = StorageServer(workdir, "\x00" * 20, io_threads=2,
+                           stats_provider=FakeStatsProvider(), **kwargs)
+        ss.setServiceParent(self.sparent)
+        return ss
+
+    def test_call_io(self):
+        # without a DiskIO, calls happen right away
+        self.failUnlessEqual(call_io(None, "path", lambda x: x+1, 1), 2)
+        self.failUnlessEqual(when_done(2, lambda x: x*2), 4)
+        d = defer.succeed(2)
+        when_done(d, lambda x: x*2)
+        d.addCallback(self.failUnlessEqual, 4)
+        return d
+
+    def test_ordering(self):
+        basedir = "storage/DiskIOThreads/ordering"
+        fileutil.make_dirs(basedir)
+        samples = []
+        diskio = DiskIO(2, lambda category, value:
+                           samples.append((category, value)))
+        diskio.add_disk(basedir)
+        self.addCleanup(diskio.stop)
+        a = os.path.join(basedir, "a")
+        b = os.path.join(basedir, "b")
+        blocker = threading.Event()
+        events = []
+        def _blocked():
+            blocker.wait(10)
+            events.append("a1")
+            return "a1"
+        def _record(what):
+            events.append(what)
+            return what
+        d1 = diskio.call(a, _blocked)
+        self.failIf(diskio.writes_pending(a))
+        d2 = diskio.call_write(a, _record, "a2")
+        self.failUnless(diskio.writes_pending(a))
+        # a call for another path does not wait for the blocked one
+        d3 = diskio.call(b, _record, "b1")
+        self.failIf(diskio.writes_pending(b))
+        self.failUnlessEqual(diskio.get_stats(), {"disks": 1, "queued": 3})
+        def _b_done(res):
+            self.failUnlessEqual(res, "b1")
+            self.failUnlessEqual(events, ["b1"])
+            blocker.set()
+            return defer.gatherResults([d1, d2])
+        d3.addCallback(_b_done)
+        def _a_done(res):
+            self.failUnlessEqual(res, ["a1", "a2"])
+            self.failUnlessEqual(events, ["b1", "a1", "a2"])
+            self.failIf(diskio.writes_pending(a))
+            self.failUnlessEqual(diskio.get_stats()["queued"], 0)
+            self.failUnlessEqual(sorted(set([c for (c, v) in samples])),
+                                 ["io-queue-depth", "io-service", "io-wait"])
+            self.failUnlessIn(("io-queue-depth", 3.0), samples)
+            # failures are passed back too
+            return diskio.call(a, lambda: 1/0)
+        d3.addCallback(_a_done)
+        d3.addCallbacks(lambda res: self.fail("should have failed"),
+                        lambda f: f.trap(ZeroDivisionError))
+        return d3
+
+    def test_immutable(self):
+        ss = self.create("test_immutable")
+        canary = FakeCanary()
+        already, writers = ss.remote_allocate_buckets("si1", "\x00"*32,
+                                                      "\x00"*32, [0, 1],
+                                                      300, canary)
+        self.failUnlessEqual(sorted(writers), [0, 1])
+        dl = []
+        for (shnum, bw) in writers.items():
+            for i in range(3):
+                dl.append(bw.remote_write(i*100, chr(ord("a")+i+shnum)*100))
+            dl.append(bw.remote_close())
+            self.failUnless(bw.closed)
+        d = defer.gatherResults(dl)
+        def _closed(ign):
+            self.failUnlessEqual(ss.allocated_size(), 0)
+            readers = ss.remote_get_buckets("si1")
+            self.failUnlessEqual(sorted(readers), [0, 1])
+            return defer.gatherResults([readers[1].remote_read(0, 300),
+                                        readers[0].remote_readv([(50, 100),
+                                                                 (290, 20)])])
+        d.addCallback(_closed)
+        def _read((data, datav)):
+            self.failUnlessEqual(data, "b"*100 + "c"*100 + "d"*100)
+            self.failUnlessEqual(datav, ["a"*50 + "b"*50, "c"*10])
+            latencies = ss.get_latencies()
+            for category in ("io-queue-depth", "io-wait", "io-service",
+                             "write", "close", "read", "readv-immutable"):
+                self.failUnlessIn(category, latencies)
+            stats = ss.get_stats()
+            self.failUnlessEqual(stats["storage_server.io.disks"], 1)
+            self.failUnlessEqual(stats["storage_server.io.queued"], 0)
+        d.addCallback(_read)
+        return d
+
+    def test_abort(self):
+        ss = self.create("test_abort")
+        already, writers = ss.remote_allocate_buckets("si1", "\x00"*32,
+                                                      "\x00"*32, [0], 100,
+                                                      FakeCanary())
+        bw = writers[0]
+        d = bw.remote_write(0, "a"*50)
+        bw.remote_abort()
+        self.failUnless(bw.closed)
+        d.addCallback(lambda ign: self.poll(lambda: ss.allocated_size() == 0,
+                                            pollinterval=0.01))
+        def _aborted(ign):
+            self.failIf(os.path.exists(bw.incominghome))
+            self.failUnlessEqual(ss.remote_get_buckets("si1"), {})
+        d.addCallback(_aborted)
+        return d
+
+    def _test_mutable(self, name, **kwargs):
+        ss = self.create(name, **kwargs)
+        secrets = (hashutil.tagged_hash("we_blah", "we1"),
+                   hashutil.tagged_hash("renew_blah", "1"),
+                   hashutil.tagged_hash("cancel_blah", "1"))
+        writev = ss.remote_slot_testv_and_readv_and_writev
+        d = writev("si1", secrets, {0: ([], [(0, "a"*100)], None),
+                                    1: ([], [(0, "b"*100)], None)}, [])
+        d.addCallback(self.failUnlessEqual, (True, {}))
+        # a test vector that fails changes nothing, but still reads
+        d.addCallback(lambda ign:
+                      writev("si1", secrets,
+                             {0: ([(0, 1, "eq", "b")], [(0, "c"*100)], None)},
+                             [(0, 2)]))
+        d.addCallback(self.failUnlessEqual, (False, {0: ["aa"], 1: ["bb"]}))
+        # several calls made at once happen in order
+        d.addCallback(lambda ign: defer.gatherResults([
+            writev("si1", secrets, {0: ([], [(0, "d"*10)], None)}, []),
+            ss.remote_slot_readv("si1", [0], [(0, 11)]),
+            writev("si1", secrets, {1: ([], [], 0)}, []),
+            ss.remote_slot_readv("si1", [], [(0, 3)])]))
+        d.addCallback(self.failUnlessEqual, [(True, {0: [], 1: []}),
+                                             {0: ["d"*10 + "a"]},
+                                             (True, {0: [], 1: []}),
+                                             {0: ["ddd"]}])
+        d.addCallback(lambda ign: ss.remote_add_lease("si1", "\x01"*32,
+                                                      "\x02"*32))
+        d.addCallback(lambda ign: ss.remote_renew_lease("si1", "\x01"*32))
+        def _check_leases(ign):
+            if ss.leasedb is not None:
+                leases = list(ss.get_leases("si1"))
+            else:
+                fn = os.path.join(ss.sharedir, storage_index_to_dir("si1"),
+                                  "0")
+                leases = list(MutableShareFile(fn).get_leases())
+            self.failUnlessEqual(set([l.renew_secret for l in leases]),
+                                 set([secrets[1], "\x01"*32]))
+            return ss.remote_renew_lease("si2", "\x01"*32)
+        d.addCallback(_check_leases)
+        d.addCallbacks(lambda res: self.fail("should have failed"),
+                       lambda f: f.trap(IndexError))
+        # errors are passed back too
+        bad_secrets = ("\x00"*32,) + secrets[1:]
+        d.addCallback(lambda ign: writev("si1", bad_secrets,
+                                         {0: ([], [(0, "e")], None)}, []))
+        d.addCallbacks(lambda res: self.fail("should have failed"),
+                       lambda f: f.trap(BadWriteEnablerError))
+        return d
+
+    def test_mutable(self):
+        return self._test_mutable("test_mutable")
+
+    def test_mutable_leasedb(self):
+        return self._test_mutable("test_mutable_leasedb", use_leasedb=True)
+
+    def test_share_inventory(self):
+        ss = self.create("test_share_inventory")
+        inv = ss.share_inventory
+        secrets = (hashutil.tagged_hash("we_blah", "we1"),
+                   hashutil.tagged_hash("renew_blah", "1"),
+                   hashutil.tagged_hash("cancel_blah", "1"))
+        writev = ss.remote_slot_testv_and_readv_and_writev
+        logged = []
+        def _log(*args, **kwargs):
+            logged.append((threading.currentThread().getName(), args))
+        ss.log = _log
+        d = writev("si1", secrets, {0: ([], [(0, "a"*10)], None)}, [])
+        def _written(ign):
+            inv.get_shares("si1")
+            hits = inv.hits
+            d = ss.remote_slot_readv("si1", [], [(0, 1)])
+            # the listing cached in the reactor thread is used by the I/O
+            # thread
+            self.failUnlessEqual(inv.hits, hits+1)
+            return d
+        d.addCallback(_written)
+        d.addCallback(self.failUnlessEqual, {0: ["a"]})
+        # a read queued behind a write that adds a share looks for itself
+        d.addCallback(lambda ign: defer.gatherResults([
+            writev("si1", secrets, {1: ([], [(0, "b"*10)], None)}, []),
+            ss.remote_slot_readv("si1", [], [(0, 1)])]))
+        d.addCallback(self.failUnlessEqual, [(True, {0: []}),
+                                             {0: ["a"], 1: ["b"]}])
+        # test vector failures are logged from the reactor thread
+        d.addCallback(lambda ign:
+                      writev("si1", secrets,
+                             {0: ([(0, 1, "eq", "b")], [(0, "c")], None)},
+                             []))
+        def _failed(res):
+            self.failUnlessEqual(res, (False, {0: [], 1: []}))
+            self.failUnlessEqual(len(logged), 1)
+            (thread, args) = logged[0]
+            self.failUnlessEqual(thread,
+                                 threading.currentThread().getName())
+            self.failUnlessIn("testv failed", args[0])
+        d.addCallback(_failed)
+        return d
+
+
+class Scheduling(unittest.TestCase):
+
+    def make_scheduler(self, *args, **kwargs):
+        self.waits = []
+        kwargs["record_latency"] = (lambda category, value:
+                                        self.waits.append(value))
+        s = FairScheduler(*args, **kwargs)
+        s.clock = Clock()
+        return s
+
+    def test_unlimited(self):
+        s = self.make_scheduler()
+        for i in range(100):
+            self.failUnlessEqual(s.call("a", 10**6, lambda x: x+1, i), i+1)
+        self.failUnlessEqual(s.get_stats(), {"clients": 1, "active": 0,
+                                             "queued": 0, "throttled": 0})
+        self.failUnlessEqual(s.get_client_stats()["a"]["bytes"], 100*10**6)
+        self.failUnlessRaises(ZeroDivisionError, s.call, "a", 0,
+                              lambda: 1/0)
+        self.failUnlessEqual(s.active, 0)
+
+    def test_ops_budget(self):
+        s = self.make_scheduler(4)
+        calls = []
+        results = [s.call("a", 0, calls.append, i) for i in range(6)]
+        # the first four run right away, and the others are queued
+        self.failUnlessEqual(calls, [0, 1, 2, 3])
+        self.failUnlessEqual(results[:4], [None]*4)
+        self.failUnless(isinstance(results[4], defer.Deferred))
+        self.failUnlessEqual(s.get_stats()["queued"], 2)
+        # another client has a budget of its own
+        s.call("b", 0, calls.append, "b")
+        self.failUnlessEqual(calls, [0, 1, 2, 3, "b"])
+
+        s.clock.advance(0.25)
+        self.failUnlessEqual(calls, [0, 1, 2, 3, "b", 4])
+        fired = []
+        results[5].addCallback(fired.append)
+        s.clock.advance(0.25)
+        self.failUnlessEqual(calls, [0, 1, 2, 3, "b", 4, 5])
+        self.failUnlessEqual(fired, [None])
+        self.failUnlessEqual(s.get_stats()["queued"], 0)
+        self.failUnlessEqual(s.get_stats()["throttled"], 2)
+        self.failUnlessEqual(len(self.waits), 2)
+        self.failUnlessAlmostEqual(s.get_client_stats()["a"]["wait"], 0.75)
+
+    def test_bytes_budget(self):
+        s = self.make_scheduler(0, 1000)
+        calls = []
+        # a request may overdraw the budget, but then the next one waits
+        s.call("a", 3000, calls.append, 0)
+        d = s.call("a", 10, calls.append, 1)
+        self.failUnlessEqual(calls, [0])
+        s.clock.advance(1.5)
+        self.failUnlessEqual(calls, [0])
+        s.clock.advance(1.0)
+        self.failUnlessEqual(calls, [0, 1])
+        self.failUnlessEqual(d.called, True)
+
+    def test_round_robin(self):
+        s = self.make_scheduler(1)
+        calls = []
+        s.call("busy", 0, calls.append, "busy-0")
+        for i in range(1, 5):
+            s.call("busy", 0, calls.append, "busy-%d" % i)
+        s.call("quiet", 0, calls.append, "quiet-0")
+        s.call("quiet", 0, calls.append, "quiet-1")
+        s.call("other", 0, calls.append, "other-0")
+        self.failUnlessEqual(calls, ["busy-0", "quiet-0", "other-0"])
+        s.clock.advance(1)
+        # the quiet client's second request does not wait behind all of the
+        # busy one's
+        self.failUnlessEqual(calls[3:], ["busy-1", "quiet-1"])
+        s.clock.pump([1]*4)
+        self.failUnlessEqual(calls[5:], ["busy-2", "busy-3", "busy-4"])
+
+    def test_max_concurrent(self):
+        s = self.make_scheduler(0, 0, 2)
+        pending = {}
+        def _start(name):
+            pending[name] = defer.Deferred()
+            return pending[name]
+        d1 = s.call("a", 0, _start, "a1")
+        s.call("a", 0, _start, "a2")
+        d3 = s.call("a", 0, _start, "a3")
+        d4 = s.call("b", 0, _start, "b1")
+        self.failUnlessEqual(sorted(pending), ["a1", "a2"])
+        self.failUnlessEqual(s.get_stats()["active"], 2)
+        self.failUnlessEqual(s.get_stats()["queued"], 2)
+        fired = []
+        d1.addCallback(fired.append)
+        pending["a1"].callback("one")
+        self.failUnlessEqual(fired, ["one"])
+        s.clock.advance(0)
+        # a3 was queued first, but b has nothing in progress
+        self.failUnlessEqual(sorted(pending), ["a1", "a2", "b1"])
+        pending["b1"].callback("b")
+        s.clock.advance(0)
+        self.failUnlessEqual(sorted(pending), ["a1", "a2", "a3", "b1"])
+        self.failUnlessEqual(d4.result, "b")
+        pending["a3"].errback(ValueError("oops"))
+        self.failUnlessFailure(d3, ValueError)
+        self.failUnlessEqual(s.get_stats()["active"], 1)
+        return d3
+
+    def test_low_priority(self):
+        s = self.make_scheduler(0, 0, 1, low_priority_clients=["old"])
+        pending = {}
+        def _start(name):
+            pending[name] = defer.Deferred()
+            return pending[name]
+        s.call("a", 0, _start, "a1")
+        s.call("old", 0, _start, "old1")
+        s.call("a", 0, _start, "a2")
+        s.call("b", 0, _start, "b1")
+        self.failUnlessEqual(sorted(pending), ["a1"])
+        # the low-priority client waits for the others, even though it has
+        # nothing in progress and asked first
+        pending["a1"].callback(None)
+        s.clock.advance(0)
+        self.failUnlessEqual(sorted(pending), ["a1", "a2"])
+        pending["a2"].callback(None)
+        s.clock.advance(0)
+        self.failUnlessEqual(sorted(pending), ["a1", "a2", "b1"])
+        pending["b1"].callback(None)
+        s.clock.advance(0)
+        self.failUnlessEqual(sorted(pending), ["a1", "a2", "b1", "old1"])
+        pending["old1"].callback(None)
+        # with no one else waiting, it does not have to wait
+        s.call("old", 0, _start, "old2")
+        self.failUnless("old2" in pending)
+
+    def test_disconnect(self):
+        s = self.make_scheduler(0, 0, 1)
+        pending = {}
+        def _start(name):
+            pending[name] = defer.Deferred()
+            return pending[name]
+        s.connect("a")
+        s.connect("b")
+        s.call("a", 0, _start, "a1")
+        s.call("b", 0, _start, "b1")
+        self.failUnlessEqual(s.get_stats()["clients"], 2)
+        # clients are kept until what they asked for is done
+        s.disconnect("a")
+        s.disconnect("b")
+        self.failUnlessEqual(s.get_stats()["clients"], 2)
+        pending["a1"].callback(None)
+        self.failUnlessEqual(s.get_stats()["clients"], 1)
+        s.clock.advance(0)
+        pending["b1"].callback(None)
+        self.failUnlessEqual(s.get_stats(), {"clients": 0, "active": 0,
+                                             "queued": 0, "throttled": 1})
+        # unless they come back
+        s.connect("c")
+        s.disconnect("c")
+        s.connect("c")
+        self.failUnlessEqual(s.get_client_stats().keys(), ["c"])
+
+    def test_stop(self):
+        s = self.make_scheduler(1)
+        calls = []
+        s.call("a", 0, calls.append, 0)
+        d = s.call("a", 0, calls.append, 1)
+        s.call("b", 0, calls.append, 2)
+        self.failUnlessEqual(calls, [0, 2])
+        s.stop()
+        # queued requests are abandoned, but their callers hear about it
+        self.failUnlessEqual(s.get_stats()["queued"], 0)
+        self.failUnlessFailure(d, defer.CancelledError)
+        s.clock.advance(10)
+        self.failUnlessEqual(calls, [0, 2])
+        return d
+
+
+class ClientSessions(GridTestMixin, unittest.TestCase):
+
+    def test_older_clients(self):
+        # clients that do not ask for a session all share one, which is
+        # low priority
+        basedir = "storage/ClientSessions/older_clients"
+        ss = StorageServer(basedir, "\x00" * 20, client_ops_per_second=10)
+        tub = Tub()
+        tub.setServiceParent(self.s)
+        portnum = iputil.allocate_tcp_port()
+        tub.listenOn("tcp:%d" % portnum)
+        tub.setLocation("localhost:%d" % portnum)
+        furl = tub.registerReference(ss)
+        client_tubs = []
+        for i in range(2):
+            client_tub = Tub()
+            client_tub.setServiceParent(self.s)
+            client_tubs.append(client_tub)
+        d = defer.gatherResults([t.getReference(furl) for t in client_tubs])
+        def _connected(rrefs):
+            return defer.gatherResults([rref.callRemote("get_sharenums",
+                                                        ["si1"])
+                                        for rref in rrefs])
+        d.addCallback(_connected)
+        def _called(results):
+            self.failUnlessEqual(results, [{}, {}])
+            by_client = ss.scheduler.get_client_stats()
+            self.failUnlessEqual(by_client.keys(), [SESSIONLESS])
+            self.failUnlessEqual(by_client[SESSIONLESS]["requests"], 2)
+            # and so do callers that did not come through foolscap
+            ss.doRemoteCall("get_sharenums", (["si1"],), {})
+            self.failUnlessEqual(ss.scheduler.get_client_stats()[SESSIONLESS]
+                                 ["requests"], 3)
+        d.addCallback(_called)
+        return d
+
+    def test_version(self):
+        basedir = "storage/ClientSessions/version"
+        ss = StorageServer(basedir, "\x00" * 20)
+        v1 = ss.remote_get_version()["http://allmydata.org/tahoe/protocols/storage/v1"]
+        self.failIf(v1["accepts-client-sessions"])
+        ss = StorageServer(basedir, "\x00" * 20, client_ops_per_second=10)
+        v1 = ss.remote_get_version()["http://allmydata.org/tahoe/protocols/storage/v1"]
+        self.failUnless(v1["accepts-client-sessions"])
+        session = ss.remote_get_client_session(FakeCanary())
+        self.failUnless(isinstance(session, ClientSession))
+        self.failUnlessEqual(session.client_id, "unknown")
+
+    def test_disconnect(self):
+        # a client is forgotten once all of its sessions have gone away
+        basedir = "storage/ClientSessions/disconnect"
+        ss = StorageServer(basedir, "\x00" * 20, client_ops_per_second=1)
+        canaries = [FakeCanary(), FakeCanary()]
+        sessions = [ss.remote_get_client_session(c) for c in canaries]
+        sessions[0].remote_get_sharenums(["si1"])
+        self.failUnlessEqual(ss.scheduler.get_stats()["clients"], 1)
+        for (f, args, kwargs) in canaries[0].disconnectors.values():
+            f(*args, **kwargs)
+        self.failUnlessEqual(ss.scheduler.get_stats()["clients"], 1)
+        for (f, args, kwargs) in canaries[1].disconnectors.values():
+            f(*args, **kwargs)
+        self.failUnlessEqual(ss.scheduler.get_stats()["clients"], 0)
+
+    def test_upload_and_download(self):
+        self.basedir = "storage/ClientSessions/upload_and_download"
+        self.set_up_grid(num_clients=2, num_servers=1)
+        ss = self.g.servers_by_number[0]
+        ss.scheduler = FairScheduler(0, 100*1000, 0, ss.add_latency)
+        self.g.use_client_sessions()
+        (c0, c1) = self.g.clients
+        for c in self.g.clients:
+            c.encoding_params["k"] = 1
+            c.encoding_params["happy"] = 1
+            c.encoding_params["n"] = 1
+        data = "data" * 50000
+        d = c0.upload(upload.Data(data, convergence=""))
+        def _uploaded(ur):
+            n = c1.create_node_from_uri(ur.get_uri())
+            return download_to_data(n)
+        d.addCallback(_uploaded)
+        def _downloaded(downloaded):
+            self.failUnlessEqual(downloaded, data)
+            by_client = ss.scheduler.get_client_stats()
+            self.failUnlessEqual(sorted(by_client),
+                                 sorted([idlib.nodeid_b2a(c0.nodeid),
+                                         idlib.nodeid_b2a(c1.nodeid)]))
+            uploaded = by_client[idlib.nodeid_b2a(c0.nodeid)]
+            self.failUnless(uploaded["bytes"] >= len(data), uploaded)
+            # the upload was more than a second's worth
+            self.failUnless(uploaded["throttled"] > 0, uploaded)
+            self.failUnless(uploaded["wait"] > 0, uploaded)
+            downloaded = by_client[idlib.nodeid_b2a(c1.nodeid)]
+            self.failUnless(downloaded["bytes"] >= len(data), downloaded)
+            stats = ss.get_stats()
+            self.failUnlessEqual(stats["storage_server.scheduler.clients"], 2)
+            self.failUnlessEqual(stats["storage_server.scheduler.queued"], 0)
+            self.failUnlessIn("scheduler-wait", ss.get_latencies())
+        d.addCallback(_downloaded)
+        return d
+
+
+class LeaseDatabase(unittest.TestCase, pollmixin.PollMixin):
+
+    def setUp(self):
+        self.s = service.MultiService()
+        self.s.startService()
+    def tearDown(self):
+        return self.s.stopService()
+
+    def make_immutable(self, ss, si, renew_secret, cancel_secret):
+        a,w = ss.remote_allocate_buckets(si, renew_secret, cancel_secret,
+                                         [0, 1], 100, FakeCanary())
+        for wb in w.values():
+            wb.remote_write(0, "a"*100)
+            wb.remote_close()
+
+    def test_leases_live_in_database(self):
+        basedir = "storage/LeaseDatabase/leases_live_in_database"
+        ss = StorageServer(basedir, "\x00" * 20, use_leasedb=True)
+        rs0, cs0 = hashutil.tagged_hash("renew", "0"), hashutil.tagged_hash("cancel", "0")
+        rs1, cs1 = hashutil.tagged_hash("renew", "1"), hashutil.tagged_hash("cancel", "1")
+        self.make_immutable(ss, "si0", rs0, cs0)
+        ss.remote_add_lease("si0", rs1, cs1)
+
+        self.failUnlessEqual(ss.leasedb.get_shares("si0"),
+                             {0: "immutable", 1: "immutable"})
+        for shnum in (0, 1):
+            leases = ss.leasedb.get_leases("si0", shnum)
+            self.failUnlessEqual(set([l.renew_secret for l in leases]),
+                                 set([rs0, rs1]))
+        # the share files only carry the lease from the original upload
+        for sf in ss._iter_share_files("si0"):
+            self.failUnlessEqual([l.renew_secret for l in sf.get_leases()],
+                                 [rs0])
+
+        ss.remote_renew_lease("si0", rs1)
+        self.failUnlessRaises(IndexError, ss.remote_renew_lease, "si0", cs1)
+
+        self.failUnlessEqual(ss.leasedb.cancel_lease("si0", 0, cs0), 1)
+        self.failUnlessRaises(IndexError, ss.leasedb.cancel_lease, "si0", 0, cs0)
+        self.failUnlessEqual(ss.leasedb.cancel_lease("si0", 0, cs1), 0)
+
+        # deleting a mutable share removes it from the database
+        secrets = (hashutil.tagged_hash("write-enabler", "1"), rs0, cs0)
+        writev = ss.remote_slot_testv_and_readv_and_writev
+        writev("si1", secrets, {0: ([], [(0, "data")], None)}, [])
+        self.failUnlessEqual(ss.leasedb.get_shares("si1"), {0: "mutable"})
+        self.failUnlessEqual(len(ss.leasedb.get_leases("si1", 0)), 1)
+        writev("si1", secrets, {0: ([], [], 0)}, [])
+        self.failUnlessEqual(ss.leasedb.get_shares("si1"), {})
+
+    def test_allocate_reconciles(self):
+        basedir = "storage/LeaseDatabase/allocate_reconciles"
+        ss = StorageServer(basedir, "\x00" * 20, use_leasedb=True)
+        rs0, cs0 = hashutil.tagged_hash("renew", "0"), hashutil.tagged_hash("cancel", "0")
+        rs1, cs1 = hashutil.tagged_hash("renew", "1"), hashutil.tagged_hash("cancel", "1")
+        self.make_immutable(ss, "si0", rs0, cs0)
+        # share 1 is lost, and share 2 is copied in by hand
+        bucketdir = os.path.join(ss.sharedir, storage_index_to_dir("si0"))
+        os.unlink(os.path.join(bucketdir, "1"))
+        shutil.copy(os.path.join(bucketdir, "0"), os.path.join(bucketdir, "2"))
+        ss.forget_bucket("si0")
+
+        already, writers = ss.remote_allocate_buckets("si0", rs1, cs1,
+                                                      [0, 1, 2], 100,
+                                                      FakeCanary())
+        self.failUnlessEqual(already, set([0, 2]))
+        self.failUnlessEqual(sorted(writers), [1])
+        self.failUnlessEqual(ss.leasedb.get_shares("si0"),
+                             {0: "immutable", 2: "immutable"})
+        # the copied share keeps the lease in its container, and both get
+        # the new one
+        for shnum in (0, 2):
+            leases = ss.leasedb.get_leases("si0", shnum)
+            self.failUnlessEqual(set([l.renew_secret for l in leases]),
+                                 set([rs0, rs1]))
+        writers[1].remote_abort()
+
+    def test_import(self):
+        basedir = "storage/LeaseDatabase/import"
+        ss = StorageServer(basedir, "\x00" * 20)
+        rs0, cs0 = hashutil.tagged_hash("renew", "0"), hashutil.tagged_hash("cancel", "0")
+        rs1, cs1 = hashutil.tagged_hash("renew", "1"), hashutil.tagged_hash("cancel", "1")
+        self.make_immutable(ss, "si0", rs0, cs0)
+        self.make_immutable(ss, "si1", rs1, cs1)
+        writev = ss.remote_slot_testv_and_readv_and_writev
+        writev("si2", (hashutil.tagged_hash("write-enabler", "2"), rs0, cs0), {0: ([], [(0, "data")], None)}, [])
+
+        # now enable the database on the same storage directory. Shares are
+        # imported when their storage index is first used.
+        ss = StorageServer(basedir, "\x00" * 20, use_leasedb=True)
+        self.failUnlessEqual(ss.leasedb.get_shares("si0"), {})
+        leases = list(ss.get_leases("si0"))
+        self.failUnlessEqual([l.renew_secret for l in leases], [rs0])
+        self.failUnlessEqual(ss.leasedb.get_shares("si0"),
+                             {0: "immutable", 1: "immutable"})
+        ss.remote_renew_lease("si1", rs1)
+        self.failUnlessEqual(len(ss.leasedb.get_leases("si1", 1)), 1)
+
+        # the crawler imports the rest, and notices shares that vanish
+        ss.leasedb_crawler.slow_start = 0
+        ss.leasedb_crawler.minimum_cycle_time = 0
+        fn = os.path.join(ss.sharedir, storage_index_to_dir("si0"), "1")
+        os.unlink(fn)
+        ss.setServiceParent(self.s)
+        def _wait():
+            return ss.leasedb_crawler.get_state()["last-cycle"] is not None
+        d = self.poll(_wait)
+        def _check(ign):
+            last = ss.leasedb_crawler.get_state()["last-cycle"]
+            self.failUnlessEqual(last["imported-shares"], 1)
+            self.failUnlessEqual(last["removed-shares"], 1)
+            self.failUnlessEqual(ss.leasedb.get_shares("si0"), {0: "immutable"})
+            self.failUnlessEqual(ss.leasedb.get_shares("si2"), {0: "mutable"})
+            leases = ss.leasedb.get_leases("si2", 0)
+            self.failUnlessEqual([l.renew_secret for l in leases], [rs0])
+        d.addCallback(_check)
+        return d
+
+    def test_expire(self):
+        basedir = "storage/LeaseDatabase/expire"
+        ss = StorageServer(basedir, "\x00" * 20, use_leasedb=True,
+                           expiration_enabled=True,
+                           expiration_mode="age",
+                           expiration_override_lease_duration=2000)
+        rs0, cs0 = hashutil.tagged_hash("renew", "0"), hashutil.tagged_hash("cancel", "0")
+        rs1, cs1 = hashutil.tagged_hash("renew", "1"), hashutil.tagged_hash("cancel", "1")
+        self.make_immutable(ss, "si0", rs0, cs0)
+        self.make_immutable(ss, "si1", rs1, cs1)
+        ss.remote_add_lease("si1", rs0, cs0)
+
+        # make the lease granted with rs0 look old, everywhere
+        ss.leasedb.cursor.execute("UPDATE leases SET expiration_time=?"
+                                  " WHERE renew_secret=?",
+                                  (int(time.time()) - 1000, base32.b2a(rs0)))
+        ss.leasedb.connection.commit()
+
+        lc = ss.lease_checker
+        lc.slow_start = 0
+        ss.setServiceParent(self.s)
+        def _wait():
+            return bool(lc.get_state()["last-cycle-finished"] is not None)
+        d = self.poll(_wait)
+        def _check(ign):
+            self.failUnlessEqual(list(ss._iter_share_files("si0")), [])
+            self.failUnlessEqual(ss.leasedb.get_shares("si0"), {})
+            self.failUnlessEqual(len(list(ss._iter_share_files("si1"))), 2)
+            leases = ss.leasedb.get_leases("si1", 0)
+            self.failUnlessEqual([l.renew_secret for l in leases], [rs1])
+        d.addCallback(_check)
+        return d
+
+    def test_upgrade_v1_v2(self):
+        basedir = "storage/LeaseDatabase/upgrade_v1_v2"
+        fileutil.make_dirs(basedir)
+        dbfile = os.path.join(basedir, "leasedb.sqlite")
+        (sqlite3, db) = dbutil.get_db(dbfile, create_version=(leasedb.SCHEMA_v1, 1))
+        db.close()
+        ldb = leasedb.LeaseDB(dbfile)
+        c = ldb.cursor
+        c.execute("SELECT version FROM version")
+        self.failUnlessEqual(c.fetchone()[0], 2)
+        c.execute("SELECT name FROM sqlite_master WHERE type='index'")
+        self.failUnlessIn("leases_by_expiration",
+                          [str(row[0]) for row in c.fetchall()])
+
+    def test_indexed_requires_leasedb(self):
+        basedir = "storage/LeaseDatabase/indexed_requires_leasedb"
+        self.failUnlessRaises(ValueError, StorageServer, basedir, "\x00" * 20,
+                              expiration_indexed=True)
+
+    def _make_old_shares(self, ss):
+        rs0, cs0 = hashutil.tagged_hash("renew", "0"), hashutil.tagged_hash("cancel", "0")
+        rs1, cs1 = hashutil.tagged_hash("renew", "1"), hashutil.tagged_hash("cancel", "1")
+        self.make_immutable(ss, "si0", rs0, cs0)
+        self.make_immutable(ss, "si1", rs1, cs1)
+        ss.remote_add_lease("si1", rs0, cs0)
+        writev = ss.remote_slot_testv_and_readv_and_writev
+        writev("si2", (hashutil.tagged_hash("write-enabler", "2"), rs0, cs0),
+               {0: ([], [(0, "data")], None)}, [])
+        # make the lease granted with rs0 look old, everywhere
+        ss.leasedb.cursor.execute("UPDATE leases SET expiration_time=?"
+                                  " WHERE renew_secret=?",
+                                  (int(time.time()) - 1000, base32.b2a(rs0)))
+        ss.leasedb.connection.commit()
+        return rs1
+
+    def test_expire_indexed(self):
+        basedir = "storage/LeaseDatabase/expire_indexed"
+        ss = StorageServer(basedir, "\x00" * 20, use_leasedb=True,
+                           expiration_enabled=True,
+                           expiration_mode="age",
+                           expiration_override_lease_duration=2000,
+                           expiration_sharetypes=("immutable",),
+                           expiration_indexed=True)
+        rs1 = self._make_old_shares(ss)
+        lc = ss.lease_checker
+        self.failUnless(isinstance(lc, IndexedLeaseCheckingCrawler))
+        lc.slow_start = 0
+        lc.batch_size = 1 # exercise the paging
+        ss.setServiceParent(self.s)
+        def _wait():
+            return bool(lc.get_state()["last-cycle-finished"] is not None)
+        d = self.poll(_wait)
+        def _check(ign):
+            self.failUnlessEqual(list(ss._iter_share_files("si0")), [])
+            self.failUnlessEqual(ss.leasedb.get_shares("si0"), {})
+            # si1 still has a live lease, so it is kept, but its expired
+            # lease is removed
+            self.failUnlessEqual(len(list(ss._iter_share_files("si1"))), 2)
+            for shnum in (0, 1):
+                leases = ss.leasedb.get_leases("si1", shnum)
+                self.failUnlessEqual([l.renew_secret for l in leases], [rs1])
+            # mutable shares were not configured to expire
+            self.failUnlessEqual(ss.leasedb.get_shares("si2"), {0: "mutable"})
+
+            last = lc.get_state()["history"][0]
+            rec = last["space-recovered"]
+            self.failUnlessEqual(rec["examined-shares"], 4)
+            self.failUnlessEqual(rec["configured-shares"], 2)
+            self.failUnlessEqual(rec["actual-shares"], 2)
+            self.failUnlessEqual(rec["actual-buckets"], 1)
+            self.failUnlessEqual(last["leases-per-share-histogram"], {1: 2, 2: 2})
+        d.addCallback(_check)
+        return d
+
+    def test_expire_indexed_disabled(self):
+        basedir = "storage/LeaseDatabase/expire_indexed_disabled"
+        ss = StorageServer(basedir, "\x00" * 20, use_leasedb=True,
+                           expiration_enabled=False,
+                           expiration_mode="cutoff-date",
+                           expiration_cutoff_date=int(time.time()) - 10,
+                           expiration_indexed=True)
+        self._make_old_shares(ss)
+        lc = ss.lease_checker
+        lc.slow_start = 0
+        lc.batch_size = 1
+        ss.setServiceParent(self.s)
+        def _wait():
+            return bool(lc.get_state()["last-cycle-finished"] is not None)
+        d = self.poll(_wait)
+        def _check(ign):
+            # nothing is removed, but each share is only examined once
+            self.failUnlessEqual(len(list(ss._iter_share_files("si0"))), 2)
+            self.failUnlessEqual(len(ss.leasedb.get_leases("si0", 0)), 1)
+            rec = lc.get_state()["history"][0]["space-recovered"]
+            self.failUnlessEqual(rec["examined-shares"], 5)
+            self.failUnlessEqual(rec["configured-shares"], 3)
+            self.failUnlessEqual(rec["actual-shares"], 0)
+        d.addCallback(_check)
+        return d
+
+
+class ShareDigests(unittest.TestCase, pollmixin.PollMixin):
+
+    def setUp(self):
+        self.s = service.MultiService()
+        self.s.startService()
+    def tearDown(self):
+        return self.s.stopService()
+
+    def expected_digest(self, data, size=None):
+        # unwritten space at the end of an immutable share reads as zeros
+        if size is not None:
+            data += "\x00" * (size - len(data))
+        hasher = hashutil.share_digest_hasher()
+        hasher.update(data)
+        return hasher.digest()
+
+    def test_immutable(self):
+        for backend in ("disk", "packed"):
+            basedir = "storage/ShareDigests/immutable-%s" % backend
+            ss = StorageServer(basedir, "\x00" * 20, share_digests=True,
+                               use_leasedb=True, backend=backend)
+            ver = ss.remote_get_version()
+            sv1 = ver['http://allmydata.org/tahoe/protocols/storage/v1']
+            self.failUnless(sv1.get('provides-share-digests'), sv1)
+            a,w = ss.remote_allocate_buckets("si0", "\x00"*32, "\x00"*32,
+                                             [0, 1, 2], 100, FakeCanary())
+            w[0].remote_write(0, "a"*50)
+            w[0].remote_write(50, "b"*50)
+            # out of order, so the share has to be read back
+            w[1].remote_write(50, "b"*50)
+            w[1].remote_write(0, "a"*50)
+            # short
+            w[2].remote_write(0, "c"*30)
+            for wb in w.values():
+                wb.remote_close()
+            whole = self.expected_digest("a"*50 + "b"*50)
+            short = self.expected_digest("c"*30, 100)
+            self.failUnlessEqual(ss.remote_get_share_digests("si0", set()),
+                                 {0: whole, 1: whole, 2: short})
+            self.failUnlessEqual(ss.remote_get_share_digests("si0",
+                                                             set([2, 3])),
+                                 {2: short})
+            self.failUnlessEqual(ss.remote_get_share_digests("si1", set()),
+                                 {})
+
+            # digests of shares that have gone are not reported
+            ss.backend.delete_share("si0", 1)
+            ss.forget_bucket("si0")
+            self.failUnlessEqual(sorted(ss.remote_get_share_digests("si0",
+                                                                    set())),
+                                 [0, 2])
+
+    def test_disabled(self):
+        basedir = "storage/ShareDigests/disabled"
+        ss = StorageServer(basedir, "\x00" * 20)
+        ver = ss.remote_get_version()
+        sv1 = ver['http://allmydata.org/tahoe/protocols/storage/v1']
+        self.failIf(sv1.get('provides-share-digests'), sv1)
+        a,w = ss.remote_allocate_buckets("si0", "\x00"*32, "\x00"*32,
+                                         [0], 100, FakeCanary())
+        w[0].remote_write(0, "a"*100)
+        w[0].remote_close()
+        self.failUnlessEqual(w[0].digest, None)
+        self.failUnlessEqual(ss.remote_get_share_digests("si0", set()), {})
+
+    def test_crawler(self):
+        basedir = "storage/ShareDigests/crawler"
+        ss = StorageServer(basedir, "\x00" * 20)
+        a,w = ss.remote_allocate_buckets("si0", "\x00"*32, "\x00"*32,
+                                         [0, 1], 100, FakeCanary())
+        for wb in w.values():
+            wb.remote_write(0, "a"*100)
+            wb.remote_close()
+
+        # shares stored before digests were enabled, and mutable shares,
+        # are hashed by the crawler
+        ss = StorageServer(basedir, "\x00" * 20, share_digests=True)
+        secrets = (hashutil.tagged_hash("write-enabler", "1"),
+                   "\x00"*32, "\x00"*32)
+        writev = ss.remote_slot_testv_and_readv_and_writev
+        writev("si1", secrets, {0: ([], [(0, "data")], None)}, [])
+        self.failUnlessEqual(ss.remote_get_share_digests("si0", set()), {})
+        self.failUnlessEqual(ss.remote_get_share_digests("si1", set()), {})
+        ss.share_digests.set_digest("si2", 0, "\x00"*32)
+
+        sdc = ss.share_digest_crawler
+        sdc.slow_start = 0
+        ss.setServiceParent(self.s)
+        def _wait():
+            return sdc.get_state()["last-cycle"] is not None
+        d = self.poll(_wait)
+        def _check(ign):
+            last = sdc.get_state()["last-cycle"]
+            self.failUnlessEqual(last["computed-digests"], 3)
+            self.failUnlessEqual(last["forgotten-digests"], 1)
+            self.failUnlessEqual(ss.remote_get_share_digests("si0", set()),
+                                 {0: self.expected_digest("a"*100),
+                                  1: self.expected_digest("a"*100)})
+            self.failUnlessEqual(ss.remote_get_share_digests("si1", set()),
+                                 {0: self.expected_digest("data")})
+            self.failUnlessEqual(ss.share_digests.get_digests("si2"), {})
+
+            # writing to a mutable share forgets its digest
+            writev("si1", secrets, {0: ([], [(4, "more")], None)}, [])
+            self.failUnlessEqual(ss.remote_get_share_digests("si1", set()),
+                                 {})
+        d.addCallback(_check)
+        return d
+
+    def check_rehash(self, basedir, threads):
+        # a share that is changed behind the server's back is hashed again
+        ss = StorageServer(basedir, "\x00" * 20, share_digests=True)
+        a,w = ss.remote_allocate_buckets("si0", "\x00"*32, "\x00"*32,
+                                         [0, 1], 100, FakeCanary())
+        for wb in w.values():
+            wb.remote_write(0, "a"*100)
+            wb.remote_close()
+        fn = w[0].finalhome
+        self.failUnlessEqual(ss.share_digests.get_identities("si0")[0],
+                             get_share_identity(fn))
+        ShareFile(fn).write_share_data(0, "b"*100)
+        s = os.stat(fn)
+        os.utime(fn, (s.st_atime, s.st_mtime + 10))
+        sdc = ss.share_digest_crawler
+        sdc.slow_start = 0
+        sdc.threads = threads
+        ss.setServiceParent(self.s)
+        d = self.poll(lambda: sdc.get_state()["last-cycle"] is not None)
+        def _check(ign):
+            self.failUnlessEqual(sdc.get_state()["last-cycle"]
+                                 ["computed-digests"], 1)
+            self.failUnlessEqual(ss.remote_get_share_digests("si0", set()),
+                                 {0: self.expected_digest("b"*100),
+                                  1: self.expected_digest("a"*100)})
+            self.failUnlessEqual(ss.share_digests.get_identities("si0")[0],
+                                 get_share_identity(fn))
+        d.addCallback(_check)
+        return d
+
+    def test_crawler_rehash(self):
+        return self.check_rehash("storage/ShareDigests/crawler_rehash", 0)
+
+    def test_crawler_rehash_threads(self):
+        return self.check_rehash("storage/ShareDigests/crawler_rehash_threads",
+                                 2)
+
+    def test_upgrade(self):
+        basedir = "storage/ShareDigests/upgrade"
+        fileutil.make_dirs(basedir)
+        dbfile = os.path.join(basedir, "share_digests.sqlite")
+        (sqlite3, db) = dbutil.get_db(dbfile,
+                                      create_version=(digests.SCHEMA_v1, 1))
+        db.execute("INSERT INTO digests VALUES (?,?,?)",
+                   (si_b2a("si0"), 0, sqlite3.Binary("\x00"*32)))
+        db.commit()
+        db.close()
+        digestdb = digests.ShareDigestDB(dbfile)
+        # digests recorded by version 1 have no identity, so the crawler
+        # will hash their shares again
+        self.failUnlessEqual(digestdb.get_digests("si0"), {0: "\x00"*32})
+        self.failUnlessEqual(digestdb.get_identities("si0"), {0: None})
+        digestdb.mark_corrupt("si0", 0, (100, 1.5, 7))
+        self.failUnlessEqual(digestdb.get_digests("si0"), {})
+        self.failUnlessEqual(digestdb.get_identities("si0"),
+                             {0: (100, 1.5, 7)})
+
+    def make_crawler(self, basedir, threads):
+        # share 0 takes three 1MB chunks to hash, and share 1 one more
+        ss = StorageServer(basedir, "\x00" * 20)
+        for (shnum, data) in [(0, "a"*2500*1000), (1, "b"*1000)]:
+            a,w = ss.remote_allocate_buckets("si0", "\x00"*32, "\x00"*32,
+                                             [shnum], len(data), FakeCanary())
+            w[shnum].remote_write(0, data)
+            w[shnum].remote_close()
+        ss = StorageServer(basedir, "\x00" * 20, share_digests=True)
+        sdc = ss.share_digest_crawler
+        sdc.slow_start = 0
+        sdc.threads = threads
+        # 2MB/s in 0.1s slices allows 200kB per slice
+        sdc.rate = 2*1000*1000
+        sdc.cpu_slice = 0.1
+        sdc.allowed_cpu_percentage = 1.0
+        self.slice_bytes = []
+        def _minimum_sleep_time(this_slice):
+            if sdc._slice_bytes:
+                self.slice_bytes.append(sdc._slice_bytes)
+            return ShareDigestCrawler.minimum_sleep_time(sdc, this_slice)
+        sdc.minimum_sleep_time = _minimum_sleep_time
+        self.reactor_hashed = []
+        def _hash_share(storage_index_b32, shnum, filename):
+            self.reactor_hashed.append(shnum)
+            return ShareDigestCrawler._hash_share(sdc, storage_index_b32,
+                                                  shnum, filename)
+        sdc._hash_share = _hash_share
+        ss.setServiceParent(self.s)
+        def _wait():
+            return sdc.get_state()["last-cycle"] is not None
+        d = self.poll(_wait)
+        def _check(ign):
+            self.failUnlessEqual(sdc.get_state()["last-cycle"]
+                                 ["computed-digests"], 2)
+            self.failUnlessEqual(ss.remote_get_share_digests("si0", set()),
+                                 {0: self.expected_digest("a"*2500*1000),
+                                  1: self.expected_digest("b"*1000)})
+        d.addCallback(_check)
+        return d
+
+    def test_crawler_rate(self):
+        d = self.make_crawler("storage/ShareDigests/crawler_rate", 0)
+        def _check(ign):
+            # one slice for each chunk
+            self.failUnlessEqual(self.slice_bytes,
+                                 [2**20, 2**20, 2500*1000 - 2*2**20, 1000])
+            self.failUnlessEqual(sorted(set(self.reactor_hashed)), [0, 1])
+        d.addCallback(_check)
+        return d
+
+    def test_crawler_threads(self):
+        d = self.make_crawler("storage/ShareDigests/crawler_threads", 2)
+        def _check(ign):
+            # share 0 uses up the first slice's budget, so share 1 is hashed
+            # in the next one. None of it is read in the reactor thread.
+            self.failUnlessEqual(self.slice_bytes, [2500*1000, 1000])
+            self.failUnlessEqual(self.reactor_hashed, [])
+        d.addCallback(_check)
+        return d
+
+
+def _corrupt_mdmf_share_data(data, debug=False):
+    # flip one bit of the first block of an MDMF share
+    data_offset = MutableShareFile.DATA_OFFSET
+    fields = struct.unpack(MDMFHEADER,
+                           data[data_offset:data_offset+
+                                struct.calcsize(MDMFHEADER)])
+    assert fields[0] == 1, fields[0]
+    share_data = fields[-3]
+    # skip the salt
+    offset = data_offset + share_data + 16 + 3
+    return data[:offset] + chr(ord(data[offset]) ^ 0x01) + data[offset+1:]
+
+class Scrubber(GridTestMixin, unittest.TestCase, pollmixin.PollMixin):
+
+    def make_scrubber(self, rate=10**9):
+        ss = self.g.servers_by_number[0]
+        statefile = os.path.join(self.basedir, "scrubber.state")
+        scrubber = ShareScrubber(ss, statefile, rate)
+        scrubber.slow_start = 0
+        scrubber.minimum_cycle_time = 0
+        return scrubber
+
+    def upload_files(self):
+        c0 = self.g.clients[0]
+        c0.encoding_params["max_segment_size"] = 100*1000
+        c0.encoding_params["happy"] = 1
+        self.uris = {}
+        d = c0.upload(upload.Data("immutable " * 30000, convergence=""))
+        def _uploaded_immutable(ur):
+            self.uris["immutable"] = ur.get_uri()
+            return c0.create_mutable_file(MutableData("sdmf " * 1000))
+        d.addCallback(_uploaded_immutable)
+        def _created_sdmf(n):
+            self.uris["sdmf"] = n.get_uri()
+            return c0.create_mutable_file(MutableData("mdmf " * 50000),
+                                          version=MDMF_VERSION)
+        d.addCallback(_created_sdmf)
+        def _created_mdmf(n):
+            self.uris["mdmf"] = n.get_uri()
+        d.addCallback(_created_mdmf)
+        return d
+
+    def corrupt_files(self):
+        self.corrupt_shares_numbered(self.uris["immutable"], [0],
+                                     common._corrupt_share_data)
+        self.corrupt_shares_numbered(self.uris["immutable"], [1],
+                                     common._corrupt_block_hashes)
+        self.corrupt_shares_numbered(self.uris["immutable"], [2],
+                                     common._corrupt_share_hashes)
+        self.corrupt_shares_numbered(self.uris["sdmf"], [3],
+                                     common._corrupt_mutable_share_data)
+        self.corrupt_shares_numbered(self.uris["mdmf"], [4],
+                                     _corrupt_mdmf_share_data)
+
+    def test_scrub(self):
+        self.basedir = "storage/Scrubber/scrub"
+        self.set_up_grid(num_servers=1)
+        d = self.upload_files()
+        def _check_clean(ign):
+            ss = self.g.servers_by_number[0]
+            # the digests of the shares found to be corrupt are marked
+            ss.share_digests = digests.ShareDigestDB(
+                os.path.join(self.basedir, "share_digests.sqlite"))
+            for (shnum, serverid, fn) in self.find_uri_shares(
+                self.uris["immutable"]):
+                self.si = si_a2b(os.path.basename(os.path.dirname(fn)))
+                ss.share_digests.set_digest(self.si, shnum, "\x00"*32)
+            self.scrubber = self.make_scrubber()
+            self.scrubber.setServiceParent(self.s)
+            d2 = self.poll(lambda: self.scrubber.get_state()["last-cycle"]
+                           is not None)
+            def _clean(ign):
+                last = self.scrubber.get_state()["last-cycle"]
+                self.failUnlessEqual(last["examined-shares"], 30)
+                self.failUnless(last["examined-bytes"] > 300*1000, last)
+                self.failUnlessEqual(last["corrupt-shares"], [])
+                self.failIf(os.path.exists(ss.corruption_advisory_dir))
+            d2.addCallback(_clean)
+            return d2
+        d.addCallback(_check_clean)
+        def _corrupt(ign):
+            self.corrupt_files()
+            # wait for a whole cycle that started after the corruption
+            cycle = self.scrubber.get_state()["last-cycle-finished"]
+            return self.poll(lambda: self.scrubber.get_state()
+                             ["last-cycle-finished"] > cycle + 1)
+        d.addCallback(_corrupt)
+        def _check_corrupt(ign):
+            ss = self.g.servers_by_number[0]
+            last = self.scrubber.get_state()["last-cycle"]
+            self.failUnlessEqual(last["examined-shares"], 30)
+            found = sorted([(shnum, sharetype) for (si_s, shnum, sharetype,
+                                                    reason)
+                            in last["corrupt-shares"]])
+            self.failUnlessEqual(found, [(0, "immutable"), (1, "immutable"),
+                                         (2, "immutable"), (3, "mutable"),
+                                         (4, "mutable")])
+            advisories = os.listdir(ss.corruption_advisory_dir)
+            self.failUnlessEqual(len(advisories), 5)
+            self.failUnlessEqual(sorted(ss.share_digests.get_digests(self.si)),
+                                 range(3, 10))
+            for fn in advisories:
+                f = open(os.path.join(ss.corruption_advisory_dir, fn), "r")
+                self.failUnlessIn("reported_by: scrubber\n", f.read())
+                f.close()
+            # shares already reported are not reported again
+            self.cycle = self.scrubber.get_state()["last-cycle-finished"]
+            return self.poll(lambda: self.scrubber.get_state()
+                             ["last-cycle-finished"] > self.cycle)
+        d.addCallback(_check_corrupt)
+        def _check_again(ign):
+            ss = self.g.servers_by_number[0]
+            last = self.scrubber.get_state()["last-cycle"]
+            self.failUnlessEqual(len(last["corrupt-shares"]), 5)
+            self.failUnlessEqual(len(os.listdir(ss.corruption_advisory_dir)),
+                                 5)
+        d.addCallback(_check_again)
+        return d
+
+    def test_rate(self):
+        self.basedir = "storage/Scrubber/rate"
+        self.set_up_grid(num_servers=1)
+        scrubber = self.make_scrubber(rate=1000*1000)
+        # 1MB/s with a 1s slice at 10% CPU allows 10MB per slice
+        start = time.time()
+        scrubber._slice_bytes = 9*1000*1000
+        self.failIf(scrubber.slice_exceeded(start))
+        scrubber._slice_bytes = 10*1000*1000
+        self.failUnless(scrubber.slice_exceeded(start))
+        # and then sleeps until the average is back down to the rate
+        self.failUnlessEqual(scrubber.minimum_sleep_time(2.0), 8.0)
+        self.failUnlessEqual(scrubber._slice_bytes, 0)
+        self.failUnlessEqual(scrubber.minimum_sleep_time(2.0), -2.0)
+
+    def test_stats(self):
+        self.basedir = "storage/Scrubber/stats"
+        ss = StorageServer(os.path.join(self.basedir, "ss"), "\x00" * 20,
+                           scrub_enabled=True)
+        self.failUnless(isinstance(ss.scrubber, ShareScrubber))
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.scrubber.examined_shares"],
+                             0)
+        self.failIfIn("storage_server.scrubber.last_cycle.examined_shares",
+                      stats)
+        ss = StorageServer(os.path.join(self.basedir, "ss2"), "\x01" * 20)
+        self.failUnlessEqual(ss.scrubber, None)
+        self.failIfIn("storage_server.scrubber.examined_shares",
+                      ss.get_stats())
+
 class MDMFProxies(unittest.TestCase, ShouldFailMixin):
     def setUp(self):
         self.sparent = LoggingServiceParent()
@@ -2805,6 +4277,13 @@ class Stats(unittest.TestCase):
         ss.setServiceParent(self.sparent)
         return ss
 
+    def failUnlessClose(self, value, expected, output):
+        # the histograms only promise to be accurate to within half a
+        # percent
+        self.failIf(value is None, output)
+        self.failUnless(abs(value - expected) < 1 + 0.005 * expected,
+                        (value, expected, output))
+
     def test_latencies(self):
         ss = self.create("test_latencies")
         for i in range(10000):
@@ -2821,47 +4300,48 @@ class Stats(unittest.TestCase):
 
         self.failUnlessEqual(sorted(output.keys()),
                              sorted(["allocate", "renew", "cancel", "write", "get"]))
-        self.failUnlessEqual(len(ss.latencies["allocate"]), 1000)
-        self.failUnless(abs(output["allocate"]["mean"] - 9500) < 1, output)
-        self.failUnless(abs(output["allocate"]["01_0_percentile"] - 9010) < 1, output)
-        self.failUnless(abs(output["allocate"]["10_0_percentile"] - 9100) < 1, output)
-        self.failUnless(abs(output["allocate"]["50_0_percentile"] - 9500) < 1, output)
-        self.failUnless(abs(output["allocate"]["90_0_percentile"] - 9900) < 1, output)
-        self.failUnless(abs(output["allocate"]["95_0_percentile"] - 9950) < 1, output)
-        self.failUnless(abs(output["allocate"]["99_0_percentile"] - 9990) < 1, output)
-        self.failUnless(abs(output["allocate"]["99_9_percentile"] - 9999) < 1, output)
-
-        self.failUnlessEqual(len(ss.latencies["renew"]), 1000)
-        self.failUnless(abs(output["renew"]["mean"] - 500) < 1, output)
-        self.failUnless(abs(output["renew"]["01_0_percentile"] -  10) < 1, output)
-        self.failUnless(abs(output["renew"]["10_0_percentile"] - 100) < 1, output)
-        self.failUnless(abs(output["renew"]["50_0_percentile"] - 500) < 1, output)
-        self.failUnless(abs(output["renew"]["90_0_percentile"] - 900) < 1, output)
-        self.failUnless(abs(output["renew"]["95_0_percentile"] - 950) < 1, output)
-        self.failUnless(abs(output["renew"]["99_0_percentile"] - 990) < 1, output)
-        self.failUnless(abs(output["renew"]["99_9_percentile"] - 999) < 1, output)
-
-        self.failUnlessEqual(len(ss.latencies["write"]), 20)
-        self.failUnless(abs(output["write"]["mean"] - 9) < 1, output)
+        # every sample is counted, not just the most recent ones
+        self.failUnlessEqual(output["allocate"]["samplesize"], 10000)
+        self.failUnlessClose(output["allocate"]["mean"], 4999.5, output)
+        self.failUnlessClose(output["allocate"]["01_0_percentile"], 100, output)
+        self.failUnlessClose(output["allocate"]["10_0_percentile"], 1000, output)
+        self.failUnlessClose(output["allocate"]["50_0_percentile"], 5000, output)
+        self.failUnlessClose(output["allocate"]["90_0_percentile"], 9000, output)
+        self.failUnlessClose(output["allocate"]["95_0_percentile"], 9500, output)
+        self.failUnlessClose(output["allocate"]["99_0_percentile"], 9900, output)
+        self.failUnlessClose(output["allocate"]["99_9_percentile"], 9990, output)
+
+        self.failUnlessEqual(output["renew"]["samplesize"], 1000)
+        self.failUnlessClose(output["renew"]["mean"], 499.5, output)
+        self.failUnlessClose(output["renew"]["01_0_percentile"],  10, output)
+        self.failUnlessClose(output["renew"]["10_0_percentile"], 100, output)
+        self.failUnlessClose(output["renew"]["50_0_percentile"], 500, output)
+        self.failUnlessClose(output["renew"]["90_0_percentile"], 900, output)
+        self.failUnlessClose(output["renew"]["95_0_percentile"], 950, output)
+        self.failUnlessClose(output["renew"]["99_0_percentile"], 990, output)
+        self.failUnlessClose(output["renew"]["99_9_percentile"], 999, output)
+
+        self.failUnlessEqual(output["write"]["samplesize"], 20)
+        self.failUnlessClose(output["write"]["mean"], 9.5, output)
         self.failUnless(output["write"]["01_0_percentile"] is None, output)
-        self.failUnless(abs(output["write"]["10_0_percentile"] -  2) < 1, output)
-        self.failUnless(abs(output["write"]["50_0_percentile"] - 10) < 1, output)
-        self.failUnless(abs(output["write"]["90_0_percentile"] - 18) < 1, output)
-        self.failUnless(abs(output["write"]["95_0_percentile"] - 19) < 1, output)
+        self.failUnlessClose(output["write"]["10_0_percentile"],  2, output)
+        self.failUnlessClose(output["write"]["50_0_percentile"], 10, output)
+        self.failUnlessClose(output["write"]["90_0_percentile"], 18, output)
+        self.failUnlessClose(output["write"]["95_0_percentile"], 19, output)
         self.failUnless(output["write"]["99_0_percentile"] is None, output)
         self.failUnless(output["write"]["99_9_percentile"] is None, output)
 
-        self.failUnlessEqual(len(ss.latencies["cancel"]), 10)
-        self.failUnless(abs(output["cancel"]["mean"] - 9) < 1, output)
+        self.failUnlessEqual(output["cancel"]["samplesize"], 10)
+        self.failUnlessClose(output["cancel"]["mean"], 9, output)
         self.failUnless(output["cancel"]["01_0_percentile"] is None, output)
-        self.failUnless(abs(output["cancel"]["10_0_percentile"] -  2) < 1, output)
-        self.failUnless(abs(output["cancel"]["50_0_percentile"] - 10) < 1, output)
-        self.failUnless(abs(output["cancel"]["90_0_percentile"] - 18) < 1, output)
+        self.failUnlessClose(output["cancel"]["10_0_percentile"],  2, output)
+        self.failUnlessClose(output["cancel"]["50_0_percentile"], 10, output)
+        self.failUnlessClose(output["cancel"]["90_0_percentile"], 18, output)
         self.failUnless(output["cancel"]["95_0_percentile"] is None, output)
         self.failUnless(output["cancel"]["99_0_percentile"] is None, output)
         self.failUnless(output["cancel"]["99_9_percentile"] is None, output)
 
-        self.failUnlessEqual(len(ss.latencies["get"]), 1)
+        self.failUnlessEqual(output["get"]["samplesize"], 1)
         self.failUnless(output["get"]["mean"] is None, output)
         self.failUnless(output["get"]["01_0_percentile"] is None, output)
         self.failUnless(output["get"]["10_0_percentile"] is None, output)
@@ -2871,6 +4351,610 @@ class Stats(unittest.TestCase):
         self.failUnless(output["get"]["99_0_percentile"] is None, output)
         self.failUnless(output["get"]["99_9_percentile"] is None, output)
 
+        stats = ss.get_stats()
+        self.failUnlessEqual(
+            stats["storage_server.latencies.allocate.samplesize"], 10000)
+        self.failUnlessEqual(
+            stats["storage_server.latencies_cumulative.allocate.samplesize"],
+            10000)
+
+    def test_latency_window(self):
+        ss = self.create("test_latency_window")
+        now = time.time()
+        for i in range(100):
+            ss.add_latency("read", 1.0 * i)
+        # pretend that some of the samples arrived a long time ago
+        old = ss.latencies["readv"]
+        for i in range(100):
+            old.add(1000.0, now - 2*ss.LATENCY_WINDOW)
+        for i in range(100):
+            old.add(1.0 * i, now)
+
+        output = ss.get_latencies()
+        self.failUnlessEqual(output["read"]["samplesize"], 100)
+        self.failUnlessEqual(output["readv"]["samplesize"], 100)
+        self.failUnlessClose(output["readv"]["99_0_percentile"], 99, output)
+
+        output = ss.get_latencies(cumulative=True)
+        self.failUnlessEqual(output["readv"]["samplesize"], 200)
+        self.failUnlessClose(output["readv"]["99_0_percentile"], 1000, output)
+
+        # once the window has passed, the newer samples are dropped too
+        later = now + 2*ss.LATENCY_WINDOW
+        self.failUnlessEqual(old.get_window(later).count, 0)
+        self.failUnlessEqual(old.cumulative.count, 200)
+
+class Inventory(unittest.TestCase):
+
+    def setUp(self):
+        self.sparent = LoggingServiceParent()
+        self._lease_secret = itertools.count()
+    def tearDown(self):
+        return self.sparent.stopService()
+
+    def workdir(self, name):
+        basedir = os.path.join("storage", "Inventory", name)
+        return basedir
+
+    def create(self, name, size=10000):
+        workdir = self.workdir(name)
+        ss = StorageServer(workdir, "\x00" * 20, share_inventory_size=size)
+        ss.setServiceParent(self.sparent)
+        return ss
+
+    def write_immutable(self, ss, storage_index, sharenums):
+        rs = hashutil.tagged_hash("blah", "%d" % self._lease_secret.next())
+        cs = hashutil.tagged_hash("blah", "%d" % self._lease_secret.next())
+        already, writers = ss.remote_allocate_buckets(storage_index, rs, cs,
+                                                      sharenums, 10,
+                                                      FakeCanary())
+        for bw in writers.values():
+            bw.remote_write(0, "a"*10)
+            bw.remote_close()
+        return already
+
+    def test_lru(self):
+        sharedir = self.workdir("test_lru")
+        fileutil.make_dirs(sharedir)
+        inv = ShareInventory(sharedir, size=2)
+        inv.get_shares("si1")
+        inv.get_shares("si2")
+        inv.get_shares("si1") # now si2 is the oldest
+        inv.get_shares("si3")
+        self.failUnlessEqual(inv.get_stats(),
+                             {"hits": 1, "misses": 3, "evictions": 1,
+                              "buckets": 2})
+        inv.get_shares("si1")
+        inv.get_shares("si2")
+        self.failUnlessEqual(inv.get_stats(),
+                             {"hits": 2, "misses": 4, "evictions": 2,
+                              "buckets": 2})
+        inv.forget("si2")
+        inv.forget("si2")
+        inv.forget("nonexistent")
+        self.failUnlessEqual(inv.get_stats()["buckets"], 1)
+        inv.clear()
+        self.failUnlessEqual(inv.get_stats()["buckets"], 0)
+        inv.get_shares("si1")
+        self.failUnlessEqual(inv.get_stats()["misses"], 5)
+
+    def test_changed_on_disk(self):
+        # shares added or removed behind the server's back are noticed
+        ss = self.create("test_changed_on_disk")
+        inv = ss.share_inventory
+        self.write_immutable(ss, "si1", [0, 1])
+        self.failUnlessEqual(sorted(ss.remote_get_buckets("si1")), [0, 1])
+        bucketdir = os.path.join(ss.sharedir, storage_index_to_dir("si1"))
+        os.unlink(os.path.join(bucketdir, "1"))
+        self.failUnlessEqual(sorted(ss.remote_get_buckets("si1")), [0])
+
+        fileutil.make_dirs(os.path.join(ss.sharedir,
+                                        storage_index_to_dir("si2")))
+        self.failUnlessEqual(ss.remote_get_sharenums(["si2"]), {})
+        fileutil.rename(bucketdir, os.path.join(ss.sharedir,
+                                                storage_index_to_dir("si2")))
+        self.failUnlessEqual(ss.remote_get_sharenums(["si1", "si2"]),
+                             {"si2": set([0])})
+        misses = inv.misses
+        self.failUnlessEqual(ss.remote_get_sharenums(["si1", "si2"]),
+                             {"si2": set([0])})
+        self.failUnlessEqual(inv.misses, misses)
+
+        # so are shares that are rewritten in place, which does not change
+        # the directory's mtime
+        fn = os.path.join(ss.sharedir, storage_index_to_dir("si2"), "0")
+        self.failUnlessEqual(inv.get_shares("si2")[0][1], "immutable")
+        f = open(fn, "r+b")
+        f.write("not a share")
+        f.close()
+        self.failUnlessEqual(inv.get_shares("si2")[0][1], None)
+        self.failUnlessEqual(inv.misses, misses+1)
+
+    def test_immutable(self):
+        ss = self.create("test_immutable")
+        inv = ss.share_inventory
+        self.failUnlessEqual(ss.remote_get_buckets("si1"), {})
+        self.failUnlessEqual(ss.remote_get_buckets("si1"), {})
+        self.failUnlessEqual((inv.hits, inv.misses), (1, 1))
+
+        # closing a new share makes the server forget the bucket
+        self.write_immutable(ss, "si1", [0, 1])
+        self.failUnlessEqual(set(ss.remote_get_buckets("si1").keys()),
+                             set([0, 1]))
+        shares = inv.get_shares("si1")
+        self.failUnlessEqual(shares[0][1:], ("immutable", 0x0c + 10 + 72))
+        already = self.write_immutable(ss, "si1", [0, 1, 2])
+        self.failUnlessEqual(already, set([0, 1]))
+        self.failUnlessEqual(set(ss.remote_get_buckets("si1").keys()),
+                             set([0, 1, 2]))
+
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.share_inventory.buckets"],
+                             1)
+        self.failUnlessEqual(stats["storage_server.share_inventory.hits"],
+                             inv.hits)
+        self.failUnlessEqual(stats["storage_server.share_inventory.misses"],
+                             inv.misses)
+
+    def test_mutable(self):
+        ss = self.create("test_mutable")
+        inv = ss.share_inventory
+        secrets = (hashutil.tagged_hash("we", "1"),
+                   hashutil.tagged_hash("renew", "1"),
+                   hashutil.tagged_hash("cancel", "1"))
+        writev = ss.remote_slot_testv_and_readv_and_writev
+        readv = ss.remote_slot_readv
+        self.failUnlessEqual(readv("si1", [], [(0, 4)]), {})
+        writev("si1", secrets, {0: ([], [(0, "data")], None),
+                                3: ([], [(0, "more")], None)}, [])
+        self.failUnlessEqual(readv("si1", [], [(0, 4)]),
+                             {0: ["data"], 3: ["more"]})
+        hits = inv.hits
+        self.failUnlessEqual(readv("si1", [3], [(0, 4)]), {3: ["more"]})
+        self.failUnlessEqual(inv.hits, hits+1)
+        self.failUnlessEqual(inv.get_shares("si1")[0][1], "mutable")
+
+        writev("si1", secrets, {0: ([], [], 0)}, [])
+        self.failUnlessEqual(readv("si1", [], [(0, 4)]), {3: ["more"]})
+        writev("si1", secrets, {3: ([], [], 0)}, [])
+        self.failUnlessEqual(readv("si1", [], [(0, 4)]), {})
+        self.failIf(os.path.exists(os.path.join(ss.sharedir,
+                                                storage_index_to_dir("si1"))))
+
+    def test_disabled(self):
+        ss = self.create("test_disabled", size=0)
+        self.write_immutable(ss, "si1", [0])
+        self.failUnlessEqual(ss.remote_get_buckets("si1").keys(), [0])
+        self.failUnlessEqual(ss.remote_get_buckets("si1").keys(), [0])
+        self.failUnlessEqual(ss.share_inventory.get_stats(),
+                             {"hits": 0, "misses": 3, "evictions": 0,
+                              "buckets": 0})
+
+class FileHandles(unittest.TestCase):
+
+    def setUp(self):
+        self.sparent = LoggingServiceParent()
+    def tearDown(self):
+        return self.sparent.stopService()
+
+    def workdir(self, name):
+        basedir = os.path.join("storage", "FileHandles", name)
+        return basedir
+
+    def create(self, name, size=128, use_mmap=False):
+        workdir = self.workdir(name)
+        ss = StorageServer(workdir, "\x00" * 20, share_fd_cache_size=size,
+                           share_mmap_reads=use_mmap)
+        ss.setServiceParent(self.sparent)
+        return ss
+
+    def write_immutable(self, ss, storage_index, sharenums, data):
+        rs = hashutil.tagged_hash("renew", storage_index)
+        cs = hashutil.tagged_hash("cancel", storage_index)
+        already, writers = ss.remote_allocate_buckets(storage_index, rs, cs,
+                                                      sharenums, len(data),
+                                                      FakeCanary())
+        for bw in writers.values():
+            bw.remote_write(0, data)
+            bw.remote_close()
+
+    def test_lru(self):
+        basedir = self.workdir("test_lru")
+        fileutil.make_dirs(basedir)
+        names = [os.path.join(basedir, str(i)) for i in range(3)]
+        for i, name in enumerate(names):
+            fileutil.write(name, "file %d" % i)
+        fdc = FileHandleCache(2)
+        f0 = fdc.open(names[0])
+        fdc.done(f0)
+        fdc.done(fdc.open(names[1]))
+        self.failUnlessIdentical(fdc.open(names[0]), f0)
+        fdc.done(f0) # now names[1] is the oldest
+        f2 = fdc.open(names[2])
+        self.failUnlessEqual(f2.read(), "file 2")
+        fdc.done(f2)
+        self.failIf(f0.closed)
+        self.failUnlessEqual(fdc.get_stats(),
+                             {"opens": 3, "hits": 1, "stale": 0,
+                              "evictions": 1, "open": 2, "maps": 0})
+
+        fdc.forget(names[0])
+        self.failUnless(f0.closed)
+        fdc.forget(names[0])
+        fdc.forget_directory(basedir)
+        self.failUnless(f2.closed)
+        self.failUnlessEqual(fdc.get_stats()["open"], 0)
+
+        disabled = FileHandleCache(0)
+        f = disabled.open(names[0])
+        disabled.done(f)
+        self.failUnless(f.closed)
+        self.failUnlessEqual(disabled.get_stats()["open"], 0)
+
+    def test_immutable(self):
+        ss = self.create("test_immutable")
+        fdc = ss.fdcache
+        self.write_immutable(ss, "si1", [0, 1], "a"*100)
+        readers = ss.remote_get_buckets("si1")
+        opens = fdc.opens
+        for i in range(10):
+            self.failUnlessEqual(readers[0].remote_read(i*10, 10), "a"*10)
+        self.failUnlessEqual(readers[1].remote_readv([(0, 5), (95, 10)]),
+                             ["a"*5, "a"*5])
+        # the files were opened when the readers were created
+        self.failUnlessEqual(fdc.opens, opens)
+        self.failUnlessEqual(fdc.get_stats()["open"], 2)
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.fd_cache.open"], 2)
+        self.failUnlessEqual(stats["storage_server.fd_cache.hits"], fdc.hits)
+
+        # forgetting the bucket closes its files; readers reopen them
+        ss.forget_bucket("si1")
+        self.failUnlessEqual(fdc.get_stats()["open"], 0)
+        self.failUnlessEqual(readers[0].remote_read(90, 20), "a"*10)
+        self.failUnlessEqual(fdc.opens, opens+1)
+
+    def test_replaced(self):
+        # files deleted or replaced behind the server's back are noticed
+        basedir = self.workdir("test_replaced")
+        fileutil.make_dirs(basedir)
+        name = os.path.join(basedir, "0")
+        fileutil.write(name, "old")
+        for use_mmap in (False, True):
+            fdc = FileHandleCache(2, use_mmap=use_mmap)
+            f = fdc.open(name)
+            self.failUnlessEqual(f.read(), "old")
+            fdc.done(f)
+            m = fdc.map(name, 3)
+            if use_mmap:
+                self.failUnlessEqual(m[:], "old")
+
+            fileutil.write(name+".tmp", "new!")
+            fileutil.rename(name+".tmp", name)
+            f2 = fdc.open(name)
+            self.failIfIdentical(f2, f)
+            self.failUnless(f.closed)
+            self.failUnlessEqual(f2.read(), "new!")
+            fdc.done(f2)
+            m = fdc.map(name, 4)
+            if use_mmap:
+                self.failUnlessEqual(m[:], "new!")
+
+            os.unlink(name)
+            self.failUnlessRaises(IOError, fdc.open, name)
+            self.failUnless(f2.closed)
+            self.failUnlessEqual(fdc.get_stats()["stale"], 2)
+            self.failUnlessEqual(fdc.get_stats()["open"], 0)
+            fileutil.write(name, "old")
+
+    def test_mmap(self):
+        ss = self.create("test_mmap", use_mmap=True)
+        fdc = ss.fdcache
+        data = "".join([chr(i%256) for i in range(20000)])
+        self.write_immutable(ss, "si1", [0], data)
+        reader = ss.remote_get_buckets("si1")[0]
+        self.failUnlessEqual(reader.remote_read(0, 10), data[:10])
+        self.failUnlessEqual(reader.remote_read(19990, 100), data[19990:])
+        self.failUnlessEqual(reader.remote_read(20000, 100), "")
+        self.failUnlessEqual(reader.remote_readv([(5000, 10), (0, 3),
+                                                  (19999, 5), (30000, 1)]),
+                             [data[5000:5010], data[:3], data[19999:], ""])
+        self.failUnlessEqual(fdc.get_stats()["maps"], 1)
+
+        ss.forget_bucket("si1")
+        self.failUnlessEqual(fdc.get_stats()["open"], 0)
+        self.failUnlessEqual(reader.remote_read(100, 10), data[100:110])
+        self.failUnlessEqual(fdc.get_stats()["maps"], 2)
+
+    def test_mmap_without_cache(self):
+        # without a file handle cache there is nothing to map
+        ss = self.create("test_mmap_without_cache", size=0, use_mmap=True)
+        self.write_immutable(ss, "si1", [0], "a"*100)
+        reader = ss.remote_get_buckets("si1")[0]
+        self.failUnlessEqual(reader.remote_read(0, 10), "a"*10)
+        self.failUnlessEqual(ss.fdcache.get_stats()["maps"], 0)
+
+    def test_mutable(self):
+        ss = self.create("test_mutable")
+        fdc = ss.fdcache
+        secrets = (hashutil.tagged_hash("we", "1"),
+                   hashutil.tagged_hash("renew", "1"),
+                   hashutil.tagged_hash("cancel", "1"))
+        writev = ss.remote_slot_testv_and_readv_and_writev
+        readv = ss.remote_slot_readv
+        writev("si1", secrets, {0: ([], [(0, "data")], None)}, [])
+        self.failUnlessEqual(readv("si1", [], [(0, 4)]), {0: ["data"]})
+        opens = fdc.opens
+        self.failUnlessEqual(readv("si1", [], [(0, 4)]), {0: ["data"]})
+        self.failUnlessEqual(fdc.opens, opens)
+
+        # writes made through another handle are seen by the cached one
+        writev("si1", secrets, {0: ([], [(0, "DATA")], None)}, [])
+        self.failUnlessEqual(readv("si1", [], [(0, 4)]), {0: ["DATA"]})
+
+        writev("si1", secrets, {0: ([], [], 0)}, [])
+        self.failUnlessEqual(fdc.get_stats()["open"], 0)
+        self.failUnlessEqual(readv("si1", [], [(0, 4)]), {})
+
+    def test_stop(self):
+        ss = self.create("test_stop")
+        self.write_immutable(ss, "si1", [0], "a"*10)
+        ss.remote_get_buckets("si1")[0].remote_read(0, 10)
+        self.failUnlessEqual(ss.fdcache.get_stats()["open"], 1)
+        d = defer.maybeDeferred(ss.stopService)
+        d.addCallback(lambda ign:
+                      self.failUnlessEqual(ss.fdcache.get_stats()["open"], 0))
+        return d
+
+class Packed(unittest.TestCase, pollmixin.PollMixin):
+
+    def setUp(self):
+        self.s = service.MultiService()
+        self.s.startService()
+    def tearDown(self):
+        return self.s.stopService()
+
+    def workdir(self, name):
+        return os.path.join("storage", "Packed", name)
+
+    def create(self, name, start=True, **kwargs):
+        ss = StorageServer(self.workdir(name), "\x00" * 20, use_leasedb=True,
+                           backend="packed", pack_max_share_size=100,
+                           **kwargs)
+        if start:
+            ss.setServiceParent(self.s)
+        return ss
+
+    def write_immutable(self, ss, storage_index, sharenums, data, tag="0"):
+        rs = hashutil.tagged_hash("renew", tag)
+        cs = hashutil.tagged_hash("cancel", tag)
+        already, writers = ss.remote_allocate_buckets(storage_index, rs, cs,
+                                                      sharenums, len(data),
+                                                      FakeCanary())
+        for bw in writers.values():
+            bw.remote_write(0, data)
+            bw.remote_close()
+        return already
+
+    def test_configuration(self):
+        self.failUnlessRaises(ValueError, StorageServer,
+                              self.workdir("test_configuration"), "\x00" * 20,
+                              backend="packed")
+        self.failUnlessRaises(ValueError, StorageServer,
+                              self.workdir("test_configuration"), "\x00" * 20,
+                              backend="packed", use_leasedb=True,
+                              expiration_enabled=True)
+        self.failUnlessRaises(ValueError, StorageServer,
+                              self.workdir("test_configuration"), "\x00" * 20,
+                              backend="tape")
+
+    def test_small_and_large_shares(self):
+        ss = self.create("test_small_and_large_shares")
+        self.failIf(ss.have_shares())
+        self.write_immutable(ss, "si1", [0, 1], "a"*100)
+        self.write_immutable(ss, "si2", [0], "b"*101)
+        self.failUnless(ss.have_shares())
+
+        # the small shares live only in a pack, the large one in a file
+        self.failIf(os.path.exists(os.path.join(ss.sharedir,
+                                                storage_index_to_dir("si1"))))
+        self.failIf(os.path.exists(os.path.join(ss.incomingdir,
+                                                storage_index_to_dir("si1"))))
+        self.failUnless(os.path.exists(os.path.join(ss.sharedir,
+                                                    storage_index_to_dir("si2"),
+                                                    "0")))
+        self.failUnlessEqual(ss.remote_get_sharenums(["si1", "si2", "si3"]),
+                             {"si1": set([0, 1]), "si2": set([0])})
+        self.failUnlessEqual(ss.leasedb.get_shares("si1"),
+                             {0: "immutable", 1: "immutable"})
+
+        readers = ss.remote_get_buckets("si1")
+        self.failUnlessEqual(sorted(readers.keys()), [0, 1])
+        self.failUnlessEqual(readers[1].remote_read(0, 10), "a"*10)
+        self.failUnlessEqual(readers[1].remote_read(95, 10), "a"*5)
+        self.failUnlessEqual(readers[1].remote_read(100, 10), "")
+        self.failUnlessEqual(readers[0].remote_readv([(90, 20), (0, 2)]),
+                             ["a"*10, "a"*2])
+        self.failUnlessEqual(ss.remote_get_buckets("si2")[0].remote_read(0, 200),
+                             "b"*101)
+
+        # a second upload finds the shares that are already there
+        already = self.write_immutable(ss, "si1", [0, 1, 2], "c"*100, tag="1")
+        self.failUnlessEqual(already, set([0, 1]))
+        self.failUnlessEqual(len(ss.leasedb.get_leases("si1", 0)), 2)
+
+        stats = ss.get_stats()
+        self.failUnlessEqual(stats["storage_server.backend.packs"], 1)
+        self.failUnlessEqual(stats["storage_server.backend.packed_shares"], 3)
+        self.failUnlessEqual(stats["storage_server.backend.pack_bytes"], 300)
+
+    def test_restart(self):
+        ss = self.create("test_restart")
+        self.write_immutable(ss, "si1", [0], "a"*100)
+        d = ss.disownServiceParent()
+        def _restart(ign):
+            ss2 = self.create("test_restart")
+            self.failUnless(ss2.have_shares())
+            reader = ss2.remote_get_buckets("si1")[0]
+            self.failUnlessEqual(reader.remote_read(0, 100), "a"*100)
+            self.write_immutable(ss2, "si2", [0], "b"*100)
+            self.failUnlessEqual(self.check_stats(ss2.backend)["packs"], 1)
+            reader = ss2.remote_get_buckets("si2")[0]
+            self.failUnlessEqual(reader.remote_read(0, 100), "b"*100)
+        d.addCallback(_restart)
+        return d
+
+    def list_packs(self, backend):
+        return sorted([fn for fn in os.listdir(backend.packdir)
+                       if not fn.startswith("index.sqlite")])
+
+    def check_stats(self, backend):
+        # the running totals must match the index
+        stats = backend.get_stats()
+        backend.cursor.execute("SELECT COUNT(*), COALESCE(SUM(size), 0),"
+                               " COALESCE(SUM(dead_bytes), 0) FROM packs")
+        (packs, size, dead_bytes) = backend.cursor.fetchone()
+        backend.cursor.execute("SELECT COUNT(*) FROM shares")
+        (shares,) = backend.cursor.fetchone()
+        self.failUnlessEqual((stats["packs"], stats["pack_bytes"],
+                              stats["dead_bytes"], stats["packed_shares"]),
+                             (packs, size, dead_bytes, shares))
+        return stats
+
+    def test_compaction(self):
+        ss = self.create("test_compaction")
+        backend = ss.backend
+        backend.PACK_SIZE = 250 # three shares per pack
+        for i in range(6):
+            self.write_immutable(ss, "si%d" % i, [0], chr(ord("a")+i)*100)
+        self.failUnlessEqual(self.check_stats(backend)["packs"], 2)
+        reader = ss.remote_get_buckets("si2")[0]
+        self.failUnlessEqual(reader.remote_read(0, 10), "c"*10)
+
+        def delete(si):
+            ss.forget_bucket(si)
+            backend.delete_share(si, 0)
+        delete("si0")
+        self.failUnlessEqual(self.check_stats(backend)["dead_bytes"], 100)
+        self.failUnlessEqual(backend.compactions, 0)
+        delete("si1")
+        # now two thirds of the first pack are dead, but it is copied in a
+        # worker thread, and can still be read in the meantime
+        self.failUnlessEqual(backend.compactions, 0)
+        self.failUnlessEqual(reader.remote_read(0, 10), "c"*10)
+        d = self.poll(lambda: backend.compactions == 1)
+        def _compacted(ign):
+            stats = self.check_stats(backend)
+            self.failUnlessEqual((stats["packs"], stats["dead_bytes"],
+                                  stats["pack_bytes"], stats["packed_shares"]),
+                                 (2, 0, 400, 4))
+            self.failUnlessEqual(ss.remote_get_sharenums(["si0", "si1", "si2"]),
+                                 {"si2": set([0])})
+            # readers follow their share to its new pack
+            self.failUnlessEqual(reader.remote_read(0, 200), "c"*100)
+            for i in range(3, 6):
+                r = ss.remote_get_buckets("si%d" % i)[0]
+                self.failUnlessEqual(r.remote_read(0, 200),
+                                     chr(ord("a")+i)*100)
+
+            # a pack whose shares are all deleted is simply removed
+            delete("si2")
+            return self.poll(lambda: backend.compactions == 2)
+        d.addCallback(_compacted)
+        def _removed(ign):
+            self.failUnlessEqual(self.check_stats(backend)["packs"], 1)
+            self.failUnlessEqual(len([fn for fn in os.listdir(backend.packdir)
+                                      if fn.startswith("pack-")]), 1)
+
+            # shares deleted while their pack is being copied are dead in
+            # the new pack
+            delete("si3")
+            delete("si4")
+            self.failUnlessEqual(backend.compactions, 2)
+            delete("si5")
+            return self.poll(lambda: backend.compactions == 3)
+        d.addCallback(_removed)
+        def _check_deleted_during_copy(ign):
+            stats = self.check_stats(backend)
+            self.failUnlessEqual((stats["packs"], stats["packed_shares"]),
+                                 (0, 0))
+            self.failUnlessEqual(self.list_packs(backend), [])
+        d.addCallback(_check_deleted_during_copy)
+        return d
+
+    def test_stop_while_compacting(self):
+        ss = self.create("test_stop_while_compacting")
+        backend = ss.backend
+        backend.PACK_SIZE = 250
+        for i in range(3):
+            self.write_immutable(ss, "si%d" % i, [0], chr(ord("a")+i)*100)
+        for si in ["si0", "si1"]:
+            ss.forget_bucket(si)
+            backend.delete_share(si, 0)
+        d = ss.disownServiceParent()
+        def _restart(ign):
+            # the copy was thrown away, and the old pack is still in use
+            self.failUnlessEqual(backend.compactions, 0)
+            self.failUnlessEqual(self.list_packs(backend), ["pack-1"])
+            ss2 = self.create("test_stop_while_compacting")
+            reader = ss2.remote_get_buckets("si2")[0]
+            self.failUnlessEqual(reader.remote_read(0, 100), "c"*100)
+            self.failUnlessEqual(ss2.backend.get_stats()["dead_bytes"], 200)
+        d.addCallback(_restart)
+        return d
+
+    def test_orphaned_pack(self):
+        ss = self.create("test_orphaned_pack")
+        self.write_immutable(ss, "si1", [0], "a"*100)
+        packdir = ss.backend.packdir
+        fileutil.write(os.path.join(packdir, "pack-99"), "partial")
+        fileutil.write(os.path.join(packdir, "compacting-1"), "partial")
+        d = ss.disownServiceParent()
+        def _restart(ign):
+            ss2 = self.create("test_orphaned_pack")
+            self.failIf(os.path.exists(os.path.join(packdir, "pack-99")))
+            self.failIf(os.path.exists(os.path.join(packdir, "compacting-1")))
+            reader = ss2.remote_get_buckets("si1")[0]
+            self.failUnlessEqual(reader.remote_read(0, 100), "a"*100)
+        d.addCallback(_restart)
+        return d
+
+    def test_expire(self):
+        ss = self.create("test_expire", start=False,
+                         expiration_enabled=True,
+                         expiration_mode="age",
+                         expiration_override_lease_duration=2000,
+                         expiration_indexed=True)
+        lc = ss.lease_checker
+        lc.slow_start = 0
+        self.write_immutable(ss, "si0", [0, 1], "a"*100, tag="0")
+        self.write_immutable(ss, "si1", [0], "b"*100, tag="1")
+        ss.leasedb.cursor.execute("UPDATE leases SET expiration_time=?"
+                                  " WHERE storage_index=?",
+                                  (int(time.time()) - 1000,
+                                   base32.b2a("si0")))
+        ss.leasedb.connection.commit()
+        # the leasedb crawler must not mistake packed shares for missing ones
+        ldbc = ss.leasedb_crawler
+        ldbc.slow_start = 0
+        ss.setServiceParent(self.s)
+        def _wait():
+            return bool(lc.get_state()["last-cycle-finished"] is not None
+                        and ldbc.get_state()["last-cycle"] is not None)
+        d = self.poll(_wait)
+        def _check(ign):
+            self.failUnlessEqual(ss.remote_get_sharenums(["si0", "si1"]),
+                                 {"si1": set([0])})
+            self.failUnlessEqual(ss.leasedb.get_shares("si1"),
+                                 {0: "immutable"})
+            rec = lc.get_state()["history"][0]["space-recovered"]
+            self.failUnlessEqual(rec["actual-shares"], 2)
+            self.failUnlessEqual(rec["actual-sharebytes"], 200)
+            self.failUnlessEqual(ldbc.get_state()["last-cycle"]
+                                 ["removed-shares"], 0)
+        d.addCallback(_check)
+        return d
+
 def remove_tags(s):
     s = re.sub(r'<[^>]*>', ' ', s)
     s = re.sub(r'\s+', ' ', s)
@@ -3193,6 +5277,11 @@ class LeaseCrawler(unittest.TestCase, pollmixin.PollMixin, WebRenderingMixin):
             self.failIfEqual(sr2["actual-shares"], None)
             self.failIfEqual(sr2["configured-diskbytes"], None)
             self.failIfEqual(sr2["original-sharebytes"], None)
+            # only the values that were touched have been written out, but
+            # those were all that changed
+            saved = CrawlerStateStore(lc.statefile).get_state()
+            self.failUnlessEqual(saved["cycle-to-date"],
+                                 lc.state["cycle-to-date"])
         d.addCallback(_after_first_bucket)
         d.addCallback(lambda ign: self.render1(webstatus))
         def _check_html_in_cycle(html):
@@ -3759,6 +5848,24 @@ class LeaseCrawler(unittest.TestCase, pollmixin.PollMixin, WebRenderingMixin):
         d.addCallback(_check)
         return d
 
+    def test_legacy_history(self):
+        basedir = "storage/LeaseCrawler/legacy_history"
+        fileutil.make_dirs(basedir)
+        # older versions pickled the history of the last ten cycles
+        history = dict([(cycle, {"cycle-start-finish-times": (cycle, cycle+1)})
+                        for cycle in range(5)])
+        historyfile = os.path.join(basedir, "lease_checker.history")
+        f = open(historyfile, "wb")
+        pickle.dump(history, f)
+        f.close()
+
+        ss = StorageServer(basedir, "\x00" * 20)
+        lc = ss.lease_checker
+        self.failUnlessEqual(lc.get_state()["history"], history)
+        lc.history_store.add_history(5, {}, 3)
+        self.failUnlessEqual(sorted(lc.get_state()["history"].keys()),
+                             [3, 4, 5])
+
     def test_unpredictable_future(self):
         basedir = "storage/LeaseCrawler/unpredictable_future"
         fileutil.make_dirs(basedir)
@@ -3962,6 +6069,52 @@ class LeaseCrawler(unittest.TestCase, pollmixin.PollMixin, WebRenderingMixin):
         d.addBoth(_cleanup)
         return d
 
+    def test_threaded(self):
+        self._poll_should_ignore_these_errors = [
+            UnknownMutableContainerVersionError,
+            UnknownImmutableContainerVersionError,
+            ]
+        basedir = "storage/LeaseCrawler/threaded"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, "\x00" * 20, crawler_threads=3)
+        lc = ss.lease_checker
+        self.failUnlessEqual(lc.threads, 3)
+        self.failUnlessEqual(ss.bucket_counter.threads, 3)
+        lc.slow_start = 0
+        self.make_shares(ss)
+
+        # corrupt the first share, which the worker threads should notice
+        first = min(self.sis)
+        first_b32 = base32.b2a(first)
+        fn = os.path.join(ss.sharedir, storage_index_to_dir(first), "0")
+        f = open(fn, "rb+")
+        f.write("BAD MAGIC")
+        f.close()
+
+        ss.setServiceParent(self.s)
+
+        def _wait():
+            return bool(lc.get_state()["last-cycle-finished"] is not None)
+        d = self.poll(_wait)
+        def _after_first_cycle(ignored):
+            s = lc.get_state()
+            last = s["history"][0]
+            self.failUnlessEqual(last["leases-per-share-histogram"], {2: 2,
+                                                                      1: 1})
+            self.failUnlessEqual(last["corrupt-shares"], [(first_b32, 0)])
+            rec = last["space-recovered"]
+            self.failUnlessEqual(rec["examined-buckets"], 4)
+            self.failUnlessEqual(rec["examined-shares"], 3)
+            self.failUnlessEqual(rec["actual-shares"], 0)
+        d.addCallback(_after_first_cycle)
+        def _cleanup(res):
+            errors = self.flushLoggedErrors(UnknownMutableContainerVersionError,
+                                            UnknownImmutableContainerVersionError)
+            self.failUnlessEqual(len(errors), 1)
+            return res
+        d.addCallback(_cleanup)
+        return d
+
     def render_json(self, page):
         d = self.render1(page, args={"t": ["json"]})
         return d
@@ -3985,6 +6138,8 @@ class WebStatus(unittest.TestCase, pollmixin.PollMixin, WebRenderingMixin):
         nodeid = "\x00" * 20
         ss = StorageServer(basedir, nodeid)
         ss.setServiceParent(self.s)
+        ss.add_latency("read", 0.5)
+        ss.add_latency("read", 0.25)
         w = StorageStatus(ss, "nickname")
         d = self.render1(w)
         def _check_html(html):
@@ -4003,6 +6158,45 @@ class WebStatus(unittest.TestCase, pollmixin.PollMixin, WebRenderingMixin):
             self.failUnlessEqual(s["storage_server.reserved_space"], 0)
             self.failUnlessIn("bucket-counter", data)
             self.failUnlessIn("lease-checker", data)
+            read = data["latencies"]["read"]
+            self.failUnlessEqual(read["window"]["samplesize"], 2)
+            self.failUnlessEqual(read["cumulative"]["samplesize"], 2)
+            self.failUnlessEqual(read["window"]["mean"], 0.375)
+            self.failUnlessEqual([b[2] for b in read["window"]["buckets"]],
+                                 [1, 1])
+            (low, high, count) = read["cumulative"]["buckets"][1]
+            self.failUnless(low <= 0.5 < high, (low, high))
+            self.failIfIn("write", data["latencies"])
+        d.addCallback(_check_json)
+        return d
+
+    def test_scheduler(self):
+        basedir = "storage/WebStatus/scheduler"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, "\x00" * 20, client_ops_per_second=1)
+        ss.setServiceParent(self.s)
+        ss.scheduler.clock = Clock()
+        session = ss.remote_get_client_session(FakeCanary())
+        session.remote_get_sharenums(["si1"])
+        d0 = session.remote_get_sharenums(["si1"])
+        w = StorageStatus(ss)
+        d = self.render1(w)
+        def _check_html(html):
+            s = remove_tags(html)
+            self.failUnlessIn("Client Scheduling", s)
+            self.failUnlessIn("Requests in progress: 0, waiting: 1", s)
+            self.failUnlessIn("Requests made to wait so far: 1", s)
+            self.failUnlessIn("unknown", s)
+        d.addCallback(_check_html)
+        d.addCallback(lambda ign: self.render_json(w))
+        def _check_json(json):
+            data = simplejson.loads(json)
+            self.failUnlessEqual(data["scheduler"]["unknown"]["requests"], 1)
+            self.failUnlessEqual(data["scheduler"]["unknown"]["queued"], 1)
+            s = data["stats"]
+            self.failUnlessEqual(s["storage_server.scheduler.throttled"], 1)
+            ss.scheduler.clock.advance(1)
+            self.failUnlessEqual(d0.result, {})
         d.addCallback(_check_json)
         return d
 
@@ -4010,6 +6204,31 @@ class WebStatus(unittest.TestCase, pollmixin.PollMixin, WebRenderingMixin):
         d = self.render1(page, args={"t": ["json"]})
         return d
 
+    def test_status_allocated_by_client(self):
+        basedir = "storage/WebStatus/status_allocated_by_client"
+        fileutil.make_dirs(basedir)
+        ss = StorageServer(basedir, "\x00" * 20)
+        ss.setServiceParent(self.s)
+        w = StorageStatus(ss)
+        s = remove_tags(w.renderSynchronously())
+        self.failUnlessIn("Space reserved for uploads in progress: none", s)
+
+        rs = hashutil.tagged_hash("renew", "si1")
+        cs = hashutil.tagged_hash("cancel", "si1")
+        a,writers = ss.remote_allocate_buckets("si1", rs, cs, [0,1], 2000,
+                                               FakeCanary(True))
+        s = remove_tags(w.renderSynchronously())
+        self.failUnlessIn("Space reserved for uploads in progress: 4.00 kB"
+                          " (by 1 clients)", s)
+        self.failUnlessIn("unknown: 4.00 kB", s)
+        ss.ALLOCATED_BY_CLIENT_STATS = 0
+        s = remove_tags(w.renderSynchronously())
+        self.failUnlessIn("Space reserved for uploads in progress: 4.00 kB"
+                          " (by 1 clients)", s)
+        self.failUnlessIn("others: 4.00 kB", s)
+        for bw in writers.values():
+            bw.remote_abort()
+
     def test_status_no_disk_stats(self):
         def call_get_disk_stats(whichdir, reserved_space=0):
             raise AttributeError()
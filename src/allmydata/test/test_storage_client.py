@@ -2,9 +2,12 @@ from mock import Mock, patch
 from allmydata.util import base32
 
 from twisted.trial import unittest
-from twisted.internet.defer import succeed, inlineCallbacks
+from twisted.internet.defer import succeed, inlineCallbacks, DeferredList, \
+     Deferred
+from twisted.internet.task import Clock
 
-from allmydata.storage_client import NativeStorageServer
+from allmydata.storage_client import NativeStorageServer, SharenumBatcher, \
+     ServerPerformance, sort_servers_by_score
 from allmydata.storage_client import StorageFarmBroker, ConnectedEnough
 
 
@@ -35,6 +38,116 @@ class TestNativeStorageServer(unittest.TestCase):
             })
         self.failUnlessEqual(nss.get_available_space(), 111)
 
+    def test_get_share_digests(self):
+        nss = NativeStorageServerWithVersion(
+            { "http://allmydata.org/tahoe/protocols/storage/v1":
+                { "provides-share-digests": True,
+                }
+            })
+        nss.rref = Mock()
+        nss.rref.callRemote.return_value = succeed({0: "digest"})
+        d = nss.get_share_digests("si1", [0])
+        d.addCallback(self.failUnlessEqual, {0: "digest"})
+        d.addCallback(lambda ign:
+                      nss.rref.callRemote.assert_called_once_with(
+                          "get_share_digests", "si1", set([0])))
+        return d
+
+    def test_get_share_digests_old(self):
+        nss = NativeStorageServerWithVersion(
+            { "http://allmydata.org/tahoe/protocols/storage/v1": {} })
+        nss.rref = None
+        d = nss.get_share_digests("si1")
+        d.addCallback(self.failUnlessEqual, {})
+        return d
+
+
+class FakeProbedRref:
+    version = {}
+    def __init__(self):
+        self.probes = []
+    def getPeer(self):
+        return None
+    def notifyOnDisconnect(self, cb):
+        pass
+    def callRemote(self, methname):
+        assert methname == "get_version"
+        d = Deferred()
+        self.probes.append(d)
+        return d
+
+
+class TestProbes(unittest.TestCase):
+    def _make_server(self, probe_interval, key):
+        ann = {"anonymous-storage-FURL": "pb://%s@nowhere/fake"
+                                         % base32.b2a(key),
+               "permutation-seed-base32": base32.b2a(key) }
+        s = NativeStorageServer(key, ann, probe_interval=probe_interval)
+        s.clock = Clock()
+        rref = FakeProbedRref()
+        s._got_versioned_service(rref, None)
+        return (s, rref)
+
+    def test_probes(self):
+        (s, rref) = self._make_server(10, "a")
+        self.failUnlessEqual(s.get_liveness(), "unknown")
+        self.failUnless(s.is_responsive())
+        s.clock.advance(10)
+        self.failUnlessEqual(len(rref.probes), 1)
+        s.clock.advance(0.5)
+        rref.probes[0].callback({})
+        self.failUnlessEqual(s.get_liveness(), "alive")
+        self.failUnlessEqual(s.get_last_probe_rtt(), 0.5)
+        self.failUnlessEqual(s.get_performance().rtt, 0.5)
+
+        # a probe that is still unanswered when the next one is due is
+        # missed, and no new probe is sent until it is answered
+        s.clock.advance(9.5)
+        self.failUnlessEqual(len(rref.probes), 2)
+        s.clock.advance(10)
+        self.failUnlessEqual(len(rref.probes), 2)
+        self.failUnlessEqual(s.get_liveness(), "unresponsive")
+        self.failIf(s.is_responsive())
+        rref.probes[1].callback({})
+        self.failUnlessEqual(s.get_liveness(), "alive")
+        self.failUnlessEqual(s.get_connection_stats()["probes_missed"], 1)
+        self.failUnlessEqual(s.get_connection_stats()["probes_sent"], 2)
+
+        s._lost()
+        self.failUnlessEqual(s.get_liveness(), "unknown")
+        self.failIf(s.clock.getDelayedCalls())
+
+    def test_no_probes(self):
+        (s, rref) = self._make_server(0, "a")
+        s.clock.advance(100)
+        self.failUnlessEqual(rref.probes, [])
+        self.failUnlessEqual(s.get_liveness(), "unknown")
+        self.failIf(s.clock.getDelayedCalls())
+
+    def test_demoted(self):
+        sb = StorageFarmBroker(True)
+        servers = {}
+        for k in ["%d" % i for i in range(5)]:
+            (servers[k], rref) = self._make_server(10, k)
+            sb.test_add_server(k, servers[k])
+        def _permuted():
+            return [s.get_longname() for s in sb.get_servers_for_psi("one")]
+        order = _permuted()
+        self.failUnlessEqual(len(order), 5)
+        first = order[0]
+        # every server misses a probe, and all but the first answer
+        for s in servers.values():
+            s.clock.advance(10)
+            s.clock.advance(10)
+            if s.get_longname() != first:
+                s.rref.probes[0].callback({})
+        self.failUnlessEqual(_permuted(), order[1:] + [first])
+        self.failUnlessEqual([s.get_longname()
+                              for s in sb.iter_servers_for_psi("one")],
+                             order[1:] + [first])
+        for s in servers.values():
+            s._lost()
+
 
 class TestStorageFarmBroker(unittest.TestCase):
 
@@ -64,7 +177,8 @@ class TestStorageFarmBroker(unittest.TestCase):
                 self.assertEqual(tub.mock_calls[-1][0], 'connectTo')
                 got_connection = tub.mock_calls[-1][1][1]
             rref = Mock()
-            rref.callRemote = Mock(return_value=succeed(1234))
+            # the server's (empty) version dictionary
+            rref.callRemote = Mock(return_value=succeed({}))
             got_connection(rref)
 
         # first 4 shouldn't trigger connected_threashold
@@ -86,3 +200,126 @@ class TestStorageFarmBroker(unittest.TestCase):
 
         yield done
         self.assertTrue(done.called)
+
+
+class FakeSharenumServer:
+    def __init__(self, version, shares):
+        self.version = version
+        self.shares = shares # storage_index -> set(shnum)
+        self.calls = []
+    def get_rref(self):
+        return self
+    def get_version(self):
+        return self.version
+    def callRemote(self, methname, *args):
+        self.calls.append((methname, args))
+        if methname == "get_buckets":
+            return succeed(dict([(shnum, None)
+                                 for shnum in self.shares.get(args[0], ())]))
+        assert methname == "get_sharenums"
+        (storage_indexes,) = args
+        return succeed(dict([(si, self.shares[si])
+                             for si in storage_indexes if si in self.shares]))
+
+
+class TestSharenumBatcher(unittest.TestCase):
+    V1 = "http://allmydata.org/tahoe/protocols/storage/v1"
+
+    def _query(self, server, storage_indexes, window=0.01):
+        clock = Clock()
+        batcher = SharenumBatcher(server, window, clock)
+        results = {}
+        for si in storage_indexes:
+            d = batcher.get_sharenums(si)
+            d.addCallback(lambda res, si=si: results.setdefault(si, []).append(res))
+        self.failUnlessEqual(server.calls, [])
+        clock.advance(window)
+        return results
+
+    def test_batched(self):
+        server = FakeSharenumServer({self.V1:
+                                     {"maximum-get-sharenums-batch": 2}},
+                                    {"si1": set([0, 1]), "si3": set([2])})
+        results = self._query(server, ["si1", "si2", "si3", "si1"])
+        self.failUnlessEqual(results, {"si1": [set([0, 1]), set([0, 1])],
+                                       "si2": [set()],
+                                       "si3": [set([2])]})
+        self.failUnlessEqual(server.calls,
+                             [("get_sharenums", (["si1", "si2"],)),
+                              ("get_sharenums", (["si3"],))])
+
+    def test_old_server(self):
+        server = FakeSharenumServer({self.V1: {}}, {"si1": set([0, 1])})
+        results = self._query(server, ["si1", "si2"])
+        self.failUnlessEqual(results, {"si1": [set([0, 1])],
+                                       "si2": [set()]})
+        self.failUnlessEqual(server.calls, [("get_buckets", ("si1",)),
+                                            ("get_buckets", ("si2",))])
+
+    def test_failure(self):
+        server = FakeSharenumServer({self.V1:
+                                     {"maximum-get-sharenums-batch": 10}},
+                                    {})
+        server.get_rref = lambda: None # not connected
+        clock = Clock()
+        batcher = SharenumBatcher(server, 0.01, clock)
+        d1 = batcher.get_sharenums("si1")
+        d2 = batcher.get_sharenums("si2")
+        clock.advance(0.01)
+        self.assertFailure(d1, AttributeError)
+        self.assertFailure(d2, AttributeError)
+        return DeferredList([d1, d2])
+
+
+class FakePerformanceServer:
+    def __init__(self, name, rtt=None):
+        self.name = name
+        self.performance = ServerPerformance()
+        if rtt is not None:
+            self.performance.record_rtt(rtt)
+    def get_performance(self):
+        return self.performance
+    def __repr__(self):
+        return self.name
+
+
+class TestServerPerformance(unittest.TestCase):
+    def test_averages(self):
+        p = ServerPerformance()
+        self.failUnlessEqual(p.estimate(), None)
+        p.record_rtt(1.0)
+        self.failUnlessEqual(p.rtt, 1.0)
+        p.record_rtt(2.0)
+        self.failUnlessAlmostEqual(p.rtt, 1.2)
+        # small transfers are timed as round trips
+        p.record_transfer(100, 2.0)
+        self.failUnlessAlmostEqual(p.rtt, 1.36)
+        self.failUnlessEqual(p.throughput, None)
+        p.record_transfer(100000, 0.5)
+        self.failUnlessEqual(p.throughput, 200000)
+        p.record_transfer(200000, 0.5)
+        self.failUnlessAlmostEqual(p.throughput, 240000)
+        self.failUnlessAlmostEqual(p.estimate(), 1.36)
+        self.failUnlessAlmostEqual(p.estimate(24000), 1.46)
+        self.failUnlessEqual(p.get_stats(), {"rtt": p.rtt,
+                                             "throughput": p.throughput,
+                                             "rtt_samples": 3,
+                                             "transfer_samples": 2})
+
+    def test_sort(self):
+        slow = FakePerformanceServer("slow", 1.0)
+        fast = FakePerformanceServer("fast", 0.11)
+        fast2 = FakePerformanceServer("fast2", 0.15)
+        local1 = FakePerformanceServer("local1", 0.001)
+        local2 = FakePerformanceServer("local2", 0.02)
+        new = FakePerformanceServer("new")
+        # servers in the same band keep their order, and servers we know
+        # nothing about go last
+        self.failUnlessEqual(sort_servers_by_score([new, slow, fast2, local2,
+                                                    fast, local1]),
+                             [local2, local1, fast2, fast, slow, new])
+        sb = StorageFarmBroker(True)
+        self.failUnlessEqual(sb.sort_servers_by_score([slow, new, local1]),
+                             [local1, slow, new])
+        self.failUnlessEqual(sb.get_server_score(slow), 1.0)
+        self.failUnlessEqual(sb.get_server_score(new), None)
@@ -5,13 +5,15 @@ from cStringIO import StringIO
 from twisted.trial import unittest
 from twisted.python.failure import Failure
 from twisted.internet import defer
-from foolscap.api import fireEventually
+from foolscap.api import fireEventually, flushEventualQueue
 
 import allmydata # for __full_version__
 from allmydata import uri, monitor, client
 from allmydata.immutable import upload, encode
+from allmydata.immutable.keycache import ConvergenceKeyCache, \
+     get_file_identity
 from allmydata.interfaces import FileTooLargeError, UploadUnhappinessError
-from allmydata.util import log, base32
+from allmydata.util import log, base32, fileutil, hashutil
 from allmydata.util.assertutil import precondition
 from allmydata.util.deferredutil import DeferredListShouldSucceed
 from allmydata.test.no_network import GridTestMixin
@@ -32,7 +34,7 @@ def extract_uri(results):
 # to screw up subsequent tests.
 timeout = 960
 
-class Uploadable(unittest.TestCase):
+class Uploadable(unittest.TestCase, ShouldFailMixin):
     def shouldEqual(self, data, expected):
         self.failUnless(isinstance(data, list))
         for e in data:
@@ -88,6 +90,87 @@ class Uploadable(unittest.TestCase):
         d.addCallback(lambda res: u.close())
         return d
 
+    def _get_key(self, u, params):
+        u.set_default_encoding_parameters(params)
+        return u.get_encryption_key()
+
+    def test_key_hasher(self):
+        data = "a"*1000
+        params = FakeClient.DEFAULT_ENCODING_PARAMETERS
+        keys = []
+        def _make(hasher_params, convergence):
+            hasher = upload.ConvergentKeyHasher(len(data), hasher_params,
+                                                convergence)
+            hasher.update(data)
+            # a closed file cannot be read, so the key must come from the
+            # hasher
+            s = StringIO(data)
+            s.close()
+            u = upload.FileHandle(s, convergence="convergence")
+            u.set_key_hasher(hasher)
+            u._size = len(data)
+            return u
+        d = self._get_key(upload.Data(data, convergence="convergence"), params)
+        d.addCallback(keys.append)
+        d.addCallback(lambda ign:
+                      self._get_key(_make(params, "convergence"), params))
+        d.addCallback(lambda key: self.failUnlessEqual(key, keys[0]))
+        # if the upload uses other parameters, the hasher cannot help
+        other = dict(params, k=4)
+        d.addCallback(lambda ign:
+                      self.shouldFail(ValueError, "k", None, self._get_key,
+                                      _make(other, "convergence"), params))
+        d.addCallback(lambda ign:
+                      self.shouldFail(ValueError, "convergence", None,
+                                      self._get_key,
+                                      _make(params, "other"), params))
+        return d
+
+    def test_key_cache(self):
+        basedir = "upload/Uploadable/test_key_cache"
+        os.makedirs(basedir)
+        fn = os.path.join(basedir, "file")
+        fileutil.write(fn, "a"*1000)
+        cache = ConvergenceKeyCache(os.path.join(basedir, "keys.sqlite"))
+        params = FakeClient.DEFAULT_ENCODING_PARAMETERS
+        (k, n) = (params["k"], params["n"])
+        segsize = upload.get_segment_size(params["max_segment_size"], k, 1000)
+        def _make(convergence="convergence"):
+            u = upload.FileName(fn, convergence=convergence)
+            u.set_key_cache(cache)
+            return u
+        u1 = _make()
+        d = self._get_key(u1, params)
+        def _check_recorded(key):
+            identity = get_file_identity(u1._filehandle)
+            self.failUnlessEqual(cache.get_key(os.path.abspath(fn), identity,
+                                               k, n, segsize, "convergence"),
+                                 (key, hashutil.storage_index_hash(key)))
+            u1.close()
+            # if the file has not changed, its key comes from the cache
+            # and not from its contents
+            cache.set_key(os.path.abspath(fn), identity,
+                          k, n, segsize, "convergence",
+                          "fake key 16bytes", "fake si 16 bytes")
+            return self._get_key(_make(), params)
+        d.addCallback(_check_recorded)
+        d.addCallback(self.failUnlessEqual, "fake key 16bytes")
+        # but not with a different convergence secret
+        d.addCallback(lambda ign: self._get_key(_make("other"), params))
+        d.addCallback(self.failIfEqual, "fake key 16bytes")
+        # and not once the file has changed
+        def _change(ign):
+            fileutil.write(fn, "b"*999)
+            return self._get_key(_make(), params)
+        d.addCallback(_change)
+        def _check_changed(key):
+            expected = upload.Data("b"*999, convergence="convergence")
+            d2 = self._get_key(expected, params)
+            d2.addCallback(self.failUnlessEqual, key)
+            return d2
+        d.addCallback(_check_changed)
+        return d
+
 class ServerError(Exception):
     pass
 
@@ -104,6 +187,7 @@ class FakeStorageServer:
     def __init__(self, mode):
         self.mode = mode
         self.allocated = []
+        self.writers = []
         self.queries = 0
         self.version = { "http://allmydata.org/tahoe/protocols/storage/v1" :
                          { "maximum-immutable-share-size": 2**32 - 1 },
@@ -141,10 +225,13 @@ class FakeStorageServer:
         else:
             for shnum in sharenums:
                 self.allocated.append( (storage_index, shnum) )
-            return (set(),
-                    dict([( shnum, FakeBucketWriter(share_size) )
-                          for shnum in sharenums]),
-                    )
+            klass = FakeBucketWriter
+            if self.mode == "hold":
+                klass = HoldingBucketWriter
+            writers = dict([( shnum, klass(share_size) )
+                            for shnum in sharenums])
+            self.writers.extend(writers.values())
+            return (set(), writers)
 
 class FakeBucketWriter:
     # a diagnostic version of storageserver.BucketWriter
@@ -184,6 +271,33 @@ class FakeBucketWriter:
     def remote_abort(self):
         pass
 
+class HoldingBucketWriter(FakeBucketWriter):
+    # a FakeBucketWriter which does not answer writes after the share header
+    # (the blocks, to begin with) until the test fires their Deferreds
+    HEADER_SIZE = 0x24
+
+    def __init__(self, size):
+        FakeBucketWriter.__init__(self, size)
+        self.holding = True
+        self.held = []
+        self.held_writes = 0
+
+    def remote_write(self, offset, data):
+        FakeBucketWriter.remote_write(self, offset, data)
+        if not self.holding or offset < self.HEADER_SIZE:
+            return None
+        d = defer.Deferred()
+        self.held.append(d)
+        self.held_writes += 1
+        return d
+
+    def release(self, count=None):
+        if count is None:
+            self.holding = False
+            count = len(self.held)
+        for i in range(count):
+            self.held.pop(0).callback(None)
+
 class FakeClient:
     DEFAULT_ENCODING_PARAMETERS = {"k":25,
                                    "happy": 25,
@@ -324,6 +438,118 @@ class GoodServer(unittest.TestCase, ShouldFailMixin, SetDEPMixin):
         d.addCallback(self._check_large, SIZE_LARGE)
         return d
 
+    def _get_writers(self):
+        writers = []
+        for s in self.node.storage_broker.get_known_servers():
+            writers.extend(s.get_rref().writers)
+        return writers
+
+    def test_pipeline_depth(self):
+        # each server may have pipeline_depth blocks in flight before the
+        # encoder waits for it, and no more
+        self.node = FakeClient(mode="hold")
+        self.u = upload.Uploader(pipeline_depth=3)
+        self.u.running = True
+        self.u.parent = self.node
+        self.set_encoding_parameters(3, 7, 10, max_segsize=600)
+        data = DATA * 50 # about 20 segments
+        uploaded = upload_data(self.u, data)
+        d = flushEventualQueue()
+        def _stalled(ign):
+            writers = self._get_writers()
+            self.failUnlessEqual(len(writers), 10)
+            self.failUnlessEqual([w.held_writes for w in writers], [3]*10)
+            # the encoder waits for the slowest server
+            writers[0].release(1)
+            d2 = flushEventualQueue()
+            def _still_stalled(ign):
+                self.failUnlessEqual([w.held_writes for w in writers],
+                                     [3]*10)
+                for w in writers[1:]:
+                    w.release(1)
+                return flushEventualQueue()
+            d2.addCallback(_still_stalled)
+            def _one_more_segment(ign):
+                self.failUnlessEqual([w.held_writes for w in writers],
+                                     [4]*10)
+                self.failUnlessEqual([len(w.held) for w in writers], [3]*10)
+                for w in writers:
+                    w.release()
+            d2.addCallback(_one_more_segment)
+            return d2
+        d.addCallback(_stalled)
+        d.addCallback(lambda ign: uploaded)
+        d.addCallback(extract_uri)
+        d.addCallback(self._check_large, len(data))
+        def _check(ign):
+            writers = self._get_writers()
+            for w in writers:
+                self.failUnless(w.closed)
+        d.addCallback(_check)
+        return d
+
+    def test_pipeline_size(self):
+        server = list(self.node.storage_broker.get_known_servers())[0]
+        def _make_tracker(pipeline_depth):
+            t = upload.ServerTracker(server, 4000, 200, 20, 4, "si" * 8,
+                                     "renew", "cancel", pipeline_depth)
+            t._got_reply((set(), {0: FakeBucketWriter(t.allocated_size)}))
+            return t.buckets[0]
+        # each bucket writer may have four blocks in flight
+        self.failUnlessEqual(_make_tracker(4)._pipeline.capacity, 800)
+        self.failUnlessEqual(_make_tracker(None)._pipeline.capacity, 50000)
+
+    def test_encoding_threads(self):
+        # a file uploaded with worker threads must come out exactly the same
+        # as one uploaded without them: that checks that the segments were
+        # hashed and encoded in order
+        self.set_encoding_parameters(3, 7, 10, max_segsize=600)
+        data = DATA * 50 # about 20 segments, and a short tail
+        threaded = upload.Uploader(encoding_threads=2)
+        threaded.running = True
+        threaded.parent = self.node
+        self.addCleanup(threaded.stopService)
+        uris = []
+        d = self.u.upload(upload.Data(data, convergence="secret"))
+        d.addCallback(extract_uri)
+        d.addCallback(uris.append)
+        d.addCallback(lambda ign:
+                      threaded.upload(upload.Data(data, convergence="secret")))
+        d.addCallback(extract_uri)
+        d.addCallback(uris.append)
+        def _check(ign):
+            self._check_large(uris[1], len(data))
+            self.failUnlessEqual(uris[0], uris[1])
+            self.failUnless(threaded._worker_pool._pool)
+        d.addCallback(_check)
+        return d
+
+    def test_key_cache(self):
+        basedir = "upload/GoodServer/test_key_cache"
+        os.makedirs(basedir)
+        fn = os.path.join(basedir, "file")
+        fileutil.write(fn, DATA)
+        cache = ConvergenceKeyCache(os.path.join(basedir, "keys.sqlite"))
+        self.u = upload.Uploader(key_cache=cache)
+        self.u.running = True
+        self.u.parent = self.node
+        d = self.u.upload(upload.FileName(fn, convergence="secret"))
+        d.addCallback(extract_uri)
+        def _check(newuri):
+            self._check_large(newuri, SIZE_LARGE)
+            u = uri.from_string(newuri)
+            k = self.node.DEFAULT_ENCODING_PARAMETERS["k"]
+            segsize = upload.get_segment_size(1*MiB, k, SIZE_LARGE)
+            f = open(fn, "rb")
+            identity = get_file_identity(f)
+            f.close()
+            self.failUnlessEqual(cache.get_key(os.path.abspath(fn), identity,
+                                               k, u.total_shares, segsize,
+                                               "secret"),
+                                 (u.key, u.get_storage_index()))
+        d.addCallback(_check)
+        return d
+
     def test_data_large_odd_segments(self):
         data = self.get_data(SIZE_LARGE)
         segsize = int(SIZE_LARGE / 2.5)
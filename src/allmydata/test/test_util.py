@@ -13,7 +13,7 @@ from pycryptopp.hash.sha256 import SHA256 as _hash
 from allmydata.util import base32, idlib, humanreadable, mathutil, hashutil
 from allmydata.util import assertutil, fileutil, deferredutil, abbreviate
 from allmydata.util import limiter, time_format, pollmixin, cachedir
-from allmydata.util import statistics, dictutil, pipeline
+from allmydata.util import statistics, dictutil, pipeline, histogram
 from allmydata.util import log as tahoe_log
 from allmydata.util.spans import Spans, overlap, DataSpans
 from allmydata.test.common_util import ReallyEqualMixin, TimezoneMixin
@@ -350,6 +350,86 @@ class Statistics(unittest.TestCase):
         self.failUnlessEqual(f(plist, .5, 3), .02734375)
 
 
+class Histogram(unittest.TestCase):
+    def test_buckets(self):
+        for value in [0.0, 1e-9, 1e-6, 0.001, 0.5, 1.0, 3.14159, 1000.0,
+                      60000.0, 1e9]:
+            bucket = histogram.get_bucket(value)
+            self.failUnless(0 <= bucket < histogram.NUM_BUCKETS, value)
+            (low, high) = histogram.get_bucket_range(bucket)
+            if 1e-6 <= value <= 60000.0:
+                self.failUnless(low <= value < high, (value, low, high))
+                self.failUnless(high - low <= value / 64, (value, low, high))
+        self.failUnlessEqual(histogram.get_bucket(0.0), 0)
+        self.failUnlessEqual(histogram.get_bucket(1e-9), 0)
+        self.failUnlessEqual(histogram.get_bucket(1e9),
+                             histogram.NUM_BUCKETS - 1)
+
+    def test_percentiles(self):
+        h = histogram.Histogram()
+        self.failUnlessEqual(h.get_percentile(0.5), None)
+        self.failUnlessEqual(h.summarize()["mean"], None)
+        for i in range(1, 1001):
+            h.add(i / 1000.0)
+        self.failUnlessEqual(h.count, 1000)
+        self.failUnlessEqual((h.min, h.max), (0.001, 1.0))
+        self.failUnlessAlmostEqual(h.sum, 500.5)
+        for fraction in [0.01, 0.1, 0.5, 0.9, 0.99]:
+            expected = (int(fraction * 1000) + 1) / 1000.0
+            p = h.get_percentile(fraction)
+            self.failUnless(abs(p - expected) <= expected / 200,
+                            (fraction, p, expected))
+        # the extremes are exact
+        self.failUnlessEqual(h.get_percentile(0.0), 0.001)
+        self.failUnlessEqual(h.get_percentile(1.0), 1.0)
+        self.failUnlessEqual(sum([b[2] for b in h.get_buckets()]), 1000)
+        # memory is bounded by the number of buckets, not samples
+        for i in range(10000):
+            h.add(0.5)
+        self.failUnless(len(h.buckets) <= 1000, len(h.buckets))
+
+        summary = h.summarize()
+        self.failUnlessEqual(summary["samplesize"], 11000)
+        self.failUnlessEqual(summary["99_9_percentile"],
+                             h.get_percentile(0.999))
+
+        few = histogram.Histogram()
+        for i in range(10):
+            few.add(1.0)
+        summary = few.summarize()
+        self.failUnlessEqual(summary["50_0_percentile"], 1.0)
+        self.failUnlessEqual(summary["01_0_percentile"], None)
+        self.failUnlessEqual(summary["99_9_percentile"], None)
+
+    def test_merge(self):
+        a = histogram.Histogram()
+        b = histogram.Histogram()
+        both = histogram.Histogram()
+        for i in range(100):
+            a.add(i * 0.01)
+            both.add(i * 0.01)
+            b.add(i * 3.0)
+            both.add(i * 3.0)
+        a.merge(b)
+        self.failUnlessEqual(a.buckets, both.buckets)
+        self.failUnlessEqual((a.count, a.min, a.max),
+                             (both.count, both.min, both.max))
+        a.merge(histogram.Histogram())
+        self.failUnlessEqual(a.count, 200)
+
+    def test_window(self):
+        wh = histogram.WindowedHistogram(window=100, slots=5)
+        for t in range(0, 200, 10):
+            wh.add(float(t), now=t)
+        self.failUnlessEqual(wh.cumulative.count, 20)
+        # the window covers the current 20-second slot and the four before
+        # it, so it holds the samples from 100 to 190
+        window = wh.get_window(now=195)
+        self.failUnlessEqual((window.count, window.min, window.max),
+                             (10, 100.0, 190.0))
+        self.failUnlessEqual(wh.get_window(now=1000).count, 0)
+        self.failUnlessEqual(wh.cumulative.count, 20)
+
 class Asserts(unittest.TestCase):
     def should_assert(self, func, *args, **kwargs):
         try:
@@ -18,7 +18,8 @@ from nevow.inevow import IRequest
 
 from allmydata import interfaces, uri, webish, dirnode
 from allmydata.storage.shares import get_share_file
-from allmydata.storage_client import StorageFarmBroker, StubServer
+from allmydata.storage_client import StorageFarmBroker, StubServer, \
+     ServerPerformance
 from allmydata.immutable import upload
 from allmydata.immutable.downloader.status import DownloadStatus
 from allmydata.dirnode import DirectoryNode
@@ -86,6 +87,7 @@ class FakeUploader(service.Service):
     helper_connected = False
 
     def upload(self, uploadable, **kw):
+        self.last_uploadable = uploadable
         d = uploadable.get_size()
         d.addCallback(lambda size: uploadable.read(size))
         def _got_data(datav):
@@ -184,10 +186,16 @@ class FakeDisplayableServer(StubServer):
         self.last_loss_time = last_loss_time
         self.last_rx_time = last_rx_time
         self.last_connect_time = last_connect_time
+        self.performance = ServerPerformance()
+        if connected:
+            self.performance.record_rtt(0.12)
+            self.performance.record_transfer(3000000, 2.0)
     def on_status_changed(self, cb):
         cb(self)
     def is_connected(self):
         return self.connected
+    def get_performance(self):
+        return self.performance
     def get_permutation_seed(self):
         return ""
     def get_remote_host(self):
@@ -234,6 +242,7 @@ class FakeStorageServer(service.MultiService):
         self.nickname = nickname
         self.bucket_counter = FakeBucketCounter()
         self.lease_checker = FakeLeaseChecker()
+        self.scheduler = None
     def get_stats(self):
         return {"storage_server.accepting_immutable_shares": False}
     def on_status_changed(self, cb):
@@ -252,6 +261,7 @@ class FakeClient(Client):
         self._secret_holder = SecretHolder("lease secret", "convergence secret")
         self.helper = None
         self.convergence = "some random string"
+        self.encoding_params = self.DEFAULT_ENCODING_PARAMETERS.copy()
         self.storage_broker = StorageFarmBroker(permute_peers=True)
         # fake knowledge of another server
         self.storage_broker.test_add_server("other_nodeid",
@@ -662,6 +672,10 @@ class Web(WebMixin, WebErrorMixin, testutil.StallMixin, testutil.ReallyEqualMixi
             self.failUnlessIn(u'\u00A9 <a href="https://tahoe-lafs.org/">Tahoe-LAFS Software Foundation', res_u)
             self.failUnlessIn('<td><h3>Available</h3></td>', res)
             self.failUnlessIn('123.5kB', res)
+            self.failUnlessIn('<td><h3>RTT</h3></td>', res)
+            self.failUnlessIn('<td class="service-rtt">120ms</td>', res)
+            self.failUnlessIn('<td class="service-throughput">1.50MBps</td>', res)
+            self.failUnlessIn('<td class="service-rtt">N/A</td>', res)
 
             self.s.basedir = 'web/test_welcome'
             fileutil.make_dirs("web/test_welcome")
@@ -4100,6 +4114,42 @@ class Web(WebMixin, WebErrorMixin, testutil.StallMixin, testutil.ReallyEqualMixi
         d.addCallback(_check2)
         return d
 
+    def _get_key(self, uploadable):
+        uploadable.set_default_encoding_parameters(
+            self.s.get_encoding_parameters())
+        return uploadable.get_encryption_key()
+
+    def test_PUT_NEWFILE_URI_large(self):
+        # a large body is hashed as it arrives, so the upload can find its
+        # key without reading it again: by now it has been closed, so it
+        # could not
+        file_contents = "New file contents here\n" * 10000
+        d = self.PUT("/uri", file_contents)
+        def _check(uri):
+            self.failUnlessReallyEqual(self.get_all_contents()[uri],
+                                       file_contents)
+            uploadable = self.s.uploader.last_uploadable
+            self.failUnless(uploadable._filehandle.closed)
+            return self._get_key(uploadable)
+        d.addCallback(_check)
+        def _check_key(key):
+            d2 = self._get_key(upload.Data(file_contents, self.s.convergence))
+            d2.addCallback(self.failUnlessReallyEqual, key)
+            return d2
+        d.addCallback(_check_key)
+        return d
+
+    def test_PUT_NEWFILE_URI_not_convergent(self):
+        file_contents = "New file contents here\n"
+        d = self.PUT("/uri?convergent=false", file_contents)
+        def _check(uri):
+            self.failUnlessReallyEqual(self.get_all_contents()[uri],
+                                       file_contents)
+            self.failUnlessIdentical(
+                self.s.uploader.last_uploadable.convergence, None)
+        d.addCallback(_check)
+        return d
+
     def test_PUT_NEWFILE_URI_not_mutable(self):
         file_contents = "New file contents here\n"
         d = self.PUT("/uri?mutable=false", file_contents)
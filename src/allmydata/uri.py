@@ -4,7 +4,7 @@ import re
 from zope.interface import implements
 from twisted.python.components import registerAdapter
 
-from allmydata.storage.server import si_a2b, si_b2a
+from allmydata.storage.common import si_a2b, si_b2a
 from allmydata.util import base32, hashutil
 from allmydata.util.assertutil import _assert
 from allmydata.interfaces import IURI, IDirnodeURI, IFileURI, IImmutableFileURI, \
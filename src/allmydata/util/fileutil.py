@@ -230,6 +230,19 @@ def remove_if_possible(f):
     except:
         pass
 
+def fsync_directory(dirname):
+    """Flush the entries of the given directory to disk, so that files which
+    were recently created in it or renamed into it survive a crash. This does
+    nothing on platforms (like Windows) which cannot open a directory."""
+    try:
+        fd = os.open(dirname, os.O_RDONLY)
+    except EnvironmentError:
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
 def du(basedir):
     size = 0
 
@@ -72,6 +72,9 @@ CIPHERTEXT_SEGMENT_TAG = "allmydata_crypttext_segment_v1"
 PLAINTEXT_SEGMENT_TAG = "allmydata_plaintext_segment_v1"
 CONVERGENT_ENCRYPTION_TAG = "allmydata_immutable_content_to_key_with_added_secret_v1+"
 
+# storage servers
+SHARE_DIGEST_TAG = "allmydata_storage_share_data_v1"
+
 CLIENT_RENEWAL_TAG = "allmydata_client_renewal_secret_v1"
 CLIENT_CANCEL_TAG = "allmydata_client_cancel_secret_v1"
 FILE_RENEWAL_TAG = "allmydata_file_renewal_secret_v1"
@@ -130,6 +133,9 @@ def plaintext_segment_hash(data):
 def plaintext_segment_hasher():
     return tagged_hasher(PLAINTEXT_SEGMENT_TAG)
 
+def share_digest_hasher():
+    return tagged_hasher(SHARE_DIGEST_TAG)
+
 KEYLEN = 16
 IVLEN = 16
 
@@ -0,0 +1,168 @@
+import math, time
+
+# Histograms with logarithmically-sized buckets, in the style of
+# HdrHistogram: each power of two is split into SUB_BUCKETS buckets of equal
+# width, so every value is counted in a bucket no wider than 1/SUB_BUCKETS
+# of the value itself, and reporting the middle of that bucket is accurate
+# to within half of that. Memory use depends only on how many different
+# buckets have been used, and never more than NUM_BUCKETS, no matter how
+# many values are added.
+
+SUB_BUCKETS = 128
+MIN_EXPONENT = -19 # 2**-20 seconds is just under a microsecond
+MAX_EXPONENT = 16  # 2**16 seconds is about 18 hours
+# bucket 0 holds zero (and anything smaller than 2**(MIN_EXPONENT-1)),
+# and values too large for the last bucket are counted there
+NUM_BUCKETS = 1 + (MAX_EXPONENT - MIN_EXPONENT + 1) * SUB_BUCKETS
+
+# (fraction, name, minimum number of samples) for the percentiles that
+# summarize() reports. A percentile is only reported (as anything other
+# than None) once there are enough samples to interpret it unambiguously:
+# for example, the 99.9th percentile of fewer than 1000 samples would just
+# be the largest one.
+PERCENTILES = [(0.01, "01_0_percentile", 100),
+               (0.10, "10_0_percentile", 10),
+               (0.50, "50_0_percentile", 10),
+               (0.90, "90_0_percentile", 10),
+               (0.95, "95_0_percentile", 20),
+               (0.99, "99_0_percentile", 100),
+               (0.999, "99_9_percentile", 1000)]
+
+def get_bucket(value):
+    """Return the number of the bucket that 'value' is counted in."""
+    if value <= 0:
+        return 0
+    (mantissa, exponent) = math.frexp(value) # 0.5 <= mantissa < 1
+    if exponent < MIN_EXPONENT:
+        return 0
+    if exponent > MAX_EXPONENT:
+        return NUM_BUCKETS - 1
+    sub = int((mantissa - 0.5) * 2 * SUB_BUCKETS)
+    return 1 + (exponent - MIN_EXPONENT) * SUB_BUCKETS + sub
+
+def get_bucket_range(bucket):
+    """Return the (low, high) bounds of the values counted in 'bucket'."""
+    if bucket == 0:
+        return (0.0, math.ldexp(0.5, MIN_EXPONENT))
+    (exponent, sub) = divmod(bucket - 1, SUB_BUCKETS)
+    exponent += MIN_EXPONENT
+    width = math.ldexp(1.0 / (2 * SUB_BUCKETS), exponent)
+    low = math.ldexp(0.5, exponent) + sub * width
+    return (low, low + width)
+
+
+class Histogram:
+    """I count values (usually latencies, in seconds) in logarithmic
+    buckets, and remember their exact number, sum, minimum, and maximum."""
+
+    def __init__(self):
+        self.buckets = {} # bucket number -> count
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        bucket = get_bucket(value)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """Add all of the values counted by another Histogram to me."""
+        for (bucket, count) in other.buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+        self.count += other.count
+        self.sum += other.sum
+        if other.min is not None and (self.min is None
+                                      or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None
+                                      or other.max > self.max):
+            self.max = other.max
+
+    def get_percentile(self, fraction):
+        """Return (approximately) the value that would be at index
+        int(fraction*count) of a sorted list of all the values I have
+        counted, or None if I am empty."""
+        if not self.count:
+            return None
+        rank = min(int(fraction * self.count), self.count - 1)
+        if rank == 0:
+            return self.min
+        if rank == self.count - 1:
+            return self.max
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen > rank:
+                break
+        (low, high) = get_bucket_range(bucket)
+        # the middle of the bucket can be beyond the smallest or largest value
+        return max(self.min, min(self.max, (low + high) / 2))
+
+    def get_buckets(self):
+        """Return a sorted list of (low, high, count) for each bucket that
+        holds at least one value."""
+        return [get_bucket_range(bucket) + (self.buckets[bucket],)
+                for bucket in sorted(self.buckets)]
+
+    def summarize(self):
+        """Return a dict with the number of values ('samplesize'), their
+        'mean' (or None if there are fewer than two), and each of the
+        percentiles in PERCENTILES (or None if there are too few values to
+        report it)."""
+        summary = {"samplesize": self.count}
+        if self.count > 1:
+            summary["mean"] = self.sum / self.count
+        else:
+            summary["mean"] = None
+        for (fraction, name, minimum) in PERCENTILES:
+            if self.count >= minimum:
+                summary[name] = self.get_percentile(fraction)
+            else:
+                summary[name] = None
+        return summary
+
+
+class WindowedHistogram:
+    """I keep a Histogram of every value added to me since I was created,
+    and another of just the values added in the last 'window' seconds,
+    which I build out of 'slots' smaller Histograms so that old values can
+    be dropped a slot at a time."""
+
+    def __init__(self, window=300, slots=5):
+        self.cumulative = Histogram()
+        self.slot_length = float(window) / slots
+        self.num_slots = slots
+        self._slots = [] # (slot number, Histogram), oldest first
+
+    def add(self, value, now=None):
+        if now is None:
+            now = time.time()
+        self.cumulative.add(value)
+        slot = int(now // self.slot_length)
+        if not self._slots or self._slots[-1][0] != slot:
+            self._slots.append((slot, Histogram()))
+            self._expire(slot)
+        self._slots[-1][1].add(value)
+
+    def _expire(self, current_slot):
+        oldest = current_slot - self.num_slots + 1
+        while self._slots and self._slots[0][0] < oldest:
+            self._slots.pop(0)
+
+    def get_window(self, now=None):
+        """Return a new Histogram of the values added in the last 'window'
+        seconds."""
+        if now is None:
+            now = time.time()
+        self._expire(int(now // self.slot_length))
+        h = Histogram()
+        for (slot, slot_histogram) in self._slots:
+            h.merge(slot_histogram)
+        return h
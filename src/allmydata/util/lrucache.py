@@ -0,0 +1,79 @@
+
+class LRUCache:
+    """I am a dictionary which holds at most 'size' items. Once I am full,
+    adding an item evicts the one that was least recently set or fetched
+    with get(). If 'on_evict' is provided, it is called with the key and
+    value of each evicted item. A size of 0 means I never hold anything, and
+    set() does nothing.
+
+    (collections.OrderedDict would make this simpler, but we still support
+    python2.6)
+    """
+
+    def __init__(self, size, on_evict=None):
+        self.size = size
+        self._on_evict = on_evict
+        self.evictions = 0
+        self._links = {} # key -> [prev, next, key, value]
+        # circular doubly-linked list, most recently used at the end
+        self._root = root = []
+        root[:] = [root, root, None, None]
+
+    def __len__(self):
+        return len(self._links)
+
+    def __contains__(self, key):
+        return key in self._links
+
+    def keys(self):
+        return self._links.keys()
+
+    def get(self, key, default=None):
+        link = self._links.get(key)
+        if link is None:
+            return default
+        self._unlink(link)
+        self._append(link)
+        return link[3]
+
+    def set(self, key, value):
+        if self.size <= 0:
+            return
+        link = self._links.get(key)
+        if link is not None:
+            self._unlink(link)
+            link[3] = value
+        else:
+            link = [None, None, key, value]
+            self._links[key] = link
+        self._append(link)
+        while len(self._links) > self.size:
+            oldest = self._root[1]
+            self.pop(oldest[2])
+            self.evictions += 1
+            if self._on_evict:
+                self._on_evict(oldest[2], oldest[3])
+
+    def pop(self, key, default=None):
+        link = self._links.pop(key, None)
+        if link is None:
+            return default
+        self._unlink(link)
+        return link[3]
+
+    def clear(self):
+        self._links.clear()
+        root = self._root
+        root[:] = [root, root, None, None]
+
+    def _unlink(self, link):
+        prev, next = link[0], link[1]
+        prev[1] = next
+        next[0] = prev
+
+    def _append(self, link):
+        root = self._root
+        last = root[0]
+        link[0] = last
+        link[1] = root
+        last[1] = root[0] = link
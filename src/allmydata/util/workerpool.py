@@ -0,0 +1,59 @@
+from twisted.internet import reactor, threads
+from twisted.python.threadpool import ThreadPool
+
+# An upload normally encrypts, hashes, and erasure-codes each segment in the
+# reactor thread, which keeps one core busy and leaves the node slow to
+# answer anything else (such as web API requests) until the upload is done.
+# If [client]upload.encoding_threads is set, the Uploader hands that work to
+# a WorkerPool instead (see EncryptAnUploadable and the immutable Encoder).
+# SHA-256 (hashlib), zfec, and AES all spend most of their time in C, so the
+# workers can use more than one core.
+#
+# Whatever a worker runs must not log, or touch any state that the reactor
+# thread might be using at the same time: the callers do that part before
+# or after the work they hand over.
+
+def call_worker(pool, f, *args):
+    """Call f(*args) in one of the threads of WorkerPool 'pool' and return
+    a Deferred that fires (in the reactor thread) with its result, or, if
+    pool is None, call it right here and return its result. Use
+    allmydata.storage.diskio.when_done to handle either."""
+    if pool is None:
+        return f(*args)
+    return pool.call(f, *args)
+
+
+class WorkerPool:
+    """I run functions in up to 'threads' worker threads, which I start
+    when they are first needed."""
+
+    def __init__(self, threads, name="worker"):
+        assert threads > 0, threads
+        self.threads = threads
+        self.name = name
+        self._pool = None
+        self._shutdown_trigger = None
+
+    def call(self, f, *args):
+        """Call f(*args) in one of my threads. Return a Deferred that fires
+        (in the reactor thread) with its result."""
+        if self._pool is None:
+            self._pool = ThreadPool(0, self.threads, self.name)
+            self._pool.start()
+            # make sure the worker threads cannot keep the process alive
+            self._shutdown_trigger = reactor.addSystemEventTrigger(
+                "during", "shutdown", self.stop)
+        return threads.deferToThreadPool(reactor, self._pool, f, *args)
+
+    def stop(self):
+        """Wait for my threads to finish what they are doing, and stop them.
+        I can be used again afterwards."""
+        if self._shutdown_trigger is not None:
+            try:
+                reactor.removeSystemEventTrigger(self._shutdown_trigger)
+            except (ValueError, KeyError):
+                pass # we are being called by it
+            self._shutdown_trigger = None
+        if self._pool is not None:
+            self._pool.stop()
+            self._pool = None
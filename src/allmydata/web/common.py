@@ -14,6 +14,7 @@ from allmydata.interfaces import ExistingChildError, NoSuchChildError, \
      EmptyPathnameComponentError, MustBeDeepImmutableError, \
      MustBeReadonlyError, MustNotBeUnknownRWError, SDMF_VERSION, MDMF_VERSION
 from allmydata.mutable.common import UnrecoverableFileError
+from allmydata.immutable.upload import FileHandle
 from allmydata.util import abbreviate
 from allmydata.util.hashutil import timing_safe_compare
 from allmydata.util.time_format import format_time, format_delta
@@ -88,6 +89,23 @@ def get_mutable_type(file_format): # accepts result of get_format()
         return None
 
 
+def get_immutable_uploadable(req, client, filehandle):
+    """Return a FileHandle that uploads 'filehandle' (the body of 'req', or
+    a file from its form) as an immutable file. It is encrypted with a
+    convergent key, unless the request has convergent=false, in which case
+    it gets a random key, and is only read once. If 'filehandle' is the
+    body, and webish.MyRequest hashed it as it arrived, a convergent upload
+    only reads it once too."""
+    convergence = client.convergence
+    if not boolean_of_arg(get_arg(req, "convergent", "true")):
+        convergence = None
+    uploadable = FileHandle(filehandle, convergence=convergence)
+    key_hasher = getattr(req, "key_hasher", None)
+    if key_hasher is not None and filehandle is req.content:
+        uploadable.set_key_hasher(key_hasher)
+    return uploadable
+
+
 def parse_offset_arg(offset):
     # XXX: This will raise a ValueError when invoked on something that
     # is not an integer. Is that okay? Or do we want a better error
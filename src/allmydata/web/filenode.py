@@ -8,7 +8,6 @@ from nevow.inevow import IRequest
 
 from allmydata.interfaces import ExistingChildError
 from allmydata.monitor import Monitor
-from allmydata.immutable.upload import FileHandle
 from allmydata.mutable.publish import MutableFileHandle
 from allmydata.mutable.common import MODE_READ
 from allmydata.util import log, base32
@@ -18,7 +17,8 @@ from allmydata.blacklist import FileProhibited, ProhibitedNode
 from allmydata.web.common import text_plain, WebError, RenderMixin, \
      boolean_of_arg, get_arg, should_create_intermediate_directories, \
      MyExceptionHandler, parse_replace_arg, parse_offset_arg, \
-     get_format, get_mutable_type, get_filenode_metadata
+     get_format, get_mutable_type, get_filenode_metadata, \
+     get_immutable_uploadable
 from allmydata.web.check_results import CheckResultsRenderer, \
      CheckAndRepairResultsRenderer, LiteralCheckResultsRenderer
 from allmydata.web.info import MoreInfo
@@ -39,7 +39,7 @@ class ReplaceMeMixin:
             d.addCallback(_uploaded)
         else:
             assert file_format == "CHK"
-            uploadable = FileHandle(req.content, convergence=client.convergence)
+            uploadable = get_immutable_uploadable(req, client, req.content)
             d = self.parentnode.add_file(self.name, uploadable,
                                          overwrite=replace)
         def _done(filenode):
@@ -81,7 +81,7 @@ class ReplaceMeMixin:
             d.addCallback(_uploaded)
             return d
 
-        uploadable = FileHandle(contents.file, convergence=client.convergence)
+        uploadable = get_immutable_uploadable(req, client, contents.file)
         d = self.parentnode.add_file(self.name, uploadable, overwrite=replace)
         d.addCallback(lambda newnode: newnode.get_uri())
         return d
@@ -13,7 +13,8 @@ from allmydata.util import log
 from allmydata.interfaces import IFileNode
 from allmydata.web import filenode, directory, unlinked, status, operations
 from allmydata.web import storage
-from allmydata.web.common import abbreviate_size, getxmlfile, WebError, \
+from allmydata.web.common import abbreviate_size, abbreviate_time, \
+     abbreviate_rate, getxmlfile, WebError, \
      get_arg, RenderMixin, get_format, get_mutable_type, render_time_delta, render_time, render_time_attr
 
 
@@ -313,6 +314,9 @@ class Root(rend.Page):
             available_space = "N/A"
         else:
             available_space = abbreviate_size(available_space)
+        performance = server.get_performance()
+        rtt = abbreviate_time(performance.rtt) or "N/A"
+        throughput = abbreviate_rate(performance.throughput) or "N/A"
         ctx.fillSlots("address", addr)
         ctx.fillSlots("service_connection_status", service_connection_status)
         ctx.fillSlots("service_connection_status_alt", self._connectedalts[service_connection_status])
@@ -323,6 +327,8 @@ class Root(rend.Page):
         ctx.fillSlots("last_received_data_rel_time", last_received_data_rel_time)
         ctx.fillSlots("version", version)
         ctx.fillSlots("available_space", available_space)
+        ctx.fillSlots("rtt", rtt)
+        ctx.fillSlots("throughput", throughput)
 
         return ctx.tag
 
@@ -32,9 +32,25 @@ class StorageStatus(rend.Page):
              "bucket-counter": self.storage.bucket_counter.get_state(),
              "lease-checker": self.storage.lease_checker.get_state(),
              "lease-checker-progress": self.storage.lease_checker.get_progress(),
+             "latencies": self.get_latency_histograms(),
              }
+        if self.storage.scheduler is not None:
+            d["scheduler"] = self.storage.scheduler.get_client_stats()
         return simplejson.dumps(d, indent=1) + "\n"
 
+    def get_latency_histograms(self):
+        # the full histograms, as lists of [low, high, count], so that
+        # several servers' latencies can be combined
+        latencies = {}
+        for (window, cumulative) in [("window", False),
+                                     ("cumulative", True)]:
+            histograms = self.storage.get_latency_histograms(cumulative)
+            for (category, h) in histograms.items():
+                l = latencies.setdefault(category, {})
+                l[window] = h.summarize()
+                l[window]["buckets"] = h.get_buckets()
+        return latencies
+
     def data_nickname(self, ctx, storage):
         return self.nickname
     def data_nodeid(self, ctx, storage):
@@ -92,6 +108,53 @@ class StorageStatus(rend.Page):
         d.setdefault("disk_avail", None)
         return d
 
+    def render_allocated_by_client(self, ctx, storage):
+        stats = self.storage.get_stats()
+        by_client = {}
+        for (k, v) in stats.items():
+            which = remove_prefix(k, "storage_server.allocated_by_client.")
+            if which is not None:
+                by_client[which] = v
+        if not by_client:
+            return ctx.tag["Space reserved for uploads in progress: none"]
+        total = sum(by_client.values())
+        # the stats only name the clients with the most space reserved
+        others = by_client.pop("others", None)
+        clients = T.ul()
+        for (size, client_id) in sorted([(size, client_id) for (client_id, size)
+                                         in by_client.items()], reverse=True):
+            clients[T.li["%s: %s" % (client_id, abbreviate_space(size))]]
+        if others is not None:
+            clients[T.li["others: %s" % abbreviate_space(others)]]
+        return ctx.tag["Space reserved for uploads in progress: %s"
+                       " (by %d clients)" % (abbreviate_space(total),
+                                 stats["storage_server.allocated_clients"]),
+                       clients]
+
+    def render_scheduler(self, ctx, storage):
+        scheduler = self.storage.scheduler
+        if scheduler is None:
+            return ""
+        s = scheduler.get_stats()
+        clients = T.table()
+        clients[T.tr[T.th["Client"], T.th["Requests"], T.th["Bytes"],
+                     T.th["Throttled"], T.th["Queued"], T.th["Waited"]]]
+        by_client = scheduler.get_client_stats()
+        for client_id in sorted(by_client):
+            c = by_client[client_id]
+            clients[T.tr[T.td[client_id],
+                         T.td[str(c["requests"])],
+                         T.td[abbreviate_space(c["bytes"])],
+                         T.td[str(c["throttled"])],
+                         T.td[str(c["queued"])],
+                         T.td[abbreviate_time(c["wait"])]]]
+        return ctx.tag[T.h2["Client Scheduling"],
+                       T.ul[T.li["Requests in progress: %d, waiting: %d"
+                                 % (s["active"], s["queued"])],
+                            T.li["Requests made to wait so far: %d"
+                                 % s["throttled"]]],
+                       clients]
+
     def data_last_complete_bucket_count(self, ctx, data):
         s = self.storage.bucket_counter.get_state()
         count = s.get("last-complete-bucket-count")
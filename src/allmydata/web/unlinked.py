@@ -3,15 +3,15 @@ import urllib
 from twisted.web import http
 from twisted.internet import defer
 from nevow import rend, url, tags as T
-from allmydata.immutable.upload import FileHandle
 from allmydata.mutable.publish import MutableFileHandle
 from allmydata.web.common import getxmlfile, get_arg, boolean_of_arg, \
-     convert_children_json, WebError, get_format, get_mutable_type
+     convert_children_json, WebError, get_format, get_mutable_type, \
+     get_immutable_uploadable
 from allmydata.web import status
 
 def PUTUnlinkedCHK(req, client):
     # "PUT /uri", to create an unlinked file.
-    uploadable = FileHandle(req.content, client.convergence)
+    uploadable = get_immutable_uploadable(req, client, req.content)
     d = client.upload(uploadable)
     d.addCallback(lambda results: results.get_uri())
     # that fires with the URI of the new file
@@ -42,7 +42,7 @@ def PUTUnlinkedCreateDirectory(req, client):
 
 def POSTUnlinkedCHK(req, client):
     fileobj = req.fields["file"].file
-    uploadable = FileHandle(fileobj, client.convergence)
+    uploadable = get_immutable_uploadable(req, client, fileobj)
     d = client.upload(uploadable)
     when_done = get_arg(req, "when_done", None)
     if when_done:
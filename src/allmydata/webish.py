@@ -4,6 +4,7 @@ from twisted.web import http, static
 from twisted.internet import defer
 from nevow import appserver, inevow
 from allmydata.util import log, fileutil
+from allmydata.immutable.upload import ConvergentKeyHasher, Uploader
 
 from allmydata.web import introweb, root
 from allmydata.web.common import IOpHandleTable, MyExceptionHandler
@@ -16,9 +17,33 @@ from allmydata.web.common import IOpHandleTable, MyExceptionHandler
 # surgery may induce a dependency upon a particular version of twisted.web
 
 parse_qs = http.parse_qs
+
+# Twisted spools request bodies at least this large to a temporary file, so
+# an upload of one would otherwise read it from disk twice: once to compute
+# its convergent encryption key, and again to encrypt it.
+MIN_HASHED_BODY_SIZE = 100000
+
 class MyRequest(appserver.NevowRequest):
     fields = None
     _tahoe_request_had_error = None
+    key_hasher = None
+
+    def gotLength(self, length):
+        appserver.NevowRequest.gotLength(self, length)
+        # a large body that is not a form may be a file to upload (with
+        # PUT), so compute its encryption key as it arrives. See
+        # web.common.get_immutable_uploadable.
+        make_key_hasher = getattr(self.channel.site, "make_key_hasher", None)
+        ctype = self.getHeader("content-type") or ""
+        if (make_key_hasher and length is not None
+            and length >= MIN_HASHED_BODY_SIZE
+            and not ctype.startswith("multipart/form-data")):
+            self.key_hasher = make_key_hasher(length)
+
+    def handleContentChunk(self, data):
+        appserver.NevowRequest.handleContentChunk(self, data)
+        if self.key_hasher is not None:
+            self.key_hasher.update(data)
 
     def requestReceived(self, command, path, version):
         """Called by channel when all data has been received.
@@ -146,6 +171,7 @@ class WebishServer(service.MultiService):
         self.webport = webport
         self.site = site = appserver.NevowSite(self.root)
         self.site.requestFactory = MyRequest
+        self.site.make_key_hasher = self._make_key_hasher
         self.site.remember(MyExceptionHandler(), inevow.ICanHandleException)
         self.staticdir = staticdir # so tests can check
         if staticdir:
@@ -168,6 +194,13 @@ class WebishServer(service.MultiService):
                 fileutil.write_atomically(nodeurl_path, line, mode="")
             self._started.addCallback(_write_nodeurl_file)
 
+    def _make_key_hasher(self, length):
+        client = self.root.client
+        if length <= Uploader.URI_LIT_SIZE_THRESHOLD:
+            return None
+        return ConvergentKeyHasher(length, client.get_encoding_parameters(),
+                                   client.convergence)
+
     def getURL(self):
         assert self._url
         return self._url